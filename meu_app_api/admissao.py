@@ -0,0 +1,244 @@
+from collections import OrderedDict
+from flask import current_app, g, request
+import math
+import os
+import threading
+import time
+
+from logger import logger
+
+
+# configuração do controle de admissão, ajustável por variáveis de ambiente:
+# requisições simultâneas de cada classe de rota por processo, taxa por
+# segundo e rajada de cada cliente por classe, no formato 'classe=taxa/rajada',
+# e quanto uma requisição espera por uma vaga antes de ser recusada. Uma
+# classe fora das listas não tem o limite correspondente.
+ADMISSAO = os.environ.get("ADMISSAO", "1") != "0"
+ADMISSAO_CONCORRENCIA = os.environ.get("ADMISSAO_CONCORRENCIA", "pesada=2,login=4,escrita=4,leitura=8")
+ADMISSAO_TAXA = os.environ.get("ADMISSAO_TAXA", "pesada=5/10,login=2/5,escrita=20/40,leitura=50/100")
+ADMISSAO_ESPERA_MS = float(os.environ.get("ADMISSAO_ESPERA_MS", 250))
+# segundos sugeridos no Retry-After das recusas por falta de vaga
+ADMISSAO_RETRY_AFTER = int(os.environ.get("ADMISSAO_RETRY_AFTER", 1))
+# clientes lembrados por classe; os usados há mais tempo são esquecidos
+ADMISSAO_CLIENTES = int(os.environ.get("ADMISSAO_CLIENTES", 10000))
+# quantidade de proxies na frente da API: com N > 0 o cliente é o N-ésimo
+# endereço do X-Forwarded-For a partir do fim, o último que um proxy de
+# confiança acrescentou; os anteriores vêm do próprio cliente. Com 0 atrás
+# de um proxy, todos os clientes dividem o balde do endereço do proxy
+ADMISSAO_PROXY = int(os.environ.get("ADMISSAO_PROXY", 0))
+# campos do corpo JSON que identificam o usuario da requisição, além do IP,
+# separados por vírgula. Desligado por padrão: a API não autentica as
+# requisições, e qualquer um poderia esgotar o balde de outro usuario
+# enviando o email dele
+CAMPOS_USUARIO = tuple(campo.strip() for campo in os.environ.get("ADMISSAO_CAMPOS_USUARIO", "").split(",")
+                       if campo.strip())
+
+
+def le_limites(texto: str) -> dict:
+    """ Lê 'classe=valor,classe=valor' em {classe: valor}.
+    """
+    limites = {}
+    for item in texto.split(","):
+        if item.strip():
+            classe, valor = item.split("=", 1)
+            limites[classe.strip()] = valor.strip()
+    return limites
+
+
+def le_taxa(valor: str):
+    """ Lê 'taxa/rajada' em (fichas por segundo, capacidade do balde).
+    """
+    taxa, rajada = (float(parte) for parte in valor.split("/"))
+    if taxa <= 0 or rajada < 1:
+        raise ValueError("Taxa de admissão inválida: %s" % valor)
+    return taxa, rajada
+
+
+def admissao(classe: str):
+    """ Decorador que define a classe de admissão da rota.
+
+    Sem ele, as rotas marcadas com rota_leitura ou rota_escrita ficam nas
+    classes 'leitura' e 'escrita', e as demais não passam pelo controle.
+    """
+    def decorador(funcao):
+        funcao.classe_admissao = classe
+        return funcao
+    return decorador
+
+
+class LimiteTaxa:
+    """ Baldes de fichas por cliente, reabastecidos a 'taxa' por segundo até
+    'rajada' fichas.
+
+    Guarda no máximo 'clientes' baldes, esquecendo os usados há mais tempo;
+    um cliente esquecido volta com o balde cheio.
+    """
+
+    def __init__(self, taxa: float, rajada: float, clientes: int):
+        self.taxa = taxa
+        self.rajada = rajada
+        self.clientes = clientes
+        self._baldes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consome(self, cliente: str) -> float:
+        """ Consome uma ficha do cliente e retorna 0, ou, sem fichas, os
+            segundos até a próxima.
+        """
+        agora = time.monotonic()
+        with self._lock:
+            balde = self._baldes.pop(cliente, None)
+            fichas = self.rajada if balde is None else min(self.rajada, balde[0] + (agora - balde[1]) * self.taxa)
+            espera = 0.0
+            if fichas >= 1:
+                fichas -= 1
+            else:
+                espera = (1 - fichas) / self.taxa
+            self._baldes[cliente] = (fichas, agora)
+            if len(self._baldes) > self.clientes:
+                self._baldes.popitem(last=False)
+        return espera
+
+
+class ControleAdmissao:
+    """ Decide, antes da rota, se a requisição é atendida.
+
+    Cada classe de rota tem um número de vagas por processo: sem vaga, a
+    requisição espera até 'espera_ms' e então é recusada com 503, em vez de
+    ficar na fila dos locks do SQLite até o cliente desistir. Antes disso os
+    clientes da requisição, o IP e, se configurado, o usuario, gastam uma
+    ficha dos seus baldes na classe, e sem ficha a resposta é 429. As duas
+    respostas trazem o Retry-After.
+    """
+
+    def __init__(self, concorrencia: dict, taxas: dict, espera_ms: float, retry_after: int, clientes: int):
+        self.vagas = {classe: threading.BoundedSemaphore(vagas) for classe, vagas in concorrencia.items()}
+        self.taxas = {classe: LimiteTaxa(taxa, rajada, clientes) for classe, (taxa, rajada) in taxas.items()}
+        self.espera = espera_ms / 1000
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        # (classe, motivo) -> requisições recusadas
+        self.rejeicoes = {}
+
+    def estatisticas(self) -> dict:
+        """ Retorna as recusas deste processo por classe e motivo.
+        """
+        with self._lock:
+            return {(("classe", classe), ("motivo", motivo)): valor
+                    for (classe, motivo), valor in self.rejeicoes.items()}
+
+    def _recusa(self, classe: str, motivo: str, status: int, retry_after: float):
+        with self._lock:
+            self.rejeicoes[(classe, motivo)] = self.rejeicoes.get((classe, motivo), 0) + 1
+        logger.warning("Requisição recusada (%s, %s): %s %s", classe, motivo, request.method, request.path)
+        if status == 429:
+            mensagem = "Muitas requisições, tente novamente em instantes."
+        else:
+            mensagem = "O servidor está sobrecarregado, tente novamente."
+        return {"mesage": mensagem}, status, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+    def admite(self, classe: str, clientes):
+        """ Reserva a vaga da requisição, ou retorna a resposta de recusa.
+
+        A vaga reservada fica em 'g' até ser devolvida ao fim da requisição.
+        """
+        # o proxy informa quando recebeu a requisição; se ela já esperou
+        # mais que o limite na fila do servidor, a resposta não chega a tempo
+        inicio = request.headers.get("X-Request-Start", "").replace("t=", "")
+        try:
+            if inicio and time.time() - float(inicio) > self.espera:
+                return self._recusa(classe, "fila", 503, self.retry_after)
+        except ValueError:
+            pass
+
+        limite = self.taxas.get(classe)
+        if limite is not None:
+            espera = max(limite.consome(cliente) for cliente in clientes)
+            if espera:
+                return self._recusa(classe, "taxa", 429, espera)
+
+        vagas = self.vagas.get(classe)
+        if vagas is not None:
+            if not vagas.acquire(timeout=self.espera):
+                return self._recusa(classe, "concorrencia", 503, self.retry_after)
+            g.vaga_admissao = vagas
+        return None
+
+
+_avisou_proxy = False
+
+
+def endereco_do_cliente() -> str:
+    """ Retorna o endereço do cliente, considerando os ADMISSAO_PROXY
+        proxies na frente da API.
+    """
+    global _avisou_proxy
+    encaminhado = [e.strip() for e in request.headers.get("X-Forwarded-For", "").split(",") if e.strip()]
+    if ADMISSAO_PROXY:
+        # um X-Forwarded-For mais curto que o esperado não passou por todos
+        # os proxies, e o endereço da conexão é o único confiável
+        if len(encaminhado) >= ADMISSAO_PROXY:
+            return encaminhado[-ADMISSAO_PROXY]
+    elif encaminhado and not _avisou_proxy:
+        _avisou_proxy = True
+        logger.warning("Requisição com X-Forwarded-For e ADMISSAO_PROXY=0: os limites por IP valem para o "
+                       "endereço %s, e não para cada cliente", request.remote_addr)
+    return request.remote_addr
+
+
+def clientes_da_requisicao():
+    """ Retorna os clientes que gastam fichas: o IP e, se ADMISSAO_CAMPOS_USUARIO
+        estiver definida e o corpo JSON identificar um usuario, o usuario.
+    """
+    clientes = ["ip:%s" % endereco_do_cliente()]
+    if not CAMPOS_USUARIO:
+        return clientes
+    dados = request.get_json(silent=True)
+    if isinstance(dados, dict):
+        for campo in CAMPOS_USUARIO:
+            if dados.get(campo) is not None:
+                clientes.append("usuario:%s" % dados[campo])
+                break
+    return clientes
+
+
+def cria_controle() -> ControleAdmissao:
+    """ Cria o controle de admissão configurado pelas variáveis de ambiente.
+    """
+    concorrencia = {classe: int(valor) for classe, valor in le_limites(ADMISSAO_CONCORRENCIA).items()}
+    taxas = {classe: le_taxa(valor) for classe, valor in le_limites(ADMISSAO_TAXA).items()}
+    return ControleAdmissao(concorrencia, taxas, ADMISSAO_ESPERA_MS, ADMISSAO_RETRY_AFTER, ADMISSAO_CLIENTES)
+
+
+controle = cria_controle()
+
+
+def _admite():
+    funcao = current_app.view_functions.get(request.endpoint)
+    classe = getattr(funcao, "classe_admissao", None) or getattr(funcao, "modo_sessao", None)
+    if classe is not None:
+        return controle.admite(classe, clientes_da_requisicao())
+
+
+def _libera_ao_fim_da_resposta(response):
+    # uma resposta em streaming continua lendo o banco depois da rota, então
+    # a vaga só é devolvida quando o servidor termina de enviá-la
+    if response.is_streamed and "vaga_admissao" in g:
+        response.call_on_close(g.pop("vaga_admissao").release)
+    return response
+
+
+def _libera(exception=None):
+    vagas = g.pop("vaga_admissao", None)
+    if vagas is not None:
+        vagas.release()
+
+
+def controla_admissao(app):
+    """ Registra no app os hooks do controle de admissão, se ADMISSAO.
+    """
+    if not ADMISSAO:
+        return
+    app.before_request(_admite)
+    app.after_request(_libera_ao_fim_da_resposta)
+    app.teardown_request(_libera)
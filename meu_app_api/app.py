@@ -1,36 +1,201 @@
-from flask_openapi3 import OpenAPI, Info, Tag
-from flask import redirect, request
+from flask_openapi3 import OpenAPI, APIBlueprint, Info, Tag
+from flask import current_app, redirect, request, Response, send_file
+from flask.cli import with_appcontext
 from urllib.parse import unquote
+from operator import attrgetter
+import json
+import os
 
+from sqlalchemy import create_engine, select
 from sqlalchemy.exc import IntegrityError
+from pydantic import ValidationError
+from datetime import date, datetime, timedelta
 
-from model import Session, Usuario, Historico
-from logger import logger
+from model import Session, session_factory, rota_leitura, rota_escrita, MODO_SESSAO, SHARD, Usuario, Historico, interpreta_score, \
+                  carrega_pontuacoes, junta_pontuacoes, calcula_estatisticas, Ranking, atualiza_ranking, \
+                  reconstroi_ranking, consulta_ranking, posicao_no_ranking, obtem_engine, inicializa_bancos, \
+                  le_usuarios, le_usuario_por_nome, le_usuario_por_id, le_credenciais_por_email, le_historicos_por_categoria, \
+                  chave_categoria, busca_usuarios, busca_categorias, junta_categorias, reconstroi_busca, CANDIDATOS_BUSCA, \
+                  atualiza_serie, reconstroi_serie, consulta_serie, soma_series, le_tabela_exportacao, \
+                  tabelas_exportacao, chave_exportacao, estado_exportacao, \
+                  arquiva_historicos, limite_arquivamento, ARQUIVO_DIAS, ARQUIVO_LOTE, ARQUIVO_PAUSA_MS, \
+                  DB_SHARDS, engines_dos_shards, engine_diretorio, shard_do_usuario, sessao_do_usuario, \
+                  reserva_id_usuario, renomeia_no_diretorio, remove_do_diretorio, numera_historicos, em_cada_shard, \
+                  sessoes_de_leitura, intercala, reparte, diretorio, le_versao_listagem, le_versao_usuario, \
+                  le_versao_atual, inicia_versao, arquivos_dos_bancos, versao_mais_recente, emails_registrados, \
+                  le_emails_duplicados, email_substituto, FiltroUsuarios, USUARIOS_LOTE, USUARIOS_PAUSA_MS, \
+                  ORFAOS_LOTE, ORFAOS_PAUSA_MS, em_transacao, remove_usuarios, atualiza_usuarios, valida_valores, \
+                  prepara_remocao, remove_orfaos, CAMPOS_LOTE
+from logger import logger, inicia_logging
+from cache import cache, chave_usuario_nome, chave_usuario_email, chaves_usuario
+from escritor import escritor, EscritaRecusada
+from filtro_emails import filtro_emails, EMAILS_FILTRO
+from backup import agendador, faz_backup, restaura_backup, BackupEmAndamento, BackupInvalido, \
+                   BACKUP_DIR, BACKUP_PAGINAS, BACKUP_PAUSA_MS, BACKUP_REINICIOS, BACKUP_NIVEL, BACKUP_RETENCAO, \
+                   BACKUP_INTERVALO
+from admissao import admissao, controla_admissao, controle, ADMISSAO_RETRY_AFTER
+from metricas import instrumenta_app, exporta_prometheus, registro
+from resposta import le_campos, filtra_campos, etag_versao, cabecalhos_etag, nao_modificado, \
+                     resposta_nao_modificada, comprime_respostas
+from exportacao import FORMATOS, COMPRESSOES, EXPORTACAO_LOTE, gera_exportacao, etag_exportacao, \
+                       arquivo_exportacao
 from schemas import *
 from flask_cors import CORS
-from schemas.historico import CategoriaBuscaHistoricoSchema, apresenta_historico, apresenta_historicos
+import click
+from schemas.historico import CategoriaBuscaHistoricoSchema, HistoricoLoteViewSchema, apresenta_historico, \
+                              apresenta_historicos, apresenta_resultado_lote, SerieBuscaSchema, \
+                              SerieViewSchema, apresenta_serie, ExportacaoBuscaSchema
 
-from schemas.usuario import HistoricoViewSchema, UsuarioBuscaHistoricoSchema, UsuarioBuscaLoginSchema, UsuarioSchemaUpdate, apresenta_login 
+from schemas.usuario import HistoricoViewSchema, UsuarioBuscaHistoricoSchema, UsuarioBuscaLoginSchema, UsuarioSchemaUpdate, apresenta_login, \
+                            apresenta_credenciais, apresenta_login_credenciais, UsuarioBuscaEmailSchema, \
+                            DisponibilidadeEmailSchema, apresenta_disponibilidade, UsuarioLoteExclusaoSchema, \
+                            UsuarioLoteAtualizacaoSchema, UsuarioLoteViewSchema, apresenta_lote_usuarios
 
 info = Info(title="Controle de Usuario", version="1.0.0")
-app = OpenAPI(__name__, info=info)
-CORS(app)
+# rotas da API, registradas em cada app criado por create_app
+api = APIBlueprint("api", __name__)
+registro.adiciona_contadores(
+    "cache_operacoes_total", "Acertos, faltas e remoções do cache de usuários.",
+    lambda: {(("tipo", tipo),): valor for tipo, valor in cache.estatisticas().items()})
+registro.adiciona_contadores(
+    "escritas_total", "Transações gravadas e escritas das rotas gravadas nelas.",
+    lambda: {(("tipo", tipo),): valor for tipo, valor in escritor.estatisticas().items()})
+registro.adiciona_contadores(
+    "filtro_emails_total", "Respostas do filtro de emails deste processo e emails guardados nele.",
+    lambda: {(("tipo", tipo),): valor for tipo, valor in filtro_emails.estatisticas().items()})
+registro.adiciona_contadores(
+    "admissao_rejeicoes_total", "Requisições recusadas pelo controle de admissão, por classe de rota e motivo.",
+    controle.estatisticas)
 
 # definindo tags
 home_tag = Tag(name="Documentação", description="Seleção de documentação: Swagger, Redoc ou RapiDoc")
 usuario_tag = Tag(name="Usuario", description="Adição, visualização e remoção de registros de usuario à base")
 historico_tag = Tag(name="Historico", description="Adição de um histórico à um registro de usuario cadastrado na base")
+ranking_tag = Tag(name="Ranking", description="Ranking dos usuarios por categoria")
+metrica_tag = Tag(name="Metricas", description="Métricas de desempenho da API no formato do Prometheus")
+estatistica_tag = Tag(name="Estatistica", description="Estatísticas de pontuação dos históricos por categoria")
+busca_tag = Tag(name="Busca", description="Busca textual de usuarios e categorias")
 
+# tamanho das páginas da listagem de usuários
+LIMITE_PADRAO_LISTAGEM = 100
+LIMITE_MAXIMO_LISTAGEM = 1000
+# quantidade de linhas buscadas por vez do banco na listagem em streaming
+LOTE_STREAMING = 1000
+# quantidade máxima de registros aceitos em um lote de históricos
+LIMITE_LOTE_HISTORICOS = 5000
+# quantidade máxima de ids aceitos nas operações em lote de usuarios
+LIMITE_LOTE_USUARIOS = 5000
+# quantidade máxima de posições retornadas pelo ranking
+LIMITE_MAXIMO_RANKING = 100
+# tamanho das páginas das buscas textuais
+LIMITE_PADRAO_BUSCA = 20
+LIMITE_MAXIMO_BUSCA = 100
+# período padrão e período máximo da série de históricos, em dias
+DIAS_PADRAO_SERIE = 90
+DIAS_MAXIMO_SERIE = 366
 
-@app.get('/', tags=[home_tag])
+
+def create_app(config: dict = None) -> OpenAPI:
+    """Cria o app com as rotas, os hooks de métricas e os comandos de manutenção
+
+    Nada aqui acessa o banco: a engine é criada e o esquema preparado na
+    primeira requisição, ou antes pelo comando 'flask init-db'. Assim o app
+    pode ser carregado pelo '--preload' do gunicorn antes do fork dos workers.
+    Os logs são configurados aqui na primeira chamada do processo.
+    As chaves DB_URL e DB_INICIALIZA de 'config' substituem as variáveis de
+    ambiente de mesmo nome.
+    """
+    inicia_logging()
+    app = OpenAPI(__name__, info=info)
+    app.config.from_mapping(DB_URL=None, DB_INICIALIZA=None)
+    if config:
+        app.config.from_mapping(config)
+    CORS(app)
+    instrumenta_app(app)
+    # as recusas são medidas, mas não chegam a abrir conexão com o banco
+    controla_admissao(app)
+    comprime_respostas(app)
+    app.before_request(conecta_banco)
+    if EMAILS_FILTRO:
+        app.before_request(aquece_filtro_emails)
+    if BACKUP_INTERVALO:
+        app.before_request(agenda_backups)
+    app.teardown_appcontext(remove_sessao)
+    app.register_api(api)
+    app.register_error_handler(EscritaRecusada, escrita_recusada)
+    app.cli.add_command(init_db)
+    app.cli.add_command(rebuild_ranking)
+    app.cli.add_command(rebuild_search)
+    app.cli.add_command(rebuild_serie)
+    app.cli.add_command(export_historicos)
+    app.cli.add_command(archive_historicos)
+    app.cli.add_command(reshard_db)
+    app.cli.add_command(backup_db)
+    app.cli.add_command(restore_db)
+    app.cli.add_command(report_emails)
+    app.cli.add_command(delete_usuarios)
+    app.cli.add_command(update_usuarios)
+    app.cli.add_command(purge_orfaos)
+    return app
+
+
+def engine_do_app():
+    """Retorna a engine do processo, criada com a configuração do app corrente.
+    """
+    return obtem_engine(current_app.config["DB_URL"], current_app.config["DB_INICIALIZA"])
+
+
+def conecta_banco():
+    """Garante que a engine existe antes de a requisição abrir uma sessão.
+    """
+    engine_do_app()
+
+
+def aquece_filtro_emails():
+    """Inicia, na primeira requisição de cada worker, o aquecimento do filtro de emails.
+    """
+    filtro_emails.inicia(emails_registrados)
+
+
+def agenda_backups():
+    """Inicia, na primeira requisição de cada worker, os backups agendados.
+    """
+    agendador.inicia(arquivos_dos_bancos(current_app.config["DB_URL"]))
+
+
+def remove_sessao(exception=None):
+    """Descarta a sessão da requisição, devolvendo a conexão ao pool.
+    """
+    Session.remove()
+
+
+def escrita_recusada(e):
+    """Responde às escritas que não entraram na fila do escritor a tempo.
+    """
+    logger.warning("Escrita recusada: %s", e)
+    return {"mesage": "O servidor está sobrecarregado, tente novamente."}, 503, \
+           {"Retry-After": str(ADMISSAO_RETRY_AFTER)}
+
+
+@api.get('/', tags=[home_tag])
 def home():
     """Redireciona para /openapi, tela que permite a escolha do estilo de documentação.
     """
     return redirect('/openapi')
 
 
-@app.post('/usuario', tags=[usuario_tag],
+@api.get('/metrics', tags=[metrica_tag])
+def get_metricas():
+    """Exporta as métricas de latência por rota, comandos SQL e cache
+
+    Retorna as métricas deste processo no formato de texto do Prometheus.
+    """
+    return Response(exporta_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@api.post('/usuario', tags=[usuario_tag],
           responses={"200": UsuarioViewSchema, "409": ErrorSchema, "400": ErrorSchema})
+@rota_escrita
 def add_usuario():
     """Adiciona um novo registro de usuario à base de dados
 
@@ -47,78 +212,198 @@ def add_usuario():
         cidade=data['cidade'],
         estado=data['estado']
     )
-    try:
-        # criando conexão com a base
-        session = Session()
+
+    def insere(session):
         # adicionando registro de usuario
         session.add(usuario)
+        session.flush()
+        # a representação e as chaves são lidas antes do commit, que expira o objeto
+        return apresenta_usuario(usuario), chaves_usuario(usuario.id, nomes=[usuario.nome], emails=[usuario.email])
+
+    try:
+        # com shards o id vem do diretório, e define o shard do usuario; o
+        # índice único de emails do diretório recusa o email de outro shard
+        usuario.id = reserva_id_usuario(usuario.nome, usuario.email)
         # efetivando o camando de adição de novo item na tabela
-        session.commit()  
-        return {"message": "Usuário adicionado com sucesso!", "usuario": apresenta_usuario(usuario)}, 200
+        payload, chaves = escritor.executa(insere, shard_do_usuario(usuario.id))
+        # um usuario de mesmo nome ou email pode mudar o resultado dessas buscas
+        cache.invalida(*chaves)
+        filtro_emails.adiciona(data["email"])
+        return {"message": "Usuário adicionado com sucesso!", "usuario": payload}, 200
 
 
     except IntegrityError as e:
-        # como a duplicidade do nome é a provável razão do IntegrityError
+        # o índice único de emails é a razão do IntegrityError
         error_msg = "Registro de usuário de mesmo email já salvo na base :/"
-        logger.warning(f"Erro ao adicionar registro de usuário '{usuario.email}', {error_msg}")
+        logger.warning("Erro ao adicionar registro de usuário '%s', %s", usuario.email, error_msg)
+        remove_do_diretorio(usuario.id)
         return {"mesage": error_msg}, 409
 
     except Exception as e:
-        logger.error(f"Erro ao adicionar registro de usuario: {e}")
+        logger.error("Erro ao adicionar registro de usuario: %s", e)
+        remove_do_diretorio(usuario.id)
         return {"mesage": "Ocorreu um erro ao adicionar o usuário."}, 400
 
 
 
-@app.get('/usuarios', tags=[usuario_tag],
-         responses={"200": ListagemUsuarioSchema, "404": ErrorSchema})
-def get_usuarios():
-    """Faz a busca por todos os registros de usuario cadastrados
+@api.get('/usuarios', tags=[usuario_tag],
+         responses={"200": ListagemUsuarioSchema, "400": ErrorSchema})
+@admissao("pesada")
+@rota_leitura
+def get_usuarios(query: UsuarioListagemBuscaSchema):
+    """Faz a busca paginada dos registros de usuario cadastrados
 
-    Retorna uma representação da listagem de registros de usuario.
+    Retorna uma representação da listagem de registros de usuario e o cursor
+    da próxima página. Com formato 'ndjson' os registros são enviados em
+    streaming, um por linha. O ETag muda quando algum usuario é inserido,
+    alterado ou removido; com ele no If-None-Match a resposta é 304.
     """
-    logger.debug(f"Coletando registros de usuario ")
-    # criando conexão com a base
-    session = Session()
-    # fazendo a busca
-    usuarios = session.query(Usuario).all()
+    after = query.after or 0
+    if query.formato not in ("json", "ndjson"):
+        return {"mesage": "Formato de listagem inválido, use 'json' ou 'ndjson'."}, 400
+    if query.limit is not None and query.limit < 1:
+        # um limite negativo chegaria ao SQLite como LIMIT -1, sem limite
+        return {"mesage": "Limite da listagem inválido, use um inteiro a partir de 1."}, 400
+    try:
+        campos = le_campos(query.fields, CAMPOS_USUARIO_LISTAGEM)
+    except ValueError as e:
+        return {"mesage": str(e)}, 400
+    limit = query.limit
+    if query.formato == "json":
+        limit = min(query.limit or LIMITE_PADRAO_LISTAGEM, LIMITE_MAXIMO_LISTAGEM)
 
-    if not usuarios:
-        # se não há usuarios cadastrados
-        return {"usuários": []}, 200
-    else:
-        logger.debug(f"%d usuários econtrados" % len(usuarios))
-        # retorna a representação de registro de usuario
-        print(usuarios)
-        return apresenta_usuarios(usuarios), 200
+    # a versão é lida antes dos registros: uma escrita entre as duas leituras
+    # só faz o cliente receber de novo a mesma página na próxima requisição
+    etag = etag_versao("usuarios", tuple(em_cada_shard(le_versao_listagem)), query.formato, after, limit, campos)
+    if nao_modificado(etag):
+        logger.debug("Listagem de usuarios não modificada: %s", etag)
+        return resposta_nao_modificada(etag)
+
+    if query.formato == "ndjson":
+        logger.debug("Enviando registros de usuario em streaming a partir de #%d", after)
+        return Response(gera_usuarios_ndjson(after, limit, campos), mimetype="application/x-ndjson",
+                        headers=cabecalhos_etag(etag))
+
+    logger.debug("Coletando até %d registros de usuario a partir de #%d", limit, after)
+    # fazendo a busca por cursor em cada shard: um registro a mais indica que há próxima página
+    partes = em_cada_shard(lambda session: le_usuarios(session, after, limit + 1))
+    usuarios = list(intercala(partes, attrgetter("id"), limit + 1))
+
+    next_cursor = None
+    if len(usuarios) > limit:
+        usuarios = usuarios[:limit]
+        next_cursor = usuarios[-1].id
+
+    logger.debug("%d usuários econtrados", len(usuarios))
+    # retorna a representação de registro de usuario
+    payload = apresenta_usuarios(usuarios, next_cursor)
+    payload["usuarios"] = [filtra_campos(usuario, campos) for usuario in payload["usuarios"]]
+    return payload, 200, cabecalhos_etag(etag)
+
+
+def gera_usuarios_ndjson(after, limit=None, campos=None):
+    """Gera a listagem de usuários em NDJSON, buscando os registros em lotes
+
+    As sessões são próprias do gerador, e não a da requisição, pois ele
+    continua sendo consumido depois que a sessão da requisição já foi
+    descartada. Os shards são lidos juntos, intercalados pelo id.
+    """
+    sessoes = sessoes_de_leitura()
+    try:
+        partes = [le_usuarios(session, after, limit, lote=LOTE_STREAMING) for session in sessoes]
+        for usuario in intercala(partes, attrgetter("id"), limit):
+            yield json.dumps(filtra_campos(apresenta_usuario_listagem(usuario), campos)) + "\n"
+    finally:
+        for session in sessoes:
+            session.close()
 
 
-@app.get('/usuario', tags=[usuario_tag],
+@api.get('/usuario', tags=[usuario_tag],
          responses={"200": UsuarioViewSchema, "404": ErrorSchema})
+@rota_leitura
 def get_usuario(query: UsuarioBuscaSchema):
     """Faz a busca por um registro de usuario a partir do nome do usuario
 
-    Retorna uma representação dos registros de usuario e históricos associados.
+    Retorna uma representação dos registros de usuario e históricos associados,
+    incluindo os históricos arquivados com historico_completo. O ETag muda
+    a cada alteração do usuario ou dos seus históricos; com ele no
+    If-None-Match a resposta é 304.
     """
     usuario_nome = query.nome
-    logger.debug(f"Coletando dados sobre usuario #{usuario_nome}")
-    # criando conexão com a base
-    session = Session()
+    logger.debug("Coletando dados sobre usuario #%s", usuario_nome)
+    return busca_usuario_por_nome(usuario_nome, bool(query.historico_completo), query.fields)
+
+
+def busca_usuario_por_nome(usuario_nome, completo=False, fields=None):
+    """Busca a representação de um usuario pelo nome, passando pelo cache
+
+    Compartilhada pelas rotas /usuario e /por-usuario, que retornam o mesmo payload.
+    O cache guarda só os payloads completos sem os históricos arquivados, que
+    são raros, junto com a versão do usuario. Uma revalidação com If-None-Match
+    lê só a versão, e os históricos só são lidos se estiverem em 'fields'.
+    """
+    try:
+        campos = le_campos(fields, CAMPOS_USUARIO_VIEW)
+    except ValueError as e:
+        return {"mesage": str(e)}, 400
+    chave = chave_usuario_nome(usuario_nome)
+    guardado = None if completo else cache.get(chave)
+    # o cache em SQLite pode ter payloads gravados antes da versão no cache
+    if guardado is not None and isinstance(guardado, tuple):
+        logger.debug("Registro de usuário encontrado no cache: '%s'", usuario_nome)
+        usuario_id, versao, payload = guardado
+        return responde_usuario(payload, usuario_id, versao, completo, campos)
+
+    # lida antes do banco, para não guardar um payload que uma escrita
+    # invalidou durante a leitura
+    geracao = cache.geracao(chave)
+    # criando conexão com a base do usuario
+    session = sessao_do_usuario(nome=usuario_nome)
+    if session is not None and request.if_none_match:
+        atual = le_versao_usuario(session, usuario_nome)
+        if atual is not None:
+            etag = etag_usuario(atual.id, atual.versao, completo, campos)
+            if nao_modificado(etag):
+                logger.debug("Registro de usuário não modificado: '%s'", usuario_nome)
+                return resposta_nao_modificada(etag)
     # fazendo a buscaPrata
-    usuario = session.query(Usuario).filter(Usuario.nome == usuario_nome).first()
+    com_historicos = campos is None or "historicos" in campos
+    usuario = le_usuario_por_nome(session, usuario_nome, completo, com_historicos) if session is not None else None
 
     if not usuario:
         # se o registro de usuario não foi encontrado
         error_msg = "Registro de usuario não encontrado na base :/"
-        logger.warning(f"Erro ao buscar usuário '{usuario_nome}', {error_msg}")
+        logger.warning("Erro ao buscar usuário '%s', %s", usuario_nome, error_msg)
         return {"mesage": error_msg}, 404
     else:
-        logger.debug(f"Registro de usuário econtrado: '{usuario.nome}'")
+        logger.debug("Registro de usuário econtrado: '%s'", usuario.nome)
+        payload = apresenta_usuario(usuario)
+        if not completo and com_historicos:
+            cache.set(chave, (usuario.id, usuario.versao, payload), geracao)
         # retorna a representação de registro de usuario
-        return apresenta_usuario(usuario), 200
+        return responde_usuario(payload, usuario.id, usuario.versao, completo, campos)
+
+
+def etag_usuario(usuario_id, versao, completo, campos):
+    """Monta o ETag da representação de um usuario
+    """
+    return etag_versao("usuario", (usuario_id, versao), completo, campos)
+
+
+def responde_usuario(payload, usuario_id, versao, completo, campos):
+    """Responde com os campos pedidos do usuario e o ETag, ou com 304 se o
+    cliente já tem essa versão
+    """
+    etag = etag_usuario(usuario_id, versao, completo, campos)
+    if nao_modificado(etag):
+        return resposta_nao_modificada(etag)
+    return filtra_campos(payload, campos), 200, cabecalhos_etag(etag)
     
 
-@app.post('/login', tags=[usuario_tag],
+@api.post('/login', tags=[usuario_tag],
          responses={"200": UsuarioViewSchema, "403": ErrorSchema, "404": ErrorSchema})
+@admissao("login")
+@rota_leitura
 def get_login():
     """Faz a busca por um registro de usuario a partir do email do usuario
 
@@ -128,29 +413,59 @@ def get_login():
     usuario_email = data['email']
     usuario_senha = data['senha']
     
-    logger.debug(f"Coletando dados sobre usuario #{usuario_email}")
-    # criando conexão com a base
-    session = Session()
-    # fazendo a buscaPrata
-    usuario = session.query(Usuario).filter(Usuario.email == usuario_email).first()
-
-    if not usuario:
-        # se o registro de usuario não foi encontrado
+    logger.debug("Coletando dados sobre usuario #%s", usuario_email)
+    if not filtro_emails.pode_existir(usuario_email):
+        # o filtro garante que o email não está cadastrado, sem consultar o banco
         error_msg = "Registro de usuario não encontrado na base :/"
-        logger.warning(f"Erro ao buscar usuário '{usuario_email}', {error_msg}")
+        logger.warning("Erro ao buscar usuário '%s', %s", usuario_email, error_msg)
         return {"mesage": error_msg}, 404
+    chave = chave_usuario_email(usuario_email)
+    credenciais = cache.get(chave)
+
+    if credenciais is None:
+        geracao = cache.geracao(chave)
+        # criando conexão com a base do usuario
+        session = sessao_do_usuario(email=usuario_email)
+        # fazendo a buscaPrata
+        usuario = le_credenciais_por_email(session, usuario_email) if session is not None else None
+
+        if not usuario:
+            # se o registro de usuario não foi encontrado
+            error_msg = "Registro de usuario não encontrado na base :/"
+            logger.warning("Erro ao buscar usuário '%s', %s", usuario_email, error_msg)
+            return {"mesage": error_msg}, 404
+        credenciais = apresenta_credenciais(usuario)
+        cache.set(chave, credenciais, geracao)
+
+    logger.debug("Registro de usuário econtrado: '%s'", credenciais["nome"])
+    if credenciais["senha"] == usuario_senha:
+        # retorna a representação de registro de usuario
+        return apresenta_login_credenciais(credenciais), 200
     else:
-        logger.debug(f"Registro de usuário econtrado: '{usuario.nome}'")
-        if usuario.senha == usuario_senha:
-            # retorna a representação de registro de usuario
-            return apresenta_login(usuario), 200
-        else:
-            error_msg = "Senha incorreta para este usuário :/"
-            return {"mesage": error_msg}, 403
+        error_msg = "Senha incorreta para este usuário :/"
+        return {"mesage": error_msg}, 403
+
+
+@api.get('/usuario/disponibilidade', tags=[usuario_tag],
+         responses={"200": DisponibilidadeEmailSchema})
+@admissao("login")
+@rota_leitura
+def get_disponibilidade(query: UsuarioBuscaEmailSchema):
+    """Informa se um email ainda pode ser usado em um novo cadastro
+
+    Os emails fora do filtro de emails são respondidos sem consultar o banco.
+    """
+    email = query.email
+    if not filtro_emails.pode_existir(email):
+        return apresenta_disponibilidade(email, True), 200
+    session = sessao_do_usuario(email=email)
+    cadastrado = session is not None and le_credenciais_por_email(session, email) is not None
+    return apresenta_disponibilidade(email, not cadastrado), 200
 
 
-@app.delete('/usuario', tags=[usuario_tag],
+@api.delete('/usuario', tags=[usuario_tag],
             responses={"200": UsuarioDelSchema, "404": ErrorSchema})
+@rota_escrita
 def del_usuario():
     """Deleta um registro de usuario a partir do id de usuario informado
 
@@ -159,32 +474,46 @@ def del_usuario():
     data = request.json
     usuario_id = data['id']
 
-    logger.debug(f"Deletando dados sobre registros de usuario #{usuario_id}")
-    # criando conexão com a base
-    session = Session()
-    # fazendo a remoção
+    logger.debug("Deletando dados sobre registros de usuario #%s", usuario_id)
+    # criando conexão com a base do usuario
+    session = sessao_do_usuario(usuario_id)
+    # nome e email identificam as entradas do usuario no cache
+    removidos = session.query(Usuario.nome, Usuario.email).filter(Usuario.id == usuario_id).all()
+    chaves = [chaves_usuario(usuario_id, nomes=[nome], emails=[email]) for nome, email in removidos]
+    # fazendo a remoção: os históricos e o ranking saem pelo ON DELETE
+    # CASCADE, e antes dela os arquivados, sem chave estrangeira, são
+    # removidos e os históricos são descontados do resumo diário
+    session.usa_escrita()
+    if removidos:
+        prepara_remocao(session, "usuario = :usuario", {"usuario": usuario_id})
     count = session.query(Usuario).filter(Usuario.id == usuario_id).delete()
     session.commit()
+    for chaves_removidas in chaves:
+        cache.invalida(*chaves_removidas)
+    for _, email in removidos:
+        filtro_emails.remove(email)
 
     if count:
+        remove_do_diretorio(usuario_id)
         # retorna a representação da mensagem de confirmação
-        logger.debug(f"Deletado registros de usuario #{usuario_id}")
+        logger.debug("Deletado registros de usuario #%s", usuario_id)
         return {"mesage": "Registro de usuario removido", "id": usuario_id}
     else:
         # se o registro de usuario não foi encontrado
         error_msg = "Registro de usuario não encontrado na base :/"
-        logger.warning(f"Erro ao deletar registro de usuario #'{usuario_id}', {error_msg}")
+        logger.warning("Erro ao deletar registro de usuario #'%s', %s", usuario_id, error_msg)
         return {"mesage": error_msg}, 404
 
-@app.put('/usuario', tags=[usuario_tag], responses={"200": UsuarioViewSchema, "404": ErrorSchema, "400": ErrorSchema})
+@api.put('/usuario', tags=[usuario_tag], responses={"200": UsuarioViewSchema, "404": ErrorSchema, "400": ErrorSchema})
+@rota_escrita
 def update_usuario():
     """Atualiza os detalhes de um usuário baseado em seu ID."""
     # Dados enviados no pedido.
     data = request.json
     usuario_id = data['id']
     
-    # Criando uma sessão para se comunicar com o banco de dados.
-    session = Session()
+    # Criando uma sessão para se comunicar com o banco de dados do usuário.
+    session = sessao_do_usuario(usuario_id)
     
     # Procurando o usuário pelo ID fornecido.
     usuario = session.query(Usuario).filter(Usuario.id == usuario_id).first()
@@ -192,9 +521,12 @@ def update_usuario():
     # Se o usuário não for encontrado, retorne um erro.
     if not usuario:
         error_msg = "Usuário não encontrado :/"
-        logger.warning(f"Erro ao atualizar o usuário com ID '{usuario_id}', {error_msg}")
+        logger.warning("Erro ao atualizar o usuário com ID '%s', %s", usuario_id, error_msg)
         return {"message": error_msg}, 404
 
+    # O nome antigo e o novo identificam entradas do cache afetadas.
+    chaves = chaves_usuario(usuario_id, nomes=[usuario.nome, data.get("nome")], emails=[usuario.email])
+
     # Se o usuário for encontrado, atualize seus detalhes.
     campos_atualizaveis = ["nome", "cep", "cidade", "estado", "logradouro", "bairro"]
     for campo in campos_atualizaveis:
@@ -203,17 +535,115 @@ def update_usuario():
     
     try:
         session.commit()
-        logger.debug(f"Detalhes do usuário com ID '{usuario_id}' atualizado com sucesso.")
+        # o diretório localiza o usuário pelo nome novo
+        if "nome" in data:
+            renomeia_no_diretorio(usuario_id, data["nome"])
+        cache.invalida(*chaves)
+        logger.debug("Detalhes do usuário com ID '%s' atualizado com sucesso.", usuario_id)
         return apresenta_usuario(usuario), 200
     except Exception as e:
         error_msg = "Erro ao atualizar os detalhes do usuário."
-        logger.error(f"Erro ao atualizar os detalhes do usuário com ID '{usuario_id}', {error_msg}")
+        logger.error("Erro ao atualizar os detalhes do usuário com ID '%s', %s", usuario_id, error_msg)
         return {"message": str(e)}, 400
 
 
+@api.delete('/usuarios/batch', tags=[usuario_tag], responses={"200": UsuarioLoteViewSchema, "400": ErrorSchema})
+@admissao("pesada")
+@rota_escrita
+def del_usuarios_lote():
+    """Remove em lote os usuarios dos ids ou do filtro informados
+
+    Os usuarios são removidos em transações de até USUARIOS_LOTE, cada uma
+    com um único DELETE; os históricos e o ranking saem junto pelo ON DELETE
+    CASCADE. Retorna a quantidade de usuarios removidos.
+    """
+    try:
+        filtro = filtro_do_lote(UsuarioLoteExclusaoSchema(**request.json))
+    except (TypeError, ValueError, ValidationError) as e:
+        return {"mesage": str(e)}, 400
+
+    logger.debug("Removendo usuarios em lote: %s", filtro)
+    quantidade = aplica_em_lotes(lambda executa: remove_usuarios(executa, filtro, pausa_ms=0), filtro,
+                                 executor_do_shard, remocao=True)
+    logger.debug("%d usuarios removidos em lote", quantidade)
+    return apresenta_lote_usuarios("Registros de usuario removidos", quantidade), 200
+
+
+@api.put('/usuarios/batch', tags=[usuario_tag], responses={"200": UsuarioLoteViewSchema, "400": ErrorSchema})
+@admissao("pesada")
+@rota_escrita
+def update_usuarios_lote():
+    """Altera em lote o endereço dos usuarios dos ids ou do filtro informados
+
+    Os usuarios recebem os 'valores' em transações de até USUARIOS_LOTE,
+    cada uma com um único UPDATE. Retorna a quantidade de usuarios alterados.
+    """
+    try:
+        corpo = UsuarioLoteAtualizacaoSchema(**request.json)
+        filtro = filtro_do_lote(corpo)
+        valores = corpo.valores.dict(exclude_none=True)
+        valida_valores(valores)
+    except (TypeError, ValueError, ValidationError) as e:
+        return {"mesage": str(e)}, 400
+
+    logger.debug("Alterando usuarios em lote: %s -> %s", filtro, valores)
+    quantidade = aplica_em_lotes(lambda executa: atualiza_usuarios(executa, filtro, valores, pausa_ms=0), filtro,
+                                 executor_do_shard)
+    logger.debug("%d usuarios alterados em lote", quantidade)
+    return apresenta_lote_usuarios("Registros de usuario alterados", quantidade), 200
+
+
+def filtro_do_lote(corpo) -> FiltroUsuarios:
+    """Monta o filtro de uma operação em lote a partir do corpo validado
+
+    Levanta ValueError se o filtro escolheria todos os usuarios ou se há
+    mais ids que LIMITE_LOTE_USUARIOS.
+    """
+    if corpo.ids is not None and len(corpo.ids) > LIMITE_LOTE_USUARIOS:
+        raise ValueError("O lote deve ter no máximo %d ids." % LIMITE_LOTE_USUARIOS)
+    campos = corpo.filtro.dict(exclude_none=True) if corpo.filtro is not None else {}
+    filtro = FiltroUsuarios(tuple(corpo.ids) if corpo.ids is not None else None, tuple(sorted(campos.items())))
+    filtro.valida()
+    return filtro
+
+
+def executor_do_shard(indice: int):
+    """Retorna a função que executa cada lote de uma rota pelo escritor do shard
+
+    Entre dois lotes entram as escritas das outras requisições na fila.
+    """
+    return lambda funcao: escritor.executa(funcao, indice)
+
+
+def aplica_em_lotes(operacao, filtro: FiltroUsuarios, executor, remocao: bool = False) -> int:
+    """Aplica uma operação em lote aos usuarios do filtro, shard por shard
 
-@app.post('/historico', tags=[historico_tag],
-          responses={"200": UsuarioViewSchema, "404": ErrorSchema})
+    'operacao' recebe a função criada por executor(indice), que executa cada
+    lote em uma transação do shard, e retorna o gerador dos lotes. Depois
+    de cada lote as entradas dos usuarios no cache são invalidadas e, na
+    remoção, eles saem do diretório e do filtro de emails. Retorna a
+    quantidade de usuarios afetados.
+    """
+    if filtro.ids is not None:
+        indices = sorted({shard_do_usuario(usuario_id) for usuario_id in filtro.ids})
+    else:
+        indices = range(DB_SHARDS)
+    total = 0
+    for indice in indices:
+        for lote in operacao(executor(indice)):
+            total += lote.quantidade
+            cache.invalida(*[chave for usuario_id, nome, email in lote.usuarios
+                             for chave in chaves_usuario(usuario_id, nomes=[nome], emails=[email])])
+            if remocao:
+                remove_do_diretorio(*[usuario_id for usuario_id, _, _ in lote.usuarios])
+                for _, _, email in lote.usuarios:
+                    filtro_emails.remove(email)
+    return total
+
+
+@api.post('/historico', tags=[historico_tag],
+          responses={"200": UsuarioViewSchema, "404": ErrorSchema, "400": ErrorSchema})
+@rota_escrita
 def add_historico():
     """Adiciona um novo histórico à um registro de usuario cadastrado na base identificado pelo id
 
@@ -221,64 +651,267 @@ def add_historico():
     """
     data = request.json
     usuario_id  = data['user']
-    logger.debug(f"Adicionando históricos ao registro de usuario #{usuario_id}")
-    # criando conexão com a base
-    session = Session()
-    # fazendo a busca pelo registro de usuario
-    usuario = session.query(Usuario).filter(Usuario.id == usuario_id).first()
+    logger.debug("Adicionando históricos ao registro de usuario #%s", usuario_id)
+
+    # criando o histórico, validado antes de chegar ao escritor
+    categoria = data['category']
+    score = data['score']
+    data = data.get('date')
+    try:
+        historico = Historico(usuario_id,categoria,score,data)
+    except (TypeError, ValueError) as e:
+        error_msg = "Data do histórico inválida, use o formato ISO 8601."
+        logger.warning("Erro ao adicionar histórico ao registro de usuario '%s', %s", usuario_id, error_msg)
+        return {"mesage": error_msg}, 400
 
+    def insere(session):
+        # no escritor ficam só a verificação do usuario e as inserções; a
+        # representação com todos os históricos é lida depois do commit
+        usuario = session.query(Usuario.id, Usuario.nome, Usuario.email).filter(Usuario.id == usuario_id).first()
+        if not usuario:
+            return None
+        # adicionando o histórico ao registro de usuario
+        linha = {"usuario": usuario.id, "categoria": historico.categoria, "score": historico.score,
+                 "acertos": historico.acertos, "total": historico.total, "data_insercao": historico.data_insercao}
+        numera_historicos(session, [linha])
+        session.execute(Historico.__table__.insert(), [linha])
+        # atualizando o ranking e o resumo diário na mesma transação
+        atualiza_ranking(session, [linha])
+        atualiza_serie(session, [linha])
+        return usuario
+
+    usuario = escritor.executa(insere, shard_do_usuario(usuario_id))
     if not usuario:
         # se registro de usuario não encontrado
         error_msg = "Registro de usuario não encontrado na base :/"
-        logger.warning(f"Erro ao adicionar histórico ao registro de usuario '{usuario_id}', {error_msg}")
+        logger.warning("Erro ao adicionar histórico ao registro de usuario '%s', %s", usuario_id, error_msg)
         return {"mesage": error_msg}, 404
+    cache.invalida(*chaves_usuario(usuario.id, nomes=[usuario.nome], emails=[usuario.email]))
 
-    # criando o histórico    
-    categoria = data['category']
-    score = data['score']
-    data = data['date']
-    historico = Historico(usuario_id,categoria,score,data)
+    logger.debug("Adicionado histórico ao registro de usuario #%s", usuario_id)
 
-    # adicionando o histórico ao registro de usuario
-    usuario.adiciona_historico(historico)
-    session.commit()
+    # retorna a representação de registro de usuario, já com o histórico gravado
+    return apresenta_usuario(le_usuario_por_id(sessao_do_usuario(usuario.id), usuario.id)), 200
 
-    logger.debug(f"Adicionado histórico ao registro de usuario #{usuario_id}")
 
-    # retorna a representação de registro de usuario
-    return apresenta_usuario(usuario), 200
 
+@api.post('/historicos/batch', tags=[historico_tag],
+          responses={"200": HistoricoLoteViewSchema, "400": ErrorSchema})
+@rota_escrita
+def add_historicos_lote():
+    """Adiciona um lote de históricos, de um ou mais usuarios, em uma única transação
+
+    Retorna o status de cada registro do lote, na mesma ordem do envio. Com
+    shards, os históricos são gravados em uma transação por shard.
+    """
+    data = request.json
+    registros = data.get('historicos') if isinstance(data, dict) else None
+    if not isinstance(registros, list):
+        return {"mesage": "O corpo deve conter a lista 'historicos'."}, 400
+    if len(registros) > LIMITE_LOTE_HISTORICOS:
+        error_msg = "O lote deve ter no máximo %d registros." % LIMITE_LOTE_HISTORICOS
+        return {"mesage": error_msg}, 400
+
+    logger.debug("Adicionando lote de %d históricos", len(registros))
+    # validando todos os registros antes de acessar a base
+    resultados = []
+    validos = []
+    for indice, registro in enumerate(registros):
+        try:
+            historico = HistoricoSchema(**registro)
+            data_insercao = datetime.fromisoformat(historico.data)
+        except (TypeError, ValueError, ValidationError) as e:
+            resultados.append({"indice": indice, "status": "invalido", "mesage": str(e)})
+            continue
+        resultados.append({"indice": indice, "status": "inserido"})
+        validos.append((indice, historico, data_insercao))
+
+    def insere(itens):
+        def escrita(session):
+            # verificando todos os usuarios referenciados em uma única consulta
+            ids = {historico.usuario_id for _, historico, _ in itens}
+            existentes = {id: (nome, email) for id, nome, email in
+                          session.query(Usuario.id, Usuario.nome, Usuario.email).filter(Usuario.id.in_(ids))} \
+                if ids else {}
+
+            linhas = []
+            for indice, historico, data_insercao in itens:
+                if historico.usuario_id not in existentes:
+                    resultados[indice] = {"indice": indice, "status": "usuario_nao_encontrado",
+                                          "mesage": "Registro de usuario não encontrado na base :/"}
+                    continue
+                acertos, total = interpreta_score(historico.score)
+                linhas.append({"usuario": historico.usuario_id, "categoria": historico.categoria,
+                               "score": historico.score, "acertos": acertos, "total": total,
+                               "data_insercao": data_insercao})
+
+            if linhas:
+                # um único executemany dentro da transação da sessão
+                numera_historicos(session, linhas)
+                session.execute(Historico.__table__.insert(), linhas)
+                atualiza_ranking(session, linhas)
+                atualiza_serie(session, linhas)
+            # chaves do cache apenas dos usuarios que receberam históricos
+            chaves = [chave for usuario_id in {linha["usuario"] for linha in linhas}
+                      for chave in chaves_usuario(usuario_id, nomes=[existentes[usuario_id][0]],
+                                                  emails=[existentes[usuario_id][1]])]
+            return len(linhas), chaves
+        return escrita
 
+    # com shards, cada shard grava os históricos dos seus usuarios na sua
+    # própria transação, e o lote deixa de ser atômico entre os shards
+    por_shard = {}
+    for item in validos:
+        por_shard.setdefault(shard_do_usuario(item[1].usuario_id), []).append(item)
+    inseridos = 0
+    for shard, itens in sorted(por_shard.items()):
+        quantidade, chaves = escritor.executa(insere(itens), shard)
+        inseridos += quantidade
+        cache.invalida(*chaves)
 
-@app.post('/por-usuario', tags=[historico_tag],
+    logger.debug("Adicionados %d de %d históricos do lote", inseridos, len(registros))
+    return apresenta_resultado_lote(resultados), 200
+
+
+@api.get('/historico/serie', tags=[historico_tag],
+         responses={"200": SerieViewSchema, "400": ErrorSchema})
+@rota_leitura
+def get_serie(query: SerieBuscaSchema):
+    """Faz a busca da quantidade e da média de acertos por categoria em cada dia ou semana
+
+    Retorna a série do período informado, por padrão os últimos 90 dias,
+    calculada a partir do resumo diário dos históricos.
+    """
+    intervalo = query.intervalo or "dia"
+    if intervalo not in ("dia", "semana"):
+        return {"mesage": "Intervalo inválido, use 'dia' ou 'semana'."}, 400
+    fim = query.fim or date.today()
+    inicio = query.inicio or fim - timedelta(days=DIAS_PADRAO_SERIE - 1)
+    if inicio > fim or (fim - inicio).days >= DIAS_MAXIMO_SERIE:
+        error_msg = "O período deve ter início antes do fim e no máximo %d dias." % DIAS_MAXIMO_SERIE
+        return {"mesage": error_msg}, 400
+
+    logger.debug("Coletando série por %s de %s a %s", intervalo, inicio, fim)
+    # os totais de cada shard são somados por categoria e período
+    pontos = soma_series(em_cada_shard(
+        lambda session: consulta_serie(session, inicio, fim, query.categoria, intervalo)))
+    return apresenta_serie(intervalo, inicio, fim, pontos), 200
+
+
+@api.get('/historicos/exportacao', tags=[historico_tag],
+         responses={"200": None, "206": None, "400": ErrorSchema})
+@admissao("pesada")
+@rota_leitura
+def get_exportacao(query: ExportacaoBuscaSchema):
+    """Exporta os históricos, com o nome do usuario, em CSV ou no formato colunar
+
+    Sem o cabeçalho Range a exportação é enviada em streaming, lida do banco
+    em lotes. O ETag da resposta identifica o conteúdo exportado: uma
+    requisição com Range e If-Range com esse ETag continua o download a
+    partir do byte pedido enquanto nenhum histórico ou usuario mudou, e
+    depois disso recebe a exportação inteira, com o novo ETag.
+    """
+    formato = query.formato or "csv"
+    if formato not in FORMATOS:
+        return {"mesage": "Formato inválido, use %s." % " ou ".join("'%s'" % f for f in FORMATOS)}, 400
+    if query.compressao not in COMPRESSOES or (query.compressao and formato != "colunar"):
+        return {"mesage": "Compressão inválida, use 'zlib' com o formato colunar."}, 400
+
+    completo = bool(query.historico_completo)
+    filtros = (formato, query.compressao, query.categoria, query.inicio, query.fim, completo)
+    # o ETag e as linhas vêm da mesma transação de leitura de cada shard
+    sessoes = sessoes_de_leitura()
+    try:
+        estados = [estado_exportacao(session) for session in sessoes]
+    except BaseException:
+        for session in sessoes:
+            session.close()
+        raise
+    ate_id, versao = (tuple(valores) for valores in zip(*estados))
+    if DB_SHARDS == 1:
+        ate_id, versao = ate_id[0], versao[0]
+    etag = etag_exportacao(ate_id, versao, *filtros)
+    mimetype, extensao = FORMATOS[formato]
+    nome_arquivo = "historicos.%s" % extensao
+
+    if request.range is not None:
+        # o tamanho total só é conhecido depois de gerar a exportação, então
+        # ela é gravada em disco e o Range é atendido pelo send_file, que
+        # envia o arquivo inteiro quando o If-Range não é o ETag atual
+        logger.debug("Gerando exportação %s em arquivo para requisição com Range", etag)
+        try:
+            caminho = arquivo_exportacao(etag, extensao, gera_exportacao_streaming(
+                sessoes, formato, query.compressao, ate_id, query.categoria, query.inicio, query.fim, completo))
+        finally:
+            # com o arquivo já gravado o gerador nem é percorrido
+            for session in sessoes:
+                session.close()
+        return send_file(os.path.abspath(caminho), mimetype=mimetype, as_attachment=True,
+                         download_name=nome_arquivo, conditional=True, etag=etag)
+
+    logger.debug("Enviando exportação %s em streaming", etag)
+    resposta = Response(gera_exportacao_streaming(sessoes, formato, query.compressao, ate_id, query.categoria,
+                                                  query.inicio, query.fim, completo), mimetype=mimetype)
+    # o gerador fecha as sessões, mas não chega a rodar se a resposta é
+    # descartada antes do envio
+    resposta.call_on_close(lambda: [session.close() for session in sessoes])
+    resposta.set_etag(etag)
+    resposta.headers["Accept-Ranges"] = "bytes"
+    resposta.headers["Content-Disposition"] = "attachment; filename=%s" % nome_arquivo
+    return resposta
+
+
+def le_historicos_dos_shards(sessoes, ate_id, categoria, inicio, fim, completo):
+    """Gera os históricos exportados de todos os shards, na ordem da exportação
+
+    'ate_id' é o maior id exportado, ou, com shards, uma tupla com o de cada
+    shard. As linhas de cada tabela de todos os shards são intercaladas,
+    então a ordem é a mesma da leitura de um único banco.
+    """
+    ate_ids = ate_id if isinstance(ate_id, tuple) else (ate_id,)
+    chave = chave_exportacao(categoria, inicio, fim)
+    for historicos in tabelas_exportacao(completo):
+        partes = [le_tabela_exportacao(session, historicos, EXPORTACAO_LOTE, limite, categoria, inicio, fim)
+                  for session, limite in zip(sessoes, ate_ids)]
+        yield from intercala(partes, chave)
+
+
+def gera_exportacao_streaming(sessoes, formato, compressao, ate_id, categoria, inicio, fim, completo):
+    """Gera a exportação a partir de sessões próprias, como gera_usuarios_ndjson
+
+    As sessões são as de sessoes_de_leitura em que o ETag foi lido, e são
+    fechadas no fim. A memória usada é a de um lote por shard, qualquer que
+    seja o tamanho da tabela.
+    """
+    try:
+        linhas = le_historicos_dos_shards(sessoes, ate_id, categoria, inicio, fim, completo)
+        yield from gera_exportacao(formato, linhas, compressao)
+    finally:
+        for session in sessoes:
+            session.close()
+
+
+@api.post('/por-usuario', tags=[historico_tag],
          responses={"200": HistoricoViewSchema, "404": ErrorSchema})
+@rota_leitura
 def get_consultaPorUsuario():
     """Faz a busca por um registro de histórico a partir do usuário
 
     Retorna uma representação dos registros de usuario e históricos associados.
+    Aceita os mesmos parâmetros 'fields' e If-None-Match de GET /usuario.
     """
     data = request.json
     usuario_nome  = data['userName']
-    logger.debug(f"Coletando dados sobre usuario #{usuario_nome}")
-    # criando conexão com a base
-    session = Session()
-    # fazendo a buscaPrata
-    usuario = session.query(Usuario).filter(Usuario.nome == usuario_nome).first()
-
-    if not usuario:
-        # se o registro de usuario não foi encontrado
-        error_msg = "Registro de usuario não encontrado na base :/"
-        logger.warning(f"Erro ao buscar usuário '{usuario_nome}', {error_msg}")
-        return {"mesage": error_msg}, 404
-    else:
-        logger.debug(f"Registro de usuário econtrado: '{usuario.nome}'")
-        # retorna a representação de registro de usuario
-        return apresenta_usuario(usuario), 200
+    logger.debug("Coletando dados sobre usuario #%s", usuario_nome)
+    # com 'fullHistory' os históricos arquivados também são retornados
+    return busca_usuario_por_nome(usuario_nome, bool(data.get('fullHistory')), request.args.get("fields"))
     
     
     
-@app.post('/por-categoria', tags=[historico_tag],
+@api.post('/por-categoria', tags=[historico_tag],
           responses={"200": HistoricoViewSchema, "404": ErrorSchema})
+@admissao("pesada")
+@rota_leitura
 def get_consultaPorCategoria():
      """Faz a busca por registros de histórico a partir da categoria
     
@@ -286,18 +919,446 @@ def get_consultaPorCategoria():
      """
      data = request.json
      categoria = data['categoryName'] 
-     logger.debug(f"Coletando dados sobre categoria #{categoria}")
-     # criando conexão com a base
-     session = Session()
-     # fazendo a busca
-     categorias = session.query(Historico).filter(Historico.categoria == categoria).all()
+     logger.debug("Coletando dados sobre categoria #%s", categoria)
+     # fazendo a busca em cada shard, intercalando os históricos pela data
+     # com 'fullHistory' os históricos arquivados também são retornados
+     completo = bool(data.get('fullHistory'))
+     partes = em_cada_shard(lambda session: le_historicos_por_categoria(session, categoria, completo))
+     categorias = list(intercala(partes, chave_categoria))
 
      if not categorias or len(categorias) == 0:
          # se o registro de categoria não foi encontrado
          error_msg = "Registros da categoria não encontrados na base :/"
-         logger.warning(f"Erro ao buscar categoria '{categoria}', {error_msg}")
+         logger.warning("Erro ao buscar categoria '%s', %s", categoria, error_msg)
          return {"mesage": error_msg}, 404
      else:
-         logger.debug(f"{len(categorias)} registros de categoria encontrados para: '{categoria}'")
+         logger.debug("%d registros de categoria encontrados para: '%s'", len(categorias), categoria)
          # retorna a representação de registros de categoria
          return {"historicos": apresenta_historicos(categorias)}, 200
+
+
+@api.get('/estatisticas/categoria', tags=[estatistica_tag],
+         responses={"200": ListagemEstatisticaSchema, "404": ErrorSchema})
+@admissao("pesada")
+@rota_leitura
+def get_estatisticasCategoria(query: EstatisticaBuscaSchema):
+    """Calcula as estatísticas de pontuação por categoria
+
+    Retorna quantidade, média, mediana, p90, desvio padrão e histograma dos
+    percentuais de acerto de cada categoria, ou apenas da categoria informada.
+    """
+    categoria = query.categoria
+    logger.debug("Calculando estatísticas da categoria %s", categoria or "(todas)")
+    # buscando as pontuações em colunas de cada shard e calculando sobre os arrays
+    categorias, percentuais = junta_pontuacoes(em_cada_shard(
+        lambda session: carrega_pontuacoes(session, categoria)))
+    estatisticas = calcula_estatisticas(categorias, percentuais)
+
+    if categoria is not None and not estatisticas:
+        # se a categoria não tem históricos com pontuação
+        error_msg = "Registros da categoria não encontrados na base :/"
+        logger.warning("Erro ao calcular estatísticas da categoria '%s', %s", categoria, error_msg)
+        return {"mesage": error_msg}, 404
+    return apresenta_estatisticas(estatisticas), 200
+
+
+@api.get('/ranking', tags=[ranking_tag],
+         responses={"200": RankingViewSchema, "404": ErrorSchema})
+@rota_leitura
+def get_ranking(query: RankingBuscaSchema):
+    """Faz a busca das melhores pontuações de uma categoria
+
+    Retorna as primeiras posições do ranking da categoria e, se informado o
+    id do usuario, a posição desse usuario.
+    """
+    categoria = query.categoria
+    limite = max(1, min(query.limite or 10, LIMITE_MAXIMO_RANKING))
+    logger.debug("Coletando ranking da categoria %s", categoria)
+    # lendo as primeiras posições de cada shard pelo índice de ranking
+    partes = em_cada_shard(lambda session: consulta_ranking(session, categoria, limite))
+    linhas = list(intercala(partes, lambda linha: (-linha[0].melhor_score, -linha[0].usuario), limite))
+
+    if not linhas:
+        # se a categoria não tem históricos com pontuação
+        error_msg = "Registros da categoria não encontrados na base :/"
+        logger.warning("Erro ao buscar ranking da categoria '%s', %s", categoria, error_msg)
+        return {"mesage": error_msg}, 404
+
+    usuario = None
+    if query.usuario_id is not None:
+        session = sessao_do_usuario(query.usuario_id)
+        ranking = session.query(Ranking).filter(Ranking.usuario == query.usuario_id,
+                                                Ranking.categoria == categoria).first()
+        if ranking:
+            nome = session.query(Usuario.nome).filter(Usuario.id == ranking.usuario).scalar()
+            # a posição soma as pontuações maiores de todos os shards
+            acima = em_cada_shard(lambda session: posicao_no_ranking(session, ranking) - 1)
+            usuario = apresenta_posicao(ranking, nome, sum(acima) + 1)
+
+    return apresenta_ranking(categoria, linhas, usuario), 200
+
+
+def pagina_da_busca(query: BuscaSchema):
+    """Retorna (limit, offset) da busca, dentro dos candidatos ordenados pelo índice
+    """
+    limit = max(1, min(query.limit or LIMITE_PADRAO_BUSCA, LIMITE_MAXIMO_BUSCA))
+    offset = max(0, min(query.offset or 0, CANDIDATOS_BUSCA))
+    return limit, offset
+
+
+def proximo_offset(resultado, limit: int, offset: int):
+    """Retorna o offset da próxima página, ou None, a página sem o registro
+    excedente e se os resultados foram truncados
+
+    Os offsets vão só até CANDIDATOS_BUSCA, então uma página que passaria
+    dele é a última, e os resultados depois dela ficam de fora.
+    """
+    registros, truncado = resultado
+    if len(registros) > limit:
+        if offset + limit > CANDIDATOS_BUSCA:
+            return None, registros[:limit], True
+        return offset + limit, registros[:limit], truncado
+    return None, registros, truncado
+
+
+@api.get('/busca/usuarios', tags=[busca_tag],
+         responses={"200": BuscaUsuarioViewSchema, "400": ErrorSchema})
+@rota_leitura
+def get_buscaUsuarios(query: BuscaSchema):
+    """Faz a busca textual de usuarios pelo nome ou email
+
+    Retorna os usuarios em ordem de relevância: primeiro os nomes que começam
+    com o termo, depois os que o contêm e por fim os parecidos com ele. Com
+    'truncado' a ordenação considerou só parte dos usuarios com o termo.
+    """
+    termo = query.q.strip()
+    if not termo:
+        return {"mesage": "Informe o termo da busca."}, 400
+    limit, offset = pagina_da_busca(query)
+    logger.debug("Buscando usuarios por '%s' a partir de %d", termo, offset)
+    # um registro a mais indica que há próxima página
+    engine = engine_diretorio()
+    if engine is None:
+        usuarios = busca_usuarios(Session(), termo, limit + 1, offset)
+    else:
+        # com shards, o diretório tem o nome e o email de todos os usuarios
+        with engine.connect() as conn:
+            usuarios = busca_usuarios(conn, termo, limit + 1, offset)
+    next_offset, usuarios, truncado = proximo_offset(usuarios, limit, offset)
+    return apresenta_busca_usuarios(usuarios, next_offset, truncado), 200
+
+
+@api.get('/busca/categorias', tags=[busca_tag],
+         responses={"200": BuscaCategoriaViewSchema, "400": ErrorSchema})
+@rota_leitura
+def get_buscaCategorias(query: BuscaSchema):
+    """Faz a busca textual de categorias pelo nome
+
+    Retorna as categorias e a quantidade de históricos de cada uma, na mesma
+    ordem de relevância da busca de usuarios.
+    """
+    termo = query.q.strip()
+    if not termo:
+        return {"mesage": "Informe o termo da busca."}, 400
+    limit, offset = pagina_da_busca(query)
+    logger.debug("Buscando categorias por '%s' a partir de %d", termo, offset)
+    # um registro a mais indica que há próxima página
+    if DB_SHARDS == 1:
+        categorias = busca_categorias(Session(), termo, limit + 1, offset)
+    else:
+        # cada shard busca desde o início, e as páginas são juntadas aqui
+        partes = em_cada_shard(lambda session: busca_categorias(session, termo, offset + limit + 1))
+        categorias = junta_categorias(partes, termo, limit + 1, offset)
+    next_offset, categorias, truncado = proximo_offset(categorias, limit, offset)
+    return apresenta_busca_categorias(categorias, next_offset, truncado), 200
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db():
+    """Cria o banco e as tabelas e aplica as migrações pendentes, em cada shard."""
+    obtem_engine(current_app.config["DB_URL"], inicializa=False)
+    inicializa_bancos()
+    duplicados = sum(em_cada_shard(lambda session: len(le_emails_duplicados(session))))
+    if duplicados:
+        logger.warning("%d usuarios tinham o email de outro e receberam um email substituto; veja "
+                       "'flask report-emails'", duplicados)
+    logger.info("Banco inicializado")
+
+
+@click.command("rebuild-ranking")
+@with_appcontext
+def rebuild_ranking():
+    """Recalcula a tabela de ranking a partir de todos os históricos."""
+    engine_do_app()
+    for engine in engines_dos_shards():
+        with engine.begin() as conn:
+            reconstroi_ranking(conn)
+    logger.info("Ranking reconstruído a partir da tabela de históricos")
+
+
+@click.command("rebuild-search")
+@with_appcontext
+def rebuild_search():
+    """Reconstrói os índices de busca de usuarios e categorias e, com shards, o diretório."""
+    engine_do_app()
+    usuarios = []
+    for engine in engines_dos_shards():
+        with engine.begin() as conn:
+            reconstroi_busca(conn)
+            usuarios.extend(conn.execute(select(Usuario.id, Usuario.nome, Usuario.email)))
+    if engine_diretorio() is not None:
+        with engine_diretorio().begin() as conn:
+            diretorio.reconstroi_diretorio(conn, usuarios)
+    logger.info("Índices de busca reconstruídos a partir das tabelas de usuarios e históricos")
+
+
+@click.command("rebuild-serie")
+@with_appcontext
+def rebuild_serie():
+    """Recalcula o resumo diário dos históricos por categoria."""
+    engine_do_app()
+    for engine in engines_dos_shards():
+        with engine.begin() as conn:
+            reconstroi_serie(conn)
+    logger.info("Resumo diário reconstruído a partir da tabela de históricos")
+
+
+@click.command("export-historicos")
+@click.argument("saida", type=click.File("wb"))
+@click.option("--formato", type=click.Choice(sorted(FORMATOS)), default="csv", show_default=True)
+@click.option("--categoria", help="exporta apenas a categoria informada")
+@click.option("--inicio", type=click.DateTime(), help="data inicial, inclusiva")
+@click.option("--fim", type=click.DateTime(), help="data final, exclusiva")
+@click.option("--compressao", type=click.Choice([c for c in COMPRESSOES if c]), help="apenas no formato colunar")
+@click.option("--completo", is_flag=True, help="inclui os históricos arquivados")
+@with_appcontext
+def export_historicos(saida, formato, categoria, inicio, fim, compressao, completo):
+    """Exporta os históricos para SAIDA ('-' para a saída padrão), em lotes."""
+    engine_do_app()
+    sessoes = sessoes_de_leitura()
+    try:
+        ate_id = tuple(estado_exportacao(session)[0] for session in sessoes)
+        linhas = le_historicos_dos_shards(sessoes, ate_id, categoria, inicio, fim, completo)
+        tamanho = 0
+        for parte in gera_exportacao(formato, linhas, compressao):
+            saida.write(parte)
+            tamanho += len(parte)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    finally:
+        for session in sessoes:
+            session.close()
+    logger.info("Exportação de históricos gravada: %d bytes", tamanho)
+
+
+@click.command("archive-historicos")
+@click.option("--dias", type=click.IntRange(min=1), default=ARQUIVO_DIAS, show_default=True,
+              help="arquiva os históricos com mais dias que isso")
+@click.option("--lote", type=click.IntRange(min=1), default=ARQUIVO_LOTE, show_default=True,
+              help="históricos movidos por transação")
+@click.option("--pausa-ms", type=click.IntRange(min=0), default=ARQUIVO_PAUSA_MS, show_default=True,
+              help="pausa entre as transações")
+@with_appcontext
+def archive_historicos(dias, lote, pausa_ms):
+    """Move os históricos antigos para o banco de arquivamento, em lotes, shard por shard."""
+    engine_do_app()
+    limite = limite_arquivamento(dias)
+    total = 0
+    for shard, engine in enumerate(engines_dos_shards()):
+        for arquivado in arquiva_historicos(engine, limite, lote, pausa_ms):
+            total += arquivado.quantidade
+            # os payloads em cache dos usuarios afetados ainda têm os históricos movidos
+            session = session_factory(info={MODO_SESSAO: "leitura", SHARD: shard})
+            try:
+                for usuario_id, nome, email in session.query(Usuario.id, Usuario.nome, Usuario.email)\
+                        .filter(Usuario.id.in_(arquivado.usuarios)):
+                    cache.invalida(*chaves_usuario(usuario_id, nomes=[nome], emails=[email]))
+            finally:
+                session.close()
+            logger.debug("%d históricos arquivados, %d no total", arquivado.quantidade, total)
+    logger.info("%d históricos anteriores a %s arquivados", total, limite.isoformat(timespec="seconds"))
+
+
+@click.command("reshard-db")
+@click.argument("destino", type=click.Path(file_okay=False))
+@click.option("--shards", type=click.IntRange(min=1), required=True, help="quantidade de shards dos bancos novos")
+@with_appcontext
+def reshard_db(destino, shards):
+    """Copia usuarios e históricos para SHARDS bancos novos em DESTINO, com a API parada.
+
+    Os bancos atuais não são alterados. Depois da cópia a API passa a usar
+    os bancos novos quando iniciada com DB_PATH=DESTINO e DB_SHARDS=SHARDS.
+    """
+    engine_do_app()
+    try:
+        reparte("sqlite:///%s" % os.path.join(os.path.abspath(destino), "db.sqlite3"), shards)
+    except FileExistsError as e:
+        raise click.ClickException(str(e))
+    logger.info("Usuarios e históricos copiados para %d shards em %s", shards, destino)
+
+
+@click.command("backup-db")
+@click.option("--destino", type=click.Path(file_okay=False), default=BACKUP_DIR, show_default=True,
+              help="diretório dos snapshots")
+@click.option("--paginas", type=click.IntRange(min=1), default=BACKUP_PAGINAS, show_default=True,
+              help="páginas copiadas por passo")
+@click.option("--pausa-ms", type=click.FloatRange(min=0), default=BACKUP_PAUSA_MS, show_default=True,
+              help="pausa entre os passos")
+@click.option("--reinicios", type=click.IntRange(min=0), default=BACKUP_REINICIOS, show_default=True,
+              help="recomeços da cópia em passos, pelas escritas, antes de copiar em um único passo")
+@click.option("--nivel", type=click.IntRange(1, 9), default=BACKUP_NIVEL, show_default=True,
+              help="nível de compressão do gzip")
+@click.option("--retencao", type=click.IntRange(min=1), default=BACKUP_RETENCAO, show_default=True,
+              help="snapshots mantidos no destino")
+@with_appcontext
+def backup_db(destino, paginas, pausa_ms, reinicios, nivel, retencao):
+    """Grava um snapshot comprimido dos bancos em DESTINO sem parar a API."""
+    engine_do_app()
+    try:
+        snapshot = faz_backup(arquivos_dos_bancos(current_app.config["DB_URL"]), destino, paginas, pausa_ms,
+                              nivel, retencao, reinicios)
+    except BackupEmAndamento as e:
+        raise click.ClickException(str(e))
+    click.echo(snapshot)
+
+
+def contador_de_versoes(arquivos) -> int:
+    """Retorna o maior contador de versões dos arquivos que têm um.
+    """
+    maior = 0
+    for arquivo in arquivos:
+        if not os.path.exists(arquivo):
+            continue
+        engine = create_engine("sqlite:///%s" % arquivo)
+        try:
+            with engine.connect() as conn:
+                if engine.dialect.has_table(conn, "versao"):
+                    maior = max(maior, le_versao_atual(conn))
+        finally:
+            engine.dispose()
+    return maior
+
+
+@click.command("restore-db")
+@click.argument("snapshot", type=click.Path(file_okay=False, exists=True))
+@with_appcontext
+def restore_db(snapshot):
+    """Substitui os bancos pelos do SNAPSHOT, com a API parada, depois de verificá-lo.
+
+    Os contadores de versões continuam acima dos atuais, para que os ETags
+    já enviados pela API não sejam reaproveitados por outras versões.
+    """
+    arquivos = arquivos_dos_bancos(current_app.config["DB_URL"])
+    base = contador_de_versoes(arquivos)
+    try:
+        restaura_backup(snapshot, arquivos, versao_mais_recente())
+    except BackupInvalido as e:
+        raise click.ClickException(str(e))
+    for arquivo in arquivos:
+        engine = create_engine("sqlite:///%s" % arquivo)
+        try:
+            with engine.begin() as conn:
+                if engine.dialect.has_table(conn, "versao"):
+                    inicia_versao(conn, base)
+        finally:
+            engine.dispose()
+    if DB_SHARDS > 1:
+        logger.info("Com shards, execute 'flask rebuild-search' se o diretório não estiver de acordo com os shards")
+
+
+@click.command("report-emails")
+@with_appcontext
+def report_emails():
+    """Lista os usuarios cujo email repetido foi substituído pelo índice único de emails."""
+    engine_do_app()
+    click.echo("usuario\temail\temail_original\tmantido\tresolvido_em")
+    for duplicados in em_cada_shard(le_emails_duplicados):
+        for duplicado in duplicados:
+            click.echo("%d\t%s\t%s\t%d\t%s" % (duplicado.usuario, email_substituto(duplicado.email, duplicado.usuario),
+                                              duplicado.email, duplicado.mantido,
+                                              duplicado.data_resolucao.isoformat(timespec="seconds")))
+
+
+def opcoes_lote_usuarios(comando):
+    """Acrescenta ao comando as opções que escolhem os usuarios e dividem os lotes
+    """
+    opcoes = [click.option("--ids", help="ids dos usuarios, separados por vírgula")]
+    opcoes += [click.option("--%s" % campo, help="só os usuarios com este valor de %s" % campo)
+               for campo in CAMPOS_LOTE]
+    opcoes += [click.option("--lote", type=click.IntRange(min=1), default=USUARIOS_LOTE, show_default=True,
+                            help="usuarios por transação"),
+               click.option("--pausa-ms", type=click.IntRange(min=0), default=USUARIOS_PAUSA_MS, show_default=True,
+                            help="pausa entre as transações")]
+    for opcao in reversed(opcoes):
+        comando = opcao(comando)
+    return comando
+
+
+def filtro_das_opcoes(opcoes: dict) -> FiltroUsuarios:
+    """Monta o filtro de um comando em lote a partir das opções de opcoes_lote_usuarios
+    """
+    try:
+        ids = tuple(int(id) for id in opcoes["ids"].split(",") if id.strip()) if opcoes["ids"] else None
+        campos = tuple((campo, opcoes[campo]) for campo in CAMPOS_LOTE if opcoes[campo] is not None)
+        filtro = FiltroUsuarios(ids, campos)
+        filtro.valida()
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return filtro
+
+
+def executor_do_comando(indice: int):
+    """Retorna a função que executa cada lote de um comando direto na engine do shard
+    """
+    return em_transacao(engines_dos_shards()[indice])
+
+
+@click.command("delete-usuarios")
+@opcoes_lote_usuarios
+@with_appcontext
+def delete_usuarios(lote, pausa_ms, **opcoes):
+    """Remove em lote os usuarios dos ids ou dos valores de endereço informados, com seus históricos."""
+    engine_do_app()
+    filtro = filtro_das_opcoes(opcoes)
+    quantidade = aplica_em_lotes(lambda executa: remove_usuarios(executa, filtro, lote, pausa_ms), filtro,
+                                 executor_do_comando, remocao=True)
+    logger.info("%d usuarios removidos", quantidade)
+
+
+@click.command("update-usuarios")
+@opcoes_lote_usuarios
+@click.option("--valor", "valores", multiple=True, required=True, metavar="CAMPO=VALOR",
+              help="coluna de endereço alterada e o novo valor; pode ser repetida")
+@with_appcontext
+def update_usuarios(lote, pausa_ms, valores, **opcoes):
+    """Altera em lote o endereço dos usuarios dos ids ou dos valores de endereço informados."""
+    engine_do_app()
+    filtro = filtro_das_opcoes(opcoes)
+    try:
+        valores = dict(valor.split("=", 1) for valor in valores)
+        valida_valores(valores)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--valor")
+    quantidade = aplica_em_lotes(lambda executa: atualiza_usuarios(executa, filtro, valores, lote, pausa_ms), filtro,
+                                 executor_do_comando)
+    logger.info("%d usuarios alterados", quantidade)
+
+
+@click.command("purge-orfaos")
+@click.option("--lote", type=click.IntRange(min=1), default=ORFAOS_LOTE, show_default=True,
+              help="linhas examinadas por passo")
+@click.option("--pausa-ms", type=click.IntRange(min=0), default=ORFAOS_PAUSA_MS, show_default=True,
+              help="pausa depois de cada transação de remoção")
+@with_appcontext
+def purge_orfaos(lote, pausa_ms):
+    """Remove, em passos curtos, os históricos e o ranking de usuarios que não existem mais."""
+    engine_do_app()
+    totais = {}
+    for shard, engine in enumerate(engines_dos_shards()):
+        for removidos in remove_orfaos(engine, lote, pausa_ms):
+            totais[removidos.tabela] = totais.get(removidos.tabela, 0) + removidos.quantidade
+            logger.debug("Shard %d: %d órfãos removidos de %s", shard, removidos.quantidade, removidos.tabela)
+    for tabela in sorted(totais):
+        logger.info("%d órfãos removidos de %s", totais[tabela], tabela)
+    logger.info("Limpeza de órfãos concluída")
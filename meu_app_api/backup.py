@@ -0,0 +1,347 @@
+from datetime import datetime
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+
+from logger import logger
+
+# configuração dos backups, ajustável por variáveis de ambiente: diretório
+# dos snapshots, páginas copiadas por passo, pausa entre os passos e
+# reinícios da cópia em passos antes de copiar em um único passo, nível
+# do gzip, quantidade de snapshots mantidos e intervalo, em segundos, dos
+# backups agendados pelo app (0 desliga o agendamento)
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "database/backups")
+BACKUP_PAGINAS = int(os.environ.get("BACKUP_PAGINAS", 256))
+BACKUP_PAUSA_MS = float(os.environ.get("BACKUP_PAUSA_MS", 10))
+BACKUP_REINICIOS = int(os.environ.get("BACKUP_REINICIOS", 3))
+BACKUP_NIVEL = int(os.environ.get("BACKUP_NIVEL", 6))
+BACKUP_RETENCAO = int(os.environ.get("BACKUP_RETENCAO", 7))
+BACKUP_INTERVALO = int(os.environ.get("BACKUP_INTERVALO", 0))
+
+if not 1 <= BACKUP_NIVEL <= 9:
+    raise ValueError("BACKUP_NIVEL inválido: %d" % BACKUP_NIVEL)
+if BACKUP_RETENCAO < 1:
+    raise ValueError("BACKUP_RETENCAO inválido: %d" % BACKUP_RETENCAO)
+if BACKUP_REINICIOS < 0:
+    raise ValueError("BACKUP_REINICIOS inválido: %d" % BACKUP_REINICIOS)
+
+MANIFESTO = "manifesto.json"
+# bytes lidos por vez na compressão e na verificação dos arquivos
+BLOCO = 1 << 20
+# formato do nome dos snapshots, que também os ordena
+FORMATO_NOME = "%Y%m%dT%H%M%S"
+
+
+class BackupEmAndamento(Exception):
+    """ Outro processo já está gravando um backup no mesmo diretório.
+    """
+
+
+class BackupInvalido(Exception):
+    """ O snapshot não passou na verificação e nenhum arquivo foi trocado.
+    """
+
+
+def _trava(destino: str):
+    """ Trava o diretório de backups para este processo, ou levanta
+        BackupEmAndamento.
+
+    A trava é do sistema operacional, então é solta mesmo se o processo
+    morrer no meio do backup.
+    """
+    os.makedirs(destino, exist_ok=True)
+    arquivo = open(os.path.join(destino, ".trava"), "w")
+    try:
+        fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        arquivo.close()
+        raise BackupEmAndamento("Já há um backup em andamento em %s" % destino)
+    return arquivo
+
+
+class _CopiaReiniciada(Exception):
+    """ As escritas reiniciaram a cópia em passos mais vezes que o permitido.
+    """
+
+
+def copia_online(origem: str, destino: str, paginas: int = BACKUP_PAGINAS, pausa_ms: float = BACKUP_PAUSA_MS,
+                 reinicios: int = BACKUP_REINICIOS):
+    """ Copia o banco 'origem' para o arquivo 'destino' pela API de backup
+        do SQLite, 'paginas' páginas por passo com uma pausa entre eles.
+
+    Cada passo abre e fecha a sua própria transação de leitura, então nas
+    pausas nenhuma leitura prende o WAL e os checkpoints da API seguem
+    normalmente. Em troca, uma escrita no banco entre dois passos faz o
+    SQLite recomeçar a cópia do início. Depois de 'reinicios' recomeços a
+    cópia é refeita em um único passo, sem pausas: a transação de leitura
+    dura só a leitura do arquivo, e durante ela o WAL cresce com as
+    escritas, que não esperam pela cópia. Nos outros modos de journal a
+    leitura de cada passo bloqueia as escritas, o que também vale para o
+    único passo.
+    """
+    fonte = sqlite3.connect(origem, isolation_level=None, check_same_thread=False)
+    copia = sqlite3.connect(destino)
+    try:
+        if fonte.execute("PRAGMA journal_mode").fetchone()[0].lower() != "wal":
+            logger.warning("Backup de %s em um único passo: o banco não está em WAL", origem)
+            fonte.backup(copia)
+            return
+
+        # páginas restantes no passo anterior e recomeços da cópia
+        estado = {"restantes": None, "reinicios": 0}
+
+        def pausa(status, restantes, total):
+            if estado["restantes"] is not None and restantes > estado["restantes"]:
+                estado["reinicios"] += 1
+                if estado["reinicios"] > reinicios:
+                    raise _CopiaReiniciada()
+            estado["restantes"] = restantes
+            if restantes:
+                time.sleep(pausa_ms / 1000)
+
+        try:
+            fonte.backup(copia, pages=paginas, progress=pausa)
+        except _CopiaReiniciada:
+            logger.warning("Backup de %s reiniciado %d vezes pelas escritas; copiando em um único passo",
+                           origem, reinicios)
+            fonte.backup(copia)
+    finally:
+        copia.close()
+        fonte.close()
+
+
+def comprime(origem: str, destino: str, nivel: int = BACKUP_NIVEL) -> str:
+    """ Grava 'origem' comprimido com gzip em 'destino' e retorna o sha256
+        do arquivo comprimido.
+    """
+    soma = hashlib.sha256()
+
+    class ComSoma:
+        # calcula a soma enquanto o gzip grava, sem ler o arquivo de novo
+        def __init__(self, arquivo):
+            self.arquivo = arquivo
+
+        def write(self, dados):
+            soma.update(dados)
+            return self.arquivo.write(dados)
+
+        def flush(self):
+            self.arquivo.flush()
+
+    with open(origem, "rb") as entrada, open(destino, "wb") as saida:
+        # sem nome e data no cabeçalho, o mesmo banco gera o mesmo arquivo
+        with gzip.GzipFile(filename="", mode="wb", compresslevel=nivel, fileobj=ComSoma(saida), mtime=0) as gz:
+            shutil.copyfileobj(entrada, gz, BLOCO)
+    return soma.hexdigest()
+
+
+def sha256_do_arquivo(caminho: str) -> str:
+    soma = hashlib.sha256()
+    with open(caminho, "rb") as arquivo:
+        for bloco in iter(lambda: arquivo.read(BLOCO), b""):
+            soma.update(bloco)
+    return soma.hexdigest()
+
+
+def lista_backups(destino: str = BACKUP_DIR):
+    """ Retorna os snapshots completos do diretório, do mais antigo para o
+        mais novo.
+    """
+    if not os.path.isdir(destino):
+        return []
+    return [os.path.join(destino, nome) for nome in sorted(os.listdir(destino))
+            if os.path.isfile(os.path.join(destino, nome, MANIFESTO))]
+
+
+def aplica_retencao(destino: str = BACKUP_DIR, retencao: int = BACKUP_RETENCAO):
+    """ Remove os snapshots mais antigos além dos 'retencao' mais novos.
+    """
+    for snapshot in lista_backups(destino)[:-retencao]:
+        logger.info("Removendo backup antigo %s", snapshot)
+        shutil.rmtree(snapshot)
+
+
+def faz_backup(arquivos, destino: str = BACKUP_DIR, paginas: int = BACKUP_PAGINAS,
+               pausa_ms: float = BACKUP_PAUSA_MS, nivel: int = BACKUP_NIVEL, retencao: int = BACKUP_RETENCAO,
+               reinicios: int = BACKUP_REINICIOS) -> str:
+    """ Grava um snapshot dos 'arquivos' em um novo diretório de 'destino' e
+        retorna o seu caminho.
+
+    Os arquivos são copiados na ordem recebida, a de arquivos_dos_bancos:
+    cada banco antes do seu banco de arquivamento, para que um histórico
+    arquivado durante o backup apareça nos dois, e não em nenhum, e o
+    diretório por último, para que os seus ids cubram os de todos os shards.
+    Cada arquivo é comprimido e tem o sha256 registrado no manifesto. O
+    snapshot é gravado em um diretório temporário, renomeado só no fim,
+    então um backup interrompido nunca é listado nem restaurado.
+    """
+    trava = _trava(destino)
+    try:
+        # restos de backups interrompidos, que nenhum outro processo está gravando
+        for nome in os.listdir(destino):
+            if nome.endswith(".tmp"):
+                shutil.rmtree(os.path.join(destino, nome), ignore_errors=True)
+
+        agora = datetime.now()
+        nome = agora.strftime(FORMATO_NOME)
+        while os.path.exists(os.path.join(destino, nome)):
+            time.sleep(1)
+            agora = datetime.now()
+            nome = agora.strftime(FORMATO_NOME)
+        temporario = os.path.join(destino, nome + ".tmp")
+        os.makedirs(temporario)
+
+        inicio = time.perf_counter()
+        manifesto = {"criado_em": agora.isoformat(timespec="seconds"), "arquivos": []}
+        for caminho in arquivos:
+            base = os.path.basename(caminho)
+            copia = os.path.join(temporario, base)
+            logger.debug("Copiando %s", caminho)
+            copia_online(caminho, copia, paginas, pausa_ms, reinicios)
+            tamanho = os.path.getsize(copia)
+            soma = comprime(copia, copia + ".gz", nivel)
+            os.remove(copia)
+            manifesto["arquivos"].append({"nome": base, "bytes": tamanho,
+                                          "bytes_comprimidos": os.path.getsize(copia + ".gz"), "sha256": soma})
+        with open(os.path.join(temporario, MANIFESTO), "w") as arquivo:
+            json.dump(manifesto, arquivo, indent=2)
+        snapshot = os.path.join(destino, nome)
+        os.rename(temporario, snapshot)
+        logger.info("Backup %s gravado em %.1f s", snapshot, time.perf_counter() - inicio)
+
+        aplica_retencao(destino, retencao)
+        return snapshot
+    finally:
+        trava.close()
+
+
+def _verifica_banco(caminho: str):
+    conexao = sqlite3.connect(caminho)
+    try:
+        resultado = [linha[0] for linha in conexao.execute("PRAGMA integrity_check")]
+        versao = conexao.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        resultado, versao = [str(e)], None
+    finally:
+        conexao.close()
+    return resultado, versao
+
+
+def restaura_backup(snapshot: str, arquivos, versao_maxima: int = None):
+    """ Substitui os 'arquivos' dos bancos pelos do snapshot.
+
+    Deve ser executada com a API parada. Antes de trocar qualquer arquivo,
+    cada um é conferido pelo sha256 do manifesto, descomprimido ao lado do
+    arquivo que vai substituir e verificado pelo 'PRAGMA integrity_check'
+    e, com 'versao_maxima', pela versão de esquema. Se algum falhar, nada é
+    trocado e BackupInvalido é levantada. Os WAL dos bancos substituídos são
+    removidos, pois seriam aplicados sobre os arquivos novos.
+    """
+    with open(os.path.join(snapshot, MANIFESTO)) as arquivo:
+        manifesto = json.load(arquivo)
+    destinos = {os.path.basename(caminho): caminho for caminho in arquivos}
+    nomes = [item["nome"] for item in manifesto["arquivos"]]
+    if sorted(nomes) != sorted(destinos):
+        raise BackupInvalido("O backup tem os arquivos %s e a configuração atual usa %s; confira DB_URL e DB_SHARDS"
+                             % (", ".join(sorted(nomes)), ", ".join(sorted(destinos))))
+
+    temporarios = []
+    try:
+        for item in manifesto["arquivos"]:
+            comprimido = os.path.join(snapshot, item["nome"] + ".gz")
+            if sha256_do_arquivo(comprimido) != item["sha256"]:
+                raise BackupInvalido("O sha256 de %s não confere com o manifesto" % comprimido)
+            destino = destinos[item["nome"]]
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            temporario = destino + ".restauracao"
+            temporarios.append(temporario)
+            try:
+                with gzip.open(comprimido, "rb") as entrada, open(temporario, "wb") as saida:
+                    shutil.copyfileobj(entrada, saida, BLOCO)
+            except (OSError, EOFError, zlib.error) as e:
+                raise BackupInvalido("Não foi possível descomprimir %s: %s" % (comprimido, e))
+            resultado, versao = _verifica_banco(temporario)
+            if resultado != ["ok"]:
+                raise BackupInvalido("%s não passou no integrity_check: %s" % (item["nome"], "; ".join(resultado[:5])))
+            if versao_maxima is not None and versao > versao_maxima:
+                raise BackupInvalido("%s tem o esquema na versão %d, mais nova que a %d desta API"
+                                     % (item["nome"], versao, versao_maxima))
+            logger.debug("%s verificado", item["nome"])
+
+        for item, temporario in zip(manifesto["arquivos"], temporarios):
+            destino = destinos[item["nome"]]
+            for sufixo in ("-wal", "-shm"):
+                if os.path.exists(destino + sufixo):
+                    os.remove(destino + sufixo)
+            os.replace(temporario, destino)
+        temporarios = []
+        logger.info("Backup %s restaurado", snapshot)
+    finally:
+        for temporario in temporarios:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+
+
+class AgendadorBackup:
+    """ Grava um backup a cada 'intervalo' segundos em uma thread do processo.
+
+    Cada worker do gunicorn tem o seu agendador, mas o intervalo é contado
+    a partir do snapshot mais novo do diretório e a trava do diretório
+    deixa um único processo gravar por vez, então os workers não repetem o
+    mesmo backup.
+    """
+
+    def __init__(self, intervalo: int, destino: str = BACKUP_DIR):
+        self.intervalo = intervalo
+        self.destino = destino
+        self._thread = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reinicia)
+
+    def _reinicia(self):
+        # a thread do processo pai não existe no filho
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def inicia(self, arquivos):
+        """ Inicia, se ainda não iniciada neste processo, a thread de backups
+            dos 'arquivos'.
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executa, args=(arquivos,), name="backup", daemon=True)
+                self._thread.start()
+
+    def _proximo(self) -> float:
+        snapshots = lista_backups(self.destino)
+        if not snapshots:
+            return 0
+        ultimo = datetime.strptime(os.path.basename(snapshots[-1]), FORMATO_NOME).timestamp()
+        return max(0.0, ultimo + self.intervalo - time.time())
+
+    def _executa(self, arquivos):
+        while True:
+            espera = self._proximo()
+            if espera:
+                # outro worker pode gravar antes, e a espera é recalculada
+                time.sleep(min(espera, 60))
+                continue
+            try:
+                faz_backup(arquivos, self.destino)
+            except BackupEmAndamento:
+                time.sleep(min(self.intervalo, 60))
+            except Exception as e:
+                logger.error("Erro no backup agendado: %s", e)
+                time.sleep(min(self.intervalo, 60))
+
+
+agendador = AgendadorBackup(BACKUP_INTERVALO)
@@ -0,0 +1,42 @@
+""" Scripts de verificação e medição de desempenho da API.
+
+Os scripts são executados a partir do diretório da API, por exemplo
+'python -m benchmark.contagem_consultas', e sempre trabalham em um banco
+temporário, nunca no 'database/' do projeto.
+"""
+import os
+import sys
+import tempfile
+
+DIR_API = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepara_ambiente(prefixo: str = "benchmark_", diretorio: str = None) -> str:
+    """ Muda para um diretório de rascunho antes de importar o app.
+
+    O banco e os logs são criados no diretório corrente quando o app é
+    importado, então isso mantém os dados da medição fora do projeto. Sem
+    'diretorio', um diretório temporário é criado. Retorna o diretório usado.
+    O controle de admissão fica desligado, a não ser que ADMISSAO já esteja
+    definida.
+    """
+    if DIR_API not in sys.path:
+        sys.path.insert(0, DIR_API)
+    # toda a carga sai de um único IP local e seria recusada pelo controle
+    # de admissão, que só é medido quando o script o liga explicitamente
+    os.environ.setdefault("ADMISSAO", "0")
+    if diretorio is None:
+        diretorio = tempfile.mkdtemp(prefix=prefixo)
+    elif not os.path.exists(diretorio):
+        os.makedirs(diretorio)
+    os.chdir(diretorio)
+    return os.path.abspath(diretorio)
+
+
+def dados_usuario(i: int) -> dict:
+    """ Retorna o corpo de cadastro do i-ésimo usuário sintético.
+    """
+    return {
+        "nome": "usuario%d" % i, "email": "usuario%d@quiz.com" % i, "senha": "senha",
+        "cep": "20000-000", "logradouro": "Rua", "bairro": "Centro",
+        "cidade": "Rio de Janeiro", "estado": "RJ"}
@@ -0,0 +1,139 @@
+""" Compara a remoção de usuarios um a um por DELETE /usuario com a remoção
+em lote por DELETE /usuarios/batch, e mede quanto as escritas da API
+esperam durante a limpeza de órfãos em passos e em um único passo.
+
+Os órfãos são criados removendo usuarios por uma conexão sem as chaves
+estrangeiras, como ficavam os bancos anteriores ao ON DELETE CASCADE. Cada
+fase de limpeza começa com os mesmos órfãos, e uma thread insere
+históricos pela API enquanto ela roda.
+
+    (env)$ python -m benchmark.administracao [--usuarios 20000] [--historicos 400000] [--remocoes 1000] \\
+                                             [--orfaos 0.2] [--lote 5000] [--pausa-ms 50]
+"""
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from benchmark import prepara_ambiente
+from benchmark.carga import percentil
+
+
+def cria_orfaos(arquivo: str, primeiro: int, fracao: float) -> int:
+    """ Remove, sem cascata, uma fração dos usuarios a partir do id
+        'primeiro' e retorna quantas linhas de histórico ficaram órfãs.
+    """
+    conexao = sqlite3.connect(arquivo, isolation_level=None)
+    conexao.execute("DELETE FROM usuario WHERE id >= ? AND abs(random()) %% 1000 < %d" % int(fracao * 1000),
+                    (primeiro,))
+    orfaos = conexao.execute("SELECT COUNT(*) FROM historico h WHERE NOT EXISTS "
+                             "(SELECT 1 FROM usuario u WHERE u.id = h.usuario)").fetchone()[0]
+    conexao.close()
+    return orfaos
+
+
+def limpa_com_escritas(app, engine, usuarios: int, lote: int, pausa_ms: int, semente: int):
+    """ Executa a limpeza de órfãos enquanto uma thread insere históricos
+        e retorna as durações das transações, das escritas e o total.
+    """
+    from model import remove_orfaos
+    from benchmark.gerador import nome_categoria
+
+    escritas = []
+    limpando = threading.Event()
+    limpando.set()
+
+    def escreve():
+        cliente = app.test_client()
+        aleatorio = random.Random(semente)
+        while limpando.is_set():
+            inicio = time.perf_counter()
+            cliente.post("/historico", json={"user": aleatorio.randint(1, usuarios),
+                                             "category": nome_categoria(aleatorio.randrange(10)), "score": "5/10"})
+            escritas.append((time.perf_counter() - inicio) * 1000)
+            time.sleep(0.005)
+
+    thread = threading.Thread(target=escreve)
+    thread.start()
+    transacoes = []
+    removidos = 0
+    inicio = time.perf_counter()
+    try:
+        anterior = time.perf_counter()
+        for orfaos in remove_orfaos(engine, lote, pausa_ms):
+            # a pausa depois da transação não conta como duração dela
+            transacoes.append((time.perf_counter() - anterior) * 1000)
+            removidos += orfaos.quantidade
+            anterior = time.perf_counter() + pausa_ms / 1000
+    finally:
+        limpando.clear()
+        thread.join()
+    transacoes.sort()
+    escritas.sort()
+    return removidos, time.perf_counter() - inicio, transacoes, escritas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=20000)
+    parser.add_argument("--historicos", type=int, default=400000)
+    parser.add_argument("--remocoes", type=int, default=1000, help="usuarios removidos em cada forma de remoção")
+    parser.add_argument("--orfaos", type=float, default=0.2, help="fração dos usuarios restantes removida sem cascata")
+    parser.add_argument("--lote", type=int, default=5000)
+    parser.add_argument("--pausa-ms", type=int, default=50)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args()
+
+    diretorio = prepara_ambiente("administracao_")
+    os.environ["CACHE_BACKEND"] = "desligado"
+    from app import create_app
+    from model import obtem_engine, arquivos_dos_bancos
+    from benchmark.gerador import gera_dados
+
+    # os avisos das escritas em usuarios removidos não fazem parte da medição
+    logging.disable(logging.WARNING)
+    app = create_app()
+    cliente = app.test_client()
+    engine = obtem_engine()
+    gera_dados(engine, args.usuarios, args.historicos, args.semente)
+
+    print("%-26s %8s %10s %12s" % ("remoção", "usuarios", "duração s", "usuarios/s"))
+    inicio = time.perf_counter()
+    for usuario_id in range(1, args.remocoes + 1):
+        assert cliente.delete("/usuario", json={"id": usuario_id}).status_code == 200
+    duracao = time.perf_counter() - inicio
+    print("%-26s %8d %10.2f %12.0f" % ("DELETE /usuario um a um", args.remocoes, duracao, args.remocoes / duracao))
+    ids = list(range(args.remocoes + 1, 2 * args.remocoes + 1))
+    inicio = time.perf_counter()
+    resposta = cliente.delete("/usuarios/batch", json={"ids": ids})
+    duracao = time.perf_counter() - inicio
+    assert resposta.status_code == 200 and resposta.json["quantidade"] == len(ids), resposta.json
+    print("%-26s %8d %10.2f %12.0f" % ("DELETE /usuarios/batch", len(ids), duracao, len(ids) / duracao))
+
+    # uma cópia do banco com os órfãos para cada forma de limpeza
+    arquivo = arquivos_dos_bancos()[0]
+    orfaos = cria_orfaos(arquivo, 2 * args.remocoes + 1, args.orfaos)
+    engine.dispose()
+    copia = os.path.join(diretorio, "orfaos.sqlite3")
+    with sqlite3.connect(arquivo) as origem, sqlite3.connect(copia) as destino:
+        origem.backup(destino)
+
+    print("\n%d históricos órfãos em %s" % (orfaos, diretorio))
+    print("%-20s %9s %6s %10s %10s %14s %14s" % (
+        "limpeza", "removidos", "txs", "duração s", "tx max ms", "POST p99 ms", "POST max ms"))
+    for nome, lote, pausa_ms in (("em passos", args.lote, args.pausa_ms), ("em um passo", 2 ** 62, 0)):
+        with sqlite3.connect(copia) as origem, sqlite3.connect(arquivo) as destino:
+            origem.backup(destino)
+        engine.dispose()
+        removidos, duracao, transacoes, escritas = limpa_com_escritas(app, engine, args.usuarios, lote, pausa_ms,
+                                                                     args.semente)
+        print("%-20s %9d %6d %10.2f %10.1f %14.1f %14.1f" % (
+            nome, removidos, len(transacoes), duracao, transacoes[-1] if transacoes else 0,
+            percentil(escritas, 99), escritas[-1] if escritas else 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+""" Mede um pico de carga com e sem o controle de admissão (ADMISSAO=0/1).
+
+Cada modo roda em um processo separado, com um banco novo e um gunicorn
+local, recebendo de '--concorrencia' threads uma mistura de rotas pesadas
+(/por-categoria, /usuarios), leituras, logins e inserções de histórico. Os
+limites de taxa por cliente ficam desligados, pois toda a carga sai do mesmo
+IP: o que se mede é o efeito das vagas por classe e da espera máxima sobre
+a latência das requisições atendidas e o tempo das recusas.
+
+    (env)$ python -m benchmark.admissao [--usuarios 2000] [--historicos 100000] \\
+                                        [--requisicoes 3000] [--concorrencia 64]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark import prepara_ambiente, DIR_API
+
+
+def requisicao(aleatorio, usuarios: int):
+    """ Sorteia uma requisição da mistura do pico.
+    """
+    from benchmark.gerador import nome_categoria
+
+    sorteio = aleatorio.random()
+    if sorteio < 0.3:
+        return "POST", "/por-categoria", {"categoryName": nome_categoria(aleatorio.randrange(10))}
+    if sorteio < 0.4:
+        return "GET", "/usuarios?limit=500&after=%d" % aleatorio.randrange(usuarios), None
+    if sorteio < 0.7:
+        return "GET", "/usuario?nome=usuario%d" % aleatorio.randrange(usuarios), None
+    if sorteio < 0.8:
+        return "POST", "/login", {"email": "usuario%d@quiz.com" % aleatorio.randrange(usuarios), "senha": "senha"}
+    return "POST", "/historico", {"user": aleatorio.randint(1, usuarios), "category": nome_categoria(
+        aleatorio.randrange(10)), "score": "%d/10" % aleatorio.randint(0, 10)}
+
+
+def executa(args) -> dict:
+    """ Dispara o pico contra um gunicorn com a configuração do ambiente.
+    """
+    prepara_ambiente("admissao_")
+    from benchmark.carga import ClienteHttp, inicia_gunicorn, porta_livre, percentil
+    from model import obtem_engine
+    from benchmark.gerador import gera_dados
+    engine = obtem_engine()
+    gera_dados(engine, args.usuarios, args.historicos, args.semente)
+    engine.dispose()
+
+    porta = porta_livre()
+    processo = inicia_gunicorn(porta, args.workers, args.threads)
+    atendidas, recusadas = [], []
+    lock = threading.Lock()
+    proximo = [0]
+
+    def trabalha(numero):
+        cliente = ClienteHttp(porta)
+        aleatorio = random.Random(args.semente * 1000 + numero)
+        while True:
+            with lock:
+                indice = proximo[0]
+                proximo[0] += 1
+            if indice >= args.requisicoes:
+                return
+            metodo, caminho, corpo = requisicao(aleatorio, args.usuarios)
+            inicio = time.perf_counter()
+            # como um proxy, informa quando a requisição foi enviada
+            status = cliente.requisita(metodo, caminho, corpo, {"X-Request-Start": "t=%.3f" % time.time()})
+            duracao = (time.perf_counter() - inicio) * 1000
+            with lock:
+                (recusadas if status in (429, 503) else atendidas).append(duracao)
+
+    inicio = time.perf_counter()
+    try:
+        threads = [threading.Thread(target=trabalha, args=(n,)) for n in range(args.concorrencia)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        processo.terminate()
+        processo.wait()
+    duracao = time.perf_counter() - inicio
+
+    atendidas.sort()
+    recusadas.sort()
+    return {
+        "vazao_atendidas": len(atendidas) / duracao,
+        "atendidas": len(atendidas),
+        "recusadas": len(recusadas),
+        "p50_ms": percentil(atendidas, 50),
+        "p99_ms": percentil(atendidas, 99),
+        "max_ms": atendidas[-1] if atendidas else 0.0,
+        "recusa_p99_ms": percentil(recusadas, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--historicos", type=int, default=100000)
+    parser.add_argument("--requisicoes", type=int, default=3000)
+    parser.add_argument("--concorrencia", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--semente", type=int, default=42)
+    # parâmetros internos de uma execução isolada
+    parser.add_argument("--execucao", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--saida", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.execucao:
+        resultado = executa(args)
+        with open(args.saida, "w") as arquivo:
+            json.dump(resultado, arquivo)
+        return
+
+    print("%-9s %10s %9s %9s %8s %8s %8s %14s" % (
+        "admissão", "req/s ok", "atendidas", "recusadas", "p50 ms", "p99 ms", "max ms", "recusa p99 ms"))
+    for modo in ("0", "1"):
+        saida = tempfile.mktemp(suffix=".json")
+        ambiente = dict(os.environ, ADMISSAO=modo, ADMISSAO_TAXA="", LOG_NIVEL="ERROR", CACHE_BACKEND="desligado")
+        subprocess.run([
+            sys.executable, "-m", "benchmark.admissao", "--execucao",
+            "--usuarios", str(args.usuarios), "--historicos", str(args.historicos),
+            "--requisicoes", str(args.requisicoes), "--concorrencia", str(args.concorrencia),
+            "--workers", str(args.workers), "--threads", str(args.threads),
+            "--semente", str(args.semente), "--saida", saida],
+            cwd=DIR_API, env=ambiente, check=True, stdout=subprocess.DEVNULL)
+        with open(saida) as arquivo:
+            r = json.load(arquivo)
+        os.remove(saida)
+        print("%-9s %10.1f %9d %9d %8.1f %8.1f %8.1f %14.1f" % (
+            "ligada" if modo == "1" else "desligada", r["vazao_atendidas"], r["atendidas"], r["recusadas"],
+            r["p50_ms"], r["p99_ms"], r["max_ms"], r["recusa_p99_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+""" Mede o tamanho da tabela quente de históricos e a latência das leituras
+antes e depois de arquivar os históricos antigos.
+
+Os históricos gerados ocupam um ano a partir de DATA_INICIAL, e são
+arquivados os anteriores aos últimos '--dias' desse ano. Durante o
+arquivamento uma thread insere históricos pela API, para medir quanto as
+escritas esperam pelas transações do arquivamento.
+
+    (env)$ python -m benchmark.arquivamento [--usuarios 2000] [--historicos 200000] [--dias 90]
+"""
+import argparse
+import logging
+import os
+import random
+import statistics
+import threading
+import time
+from datetime import timedelta
+
+from benchmark import prepara_ambiente
+from benchmark.carga import percentil
+
+
+def tamanho_historicos(engine) -> dict:
+    """ Retorna o tamanho em bytes da tabela quente e dos seus índices.
+    """
+    linhas = engine.execute(
+        "SELECT s.name, SUM(s.pgsize) FROM dbstat('main') s JOIN sqlite_master m ON m.name = s.name "
+        "WHERE m.tbl_name = 'historico' GROUP BY s.name").fetchall()
+    return dict(linhas)
+
+
+def mede_leituras(cliente, usuarios: int, categorias: int, amostras: int, semente: int) -> dict:
+    """ Retorna a mediana e o p95 em milissegundos das leituras de usuario e
+        categoria, só com a tabela quente e com o histórico completo.
+    """
+    from benchmark.gerador import nome_categoria
+
+    aleatorio = random.Random(semente)
+    leituras = {
+        "GET /usuario": lambda completo: cliente.get(
+            "/usuario?nome=usuario%d%s" % (aleatorio.randrange(usuarios), "&historico_completo=true" * completo)),
+        "POST /por-categoria": lambda completo: cliente.post("/por-categoria", json={
+            "categoryName": nome_categoria(aleatorio.randrange(categorias)), "fullHistory": completo}),
+    }
+    resultados = {}
+    for nome, leitura in leituras.items():
+        for completo in (False, True):
+            latencias = []
+            for _ in range(amostras):
+                inicio = time.perf_counter()
+                resposta = leitura(completo)
+                latencias.append((time.perf_counter() - inicio) * 1000)
+                assert resposta.status_code == 200, resposta.status_code
+            latencias.sort()
+            resultados["%s%s" % (nome, " completo" if completo else "")] = (
+                statistics.median(latencias), percentil(latencias, 95))
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--historicos", type=int, default=200000)
+    parser.add_argument("--dias", type=int, default=90)
+    parser.add_argument("--lote", type=int, default=500)
+    parser.add_argument("--pausa-ms", type=int, default=50)
+    parser.add_argument("--amostras", type=int, default=100)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args()
+
+    prepara_ambiente("arquivamento_")
+    # as leituras medidas devem ir ao banco, não ao cache
+    os.environ["CACHE_BACKEND"] = "desligado"
+    from app import create_app
+    from model import obtem_engine, arquiva_historicos
+    from benchmark.gerador import gera_dados, quantidade_categorias, DATA_INICIAL, nome_categoria
+
+    # os logs de depuração das rotas não fazem parte da medição
+    logging.disable(logging.INFO)
+    cliente = create_app().test_client()
+    engine = obtem_engine()
+    gera_dados(engine, args.usuarios, args.historicos, args.semente)
+    categorias = quantidade_categorias(args.historicos)
+
+    antes = tamanho_historicos(engine)
+    leituras_antes = mede_leituras(cliente, args.usuarios, categorias, args.amostras, args.semente)
+
+    # escritas concorrentes durante o arquivamento
+    escritas = []
+    arquivando = threading.Event()
+    arquivando.set()
+
+    def escreve():
+        escritor = create_app().test_client()
+        aleatorio = random.Random(args.semente)
+        while arquivando.is_set():
+            inicio = time.perf_counter()
+            escritor.post("/historico", json={
+                "user": aleatorio.randint(1, args.usuarios), "category": nome_categoria(aleatorio.randrange(categorias)),
+                "score": "5/10"})
+            escritas.append((time.perf_counter() - inicio) * 1000)
+            time.sleep(0.005)
+
+    thread = threading.Thread(target=escreve)
+    thread.start()
+    limite = DATA_INICIAL + timedelta(days=365 - args.dias)
+    transacoes = []
+    arquivados = 0
+    inicio = time.perf_counter()
+    try:
+        anterior = time.perf_counter()
+        for lote in arquiva_historicos(engine, limite, args.lote, args.pausa_ms):
+            transacoes.append((time.perf_counter() - anterior) * 1000)
+            arquivados += lote.quantidade
+            # a pausa entre os lotes não conta como duração da transação
+            anterior = time.perf_counter() + args.pausa_ms / 1000
+    finally:
+        arquivando.clear()
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    depois = tamanho_historicos(engine)
+    leituras_depois = mede_leituras(cliente, args.usuarios, categorias, args.amostras, args.semente)
+
+    transacoes.sort()
+    escritas.sort()
+    print("%d históricos arquivados em %.1f s, %d transações (p50 %.1f ms, max %.1f ms)"
+          % (arquivados, duracao, len(transacoes), percentil(transacoes, 50), transacoes[-1] if transacoes else 0))
+    print("POST /historico durante o arquivamento: %d escritas, p50 %.1f ms, p99 %.1f ms, max %.1f ms"
+          % (len(escritas), percentil(escritas, 50), percentil(escritas, 99), escritas[-1] if escritas else 0))
+
+    print("\n%-34s %12s %12s" % ("tamanho da tabela quente", "antes KiB", "depois KiB"))
+    for nome in sorted(antes):
+        print("%-34s %12.0f %12.0f" % (nome, antes[nome] / 1024, depois.get(nome, 0) / 1024))
+    print("%-34s %12.0f %12.0f" % ("total", sum(antes.values()) / 1024, sum(depois.values()) / 1024))
+
+    print("\n%-30s %18s %18s" % ("leitura", "antes p50/p95 ms", "depois p50/p95 ms"))
+    for nome in leituras_antes:
+        print("%-30s %8.2f /%8.2f %8.2f /%8.2f" % ((nome,) + leituras_antes[nome] + leituras_depois[nome]))
+
+
+if __name__ == "__main__":
+    main()
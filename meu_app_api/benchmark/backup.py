@@ -0,0 +1,179 @@
+""" Mede a latência de POST /historico enquanto 'flask backup-db' copia o
+banco, comparando a cópia em passos com pausas (BACKUP_PAGINAS e
+BACKUP_PAUSA_MS) com a cópia em um único passo, e o maior tamanho do WAL
+do banco em cada fase, que cresce enquanto uma leitura impede os
+checkpoints de alcançar o fim dele.
+
+O banco é gerado por benchmark.gerador e aumentado até '--mb' megabytes
+com uma tabela de enchimento, para que a cópia dure o bastante. A carga
+roda contra um gunicorn local durante cada fase: sem backup, por
+'--segundos', e nas outras até o backup terminar. O backup roda em outro
+processo, como em produção.
+
+    (env)$ python -m benchmark.backup [--mb 2048] [--usuarios 2000] [--historicos 100000] [--concorrencia 8] \\
+                                      [--segundos 20] [--paginas 256] [--pausa-ms 10]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from benchmark import prepara_ambiente, DIR_API
+from benchmark.carga import percentil
+
+# linhas de enchimento inseridas por transação, de 4 KB cada
+LOTE_ENCHIMENTO = 1000
+
+
+def enche_banco(arquivo: str, megabytes: int):
+    """ Aumenta o banco até 'megabytes' com linhas aleatórias em uma tabela
+        que a API não usa.
+    """
+    conexao = sqlite3.connect(arquivo, isolation_level=None)
+    conexao.execute("CREATE TABLE IF NOT EXISTS enchimento (dados BLOB)")
+    while os.path.getsize(arquivo) < megabytes * 1024 * 1024:
+        conexao.execute("BEGIN")
+        conexao.execute("INSERT INTO enchimento SELECT randomblob(4096) FROM "
+                        "(WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) SELECT i FROM n)",
+                        (LOTE_ENCHIMENTO,))
+        conexao.execute("COMMIT")
+        conexao.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conexao.close()
+
+
+def carga(porta: int, usuarios: int, concorrencia: int, para: threading.Event, semente: int) -> dict:
+    """ Insere históricos com 'concorrencia' threads até 'para' e retorna
+        vazão, erros e latências em milissegundos.
+    """
+    from benchmark.carga import ClienteHttp
+    from benchmark.gerador import nome_categoria
+
+    latencias = []
+    erros = [0]
+    lock = threading.Lock()
+
+    def trabalha(numero):
+        cliente = ClienteHttp(porta)
+        aleatorio = random.Random(semente * 1000 + numero)
+        while not para.is_set():
+            corpo = {"user": aleatorio.randint(1, usuarios), "category": nome_categoria(aleatorio.randrange(10)),
+                     "score": "%d/10" % aleatorio.randint(0, 10)}
+            inicio = time.perf_counter()
+            status = cliente.requisita("POST", "/historico", corpo)
+            duracao = (time.perf_counter() - inicio) * 1000
+            with lock:
+                latencias.append(duracao)
+                if status != 200:
+                    erros[0] += 1
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=trabalha, args=(n,)) for n in range(concorrencia)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {"requisicoes": len(latencias), "erros": erros[0], "vazao": len(latencias) / duracao,
+            "p50_ms": percentil(latencias, 50), "p95_ms": percentil(latencias, 95),
+            "p99_ms": percentil(latencias, 99), "max_ms": latencias[-1] if latencias else 0.0}
+
+
+def mede_wal(arquivo: str, para: threading.Event, maximo: list):
+    """ Guarda em 'maximo' o maior tamanho do WAL de 'arquivo' até 'para'.
+    """
+    while not para.is_set():
+        try:
+            maximo[0] = max(maximo[0], os.path.getsize(arquivo + "-wal"))
+        except OSError:
+            pass
+        time.sleep(0.05)
+
+
+def fase(porta: int, arquivo: str, args, comando=None) -> dict:
+    """ Roda a carga por '--segundos' ou, com 'comando', enquanto ele executa.
+    """
+    para = threading.Event()
+    resultado = {}
+    wal = [0]
+    thread = threading.Thread(target=lambda: resultado.update(
+        carga(porta, args.usuarios, args.concorrencia, para, args.semente)))
+    thread.start()
+    medicao = threading.Thread(target=mede_wal, args=(arquivo, para, wal))
+    medicao.start()
+    duracao = None
+    try:
+        if comando is None:
+            time.sleep(args.segundos)
+        else:
+            ambiente = dict(os.environ, FLASK_APP="%s:create_app()" % os.path.join(DIR_API, "app.py"))
+            inicio = time.perf_counter()
+            subprocess.run([sys.executable, "-m", "flask"] + comando, env=ambiente, check=True,
+                           stdout=subprocess.DEVNULL)
+            duracao = time.perf_counter() - inicio
+    finally:
+        para.set()
+        thread.join()
+        medicao.join()
+    resultado["backup_s"] = duracao
+    resultado["wal_mb"] = wal[0] / 2 ** 20
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mb", type=int, default=2048, help="tamanho do banco, em megabytes")
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--historicos", type=int, default=100000)
+    parser.add_argument("--concorrencia", type=int, default=8)
+    parser.add_argument("--segundos", type=float, default=20, help="duração da fase sem backup")
+    parser.add_argument("--paginas", type=int, default=256)
+    parser.add_argument("--pausa-ms", type=float, default=10)
+    parser.add_argument("--nivel", type=int, default=1, help="nível do gzip nas duas fases com backup")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args()
+
+    diretorio = prepara_ambiente("backup_")
+    os.environ.setdefault("LOG_NIVEL", "WARNING")
+    from benchmark.carga import inicia_gunicorn, porta_livre
+    from benchmark.gerador import gera_dados
+    from model import obtem_engine, engines_dos_shards, arquivos_dos_bancos
+    gera_dados(obtem_engine(), args.usuarios, args.historicos, args.semente)
+    for engine in engines_dos_shards():
+        engine.dispose()
+    inicio = time.perf_counter()
+    enche_banco(arquivos_dos_bancos()[0], args.mb)
+    print("banco com %.0f MB em %s (enchimento em %.0f s)" % (
+        os.path.getsize(arquivos_dos_bancos()[0]) / 2 ** 20, diretorio, time.perf_counter() - inicio))
+
+    fases = (
+        ("sem backup", None),
+        ("backup em passos", ["backup-db", "--destino", "passos", "--paginas", str(args.paginas),
+                              "--pausa-ms", str(args.pausa_ms), "--nivel", str(args.nivel)]),
+        ("backup em um passo", ["backup-db", "--destino", "um_passo", "--paginas", str(2 ** 31 - 1),
+                                "--pausa-ms", "0", "--nivel", str(args.nivel)]),
+    )
+    porta = porta_livre()
+    processo = inicia_gunicorn(porta, args.workers, args.threads)
+    try:
+        print("%-20s %8s %6s %8s %8s %8s %8s %8s %9s %10s" % (
+            "fase", "req", "erros", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "backup s", "wal max MB"))
+        for nome, comando in fases:
+            r = fase(porta, arquivos_dos_bancos()[0], args, comando)
+            print("%-20s %8d %6d %8.1f %8.2f %8.2f %8.2f %8.2f %9s %10.1f" % (
+                nome, r["requisicoes"], r["erros"], r["vazao"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["max_ms"],
+                "-" if r["backup_s"] is None else "%.1f" % r["backup_s"], r["wal_mb"]))
+    finally:
+        processo.terminate()
+        processo.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+""" Executa todas as rotas da API sob carga em bancos de vários tamanhos.
+
+Para cada tamanho e modo, um processo separado gera os dados com
+benchmark.gerador e dispara as requisições pelo cliente de teste do Flask
+('flask') ou contra um gunicorn local ('gunicorn'). O resultado traz vazão,
+latências p50/p95/p99 por rota e o pico de memória (RSS), e é gravado em
+JSON para ser comparado entre commits com benchmark.compara.
+
+    (env)$ python -m benchmark.carga --tamanhos 1000x10000,10000x100000 \\
+                                     --modos flask,gunicorn --saida resultados.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from benchmark import prepara_ambiente, DIR_API
+
+
+def rotas(usuarios: int):
+    """ Retorna as rotas medidas e a função que monta cada requisição.
+
+    Cada função recebe um gerador aleatório e o índice da requisição e
+    retorna (método, caminho, corpo). As remoções usam os últimos ids, um
+    por requisição, e as demais escritas ficam na primeira metade dos
+    usuários para nunca atingir um usuário removido.
+    """
+    from benchmark.gerador import nome_categoria
+
+    metade = max(1, usuarios // 2)
+    return [
+        ("GET /usuarios", lambda a, i: (
+            "GET", "/usuarios?limit=100&after=%d" % a.randrange(usuarios), None)),
+        ("GET /usuario", lambda a, i: (
+            "GET", "/usuario?nome=usuario%d" % a.randrange(usuarios), None)),
+        ("POST /login", lambda a, i: (
+            "POST", "/login", {"email": "usuario%d@quiz.com" % a.randrange(usuarios), "senha": "senha"})),
+        ("POST /por-usuario", lambda a, i: (
+            "POST", "/por-usuario", {"userName": "usuario%d" % a.randrange(usuarios)})),
+        ("POST /por-categoria", lambda a, i: (
+            "POST", "/por-categoria", {"categoryName": nome_categoria(a.randrange(10))})),
+        ("POST /historico", lambda a, i: (
+            "POST", "/historico", {"user": a.randint(1, metade), "category": nome_categoria(a.randrange(10)),
+                                   "score": "%d/10" % a.randint(0, 10), "date": "2023-06-01T12:00:00"})),
+        ("PUT /usuario", lambda a, i: (
+            "PUT", "/usuario", {"id": a.randint(1, metade), "cidade": "Niterói"})),
+        ("DELETE /usuario", lambda a, i: (
+            "DELETE", "/usuario", {"id": max(1, usuarios - i)})),
+    ]
+
+
+class ClienteFlask:
+    """ Dispara as requisições pelo cliente de teste do Flask, no mesmo processo.
+    """
+
+    def __init__(self):
+        from app import create_app
+        self.cliente = create_app().test_client()
+
+    def requisita(self, metodo, caminho, corpo) -> int:
+        return self.cliente.open(caminho, method=metodo, json=corpo).status_code
+
+
+class ClienteHttp:
+    """ Dispara as requisições por HTTP, reaproveitando a conexão.
+    """
+
+    def __init__(self, porta: int):
+        self.conexao = http.client.HTTPConnection("127.0.0.1", porta, timeout=60)
+
+    def requisita(self, metodo, caminho, corpo, cabecalhos=None) -> int:
+        cabecalhos = dict(cabecalhos or {})
+        dados = None
+        if corpo is not None:
+            dados = json.dumps(corpo)
+            cabecalhos["Content-Type"] = "application/json"
+        self.conexao.request(metodo, caminho, body=dados, headers=cabecalhos)
+        resposta = self.conexao.getresponse()
+        resposta.read()
+        return resposta.status
+
+
+def percentil(valores, p: float) -> float:
+    """ Percentil pelo método do posto mais próximo, sobre valores ordenados.
+    """
+    if not valores:
+        return 0.0
+    indice = max(0, min(len(valores) - 1, int(round(p / 100.0 * len(valores))) - 1))
+    return valores[indice]
+
+
+def mede_rota(fabrica_cliente, requisicao, requisicoes: int, concorrencia: int, semente: int) -> dict:
+    """ Executa 'requisicoes' chamadas da rota divididas entre 'concorrencia'
+        threads e retorna vazão, erros e latências em milissegundos.
+    """
+    latencias = []
+    erros = [0]
+    lock = threading.Lock()
+    proximo = [0]
+
+    def trabalha(numero):
+        cliente = fabrica_cliente()
+        aleatorio = random.Random(semente * 1000 + numero)
+        while True:
+            with lock:
+                indice = proximo[0]
+                proximo[0] += 1
+            if indice >= requisicoes:
+                return
+            metodo, caminho, corpo = requisicao(aleatorio, indice)
+            inicio = time.perf_counter()
+            status = cliente.requisita(metodo, caminho, corpo)
+            duracao = (time.perf_counter() - inicio) * 1000
+            with lock:
+                latencias.append(duracao)
+                if status >= 500 or status in (400, 409):
+                    erros[0] += 1
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=trabalha, args=(n,)) for n in range(concorrencia)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        "requisicoes": len(latencias),
+        "erros": erros[0],
+        "vazao": len(latencias) / duracao,
+        "p50_ms": percentil(latencias, 50),
+        "p95_ms": percentil(latencias, 95),
+        "p99_ms": percentil(latencias, 99),
+    }
+
+
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def inicia_gunicorn(porta: int, workers: int, threads: int):
+    """ Inicia um gunicorn local no diretório corrente e espera ele aceitar conexões.
+    """
+    processo = subprocess.Popen([
+        sys.executable, "-m", "gunicorn", "--workers", str(workers), "--threads", str(threads),
+        "--bind", "127.0.0.1:%d" % porta, "--pythonpath", DIR_API, "--log-level", "warning", "app:create_app()"])
+    limite = time.time() + 60
+    while time.time() < limite:
+        try:
+            ClienteHttp(porta).requisita("GET", "/metrics", None)
+            return processo
+        except OSError:
+            time.sleep(0.2)
+    processo.terminate()
+    raise RuntimeError("gunicorn não respondeu na porta %d" % porta)
+
+
+def executa(args) -> dict:
+    """ Gera um banco do tamanho pedido e mede todas as rotas em um modo.
+
+    Roda em um processo próprio para que o banco, o cache e o pico de
+    memória de um tamanho não interfiram nos demais.
+    """
+    prepara_ambiente("carga_")
+    from model import obtem_engine
+    from benchmark.gerador import gera_dados
+    engine = obtem_engine()
+    gera_dados(engine, args.usuarios, args.historicos, args.semente)
+    engine.dispose()
+
+    processo = None
+    if args.modo == "gunicorn":
+        porta = porta_livre()
+        processo = inicia_gunicorn(porta, args.workers, args.threads)
+        fabrica = lambda: ClienteHttp(porta)
+    else:
+        fabrica = ClienteFlask
+
+    resultados = {}
+    try:
+        for nome, requisicao in rotas(args.usuarios):
+            resultados[nome] = mede_rota(fabrica, requisicao, args.requisicoes, args.concorrencia, args.semente)
+    finally:
+        if processo is not None:
+            processo.send_signal(signal.SIGTERM)
+            processo.wait()
+
+    # no modo gunicorn o pico é o do maior processo do servidor já encerrado
+    quem = resource.RUSAGE_CHILDREN if processo is not None else resource.RUSAGE_SELF
+    return {
+        "modo": args.modo,
+        "usuarios": args.usuarios,
+        "historicos": args.historicos,
+        "pico_rss_kb": resource.getrusage(quem).ru_maxrss,
+        "rotas": resultados,
+    }
+
+
+def commit_atual():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=DIR_API,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def imprime(execucao: dict):
+    print("\n%s - %d usuários, %d históricos, pico RSS %.1f MiB"
+          % (execucao["modo"], execucao["usuarios"], execucao["historicos"], execucao["pico_rss_kb"] / 1024))
+    print("%-20s %10s %10s %10s %10s %6s" % ("rota", "req/s", "p50 ms", "p95 ms", "p99 ms", "erros"))
+    for nome, r in execucao["rotas"].items():
+        print("%-20s %10.1f %10.2f %10.2f %10.2f %6d"
+              % (nome, r["vazao"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["erros"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tamanhos", default="1000x10000,10000x100000",
+                        help="lista de usuariosxhistoricos separados por vírgula")
+    parser.add_argument("--modos", default="flask,gunicorn")
+    parser.add_argument("--requisicoes", type=int, default=200, help="requisições por rota")
+    parser.add_argument("--concorrencia", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--saida", default="resultados_benchmark.json")
+    # parâmetros internos de uma execução isolada
+    parser.add_argument("--execucao", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--usuarios", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--historicos", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--modo", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.execucao:
+        resultado = executa(args)
+        with open(args.saida, "w") as arquivo:
+            json.dump(resultado, arquivo)
+        return
+
+    saida = os.path.abspath(args.saida)
+    ambiente = dict(os.environ, LOG_NIVEL=os.environ.get("LOG_NIVEL", "WARNING"))
+    execucoes = []
+    for modo in args.modos.split(","):
+        for tamanho in args.tamanhos.split(","):
+            usuarios, historicos = (int(v) for v in tamanho.split("x"))
+            parcial = tempfile.mktemp(suffix=".json")
+            subprocess.run([
+                sys.executable, "-m", "benchmark.carga", "--execucao", "--modo", modo,
+                "--usuarios", str(usuarios), "--historicos", str(historicos),
+                "--requisicoes", str(args.requisicoes), "--concorrencia", str(args.concorrencia),
+                "--workers", str(args.workers), "--threads", str(args.threads),
+                "--semente", str(args.semente), "--saida", parcial],
+                cwd=DIR_API, env=ambiente, check=True, stdout=subprocess.DEVNULL)
+            with open(parcial) as arquivo:
+                execucao = json.load(arquivo)
+            os.remove(parcial)
+            imprime(execucao)
+            execucoes.append(execucao)
+
+    with open(saida, "w") as arquivo:
+        json.dump({
+            "commit": commit_atual(),
+            "data": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "parametros": {"requisicoes": args.requisicoes, "concorrencia": args.concorrencia,
+                           "workers": args.workers, "threads": args.threads, "semente": args.semente},
+            "execucoes": execucoes,
+        }, arquivo, indent=2)
+    print("\nresultados gravados em %s" % saida)
+
+
+if __name__ == "__main__":
+    main()
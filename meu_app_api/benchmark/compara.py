@@ -0,0 +1,54 @@
+""" Compara dois arquivos de resultados de benchmark.carga.
+
+Lista, por modo, tamanho e rota, a variação de vazão e de p95 e termina com
+código 1 se alguma rota piorar além da tolerância.
+
+    (env)$ python -m benchmark.compara base.json novo.json [--tolerancia 0.15]
+"""
+import argparse
+import json
+import sys
+
+
+def indexa(resultados: dict) -> dict:
+    """ Retorna {(modo, usuarios, historicos, rota): medidas}.
+    """
+    return {(e["modo"], e["usuarios"], e["historicos"], rota): medidas
+            for e in resultados["execucoes"] for rota, medidas in e["rotas"].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base")
+    parser.add_argument("novo")
+    parser.add_argument("--tolerancia", type=float, default=0.15,
+                        help="piora relativa aceita na vazão e no p95")
+    args = parser.parse_args()
+
+    with open(args.base) as arquivo:
+        base = json.load(arquivo)
+    with open(args.novo) as arquivo:
+        novo = json.load(arquivo)
+    print("base %s (%s) x novo %s (%s)" % (base.get("commit"), base.get("data"), novo.get("commit"), novo.get("data")))
+
+    anteriores = indexa(base)
+    regressoes = 0
+    print("%-9s %-14s %-20s %10s %10s" % ("modo", "tamanho", "rota", "vazão", "p95"))
+    for chave, medidas in sorted(indexa(novo).items()):
+        if chave not in anteriores:
+            continue
+        antes = anteriores[chave]
+        vazao = medidas["vazao"] / antes["vazao"] - 1 if antes["vazao"] else 0.0
+        p95 = medidas["p95_ms"] / antes["p95_ms"] - 1 if antes["p95_ms"] else 0.0
+        piorou = vazao < -args.tolerancia or p95 > args.tolerancia
+        regressoes += piorou
+        modo, usuarios, historicos, rota = chave
+        print("%-9s %-14s %-20s %+9.1f%% %+9.1f%% %s"
+              % (modo, "%dx%d" % (usuarios, historicos), rota, vazao * 100, p95 * 100,
+                 "REGRESSÃO" if piorou else ""))
+
+    return 1 if regressoes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+""" Mede os bytes enviados e a latência de GET /usuario e GET /usuarios com
+a resposta completa, comprimida com gzip, só com alguns campos ('fields') e
+revalidada com If-None-Match (304).
+
+As requisições são feitas por HTTP a um gunicorn local, em um banco novo
+gerado por benchmark.gerador. Os bytes contam o corpo, como enviado, e os
+cabeçalhos da resposta. Antes da revalidação os ETags de cada recurso são
+obtidos por uma requisição que não entra na medição.
+
+    (env)$ python -m benchmark.condicional [--usuarios 2000] [--historicos 100000] [--requisicoes 1000] \\
+                                           [--recursos 200]
+"""
+import argparse
+import http.client
+import os
+import random
+import time
+
+from benchmark import prepara_ambiente
+from benchmark.carga import percentil
+
+CAMPOS_USUARIO = "id,nome,email,cep,logradouro,bairro,cidade,estado"
+CAMPOS_LISTAGEM = "id,nome"
+
+# cenário -> (parâmetros extras da url, cabeçalhos, revalida com o ETag)
+CENARIOS = (
+    ("completa", "", {}, False),
+    ("gzip", "", {"Accept-Encoding": "gzip"}, False),
+    ("fields", "&fields={campos}", {}, False),
+    ("fields+gzip", "&fields={campos}", {"Accept-Encoding": "gzip"}, False),
+    ("304", "", {"Accept-Encoding": "gzip"}, True),
+)
+
+
+def requisita(conexao, caminho: str, cabecalhos: dict):
+    """ Faz um GET e retorna o status, os bytes da resposta e o ETag.
+    """
+    conexao.request("GET", caminho, headers=cabecalhos)
+    resposta = conexao.getresponse()
+    corpo = resposta.read()
+    return resposta.status, len(corpo) + len(str(resposta.msg)), resposta.getheader("ETag")
+
+
+def mede(conexao, caminhos, cabecalhos: dict, etags, requisicoes: int, semente: int) -> dict:
+    """ Faz 'requisicoes' GETs em caminhos sorteados e retorna as latências
+        e a média de bytes por resposta.
+    """
+    aleatorio = random.Random(semente)
+    latencias = []
+    total_bytes = 0
+    status = set()
+    for _ in range(requisicoes):
+        caminho = aleatorio.choice(caminhos)
+        extras = dict(cabecalhos)
+        if etags is not None:
+            extras["If-None-Match"] = etags[caminho]
+        inicio = time.perf_counter()
+        codigo, quantidade, _ = requisita(conexao, caminho, extras)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        total_bytes += quantidade
+        status.add(codigo)
+    latencias.sort()
+    return {"bytes": total_bytes / requisicoes, "p50_ms": percentil(latencias, 50),
+            "p95_ms": percentil(latencias, 95), "status": sorted(status)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--historicos", type=int, default=100000)
+    parser.add_argument("--requisicoes", type=int, default=1000)
+    parser.add_argument("--recursos", type=int, default=200, help="usuarios e páginas distintos pedidos")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args()
+
+    prepara_ambiente("condicional_")
+    # mede as leituras do banco, não os acertos do cache
+    os.environ["CACHE_BACKEND"] = "desligado"
+    os.environ.setdefault("LOG_NIVEL", "WARNING")
+    from benchmark.carga import inicia_gunicorn, porta_livre
+    from benchmark.gerador import gera_dados
+    from model import obtem_engine, engines_dos_shards
+    gera_dados(obtem_engine(), args.usuarios, args.historicos, args.semente)
+    for engine in engines_dos_shards():
+        engine.dispose()
+
+    aleatorio = random.Random(args.semente)
+    rotas = {
+        "GET /usuario": (["/usuario?nome=usuario%d" % aleatorio.randrange(args.usuarios)
+                          for _ in range(args.recursos)], CAMPOS_USUARIO),
+        "GET /usuarios": (["/usuarios?limit=100&after=%d" % aleatorio.randrange(args.usuarios)
+                           for _ in range(args.recursos)], CAMPOS_LISTAGEM),
+    }
+
+    porta = porta_livre()
+    processo = inicia_gunicorn(porta, args.workers, args.threads)
+    try:
+        conexao = http.client.HTTPConnection("127.0.0.1", porta, timeout=60)
+        print("%-14s %-12s %10s %8s %8s %8s %s" % ("rota", "cenário", "bytes", "% bytes", "p50 ms", "p95 ms",
+                                                    "status"))
+        for nome, (caminhos, campos) in rotas.items():
+            base = None
+            for cenario, parametros, cabecalhos, revalida in CENARIOS:
+                pedidos = [caminho + parametros.format(campos=campos) for caminho in caminhos]
+                etags = None
+                if revalida:
+                    etags = {caminho: requisita(conexao, caminho, cabecalhos)[2] for caminho in pedidos}
+                r = mede(conexao, pedidos, cabecalhos, etags, args.requisicoes, args.semente)
+                base = base or r["bytes"]
+                print("%-14s %-12s %10.0f %7.1f%% %8.2f %8.2f %s" % (
+                    nome, cenario, r["bytes"], 100 * r["bytes"] / base, r["p50_ms"], r["p95_ms"],
+                    ",".join(str(s) for s in r["status"])))
+    finally:
+        processo.terminate()
+        processo.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+""" Verifica a quantidade de comandos SQL emitidos por cada rota da API.
+
+Executa as rotas pelo cliente de teste do Flask em um banco temporário
+populado com vários usuários e históricos e compara a quantidade de
+comandos com o limite esperado. Uma consulta N+1 faz a contagem crescer
+com a quantidade de registros e o script termina com código 1.
+
+    (env)$ python -m benchmark.contagem_consultas
+"""
+import os
+import sys
+
+from benchmark import prepara_ambiente, dados_usuario
+
+# quantidade de registros usada para tornar visível uma consulta N+1
+USUARIOS = 20
+HISTORICOS_POR_USUARIO = 5
+
+# rota -> (método, caminho, corpo, limite de comandos SQL)
+ROTAS = {
+    # versão da listagem, para o ETag, e a página
+    "GET /usuarios": ("get", "/usuarios", None, 2),
+    "GET /usuario": ("get", "/usuario?nome=usuario0", None, 2),
+    "POST /login": ("post", "/login", {"email": "usuario0@quiz.com", "senha": "senha"}, 1),
+    "POST /por-usuario": ("post", "/por-usuario", {"userName": "usuario0"}, 2),
+    "POST /por-categoria": ("post", "/por-categoria", {"categoryName": "categoria0"}, 1),
+    "POST /historico": ("post", "/historico",
+                        {"user": 1, "category": "categoria0", "score": "5/10", "date": "2023-01-01"}, 7),
+    "POST /historicos/batch": ("post", "/historicos/batch", {"historicos": [
+        {"usuario_id": i % USUARIOS + 1, "categoria": "categoria0", "score": "5/10", "data": "2023-01-01"}
+        for i in range(50)]}, 4),
+    "GET /estatisticas": ("get", "/estatisticas/categoria", None, 1),
+    "GET /historico/serie": ("get", "/historico/serie?inicio=2022-12-01&fim=2023-01-31", None, 1),
+    "GET /ranking": ("get", "/ranking?categoria=categoria0&usuario_id=3", None, 4),
+    "PUT /usuario": ("put", "/usuario", {"id": 1, "cidade": "Niterói"}, 4),
+    "GET /busca/usuarios": ("get", "/busca/usuarios?q=usuario1", None, 1),
+    # sem nenhum nome com o trecho: vocabulário de trigramas e busca aproximada
+    "GET /busca aproximada": ("get", "/busca/usuarios?q=usario1", None, 3),
+    "GET /busca/categorias": ("get", "/busca/categorias?q=categ", None, 1),
+    # maior id dos históricos e versão do banco, para o ETag, e a leitura em
+    # lotes com o nome do usuário, todos na mesma transação
+    "GET /historicos/exportacao": ("get", "/historicos/exportacao?formato=colunar&categoria=categoria0", None, 3),
+    # um lote: seleção dos usuarios, tabela temporária do lote e o UPDATE,
+    # e a seleção vazia que termina a operação
+    "PUT /usuarios/batch": ("put", "/usuarios/batch", {"filtro": {"estado": "RJ"}, "valores": {"cidade": "Niterói"}},
+                            6),
+    # idem, com o desconto do resumo diário dos históricos e dos arquivados,
+    # o das categorias dos arquivados e os dois DELETEs; os históricos e o
+    # ranking saem pelo ON DELETE CASCADE. Só o último usuario existe, para
+    # que o filtro de emails não seja reconstruído
+    "DELETE /usuarios/batch": ("delete", "/usuarios/batch", {"ids": list(range(USUARIOS, USUARIOS + 50))}, 22),
+}
+
+# rotas com ETag -> (caminho, limite de comandos SQL da revalidação com
+# If-None-Match, que responde 304 lendo só a versão)
+REVALIDACOES = {
+    "GET /usuarios 304": ("/usuarios", 1),
+    "GET /usuario 304": ("/usuario?nome=usuario0", 1),
+}
+
+# emails não cadastrados, respondidos pelo filtro de emails sem consultar o
+# banco -> (método, caminho, corpo, status esperado)
+EMAILS_DESCONHECIDOS = {
+    "POST /login desconhecido": ("post", "/login", {"email": "ninguem@quiz.com", "senha": "senha"}, 404),
+    "GET /disponibilidade": ("get", "/usuario/disponibilidade?email=ninguem@quiz.com", None, 200),
+}
+
+
+def popula(cliente):
+    """ Cadastra os usuários e históricos usados na verificação.
+    """
+    for i in range(USUARIOS):
+        cliente.post("/usuario", json=dados_usuario(i))
+        for j in range(HISTORICOS_POR_USUARIO):
+            cliente.post("/historico", json={
+                "user": i + 1, "category": "categoria%d" % (j % 2),
+                "score": "%d/10" % j, "date": "2023-01-01"})
+
+
+# comandos de controle de transação, que não dependem da quantidade de
+# registros e variam com o ESCRITA_MODO
+CONTROLE_TRANSACAO = ("BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK")
+
+
+def conta_comandos(funcao):
+    """ Executa 'funcao' e retorna os comandos SQL emitidos, em qualquer
+        engine, exceto os de controle de transação.
+    """
+    from sqlalchemy import event
+    # as rotas de leitura e as de escrita usam engines diferentes
+    from sqlalchemy.engine import Engine as engine
+
+    comandos = []
+
+    def registra(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(CONTROLE_TRANSACAO):
+            comandos.append(statement)
+
+    event.listen(engine, "before_cursor_execute", registra)
+    try:
+        funcao()
+    finally:
+        event.remove(engine, "before_cursor_execute", registra)
+    return comandos
+
+
+def main():
+    prepara_ambiente("contagem_consultas_")
+    # mede as consultas ao banco, não os acertos do cache
+    os.environ.setdefault("CACHE_BACKEND", "desligado")
+    # os limites valem para um único banco; com shards as rotas que leem
+    # todos eles emitem uma consulta por shard
+    os.environ["DB_SHARDS"] = "1"
+    from app import create_app
+    from filtro_emails import filtro_emails
+    from model import emails_registrados
+
+    cliente = create_app().test_client()
+    popula(cliente)
+    # o aquecimento da primeira requisição roda em segundo plano
+    filtro_emails.aquece(emails_registrados)
+
+    falhas = 0
+    for nome, (metodo, caminho, corpo, limite) in ROTAS.items():
+        resposta = []
+
+        def requisita():
+            resposta.append(getattr(cliente, metodo)(caminho, json=corpo))
+            # as respostas em streaming só consultam o banco quando lidas
+            resposta[0].get_data()
+
+        comandos = conta_comandos(requisita)
+        falhas += not relata(nome, resposta[0].status_code, 200, comandos, limite)
+
+    for nome, (caminho, limite) in REVALIDACOES.items():
+        etag = cliente.get(caminho).headers["ETag"]
+        resposta = []
+        comandos = conta_comandos(lambda: resposta.append(cliente.get(caminho, headers={"If-None-Match": etag})))
+        falhas += not relata(nome, resposta[0].status_code, 304, comandos, limite)
+
+    for nome, (metodo, caminho, corpo, esperado) in EMAILS_DESCONHECIDOS.items():
+        resposta = []
+        comandos = conta_comandos(lambda: resposta.append(getattr(cliente, metodo)(caminho, json=corpo)))
+        falhas += not relata(nome, resposta[0].status_code, esperado, comandos, 0)
+
+    return 1 if falhas else 0
+
+
+def relata(nome, status, esperado, comandos, limite) -> bool:
+    """ Imprime o resultado de uma rota e retorna se ela passou.
+    """
+    ok = status == esperado and len(comandos) <= limite
+    print("%-22s status=%d comandos=%d limite=%d %s"
+          % (nome, status, len(comandos), limite, "ok" if ok else "FALHOU"))
+    if not ok:
+        for comando in comandos:
+            print("    " + " ".join(comando.split()))
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(main())
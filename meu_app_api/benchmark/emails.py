@@ -0,0 +1,123 @@
+""" Compara o login e a consulta de disponibilidade de emails não
+cadastrados com e sem o filtro de emails (EMAILS_FILTRO), e confere que um
+usuario cadastrado por um worker consegue entrar logo em seguida por outro.
+
+Cada configuração roda em um gunicorn local novo sobre o mesmo banco,
+gerado por benchmark.gerador. Antes da medição o script espera o filtro
+ser aquecido em todos os workers. O login de emails cadastrados entra na
+comparação para mostrar o custo dos positivos, que ainda vão ao banco.
+
+    (env)$ python -m benchmark.emails [--usuarios 100000] [--historicos 100000] [--requisicoes 4000] \\
+                                      [--concorrencia 8] [--cadastros 200]
+"""
+import argparse
+import os
+import time
+
+from benchmark import prepara_ambiente, dados_usuario
+
+# configuração -> valor de EMAILS_FILTRO
+CONFIGURACOES = (("sem filtro", "0"), ("com filtro", "1"))
+
+
+def rotas(usuarios: int):
+    """ Retorna as rotas medidas e a função que monta cada requisição.
+    """
+    return [
+        ("POST /login desconhecido", lambda a, i: (
+            "POST", "/login", {"email": "bot%d@spam.com" % a.randrange(10 ** 9), "senha": "senha"})),
+        ("GET /disponibilidade livre", lambda a, i: (
+            "GET", "/usuario/disponibilidade?email=novo%d@quiz.com" % a.randrange(10 ** 9), None)),
+        ("POST /login cadastrado", lambda a, i: (
+            "POST", "/login", {"email": "usuario%d@quiz.com" % a.randrange(usuarios), "senha": "senha"})),
+    ]
+
+
+def espera_aquecimento(porta: int, usuarios: int, amostras: int = 40):
+    """ Espera o filtro ter todos os emails em 'amostras' seguidas do
+        /metrics, cada uma por uma conexão nova e portanto por qualquer worker.
+    """
+    from benchmark.carga import ClienteHttp
+
+    limite = time.time() + 300
+    seguidas = 0
+    while seguidas < amostras:
+        if time.time() > limite:
+            raise RuntimeError("o filtro de emails não foi aquecido")
+        cliente = ClienteHttp(porta)
+        cliente.conexao.request("GET", "/metrics")
+        texto = cliente.conexao.getresponse().read().decode()
+        cliente.conexao.close()
+        aquecido = any(linha.startswith('filtro_emails_total{tipo="emails"}') and float(linha.split()[-1]) >= usuarios
+                       for linha in texto.splitlines())
+        seguidas = seguidas + 1 if aquecido else 0
+        if not aquecido:
+            time.sleep(0.2)
+
+
+def confere_cadastros(porta: int, cadastros: int, inicio: int) -> int:
+    """ Cadastra usuarios e faz o login de cada um por uma conexão nova, em
+        qualquer worker. Retorna quantos logins não encontraram o usuario.
+    """
+    from benchmark.carga import ClienteHttp
+
+    perdidos = 0
+    for i in range(inicio, inicio + cadastros):
+        dados = dados_usuario(i)
+        ClienteHttp(porta).requisita("POST", "/usuario", dados)
+        status = ClienteHttp(porta).requisita("POST", "/login", {"email": dados["email"], "senha": dados["senha"]})
+        perdidos += status == 404
+    return perdidos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=100000)
+    parser.add_argument("--historicos", type=int, default=100000)
+    parser.add_argument("--requisicoes", type=int, default=4000)
+    parser.add_argument("--concorrencia", type=int, default=8)
+    parser.add_argument("--cadastros", type=int, default=200, help="usuarios cadastrados na conferência")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args()
+
+    prepara_ambiente("emails_")
+    os.environ["CACHE_BACKEND"] = "desligado"
+    os.environ.setdefault("LOG_NIVEL", "ERROR")
+    os.environ.setdefault("EMAILS_FILTRO_CAPACIDADE", str(2 * args.usuarios))
+    from benchmark.carga import ClienteHttp, inicia_gunicorn, mede_rota, porta_livre
+    from benchmark.gerador import gera_dados
+    from filtro_emails import FiltroBloom, EMAILS_FILTRO_FP, EMAILS_FILTRO_MAX_KB
+    from model import obtem_engine, engines_dos_shards
+    gera_dados(obtem_engine(), args.usuarios, args.historicos, args.semente)
+    for engine in engines_dos_shards():
+        engine.dispose()
+
+    filtro = FiltroBloom(int(os.environ["EMAILS_FILTRO_CAPACIDADE"]), EMAILS_FILTRO_FP, EMAILS_FILTRO_MAX_KB * 1024)
+    print("filtro: %d KB por worker, %d hashes, taxa de falsos positivos pedida %.3f"
+          % (len(filtro.bits) // 1024, filtro.hashes, EMAILS_FILTRO_FP))
+    print("%-12s %-26s %8s %8s %8s %8s %6s" % ("config", "rota", "req/s", "p50 ms", "p95 ms", "p99 ms", "erros"))
+    cadastrados = args.usuarios
+    for nome, valor in CONFIGURACOES:
+        os.environ["EMAILS_FILTRO"] = valor
+        porta = porta_livre()
+        processo = inicia_gunicorn(porta, args.workers, args.threads)
+        try:
+            if valor == "1":
+                espera_aquecimento(porta, args.usuarios)
+            for rota, requisicao in rotas(args.usuarios):
+                r = mede_rota(lambda: ClienteHttp(porta), requisicao, args.requisicoes, args.concorrencia,
+                              args.semente)
+                print("%-12s %-26s %8.1f %8.2f %8.2f %8.2f %6d" % (
+                    nome, rota, r["vazao"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["erros"]))
+            perdidos = confere_cadastros(porta, args.cadastros, cadastrados)
+            cadastrados += args.cadastros
+            print("%-12s %d cadastros, %d logins seguintes sem encontrar o usuario" % (nome, args.cadastros, perdidos))
+        finally:
+            processo.terminate()
+            processo.wait()
+
+
+if __name__ == "__main__":
+    main()
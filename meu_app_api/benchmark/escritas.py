@@ -0,0 +1,115 @@
+""" Compara a vazão e a latência das escritas concorrentes com o escritor
+agrupado (ESCRITA_MODO=agrupada) e com um commit por requisição
+(ESCRITA_MODO=direta).
+
+Cada combinação de modo, servidor e PRAGMA synchronous roda em um processo
+separado, com um banco novo, disparando POST /historico e POST /usuario
+intercalados a partir de '--concorrencia' threads. No servidor 'gunicorn'
+as threads disputam o banco entre vários workers, cada um com o seu
+escritor; no 'flask' todas passam pelo cliente de teste de um processo.
+
+    (env)$ python -m benchmark.escritas [--requisicoes 2000] [--concorrencia 16] \\
+                                        [--servidores flask,gunicorn] [--synchronous NORMAL,FULL]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmark import prepara_ambiente, dados_usuario, DIR_API
+
+MODOS = ("direta", "agrupada")
+USUARIOS = 100
+
+
+def requisicao(aleatorio, indice):
+    """ Três inserções de histórico para cada cadastro de usuário.
+    """
+    if indice % 4 == 3:
+        return "POST", "/usuario", dados_usuario(USUARIOS + indice)
+    return "POST", "/historico", {"user": aleatorio.randint(1, USUARIOS), "category": "categoria%d" % (indice % 7),
+                                  "score": "%d/10" % aleatorio.randint(0, 10)}
+
+
+def executa(args) -> dict:
+    """ Mede as escritas em um banco novo com a configuração do ambiente.
+    """
+    prepara_ambiente("escritas_")
+    from benchmark.carga import mede_rota, ClienteFlask, ClienteHttp, inicia_gunicorn, porta_livre
+    from model import obtem_engine
+    from benchmark.gerador import gera_dados
+    engine = obtem_engine()
+    gera_dados(engine, USUARIOS, 0, args.semente)
+    engine.dispose()
+
+    processo = None
+    if args.servidor == "gunicorn":
+        porta = porta_livre()
+        processo = inicia_gunicorn(porta, args.workers, args.threads)
+        fabrica = lambda: ClienteHttp(porta)
+    else:
+        cliente = ClienteFlask()
+        fabrica = lambda: cliente
+    try:
+        resultado = mede_rota(fabrica, requisicao, args.requisicoes, args.concorrencia, args.semente)
+    finally:
+        if processo is not None:
+            processo.terminate()
+            processo.wait()
+
+    if args.servidor == "flask":
+        from escritor import escritor
+        resultado.update(escritor.estatisticas())
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requisicoes", type=int, default=2000)
+    parser.add_argument("--concorrencia", type=int, default=16)
+    parser.add_argument("--servidores", default="flask,gunicorn")
+    parser.add_argument("--synchronous", default="NORMAL,FULL")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--semente", type=int, default=42)
+    # parâmetros internos de uma execução isolada
+    parser.add_argument("--execucao", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--servidor", help=argparse.SUPPRESS)
+    parser.add_argument("--saida", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.execucao:
+        resultado = executa(args)
+        with open(args.saida, "w") as arquivo:
+            json.dump(resultado, arquivo)
+        return
+
+    print("%-9s %-6s %-9s %10s %8s %8s %8s %6s %11s" % (
+        "servidor", "sync", "escrita", "req/s", "p50 ms", "p95 ms", "p99 ms", "erros", "transações"))
+    for servidor in args.servidores.split(","):
+        for synchronous in args.synchronous.split(","):
+            vazoes = {}
+            for modo in MODOS:
+                saida = tempfile.mktemp(suffix=".json")
+                ambiente = dict(os.environ, ESCRITA_MODO=modo, DB_SYNCHRONOUS=synchronous,
+                                LOG_NIVEL="WARNING", CACHE_BACKEND="desligado")
+                subprocess.run([
+                    sys.executable, "-m", "benchmark.escritas", "--execucao", "--servidor", servidor,
+                    "--requisicoes", str(args.requisicoes), "--concorrencia", str(args.concorrencia),
+                    "--workers", str(args.workers), "--threads", str(args.threads),
+                    "--semente", str(args.semente), "--saida", saida],
+                    cwd=DIR_API, env=ambiente, check=True, stdout=subprocess.DEVNULL)
+                with open(saida) as arquivo:
+                    r = json.load(arquivo)
+                os.remove(saida)
+                vazoes[modo] = r["vazao"]
+                print("%-9s %-6s %-9s %10.1f %8.2f %8.2f %8.2f %6d %11s" % (
+                    servidor, synchronous, modo, r["vazao"], r["p50_ms"], r["p95_ms"], r["p99_ms"], r["erros"],
+                    r.get("transacoes", "-")))
+            print("%-9s %-6s %-9s %9.2fx" % (servidor, synchronous, "ganho", vazoes["agrupada"] / vazoes["direta"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+""" Gera usuários e históricos sintéticos em um banco SQLite de rascunho.
+
+Os dados dependem apenas da semente, então duas execuções com os mesmos
+parâmetros geram bancos idênticos e os resultados podem ser comparados.
+
+    (env)$ python -m benchmark.gerador --usuarios 10000 --historicos 100000 [--destino dir]
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from benchmark import prepara_ambiente, dados_usuario
+
+# linhas inseridas por executemany, para não montar a tabela inteira na memória
+LOTE_INSERCAO = 10000
+DATA_INICIAL = datetime(2023, 1, 1)
+
+
+def nome_categoria(i: int) -> str:
+    return "categoria%d" % i
+
+
+def quantidade_categorias(historicos: int) -> int:
+    """ Quantidade de categorias usada para a quantidade de históricos, com
+        cerca de mil históricos por categoria.
+    """
+    return max(10, historicos // 1000)
+
+
+def gera_dados(engine, usuarios: int, historicos: int, semente: int = 42):
+    """ Insere os usuários e históricos sintéticos no banco da engine.
+
+    Usa inserções em lote direto nas tabelas e reconstrói o ranking, o
+    resumo diário e a busca no fim, como fariam os comandos 'flask
+    rebuild-*'. Com DB_SHARDS > 1 a engine é a do primeiro shard, e os
+    dados são divididos entre todos os shards do processo e o diretório.
+    """
+    from model import DB_SHARDS, engines_dos_shards, engine_diretorio, copia_para_shards
+
+    aleatorio = random.Random(semente)
+    categorias = quantidade_categorias(historicos)
+
+    def linhas_historico():
+        for id in range(1, historicos + 1):
+            total = 10
+            acertos = aleatorio.randint(0, total)
+            yield {
+                "id": id, "usuario": aleatorio.randint(1, usuarios),
+                "categoria": nome_categoria(aleatorio.randrange(categorias)),
+                "score": "%d/%d" % (acertos, total), "acertos": acertos, "total": total,
+                "data_insercao": DATA_INICIAL + timedelta(minutes=aleatorio.randrange(365 * 24 * 60))}
+
+    destinos = engines_dos_shards() if DB_SHARDS > 1 else [engine]
+    copia_para_shards(destinos, (dict(dados_usuario(i), id=i + 1) for i in range(usuarios)), linhas_historico(),
+                      diretorio=engine_diretorio(), lote=LOTE_INSERCAO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=10000)
+    parser.add_argument("--historicos", type=int, default=100000)
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--destino", help="diretório do banco; por padrão um diretório temporário")
+    args = parser.parse_args()
+
+    diretorio = prepara_ambiente("gerador_", args.destino)
+    from model import obtem_engine
+    gera_dados(obtem_engine(), args.usuarios, args.historicos, args.semente)
+    print("%d usuários e %d históricos gerados em %s/database/"
+          % (args.usuarios, args.historicos, diretorio))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+""" Compara a vazão de inserção de históricos registro a registro, pela rota
+POST /historico, com a inserção em lote, pela rota POST /historicos/batch.
+
+    (env)$ python -m benchmark.historicos_lote [--registros 2000] [--lote 1000]
+"""
+import argparse
+import logging
+import time
+
+from benchmark import prepara_ambiente, dados_usuario
+
+USUARIOS = 50
+
+
+def mede(funcao, registros: int) -> float:
+    """ Executa 'funcao' e retorna a vazão em registros por segundo.
+    """
+    inicio = time.perf_counter()
+    funcao()
+    return registros / (time.perf_counter() - inicio)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--registros", type=int, default=2000)
+    parser.add_argument("--lote", type=int, default=1000)
+    args = parser.parse_args()
+
+    prepara_ambiente("historicos_lote_")
+    from app import create_app
+
+    # os logs de depuração das rotas não fazem parte da medição
+    logging.disable(logging.INFO)
+    cliente = create_app().test_client()
+    for i in range(USUARIOS):
+        cliente.post("/usuario", json=dados_usuario(i))
+
+    def individual():
+        for i in range(args.registros):
+            resposta = cliente.post("/historico", json={
+                "user": i % USUARIOS + 1, "category": "categoria%d" % (i % 7),
+                "score": "%d/10" % (i % 11), "date": "2023-01-01T10:00:00"})
+            assert resposta.status_code == 200
+
+    def em_lote():
+        for inicio in range(0, args.registros, args.lote):
+            historicos = [{
+                "usuario_id": i % USUARIOS + 1, "categoria": "categoria%d" % (i % 7),
+                "score": "%d/10" % (i % 11), "data": "2023-01-01T10:00:00"}
+                for i in range(inicio, min(inicio + args.lote, args.registros))]
+            resposta = cliente.post("/historicos/batch", json={"historicos": historicos})
+            assert resposta.json["inseridos"] == len(historicos)
+
+    vazao_individual = mede(individual, args.registros)
+    vazao_lote = mede(em_lote, args.registros)
+    print("POST /historico         %10.0f registros/s" % vazao_individual)
+    print("POST /historicos/batch  %10.0f registros/s" % vazao_lote)
+    print("ganho                   %10.1fx" % (vazao_lote / vazao_individual))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+""" Mede o tempo de inicialização da API, do import até a primeira resposta.
+
+Cada amostra é um processo novo que importa o app, chama create_app e faz
+a primeira requisição pelo cliente de teste do Flask, que é quando a engine
+é criada. Com '--banco novo' cada amostra começa sem banco e a primeira
+requisição também cria o esquema; com '--banco existente' o banco é
+preparado antes pelo 'flask init-db' e a API roda com DB_INICIALIZA=0.
+
+    (env)$ python -m benchmark.inicializacao [--amostras 10] [--banco novo,existente]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmark import DIR_API
+
+ETAPAS = ("import", "create_app", "primeira_requisicao")
+
+
+def amostra():
+    """ Executada no processo filho: imprime em JSON a duração de cada etapa.
+    """
+    import time
+    inicio = time.perf_counter()
+    from app import create_app
+    importado = time.perf_counter()
+    app = create_app()
+    criado = time.perf_counter()
+    resposta = app.test_client().get("/usuarios?limit=1")
+    respondido = time.perf_counter()
+    assert resposta.status_code == 200, resposta.status_code
+    print(json.dumps({"import": importado - inicio, "create_app": criado - importado,
+                      "primeira_requisicao": respondido - criado}))
+
+
+def executa(banco: str, amostras: int) -> dict:
+    """ Retorna as durações em segundos de cada etapa, por amostra.
+    """
+    duracoes = {etapa: [] for etapa in ETAPAS}
+    ambiente = dict(os.environ, LOG_NIVEL="WARNING")
+    diretorio = None
+    if banco == "existente":
+        diretorio = tempfile.mkdtemp(prefix="inicializacao_")
+        subprocess.run([sys.executable, "-m", "flask", "init-db"], cwd=diretorio, check=True,
+                       env=dict(ambiente, FLASK_APP="app", PYTHONPATH=DIR_API), stdout=subprocess.DEVNULL)
+        ambiente["DB_INICIALIZA"] = "0"
+
+    for _ in range(amostras):
+        cwd = diretorio or tempfile.mkdtemp(prefix="inicializacao_")
+        saida = subprocess.check_output([sys.executable, "-c", "from benchmark.inicializacao import amostra; amostra()"],
+                                        cwd=cwd, env=dict(ambiente, PYTHONPATH=DIR_API), text=True)
+        for etapa, duracao in json.loads(saida.splitlines()[-1]).items():
+            duracoes[etapa].append(duracao)
+    return duracoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--amostras", type=int, default=10)
+    parser.add_argument("--banco", default="novo,existente")
+    args = parser.parse_args()
+
+    print("%-10s %-20s %10s %10s" % ("banco", "etapa", "mediana ms", "max ms"))
+    for banco in args.banco.split(","):
+        duracoes = executa(banco, args.amostras)
+        totais = [sum(valores) for valores in zip(*duracoes.values())]
+        for etapa, valores in list(duracoes.items()) + [("total", totais)]:
+            print("%-10s %-20s %10.1f %10.1f"
+                  % (banco, etapa, statistics.median(valores) * 1000, max(valores) * 1000))
+
+
+if __name__ == "__main__":
+    main()
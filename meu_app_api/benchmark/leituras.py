@@ -0,0 +1,135 @@
+""" Compara a latência das rotas de leitura, com escritas simultâneas, com a
+engine somente leitura separada (DB_LEITURA=1) e com uma única engine para
+leituras e escritas (DB_LEITURA=0).
+
+Cada combinação de servidor e modo roda em um processo separado, com um
+banco novo. Enquanto '--concorrencia' threads medem GET /usuario e
+POST /por-categoria, outras '--escritores' threads inserem históricos sem
+parar pela mesma API.
+
+    (env)$ python -m benchmark.leituras [--usuarios 2000] [--historicos 100000] [--requisicoes 2000] \\
+                                        [--concorrencia 16] [--escritores 4] [--servidores flask,gunicorn]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+
+from benchmark import prepara_ambiente, DIR_API
+
+MODOS = (("unica", "0"), ("separada", "1"))
+
+
+def leituras(usuarios: int):
+    """ Retorna as leituras medidas e a função que monta cada requisição.
+    """
+    from benchmark.gerador import nome_categoria
+
+    return [
+        ("GET /usuario", lambda a, i: ("GET", "/usuario?nome=usuario%d" % a.randrange(usuarios), None)),
+        ("POST /por-categoria", lambda a, i: (
+            "POST", "/por-categoria", {"categoryName": nome_categoria(a.randrange(10))})),
+    ]
+
+
+def executa(args) -> dict:
+    """ Mede as leituras em um banco novo com a configuração do ambiente.
+    """
+    prepara_ambiente("leituras_")
+    from benchmark.carga import mede_rota, ClienteFlask, ClienteHttp, inicia_gunicorn, porta_livre
+    from model import obtem_engine
+    from benchmark.gerador import gera_dados, nome_categoria
+    engine = obtem_engine()
+    gera_dados(engine, args.usuarios, args.historicos, args.semente)
+    engine.dispose()
+
+    processo = None
+    if args.servidor == "gunicorn":
+        porta = porta_livre()
+        processo = inicia_gunicorn(porta, args.workers, args.threads)
+        fabrica = lambda: ClienteHttp(porta)
+    else:
+        cliente = ClienteFlask()
+        fabrica = lambda: cliente
+
+    escrevendo = threading.Event()
+    escrevendo.set()
+    escritas = [0]
+
+    def escreve(numero):
+        cliente = fabrica()
+        aleatorio = random.Random(args.semente + numero)
+        while escrevendo.is_set():
+            cliente.requisita("POST", "/historico", {
+                "user": aleatorio.randint(1, args.usuarios), "category": nome_categoria(aleatorio.randrange(10)),
+                "score": "%d/10" % aleatorio.randint(0, 10)})
+            escritas[0] += 1
+
+    escritores = [threading.Thread(target=escreve, args=(n,)) for n in range(args.escritores)]
+    for thread in escritores:
+        thread.start()
+    resultados = {}
+    try:
+        for nome, requisicao in leituras(args.usuarios):
+            resultados[nome] = mede_rota(fabrica, requisicao, args.requisicoes, args.concorrencia, args.semente)
+    finally:
+        escrevendo.clear()
+        for thread in escritores:
+            thread.join()
+        if processo is not None:
+            processo.terminate()
+            processo.wait()
+    return {"rotas": resultados, "escritas": escritas[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=2000)
+    parser.add_argument("--historicos", type=int, default=100000)
+    parser.add_argument("--requisicoes", type=int, default=2000)
+    parser.add_argument("--concorrencia", type=int, default=16)
+    parser.add_argument("--escritores", type=int, default=4)
+    parser.add_argument("--servidores", default="flask,gunicorn")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--semente", type=int, default=42)
+    # parâmetros internos de uma execução isolada
+    parser.add_argument("--execucao", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--servidor", help=argparse.SUPPRESS)
+    parser.add_argument("--saida", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.execucao:
+        resultado = executa(args)
+        with open(args.saida, "w") as arquivo:
+            json.dump(resultado, arquivo)
+        return
+
+    print("%-9s %-9s %-20s %10s %8s %8s %8s %6s %9s" % (
+        "servidor", "engines", "rota", "req/s", "p50 ms", "p95 ms", "p99 ms", "erros", "escritas"))
+    for servidor in args.servidores.split(","):
+        for modo, valor in MODOS:
+            saida = tempfile.mktemp(suffix=".json")
+            ambiente = dict(os.environ, DB_LEITURA=valor, LOG_NIVEL="WARNING", CACHE_BACKEND="desligado")
+            subprocess.run([
+                sys.executable, "-m", "benchmark.leituras", "--execucao", "--servidor", servidor,
+                "--usuarios", str(args.usuarios), "--historicos", str(args.historicos),
+                "--requisicoes", str(args.requisicoes), "--concorrencia", str(args.concorrencia),
+                "--escritores", str(args.escritores), "--workers", str(args.workers),
+                "--threads", str(args.threads), "--semente", str(args.semente), "--saida", saida],
+                cwd=DIR_API, env=ambiente, check=True, stdout=subprocess.DEVNULL)
+            with open(saida) as arquivo:
+                r = json.load(arquivo)
+            os.remove(saida)
+            for nome, rota in r["rotas"].items():
+                print("%-9s %-9s %-20s %10.1f %8.2f %8.2f %8.2f %6d %9d" % (
+                    servidor, modo, nome, rota["vazao"], rota["p50_ms"], rota["p95_ms"], rota["p99_ms"],
+                    rota["erros"], r["escritas"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+""" Mede o custo dos logs por requisição antes e depois da fila de logs.
+
+'antes' reproduz a configuração anterior: f-strings avaliadas mesmo com
+DEBUG desligado e RotatingFileHandler síncrono com maxBytes de 10000.
+'depois' usa chamadas com formatação preguiçosa e a escrita pela fila
+configurada em logger.py.
+
+    (env)$ python -m benchmark.log_requisicao [--requisicoes 20000]
+"""
+import argparse
+import os
+import sys
+import time
+
+from benchmark import prepara_ambiente
+
+
+def requisicao_antes(logger, usuario_nome, usuario):
+    # mesmas chamadas feitas pelas rotas de busca de usuario
+    logger.debug(f"Coletando dados sobre usuario #{usuario_nome}")
+    logger.debug(f"Registro de usuário econtrado: '{usuario}'")
+    logger.warning(f"Erro ao buscar usuário '{usuario_nome}', Registro de usuario não encontrado na base :/")
+
+
+def requisicao_depois(logger, usuario_nome, usuario):
+    logger.debug("Coletando dados sobre usuario #%s", usuario_nome)
+    logger.debug("Registro de usuário econtrado: '%s'", usuario)
+    logger.warning("Erro ao buscar usuário '%s', %s", usuario_nome, "Registro de usuario não encontrado na base :/")
+
+
+def mede(logger, requisicao, requisicoes: int) -> float:
+    """ Retorna o custo médio, em microssegundos, dos logs de uma requisição.
+    """
+    usuario = {"id": 1, "nome": "usuario1", "historicos": list(range(20))}
+    inicio = time.perf_counter()
+    for i in range(requisicoes):
+        requisicao(logger, "usuario%d" % i, usuario)
+    return (time.perf_counter() - inicio) / requisicoes * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requisicoes", type=int, default=20000)
+    args = parser.parse_args()
+
+    prepara_ambiente("log_requisicao_")
+    # o console é descartado para medir apenas o custo no processo
+    sys.stdout = open(os.devnull, "w")
+    from logger import logger, configura_logging, para_listeners
+
+    configura_logging(max_bytes=10000, fila=False)
+    antes = mede(logger, requisicao_antes, args.requisicoes)
+
+    configura_logging(fila=True)
+    depois = mede(logger, requisicao_depois, args.requisicoes)
+    para_listeners()
+
+    sys.stdout = sys.__stdout__
+    print("antes  (síncrono, f-strings)      %8.1f us/requisição" % antes)
+    print("depois (fila, formatação lazy)    %8.1f us/requisição" % depois)
+
+
+if __name__ == "__main__":
+    main()
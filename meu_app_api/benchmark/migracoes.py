@@ -0,0 +1,124 @@
+""" Verifica a atualização de um banco criado pela primeira versão da API.
+
+Cria, com o sqlite3, um banco com o esquema original de 'usuario' e
+'historico', sem 'user_version' e com emails repetidos, inicia o app sobre
+ele e confere que todas as migrações foram aplicadas, que o esquema final
+tem os mesmos índices e triggers de um banco novo e que as rotas respondem
+sobre os dados antigos. Termina com código 1 se alguma verificação falha.
+
+    (env)$ python -m benchmark.migracoes
+"""
+import os
+import sqlite3
+import sys
+
+from benchmark import prepara_ambiente, dados_usuario
+
+USUARIOS = 20
+HISTORICOS_POR_USUARIO = 5
+
+# esquema gerado pelo create_all da primeira versão, antes das migrações
+ESQUEMA_ORIGINAL = (
+    "CREATE TABLE usuario (id INTEGER NOT NULL, nome VARCHAR(140), email VARCHAR(256), senha VARCHAR(256), "
+    "cep VARCHAR(9), logradouro VARCHAR(256), bairro VARCHAR(256), cidade VARCHAR(256), estado VARCHAR(2), "
+    "PRIMARY KEY (id))",
+    "CREATE TABLE historico (id INTEGER NOT NULL, categoria VARCHAR(256), score VARCHAR(32), "
+    "data_insercao DATETIME, usuario INTEGER NOT NULL, PRIMARY KEY (id), "
+    "FOREIGN KEY(usuario) REFERENCES usuario (id))",
+)
+
+
+def cria_banco_original(arquivo: str):
+    """ Cria o banco no esquema original, populado com usuarios, um deles
+        com o email de outro, e históricos.
+    """
+    os.makedirs(os.path.dirname(arquivo), exist_ok=True)
+    conexao = sqlite3.connect(arquivo)
+    with conexao:
+        for comando in ESQUEMA_ORIGINAL:
+            conexao.execute(comando)
+        for i in range(USUARIOS):
+            dados = dados_usuario(i)
+            if i == USUARIOS - 1:
+                # a unicidade dos emails chegou depois, na migração 8
+                dados["email"] = dados_usuario(0)["email"]
+            conexao.execute("INSERT INTO usuario (nome, email, senha, cep, logradouro, bairro, cidade, estado) "
+                            "VALUES (:nome, :email, :senha, :cep, :logradouro, :bairro, :cidade, :estado)", dados)
+            for j in range(HISTORICOS_POR_USUARIO):
+                conexao.execute("INSERT INTO historico (categoria, score, data_insercao, usuario) "
+                                "VALUES (?, ?, '2023-01-01 00:00:00.000000', ?)",
+                                ("categoria%d" % (j % 2), "%d/10" % j, i + 1))
+    conexao.close()
+
+
+def esquema(arquivo: str) -> set:
+    """ Retorna os nomes dos índices e triggers do banco.
+    """
+    conexao = sqlite3.connect(arquivo)
+    nomes = {(tipo, nome) for tipo, nome in conexao.execute(
+        "SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger')")}
+    conexao.close()
+    return nomes
+
+
+def main():
+    diretorio = prepara_ambiente("migracoes_")
+    os.environ.setdefault("CACHE_BACKEND", "desligado")
+    os.environ["DB_SHARDS"] = "1"
+    arquivo = os.path.join(diretorio, "database", "db.sqlite3")
+    cria_banco_original(arquivo)
+
+    from app import create_app
+    from model import cria_engine, inicializa_banco, obtem_engine, versao_mais_recente
+
+    cliente = create_app().test_client()
+    # o banco é migrado no primeiro uso da engine, como na primeira requisição
+    obtem_engine()
+
+    falhas = 0
+    conexao = sqlite3.connect(arquivo)
+    versao = conexao.execute("PRAGMA user_version").fetchone()[0]
+    integridade = conexao.execute("PRAGMA integrity_check").fetchone()[0]
+    conexao.close()
+    falhas += not relata("versão do esquema", versao == versao_mais_recente(), "%d" % versao)
+    falhas += not relata("integridade", integridade == "ok", integridade)
+
+    # um banco novo, criado direto no esquema mais recente, como referência
+    novo = os.path.join(diretorio, "novo", "db.sqlite3")
+    engine = cria_engine("sqlite:///%s" % novo, arquivo=False)
+    inicializa_banco(engine)
+    engine.dispose()
+    faltando = sorted(nome for _, nome in esquema(novo) - esquema(arquivo))
+    falhas += not relata("índices e triggers", not faltando, ", ".join(faltando) or "iguais")
+
+    etag = cliente.get("/usuario?nome=usuario1").headers.get("ETag")
+    # rota -> (método, caminho, corpo, status esperado)
+    rotas = {
+        "GET /usuarios": ("get", "/usuarios", None, 200),
+        "POST /login": ("post", "/login", {"email": "usuario0@quiz.com", "senha": "senha"}, 200),
+        "POST /historico": ("post", "/historico", {"user": 2, "category": "categoria0", "score": "7/10"}, 200),
+        "GET /ranking": ("get", "/ranking?categoria=categoria0&usuario_id=2", None, 200),
+        "GET /busca/categorias": ("get", "/busca/categorias?q=categ", None, 200),
+        "GET /historico/serie": ("get", "/historico/serie?inicio=2022-12-01&fim=2023-01-31", None, 200),
+        "PUT /usuario": ("put", "/usuario", {"id": 3, "cidade": "Niterói"}, 200),
+        "DELETE /usuario": ("delete", "/usuario", {"id": 4}, 200),
+    }
+    for nome, (metodo, caminho, corpo, esperado) in rotas.items():
+        status = getattr(cliente, metodo)(caminho, json=corpo).status_code
+        falhas += not relata(nome, status == esperado, "status=%d" % status)
+    # o histórico inserido muda a versão do usuario, e com ela o ETag
+    novo_etag = cliente.get("/usuario?nome=usuario1").headers.get("ETag")
+    falhas += not relata("ETag do usuario", etag and novo_etag and etag != novo_etag, "%s -> %s" % (etag, novo_etag))
+
+    return 1 if falhas else 0
+
+
+def relata(nome: str, ok: bool, detalhe: str) -> bool:
+    """ Imprime o resultado de uma verificação e retorna se ela passou.
+    """
+    print("%-22s %s %s" % (nome, detalhe, "ok" if ok else "FALHOU"))
+    return bool(ok)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+""" Compara o caminho de leitura pelo ORM com a camada de leitura por colunas
+(model/leitura.py), medindo vazão e pico de memória alocada por operação.
+
+    (env)$ python -m benchmark.projecao_leitura [--usuarios 5000] [--historicos 50000]
+"""
+import argparse
+import time
+import tracemalloc
+
+from benchmark import prepara_ambiente, dados_usuario
+
+
+def mede(funcao, repeticoes: int):
+    """ Retorna (operações por segundo, pico de KiB alocados em uma operação).
+    """
+    funcao()
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        funcao()
+    vazao = repeticoes / (time.perf_counter() - inicio)
+
+    tracemalloc.start()
+    funcao()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return vazao, pico / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=5000)
+    parser.add_argument("--historicos", type=int, default=50000)
+    parser.add_argument("--repeticoes", type=int, default=20)
+    args = parser.parse_args()
+
+    prepara_ambiente("projecao_leitura_")
+    from model import obtem_engine, session_factory, Usuario, Historico, le_usuarios, le_usuario_por_nome, \
+        le_historicos_por_categoria, consulta_usuarios_com_historicos, consulta_historicos_por_categoria
+    from schemas import apresenta_usuarios, apresenta_usuario
+    from schemas.historico import apresenta_historicos
+    from datetime import datetime
+
+    with obtem_engine().begin() as conn:
+        conn.execute(Usuario.__table__.insert(), [dados_usuario(i) for i in range(args.usuarios)])
+        conn.execute(Historico.__table__.insert(), [{
+            "usuario": i % args.usuarios + 1, "categoria": "categoria%d" % (i % 10),
+            "score": "%d/10" % (i % 11), "acertos": i % 11, "total": 10,
+            "data_insercao": datetime(2023, 1, 1)} for i in range(args.historicos)])
+
+    def com_sessao(funcao):
+        def executa():
+            session = session_factory()
+            try:
+                funcao(session)
+            finally:
+                session.close()
+        return executa
+
+    casos = {
+        "listagem de usuarios": (
+            lambda s: apresenta_usuarios(s.query(Usuario).order_by(Usuario.id).all()),
+            lambda s: apresenta_usuarios(le_usuarios(s))),
+        "usuario com historicos": (
+            lambda s: apresenta_usuario(consulta_usuarios_com_historicos(s)
+                                        .filter(Usuario.nome == "usuario1").first()),
+            lambda s: apresenta_usuario(le_usuario_por_nome(s, "usuario1"))),
+        "historicos da categoria": (
+            lambda s: apresenta_historicos(consulta_historicos_por_categoria(s, "categoria1").all()),
+            lambda s: apresenta_historicos(le_historicos_por_categoria(s, "categoria1"))),
+    }
+
+    print("%-24s %-8s %12s %14s" % ("caso", "caminho", "ops/s", "pico KiB/op"))
+    for nome, (orm, leitura) in casos.items():
+        for caminho, funcao in (("orm", orm), ("leitura", leitura)):
+            vazao, pico = mede(com_sessao(funcao), args.repeticoes)
+            print("%-24s %-8s %12.1f %14.0f" % (nome, caminho, vazao, pico))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+""" Compara a vazão e a latência das rotas com os usuarios em 1, 4 e 8
+shards (DB_SHARDS).
+
+Cada combinação de servidor e quantidade de shards roda em um processo
+separado, com um banco novo com os mesmos dados sintéticos divididos entre
+os shards. As rotas de um usuario (inserção de histórico, busca pelo nome e
+login) vão a um único shard, e a listagem de usuarios e a busca por
+categoria consultam todos os shards em paralelo.
+
+    (env)$ python -m benchmark.shards [--usuarios 10000] [--historicos 100000] [--requisicoes 2000] \\
+                                      [--concorrencia 16] [--shards 1,4,8] [--servidores flask,gunicorn]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmark import prepara_ambiente, DIR_API
+
+
+def rotas(usuarios: int):
+    """ Retorna as rotas medidas e a função que monta cada requisição.
+    """
+    from benchmark.gerador import nome_categoria
+
+    return [
+        ("POST /historico", lambda a, i: (
+            "POST", "/historico", {"user": a.randint(1, usuarios), "category": nome_categoria(a.randrange(10)),
+                                   "score": "%d/10" % a.randint(0, 10)})),
+        ("GET /usuario", lambda a, i: ("GET", "/usuario?nome=usuario%d" % a.randrange(usuarios), None)),
+        ("POST /login", lambda a, i: (
+            "POST", "/login", {"email": "usuario%d@quiz.com" % a.randrange(usuarios), "senha": "senha"})),
+        ("GET /usuarios", lambda a, i: ("GET", "/usuarios?limit=100&after=%d" % a.randrange(usuarios), None)),
+        ("POST /por-categoria", lambda a, i: (
+            "POST", "/por-categoria", {"categoryName": nome_categoria(a.randrange(10))})),
+    ]
+
+
+def executa(args) -> dict:
+    """ Mede as rotas em um banco novo com a configuração do ambiente.
+    """
+    prepara_ambiente("shards_")
+    from benchmark.carga import mede_rota, ClienteFlask, ClienteHttp, inicia_gunicorn, porta_livre
+    from model import obtem_engine, engines_dos_shards
+    from benchmark.gerador import gera_dados
+    gera_dados(obtem_engine(), args.usuarios, args.historicos, args.semente)
+    for engine in engines_dos_shards():
+        engine.dispose()
+
+    processo = None
+    if args.servidor == "gunicorn":
+        porta = porta_livre()
+        processo = inicia_gunicorn(porta, args.workers, args.threads)
+        fabrica = lambda: ClienteHttp(porta)
+    else:
+        cliente = ClienteFlask()
+        fabrica = lambda: cliente
+    try:
+        return {nome: mede_rota(fabrica, requisicao, args.requisicoes, args.concorrencia, args.semente)
+                for nome, requisicao in rotas(args.usuarios)}
+    finally:
+        if processo is not None:
+            processo.terminate()
+            processo.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=10000)
+    parser.add_argument("--historicos", type=int, default=100000)
+    parser.add_argument("--requisicoes", type=int, default=2000)
+    parser.add_argument("--concorrencia", type=int, default=16)
+    parser.add_argument("--shards", default="1,4,8")
+    parser.add_argument("--servidores", default="flask,gunicorn")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--semente", type=int, default=42)
+    # parâmetros internos de uma execução isolada
+    parser.add_argument("--execucao", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--servidor", help=argparse.SUPPRESS)
+    parser.add_argument("--saida", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.execucao:
+        resultado = executa(args)
+        with open(args.saida, "w") as arquivo:
+            json.dump(resultado, arquivo)
+        return
+
+    print("%-9s %6s %-20s %10s %8s %8s %8s %6s" % (
+        "servidor", "shards", "rota", "req/s", "p50 ms", "p95 ms", "p99 ms", "erros"))
+    for servidor in args.servidores.split(","):
+        for shards in args.shards.split(","):
+            saida = tempfile.mktemp(suffix=".json")
+            ambiente = dict(os.environ, DB_SHARDS=shards, LOG_NIVEL="WARNING", CACHE_BACKEND="desligado")
+            subprocess.run([
+                sys.executable, "-m", "benchmark.shards", "--execucao", "--servidor", servidor,
+                "--usuarios", str(args.usuarios), "--historicos", str(args.historicos),
+                "--requisicoes", str(args.requisicoes), "--concorrencia", str(args.concorrencia),
+                "--workers", str(args.workers), "--threads", str(args.threads),
+                "--semente", str(args.semente), "--saida", saida],
+                cwd=DIR_API, env=ambiente, check=True, stdout=subprocess.DEVNULL)
+            with open(saida) as arquivo:
+                r = json.load(arquivo)
+            os.remove(saida)
+            for nome, rota in r.items():
+                print("%-9s %6s %-20s %10.1f %8.2f %8.2f %8.2f %6d" % (
+                    servidor, shards, nome, rota["vazao"], rota["p50_ms"], rota["p95_ms"], rota["p99_ms"],
+                    rota["erros"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+from collections import OrderedDict
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+# configuração do cache, ajustável por variáveis de ambiente:
+# 'memoria' mantém um cache por processo, 'sqlite' compartilha um arquivo
+# entre todos os workers e 'desligado' desativa o cache
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memoria")
+CACHE_TAMANHO = int(os.environ.get("CACHE_TAMANHO", 1024))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 60))
+CACHE_ARQUIVO = os.environ.get("CACHE_ARQUIVO", "database/cache.sqlite3")
+
+
+def chave_usuario_id(usuario_id) -> str:
+    return "usuario:id:%s" % usuario_id
+
+
+def chave_usuario_nome(nome: str) -> str:
+    return "usuario:nome:%s" % nome
+
+
+def chave_usuario_email(email: str) -> str:
+    return "usuario:email:%s" % email
+
+
+def chaves_usuario(usuario_id=None, *, nomes=(), emails=()):
+    """ Retorna todas as chaves que podem guardar dados de um usuário.
+
+    Recebe listas de nomes e e-mails porque uma atualização precisa
+    invalidar tanto o valor antigo quanto o novo.
+    """
+    chaves = [chave_usuario_id(usuario_id)] if usuario_id is not None else []
+    chaves += [chave_usuario_nome(nome) for nome in nomes if nome is not None]
+    chaves += [chave_usuario_email(email) for email in emails if email is not None]
+    return chaves
+
+
+class Cache:
+    """ Interface comum dos caches de payloads já serializados.
+
+    Mantém os contadores de acertos, faltas e remoções por processo.
+
+    Cada invalidação recebe uma geração crescente. Uma leitura do banco que
+    vai preencher o cache lê a geração antes de consultar o banco e a passa
+    ao set, que descarta o payload se a chave foi invalidada depois: uma
+    escrita que terminou no meio da leitura não tem o seu payload antigo
+    gravado de volta no cache até o fim do tempo de vida.
+    """
+
+    def __init__(self):
+        self.acertos = 0
+        self.faltas = 0
+        self.remocoes = 0
+
+    def get(self, chave: str):
+        """ Retorna o payload guardado em 'chave' ou None.
+        """
+        valor = self._get(chave)
+        if valor is None:
+            self.faltas += 1
+        else:
+            self.acertos += 1
+        return valor
+
+    def geracao(self, chave: str) -> int:
+        """ Retorna a geração atual das invalidações, a ser lida antes da
+            consulta ao banco cujo resultado será passado ao set.
+        """
+        return self._geracao(chave)
+
+    def set(self, chave: str, valor, geracao: int = None):
+        """ Guarda o payload em 'chave' pelo tempo de vida configurado.
+
+        Com 'geracao', a de antes da leitura do payload, ele só é guardado
+        se a chave não foi invalidada desde então.
+        """
+        self._set(chave, valor, geracao)
+
+    def invalida(self, *chaves: str):
+        """ Remove as chaves informadas do cache.
+        """
+        self._invalida(chaves)
+
+    def estatisticas(self) -> dict:
+        """ Retorna os contadores do cache deste processo.
+        """
+        return {"acertos": self.acertos, "faltas": self.faltas, "remocoes": self.remocoes}
+
+    def _get(self, chave):
+        return None
+
+    def _geracao(self, chave):
+        return 0
+
+    def _set(self, chave, valor, geracao):
+        pass
+
+    def _invalida(self, chaves):
+        pass
+
+
+class CacheMemoria(Cache):
+    """ Cache LRU com tempo de vida, local a cada processo.
+
+    Guarda a geração das últimas 'tamanho' chaves invalidadas; as gerações
+    descartadas ficam representadas pela maior delas, e um set com geração
+    anterior a ela é descartado, mesmo que a sua chave não tenha mudado.
+    """
+
+    def __init__(self, tamanho: int, ttl: float):
+        super().__init__()
+        self.tamanho = tamanho
+        self.ttl = ttl
+        self._itens = OrderedDict()
+        self._invalidacoes = OrderedDict()
+        self._contador = 0
+        self._descartada = 0
+        self._lock = threading.Lock()
+
+    def _get(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            expira, valor = item
+            if expira < time.monotonic():
+                del self._itens[chave]
+                return None
+            # marca a chave como a usada mais recentemente
+            self._itens.move_to_end(chave)
+            return valor
+
+    def _geracao(self, chave):
+        with self._lock:
+            return self._contador
+
+    def _set(self, chave, valor, geracao):
+        with self._lock:
+            if geracao is not None and (geracao < self._descartada or self._invalidacoes.get(chave, 0) > geracao):
+                return
+            self._itens[chave] = (time.monotonic() + self.ttl, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.tamanho:
+                self._itens.popitem(last=False)
+                self.remocoes += 1
+
+    def _invalida(self, chaves):
+        with self._lock:
+            for chave in chaves:
+                self._itens.pop(chave, None)
+                self._contador += 1
+                self._invalidacoes[chave] = self._contador
+                self._invalidacoes.move_to_end(chave)
+            while len(self._invalidacoes) > self.tamanho:
+                _, geracao = self._invalidacoes.popitem(last=False)
+                self._descartada = max(self._descartada, geracao)
+
+
+class CacheSQLite(Cache):
+    """ Cache LRU com tempo de vida guardado em um arquivo SQLite.
+
+    Todos os workers que apontam para o mesmo arquivo veem as mesmas
+    entradas, então uma invalidação feita por um deles vale para todos. As
+    gerações das invalidações ficam na tabela 'invalidacao', também
+    limitada a 'tamanho' chaves, e a linha de chave vazia guarda a maior
+    geração descartada, como no CacheMemoria.
+    """
+
+    def __init__(self, arquivo: str, tamanho: int, ttl: float):
+        super().__init__()
+        self.arquivo = arquivo
+        self.tamanho = tamanho
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _conexao(self):
+        """ Retorna a conexão desta thread com o arquivo de cache.
+
+        O arquivo e a tabela são criados na primeira conexão, e não na
+        criação do cache, para que importar o app não toque no disco. A
+        conexão guarda o pid de quem a abriu porque uma conexão herdada
+        pelo fork dos workers não pode ser usada pelo processo filho.
+        """
+        conexao = getattr(self._local, "conexao", None)
+        if conexao is None or self._local.pid != os.getpid():
+            diretorio = os.path.dirname(self.arquivo)
+            if diretorio and not os.path.exists(diretorio):
+                os.makedirs(diretorio)
+            # autocommit: cada comando é uma transação curta
+            conexao = sqlite3.connect(self.arquivo, timeout=5, isolation_level=None)
+            conexao.execute("PRAGMA journal_mode=WAL")
+            conexao.execute("PRAGMA synchronous=NORMAL")
+            conexao.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "chave TEXT PRIMARY KEY, valor BLOB NOT NULL, expira REAL NOT NULL, acesso REAL NOT NULL)")
+            conexao.execute("CREATE INDEX IF NOT EXISTS ix_cache_acesso ON cache (acesso)")
+            conexao.execute("CREATE TABLE IF NOT EXISTS invalidacao (chave TEXT PRIMARY KEY, geracao INTEGER NOT NULL)")
+            conexao.execute("CREATE INDEX IF NOT EXISTS ix_invalidacao_geracao ON invalidacao (geracao)")
+            self._local.conexao = conexao
+            self._local.pid = os.getpid()
+        return conexao
+
+    def _get(self, chave):
+        conexao = self._conexao()
+        linha = conexao.execute("SELECT valor, expira FROM cache WHERE chave = ?", (chave,)).fetchone()
+        if linha is None:
+            return None
+        agora = time.time()
+        if linha[1] < agora:
+            conexao.execute("DELETE FROM cache WHERE chave = ?", (chave,))
+            return None
+        conexao.execute("UPDATE cache SET acesso = ? WHERE chave = ?", (agora, chave))
+        return pickle.loads(linha[0])
+
+    def _geracao(self, chave):
+        return self._conexao().execute("SELECT COALESCE(MAX(geracao), 0) FROM invalidacao").fetchone()[0]
+
+    def _set(self, chave, valor, geracao):
+        conexao = self._conexao()
+        agora = time.time()
+        if geracao is None:
+            conexao.execute("INSERT OR REPLACE INTO cache (chave, valor, expira, acesso) VALUES (?, ?, ?, ?)",
+                            (chave, pickle.dumps(valor), agora + self.ttl, agora))
+        else:
+            # a verificação e a gravação são um único comando, atômico em
+            # relação às invalidações dos outros workers
+            conexao.execute(
+                "INSERT OR REPLACE INTO cache (chave, valor, expira, acesso) SELECT ?, ?, ?, ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM invalidacao WHERE chave IN (?, '') AND geracao > ?)",
+                (chave, pickle.dumps(valor), agora + self.ttl, agora, chave, geracao))
+        # remove as entradas usadas há mais tempo além do tamanho máximo
+        removidas = conexao.execute(
+            "DELETE FROM cache WHERE chave IN (SELECT chave FROM cache ORDER BY acesso "
+            "LIMIT max(0, (SELECT COUNT(*) FROM cache) - ?))", (self.tamanho,)).rowcount
+        self.remocoes += max(removidas, 0)
+
+    def _invalida(self, chaves):
+        if not chaves:
+            return
+        conexao = self._conexao()
+        # a geração muda antes da remoção, então um set que chegue entre as
+        # duas já a encontra
+        conexao.executemany("INSERT OR REPLACE INTO invalidacao (chave, geracao) "
+                            "SELECT ?, COALESCE(MAX(geracao), 0) + 1 FROM invalidacao", [(chave,) for chave in chaves])
+        conexao.executemany("DELETE FROM cache WHERE chave = ?", [(chave,) for chave in chaves])
+        # a linha de chave vazia fica com a maior geração das linhas
+        # descartadas além do tamanho máximo
+        limite = conexao.execute("SELECT geracao FROM invalidacao WHERE chave != '' ORDER BY geracao DESC "
+                                 "LIMIT 1 OFFSET ?", (self.tamanho,)).fetchone()
+        if limite is not None:
+            conexao.execute("INSERT OR REPLACE INTO invalidacao (chave, geracao) "
+                            "SELECT '', MAX(?, COALESCE((SELECT geracao FROM invalidacao WHERE chave = ''), 0))",
+                            (limite[0],))
+            conexao.execute("DELETE FROM invalidacao WHERE chave != '' AND geracao <= ?", (limite[0],))
+
+
+def cria_cache(backend: str = CACHE_BACKEND) -> Cache:
+    """ Cria o cache configurado pelas variáveis de ambiente.
+    """
+    if backend == "memoria":
+        return CacheMemoria(CACHE_TAMANHO, CACHE_TTL)
+    if backend == "sqlite":
+        return CacheSQLite(CACHE_ARQUIVO, CACHE_TAMANHO, CACHE_TTL)
+    if backend == "desligado":
+        return Cache()
+    raise ValueError("CACHE_BACKEND inválido: %s" % backend)
+
+
+cache = cria_cache()
@@ -0,0 +1,194 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import os
+import queue
+import threading
+import time
+
+from model import Session, session_factory, usa_shard, SHARD
+
+
+# configuração das escritas, ajustável por variáveis de ambiente:
+# 'agrupada' envia as escritas a uma thread que grava várias em uma única
+# transação e 'direta' grava cada uma na transação da própria requisição
+ESCRITA_MODO = os.environ.get("ESCRITA_MODO", "agrupada")
+# escritas aguardando a thread; com a fila cheia as requisições esperam
+ESCRITA_FILA = int(os.environ.get("ESCRITA_FILA", 1000))
+# máximo de escritas por transação e quanto a thread espera por mais
+# escritas depois da primeira antes de gravar
+ESCRITA_LOTE = int(os.environ.get("ESCRITA_LOTE", 64))
+ESCRITA_ESPERA_MS = float(os.environ.get("ESCRITA_ESPERA_MS", 2))
+# tempo máximo que uma requisição espera a sua escrita começar
+ESCRITA_TIMEOUT = float(os.environ.get("ESCRITA_TIMEOUT", 10))
+
+
+class EscritaRecusada(Exception):
+    """ A escrita não foi feita porque a fila não a aceitou a tempo.
+    """
+
+
+class Escritor:
+    """ Executa as escritas das rotas, cada uma na sua própria transação.
+
+    Uma escrita é uma função que recebe a sessão, faz as alterações sem
+    chamar commit e retorna o resultado para a rota. Com DB_SHARDS > 1 cada
+    escrita grava em um único shard, o do usuario que ela altera. Mantém os
+    contadores de transações e escritas por processo.
+    """
+
+    def __init__(self):
+        self.transacoes = 0
+        self.escritas = 0
+
+    def executa(self, escrita, shard: int = 0):
+        """ Executa a escrita no shard, grava a transação e retorna o resultado.
+
+        Exceções da escrita ou do commit são repassadas a quem chamou, e
+        nada da escrita é gravado.
+        """
+        session = usa_shard(shard)
+        try:
+            # as leituras da escrita também vão à conexão de escrita, na
+            # mesma transação das alterações
+            session.usa_escrita()
+            resultado = escrita(session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.transacoes += 1
+        self.escritas += 1
+        return resultado
+
+    def estatisticas(self) -> dict:
+        """ Retorna os contadores de escritas deste processo.
+        """
+        return {"transacoes": self.transacoes, "escritas": self.escritas}
+
+
+class EscritorAgrupado(Escritor):
+    """ Grava as escritas de várias requisições em uma única transação.
+
+    O SQLite aceita um escritor por vez: com uma transação por requisição,
+    as requisições simultâneas disputam o lock e cada uma paga o seu commit.
+    Aqui as escritas entram em uma fila limitada e uma thread do processo
+    as executa em grupos de até 'lote', esperando até 'espera_ms' por mais
+    escritas depois da primeira. Cada escrita roda em um SAVEPOINT, então o
+    erro de uma desfaz só ela, e o grupo é gravado com um único commit.
+    Cada requisição espera o seu resultado em um Future. Cada shard tem a
+    sua fila e a sua thread, e os shards gravam em paralelo.
+    """
+
+    def __init__(self, tamanho_fila: int, lote: int, espera_ms: float, timeout: float):
+        super().__init__()
+        self.tamanho_fila = tamanho_fila
+        self.lote = lote
+        self.espera = espera_ms / 1000
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reinicia()
+        # a thread não sobrevive ao fork, então o filho cria a sua no primeiro uso
+        os.register_at_fork(after_in_child=self._reinicia)
+
+    def _reinicia(self):
+        # fila de cada shard, criada junto com a sua thread no primeiro uso
+        self._filas = {}
+
+    def _fila_do_shard(self, shard: int):
+        fila = self._filas.get(shard)
+        if fila is None:
+            with self._lock:
+                fila = self._filas.get(shard)
+                if fila is None:
+                    fila = queue.Queue(self.tamanho_fila)
+                    threading.Thread(target=self._grava_continuamente, args=(fila, shard),
+                                     name="escritor-%d" % shard, daemon=True).start()
+                    self._filas[shard] = fila
+        return fila
+
+    def executa(self, escrita, shard: int = 0):
+        fila = self._fila_do_shard(shard)
+        futuro = Future()
+        try:
+            fila.put((escrita, futuro), timeout=self.timeout)
+        except queue.Full:
+            raise EscritaRecusada("Fila de escritas cheia")
+        try:
+            resultado = futuro.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # só desiste se a escrita ainda não começou; se já começou, o
+            # resultado chega assim que o grupo dela for gravado
+            if futuro.cancel():
+                raise EscritaRecusada("Escrita não iniciada a tempo")
+            resultado = futuro.result()
+        # uma transação de leitura aberta antes pela requisição não veria a
+        # escrita; encerrada aqui, como o commit do modo direto, a próxima
+        # leitura da requisição já a encontra
+        session = Session()
+        if session.in_transaction():
+            session.commit()
+        return resultado
+
+    def _proximo_grupo(self, fila):
+        grupo = [fila.get()]
+        limite = time.monotonic() + self.espera
+        while len(grupo) < self.lote:
+            restante = limite - time.monotonic()
+            try:
+                grupo.append(fila.get(timeout=restante) if restante > 0 else fila.get_nowait())
+            except queue.Empty:
+                break
+        return grupo
+
+    def _grava_continuamente(self, fila, shard: int):
+        while True:
+            self._grava(self._proximo_grupo(fila), shard)
+
+    def _grava(self, grupo, shard: int = 0):
+        # as escritas que expiraram na fila são descartadas
+        grupo = [(escrita, futuro) for escrita, futuro in grupo if futuro.set_running_or_notify_cancel()]
+        if not grupo:
+            return
+
+        session = session_factory(info={SHARD: shard})
+        resultados = []
+        try:
+            # o lock de escrita é obtido no início, e não na primeira
+            # alteração, para que os SAVEPOINTs fiquem dentro da transação
+            session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            for escrita, futuro in grupo:
+                try:
+                    with session.begin_nested():
+                        resultados.append((futuro, escrita(session), None))
+                except Exception as e:
+                    resultados.append((futuro, None, e))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            for _, futuro in grupo:
+                futuro.set_exception(e)
+            return
+        finally:
+            session.close()
+
+        # as threads dos shards atualizam os mesmos contadores
+        with self._lock:
+            self.transacoes += 1
+            self.escritas += len(grupo)
+        for futuro, resultado, erro in resultados:
+            if erro is None:
+                futuro.set_result(resultado)
+            else:
+                futuro.set_exception(erro)
+
+
+def cria_escritor(modo: str = ESCRITA_MODO) -> Escritor:
+    """ Cria o escritor configurado pelas variáveis de ambiente.
+    """
+    if modo == "agrupada":
+        return EscritorAgrupado(ESCRITA_FILA, ESCRITA_LOTE, ESCRITA_ESPERA_MS, ESCRITA_TIMEOUT)
+    if modo == "direta":
+        return Escritor()
+    raise ValueError("ESCRITA_MODO inválido: %s" % modo)
+
+
+escritor = cria_escritor()
@@ -0,0 +1,237 @@
+from array import array
+from datetime import datetime, timedelta
+from itertools import islice
+import csv
+import hashlib
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+
+# configuração da exportação de históricos, ajustável por variáveis de ambiente:
+# linhas por bloco lido do banco e escrito na resposta, diretório dos arquivos
+# gerados para as requisições com Range e tempo que eles são mantidos
+EXPORTACAO_LOTE = int(os.environ.get("EXPORTACAO_LOTE", 5000))
+EXPORTACAO_DIR = os.environ.get("EXPORTACAO_DIR", "database/exportacoes")
+EXPORTACAO_TTL = int(os.environ.get("EXPORTACAO_TTL", 3600))
+
+COLUNAS = ("id", "usuario", "nome_usuario", "categoria", "score", "acertos", "total", "data_insercao")
+
+# Formato colunar: o arquivo começa com MAGICO e um cabeçalho JSON com as
+# colunas e a compressão, seguido de blocos de até EXPORTACAO_LOTE linhas.
+# Cada bloco tem a quantidade de linhas e o tamanho do conteúdo (uint32) e,
+# no conteúdo, cada coluna é o tamanho (uint32) seguido dos seus bytes:
+#   i64  - array de inteiros de 64 bits; nulos valem NULO_I64
+#   ts   - i64 com os microssegundos desde 1970-01-01 (horário local)
+#   str  - array de comprimentos int32 (-1 para nulo) seguido do texto UTF-8
+# Todos os números são little-endian. Com compressão 'zlib', o conteúdo de
+# cada bloco é comprimido separadamente, então a memória usada na escrita e
+# na leitura é a de um bloco.
+MAGICO = b"QUIZCOL1"
+NULO_I64 = -2 ** 63
+TIPOS = {"id": "i64", "usuario": "i64", "nome_usuario": "str", "categoria": "str", "score": "str",
+         "acertos": "i64", "total": "i64", "data_insercao": "ts"}
+COMPRESSOES = (None, "zlib")
+EPOCA = datetime(1970, 1, 1)
+
+_U32 = struct.Struct("<I")
+_INVERTE_BYTES = sys.byteorder == "big"
+
+
+def _lotes(linhas, lote: int):
+    linhas = iter(linhas)
+    while True:
+        bloco = list(islice(linhas, lote))
+        if not bloco:
+            return
+        yield bloco
+
+
+def _texto_csv(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    return valor
+
+
+def gera_csv(linhas, lote: int = EXPORTACAO_LOTE):
+    """ Gera o CSV das linhas em pedaços de 'lote' linhas, começando pelo
+        cabeçalho com os nomes das colunas.
+    """
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(COLUNAS)
+    yield buffer.getvalue().encode()
+    for bloco in _lotes(linhas, lote):
+        buffer.seek(0)
+        buffer.truncate()
+        escritor.writerows([_texto_csv(valor) for valor in linha] for linha in bloco)
+        yield buffer.getvalue().encode()
+
+
+def _bytes_do_array(valores: array) -> bytes:
+    if _INVERTE_BYTES:
+        valores.byteswap()
+    return valores.tobytes()
+
+
+def _codifica_coluna(tipo: str, valores) -> bytes:
+    if tipo == "i64":
+        return _bytes_do_array(array("q", (NULO_I64 if v is None else v for v in valores)))
+    if tipo == "ts":
+        return _bytes_do_array(array("q", (NULO_I64 if v is None else (v - EPOCA) // timedelta(microseconds=1)
+                                           for v in valores)))
+    textos = [None if v is None else v.encode() for v in valores]
+    comprimentos = array("i", (-1 if t is None else len(t) for t in textos))
+    return _U32.pack(len(textos) * comprimentos.itemsize) + _bytes_do_array(comprimentos) \
+        + b"".join(t for t in textos if t)
+
+
+def gera_colunar(linhas, lote: int = EXPORTACAO_LOTE, compressao: str = None):
+    """ Gera o arquivo colunar das linhas, um bloco por vez.
+    """
+    if compressao not in COMPRESSOES:
+        raise ValueError("Compressão inválida: %s" % compressao)
+    cabecalho = json.dumps({"colunas": [[nome, TIPOS[nome]] for nome in COLUNAS],
+                            "compressao": compressao}).encode()
+    yield MAGICO + _U32.pack(len(cabecalho)) + cabecalho
+    for bloco in _lotes(linhas, lote):
+        conteudo = b"".join(
+            _U32.pack(len(coluna)) + coluna
+            for coluna in (_codifica_coluna(TIPOS[nome], valores) for nome, valores in zip(COLUNAS, zip(*bloco))))
+        if compressao == "zlib":
+            conteudo = zlib.compress(conteudo, 6)
+        yield _U32.pack(len(bloco)) + _U32.pack(len(conteudo)) + conteudo
+
+
+def _le_exato(arquivo, tamanho: int) -> bytes:
+    dados = arquivo.read(tamanho)
+    if len(dados) != tamanho:
+        raise ValueError("Arquivo colunar truncado")
+    return dados
+
+
+def _decodifica_coluna(tipo: str, dados: bytes):
+    if tipo in ("i64", "ts"):
+        valores = array("q")
+        valores.frombytes(dados)
+        if _INVERTE_BYTES:
+            valores.byteswap()
+        if tipo == "ts":
+            return [None if v == NULO_I64 else EPOCA + timedelta(microseconds=v) for v in valores]
+        return [None if v == NULO_I64 else v for v in valores]
+    tamanho = _U32.unpack_from(dados)[0]
+    comprimentos = array("i")
+    comprimentos.frombytes(dados[4:4 + tamanho])
+    if _INVERTE_BYTES:
+        comprimentos.byteswap()
+    valores = []
+    posicao = 4 + tamanho
+    for comprimento in comprimentos:
+        if comprimento < 0:
+            valores.append(None)
+        else:
+            valores.append(dados[posicao:posicao + comprimento].decode())
+            posicao += comprimento
+    return valores
+
+
+def le_colunar(arquivo):
+    """ Lê um arquivo colunar gerado por gera_colunar, retornando as linhas
+        como tuplas na ordem de COLUNAS.
+    """
+    if _le_exato(arquivo, len(MAGICO)) != MAGICO:
+        raise ValueError("Arquivo não está no formato colunar de históricos")
+    cabecalho = json.loads(_le_exato(arquivo, _U32.unpack(_le_exato(arquivo, 4))[0]))
+    tipos = [tipo for _, tipo in cabecalho["colunas"]]
+    while True:
+        # a quantidade de linhas do bloco; o fim do arquivo encerra a leitura
+        if not arquivo.read(4):
+            return
+        conteudo = _le_exato(arquivo, _U32.unpack(_le_exato(arquivo, 4))[0])
+        if cabecalho["compressao"] == "zlib":
+            conteudo = zlib.decompress(conteudo)
+        colunas = []
+        posicao = 0
+        for tipo in tipos:
+            tamanho = _U32.unpack_from(conteudo, posicao)[0]
+            colunas.append(_decodifica_coluna(tipo, conteudo[posicao + 4:posicao + 4 + tamanho]))
+            posicao += 4 + tamanho
+        yield from zip(*colunas)
+
+
+# formato -> (mimetype, extensão do arquivo)
+FORMATOS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "colunar": ("application/octet-stream", "qcol"),
+}
+
+
+def gera_exportacao(formato: str, linhas, compressao: str = None, lote: int = EXPORTACAO_LOTE):
+    """ Gera os bytes da exportação das linhas no formato informado.
+    """
+    if formato == "colunar":
+        # validada aqui porque o gerador só executaria a validação na leitura
+        if compressao not in COMPRESSOES:
+            raise ValueError("Compressão inválida: %s" % compressao)
+        return gera_colunar(linhas, lote, compressao)
+    if compressao is not None:
+        raise ValueError("Compressão disponível apenas no formato colunar")
+    return gera_csv(linhas, lote)
+
+
+def etag_exportacao(ate_id, versao, *filtros) -> str:
+    """ Retorna o ETag de uma exportação.
+
+    O ETag começa pelo maior id exportado e pela versão do banco lida junto
+    com ele, ou, com shards, pelos de cada shard separados por pontos, e
+    termina com o resumo dos filtros e do formato. Como a versão muda com
+    qualquer alteração das linhas exportadas, inclusive o nome do usuario,
+    um If-Range com o ETag de outro conteúdo recebe a exportação inteira.
+    """
+    ids = ate_id if isinstance(ate_id, tuple) else (ate_id,)
+    versoes = versao if isinstance(versao, tuple) else (versao,)
+    resumo = hashlib.sha1(json.dumps([ate_id, versao] + [str(f) for f in filtros]).encode()).hexdigest()[:16]
+    return "%s-%s-%s" % (".".join("%d" % id for id in ids), ".".join("%d" % v for v in versoes), resumo)
+
+
+def arquivo_exportacao(etag: str, extensao: str, partes) -> str:
+    """ Retorna o caminho do arquivo da exportação identificada pelo ETag,
+        gravando as partes nele se ainda não existir.
+
+    O arquivo é escrito em um temporário e renomeado no fim, então uma
+    exportação interrompida nunca é servida pela metade. Arquivos mais
+    antigos que EXPORTACAO_TTL são removidos ao criar um novo.
+    """
+    caminho = os.path.join(EXPORTACAO_DIR, "%s.%s" % (etag, extensao))
+    if os.path.exists(caminho):
+        return caminho
+    if not os.path.exists(EXPORTACAO_DIR):
+        os.makedirs(EXPORTACAO_DIR)
+
+    limite = time.time() - EXPORTACAO_TTL
+    for nome in os.listdir(EXPORTACAO_DIR):
+        antigo = os.path.join(EXPORTACAO_DIR, nome)
+        try:
+            if os.path.getmtime(antigo) < limite:
+                os.remove(antigo)
+        except OSError:
+            # outro worker já removeu o arquivo
+            pass
+
+    descritor, temporario = tempfile.mkstemp(dir=EXPORTACAO_DIR, suffix=".parcial")
+    try:
+        with os.fdopen(descritor, "wb") as arquivo:
+            for parte in partes:
+                arquivo.write(parte)
+        os.replace(temporario, caminho)
+    except BaseException:
+        os.remove(temporario)
+        raise
+    return caminho
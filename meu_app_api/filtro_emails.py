@@ -0,0 +1,316 @@
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+
+from logger import logger
+
+# configuração do filtro de emails, ajustável por variáveis de ambiente: o
+# filtro é dimensionado para EMAILS_FILTRO_CAPACIDADE emails com a taxa de
+# falsos positivos EMAILS_FILTRO_FP, limitado a EMAILS_FILTRO_MAX_KB de
+# memória por worker (com o limite, a taxa fica maior que a pedida)
+EMAILS_FILTRO = os.environ.get("EMAILS_FILTRO", "1") != "0"
+EMAILS_FILTRO_CAPACIDADE = int(os.environ.get("EMAILS_FILTRO_CAPACIDADE", 100000))
+EMAILS_FILTRO_FP = float(os.environ.get("EMAILS_FILTRO_FP", 0.01))
+EMAILS_FILTRO_MAX_KB = int(os.environ.get("EMAILS_FILTRO_MAX_KB", 1024))
+# arquivo em que os workers anotam os emails inseridos e removidos, e o
+# tamanho a partir do qual ele é compactado e os filtros reconstruídos
+EMAILS_FILTRO_ARQUIVO = os.environ.get("EMAILS_FILTRO_ARQUIVO", "database/emails.log")
+EMAILS_FILTRO_ARQUIVO_MAX_KB = int(os.environ.get("EMAILS_FILTRO_ARQUIVO_MAX_KB", 4096))
+
+if not 0 < EMAILS_FILTRO_FP < 1:
+    raise ValueError("EMAILS_FILTRO_FP inválido: %s" % EMAILS_FILTRO_FP)
+if EMAILS_FILTRO_CAPACIDADE < 1 or EMAILS_FILTRO_MAX_KB < 1:
+    raise ValueError("EMAILS_FILTRO_CAPACIDADE e EMAILS_FILTRO_MAX_KB devem ser positivos")
+
+# fração de emails removidos a partir da qual o filtro é reconstruído, para
+# que os bits dos removidos deixem de gerar falsos positivos
+FRACAO_RECONSTRUCAO = 0.1
+
+
+class FiltroBloom:
+    """ Filtro de Bloom de textos: sem falsos negativos, com falsos positivos
+        na taxa definida pela capacidade e pelo tamanho.
+    """
+
+    def __init__(self, capacidade: int, taxa: float, max_bytes: int):
+        bits = math.ceil(-capacidade * math.log(taxa) / math.log(2) ** 2)
+        self.tamanho = max(64, min(bits, max_bytes * 8))
+        self.hashes = max(1, round(self.tamanho / capacidade * math.log(2)))
+        self.bits = bytearray((self.tamanho + 7) // 8)
+        self.quantidade = 0
+        # o |= de um byte não é atômico, e dois bits perdidos seriam falsos negativos
+        self._lock = threading.Lock()
+
+    def _posicoes(self, valor: str):
+        # as k posições vêm de dois hashes de 64 bits (Kirsch e Mitzenmacher)
+        resumo = hashlib.blake2b(valor.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(resumo[:8], "little")
+        h2 = int.from_bytes(resumo[8:], "little") | 1
+        return [(h1 + i * h2) % self.tamanho for i in range(self.hashes)]
+
+    def adiciona(self, valor: str):
+        posicoes = self._posicoes(valor)
+        with self._lock:
+            for posicao in posicoes:
+                self.bits[posicao >> 3] |= 1 << (posicao & 7)
+            self.quantidade += 1
+
+    def __contains__(self, valor: str) -> bool:
+        bits = self.bits
+        return all(bits[posicao >> 3] & (1 << (posicao & 7)) for posicao in self._posicoes(valor))
+
+    def taxa_estimada(self) -> float:
+        """ Taxa de falsos positivos esperada com os valores já adicionados.
+        """
+        return (1 - math.exp(-self.hashes * self.quantidade / self.tamanho)) ** self.hashes
+
+
+class FiltroEmails:
+    """ Filtro de Bloom dos emails cadastrados, um por worker.
+
+    Um email fora do filtro certamente não está cadastrado, então o login e
+    a consulta de disponibilidade respondem sem consultar o banco. O filtro
+    é aquecido com todos os emails do banco na primeira requisição de cada
+    worker, em segundo plano; até lá, todo email é consultado no banco.
+
+    Cada worker anota os emails que insere ou remove no fim de
+    EMAILS_FILTRO_ARQUIVO, e antes de responder que um email não existe o
+    filtro lê as linhas novas do arquivo. Assim um email cadastrado por
+    outro worker nunca é dado como inexistente, e o arquivo só é lido
+    quando mudou. Os removidos continuam no filtro, como falsos positivos,
+    até que passem de FRACAO_RECONSTRUCAO dos emails, ou o arquivo passe de
+    EMAILS_FILTRO_ARQUIVO_MAX_KB, e o filtro seja reconstruído a partir do
+    banco.
+
+    A reconstrução compacta o arquivo: as anotações anteriores já estão no
+    banco, lido depois disso, e o arquivo é trocado por um novo, que começa
+    com uma linha de geração própria. Os outros workers veem a geração nova,
+    consultam todo email no banco até reconstruírem os seus filtros e não
+    perdem as anotações que não chegaram a ler. As anotações e a troca do
+    arquivo são separadas por uma trava do sistema operacional.
+    """
+
+    def __init__(self, ligado: bool = EMAILS_FILTRO, arquivo: str = EMAILS_FILTRO_ARQUIVO,
+                 capacidade: int = EMAILS_FILTRO_CAPACIDADE, taxa: float = EMAILS_FILTRO_FP,
+                 max_kb: int = EMAILS_FILTRO_MAX_KB, arquivo_max_kb: int = EMAILS_FILTRO_ARQUIVO_MAX_KB):
+        self.ligado = ligado
+        self.arquivo = arquivo
+        self.capacidade = capacidade
+        self.taxa = taxa
+        self.max_kb = max_kb
+        self.arquivo_max_kb = arquivo_max_kb
+        self._reinicia()
+        os.register_at_fork(after_in_child=self._reinicia)
+
+    def _reinicia(self):
+        # o filtro e a thread do processo pai não valem no filho
+        self.filtro = None
+        # linha de geração e inode do arquivo lido pelo filtro, e a posição lida
+        self.geracao = None
+        self.inode = None
+        self.posicao = 0
+        self.removidos = 0
+        self.negativos = 0
+        self.positivos = 0
+        self._fonte = None
+        self._thread = None
+        self._reconstruindo = False
+        self._lock = threading.Lock()
+
+    def inicia(self, fonte):
+        """ Aquece o filtro em segundo plano, se ainda não aquecido neste
+            processo, com os emails retornados por fonte().
+        """
+        if not self.ligado or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._fonte = fonte
+                self._thread = threading.Thread(target=self.aquece, args=(fonte,), name="filtro-emails",
+                                                daemon=True)
+                self._thread.start()
+
+    def aquece(self, fonte, compacta: bool = False):
+        """ Monta um filtro novo com os emails retornados por fonte() e passa
+            a usá-lo, compactando antes o arquivo de anotações se 'compacta'.
+        """
+        # a posição é lida antes do banco: o que for anotado depois dela é
+        # lido pelo filtro novo, mesmo que já esteja no banco
+        geracao, inode, posicao = self._marca(compacta)
+        filtro = FiltroBloom(self.capacidade, self.taxa, self.max_kb * 1024)
+        for email in fonte():
+            if email is not None:
+                filtro.adiciona(email)
+        with self._lock:
+            self.filtro, self.geracao, self.inode, self.posicao = filtro, geracao, inode, posicao
+            self.removidos = 0
+            self._reconstruindo = False
+        self._acompanha()
+        if filtro.quantidade > self.capacidade:
+            logger.warning("Filtro de emails com %d emails, acima da capacidade de %d: taxa estimada de falsos "
+                           "positivos %.3f", filtro.quantidade, self.capacidade, filtro.taxa_estimada())
+        logger.info("Filtro de emails aquecido com %d emails em %d KB", filtro.quantidade, len(filtro.bits) // 1024)
+
+    @contextmanager
+    def _trava(self, modo: int):
+        # a trava fica em um arquivo à parte, pois o de anotações é trocado
+        diretorio = os.path.dirname(self.arquivo)
+        if diretorio:
+            os.makedirs(diretorio, exist_ok=True)
+        with open(self.arquivo + ".trava", "a") as trava:
+            fcntl.flock(trava, modo)
+            yield
+
+    def _abre(self):
+        try:
+            return open(self.arquivo, "rb")
+        except FileNotFoundError:
+            return None
+
+    def _marca(self, compacta: bool):
+        """ Retorna a geração, o inode e o tamanho do arquivo de anotações,
+            trocando-o antes por um novo se 'compacta' ou se ele não tem a
+            linha de geração.
+        """
+        with self._trava(fcntl.LOCK_EX):
+            arquivo = self._abre()
+            geracao = arquivo.readline() if arquivo is not None else b""
+            if arquivo is not None:
+                arquivo.close()
+            if not geracao.startswith(b"#") or (compacta and geracao == self.geracao):
+                with self._lock:
+                    # as últimas anotações vão para o filtro em uso, que
+                    # continua respondendo até o novo ficar pronto
+                    self._acompanha_arquivo()
+                    geracao = self._troca_arquivo()
+            arquivo = self._abre()
+            with arquivo:
+                estado = os.fstat(arquivo.fileno())
+                return arquivo.readline(), estado.st_ino, estado.st_size
+
+    def _troca_arquivo(self) -> bytes:
+        # chamada com a trava exclusiva e self._lock
+        geracao = ("#%s\n" % os.urandom(8).hex()).encode()
+        descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(self.arquivo) or ".", suffix=".parcial")
+        try:
+            os.write(descritor, geracao)
+            os.fchmod(descritor, 0o644)
+        finally:
+            os.close(descritor)
+        os.replace(temporario, self.arquivo)
+        if self.filtro is not None:
+            self.geracao, self.inode, self.posicao = geracao, os.stat(self.arquivo).st_ino, len(geracao)
+        return geracao
+
+    def _anota(self, sinal: str, email: str):
+        linha = (sinal + json.dumps(email) + "\n").encode()
+        # com O_APPEND cada linha é escrita inteira no fim, mesmo entre
+        # processos; a trava compartilhada só espera por uma compactação
+        with self._trava(fcntl.LOCK_SH):
+            descritor = os.open(self.arquivo, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(descritor, linha)
+            finally:
+                os.close(descritor)
+
+    def _acompanha_arquivo(self) -> bool:
+        """ Aplica ao filtro as linhas do arquivo desde a última leitura, com
+            self._lock, e retorna False se o arquivo é de outra geração.
+        """
+        if self.filtro is None:
+            return True
+        arquivo = self._abre()
+        if arquivo is None:
+            return False
+        with arquivo:
+            if arquivo.readline() != self.geracao:
+                return False
+            arquivo.seek(self.posicao)
+            dados = arquivo.read()
+        # uma linha ainda sem o '\n' é lida na próxima vez
+        completos = dados.rfind(b"\n") + 1
+        for linha in dados[:completos].splitlines():
+            if linha[:1] == b"+":
+                self.filtro.adiciona(json.loads(linha[1:]))
+            elif linha[:1] == b"-":
+                self.removidos += 1
+        self.posicao += completos
+        return True
+
+    def _acompanha(self):
+        """ Aplica ao filtro as linhas anotadas no arquivo desde a última
+            leitura, e inicia a reconstrução do filtro quando preciso.
+        """
+        if self.filtro is None:
+            return
+        try:
+            estado = os.stat(self.arquivo)
+            if estado.st_ino == self.inode and estado.st_size <= self.posicao:
+                return
+        except FileNotFoundError:
+            pass
+        compacta = None
+        with self._lock:
+            if self.filtro is None:
+                return
+            if not self._acompanha_arquivo():
+                # outro worker compactou o arquivo, e as anotações que este
+                # não leu ficaram no anterior: até a reconstrução, todo
+                # email é consultado no banco
+                self.filtro = None
+                compacta = False
+            elif not self._reconstruindo and (
+                    self.removidos > FRACAO_RECONSTRUCAO * max(self.filtro.quantidade, 1)
+                    or self.posicao > self.arquivo_max_kb * 1024):
+                compacta = True
+            if compacta is not None:
+                self.removidos = 0
+                self._reconstruindo = True
+        if compacta is not None and self._fonte is not None:
+            threading.Thread(target=self.aquece, args=(self._fonte, compacta), name="filtro-emails",
+                             daemon=True).start()
+
+    def pode_existir(self, email: str) -> bool:
+        """ Indica se o email pode estar cadastrado; False garante que não está.
+        """
+        if self.filtro is None:
+            return True
+        if email not in self.filtro:
+            # outro worker pode ter cadastrado o email depois do aquecimento;
+            # se ele compactou o arquivo, o filtro é descartado
+            self._acompanha()
+            filtro = self.filtro
+            if filtro is not None and email not in filtro:
+                self.negativos += 1
+                return False
+        self.positivos += 1
+        return True
+
+    def adiciona(self, email: str):
+        """ Anota um email cadastrado, para este e os outros workers.
+        """
+        if self.ligado and email is not None:
+            self._anota("+", email)
+            self._acompanha()
+
+    def remove(self, email: str):
+        """ Anota um email removido, contado para a reconstrução do filtro.
+        """
+        if self.ligado and email is not None:
+            self._anota("-", email)
+            self._acompanha()
+
+    def estatisticas(self) -> dict:
+        """ Retorna as respostas do filtro deste processo e a quantidade de
+            emails nele.
+        """
+        return {"negativos": self.negativos, "positivos": self.positivos,
+                "emails": self.filtro.quantidade if self.filtro is not None else 0}
+
+
+filtro_emails = FiltroEmails()
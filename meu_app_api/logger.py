@@ -1,71 +1,160 @@
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+import atexit
 import logging
 import os
+import queue
 
 
-log_path = "log/"
-# Verifica se o diretorio para armazenar os logs não existe
-if not os.path.exists(log_path):
-   # então cria o diretorio
-   os.makedirs(log_path)
+# configuração dos logs, ajustável por variáveis de ambiente
+LOG_PATH = os.environ.get("LOG_PATH", "log/")
+LOG_NIVEL = os.environ.get("LOG_NIVEL", "INFO").upper()
+LOG_NIVEL_CONSOLE = os.environ.get("LOG_NIVEL_CONSOLE", LOG_NIVEL).upper()
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 10))
+# com a fila, a escrita em console e arquivos é feita por uma thread própria
+LOG_FILA = os.environ.get("LOG_FILA", "1") != "0"
 
+# listeners ativos, parados ao reconfigurar ou ao encerrar o processo
+_listeners = []
+# indica se a configuração já foi feita neste processo
+_configurado = False
 
-dictConfig({
-    "version": 1,
-    "disable_existing_loggers": True,
-    "formatters": {
-        "default": {
-            "format": "[%(asctime)s] %(levelname)-4s %(funcName)s() L%(lineno)-4d %(message)s",
+
+def _enfileira(logger: logging.Logger):
+    """ Troca os handlers do logger por um QueueHandler.
+
+    Os handlers originais passam a ser chamados por um QueueListener em
+    segundo plano, então a requisição só coloca o registro na fila e não
+    espera pela escrita nem pela rotação dos arquivos.
+    """
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    fila = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(fila))
+    listener = QueueListener(fila, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+
+def para_listeners():
+    """ Esvazia as filas de log e para as threads de escrita.
+    """
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def _reinicia_listeners():
+    """ Recria as threads de escrita no processo filho após um fork.
+
+    Threads não sobrevivem ao fork, então sem isso os workers carregados
+    com o '--preload' do gunicorn enfileirariam logs que ninguém escreve.
+    Cada listener herdado é trocado por um novo, com a mesma fila e os
+    mesmos handlers: o stop() do herdado enfileiraria o aviso de parada,
+    que o novo leria em seguida.
+    """
+    for indice, listener in enumerate(_listeners):
+        novo = QueueListener(listener.queue, *listener.handlers,
+                             respect_handler_level=listener.respect_handler_level)
+        novo.start()
+        _listeners[indice] = novo
+
+
+def configura_logging(log_path: str = LOG_PATH, nivel: str = LOG_NIVEL,
+                      nivel_console: str = LOG_NIVEL_CONSOLE, max_bytes: int = LOG_MAX_BYTES,
+                      backup_count: int = LOG_BACKUP_COUNT, fila: bool = LOG_FILA):
+    """ Configura os handlers de console e de arquivo da aplicação.
+    """
+    global _configurado
+    para_listeners()
+    _configurado = True
+
+    # Verifica se o diretorio para armazenar os logs não existe
+    if not os.path.exists(log_path):
+       # então cria o diretorio
+       os.makedirs(log_path)
+
+    dictConfig({
+        "version": 1,
+        "disable_existing_loggers": True,
+        "formatters": {
+            "default": {
+                "format": "[%(asctime)s] %(levelname)-4s %(funcName)s() L%(lineno)-4d %(message)s",
+            },
+            "detailed": {
+                "format": "[%(asctime)s] %(levelname)-4s %(funcName)s() L%(lineno)-4d %(message)s - call_trace=%(pathname)s L%(lineno)-4d",
+            }
         },
-        "detailed": {
-            "format": "[%(asctime)s] %(levelname)-4s %(funcName)s() L%(lineno)-4d %(message)s - call_trace=%(pathname)s L%(lineno)-4d",
-        }
-    },
-    "handlers": {
-        "console": {
-            "class": "logging.StreamHandler",
-            "formatter": "default",
-            "stream": "ext://sys.stdout",
+        "handlers": {
+            "console": {
+                "class": "logging.StreamHandler",
+                "formatter": "default",
+                "level": nivel_console,
+                "stream": "ext://sys.stdout",
+            },
+            # "email": {
+            #     "class": "logging.handlers.SMTPHandler",
+            #     "formatter": "default",
+            #     "level": "ERROR",
+            #     "mailhost": ("smtp.example.com", 587),
+            #     "fromaddr": "devops@example.com",
+            #     "toaddrs": ["receiver@example.com", "receiver2@example.com"],
+            #     "subject": "Error Logs",
+            #     "credentials": ("username", "password"),
+            # },
+            "error_file": {
+                "class": "logging.handlers.RotatingFileHandler",
+                "formatter": "detailed",
+                "filename": os.path.join(log_path, "gunicorn.error.log"),
+                "maxBytes": max_bytes,
+                "backupCount": backup_count,
+                "delay": True,
+            },
+            "detailed_file": {
+                "class": "logging.handlers.RotatingFileHandler",
+                "formatter": "detailed",
+                "filename": os.path.join(log_path, "gunicorn.detailed.log"),
+                "maxBytes": max_bytes,
+                "backupCount": backup_count,
+                "delay": True,
+            }
         },
-        # "email": {
-        #     "class": "logging.handlers.SMTPHandler",
-        #     "formatter": "default",
-        #     "level": "ERROR",
-        #     "mailhost": ("smtp.example.com", 587),
-        #     "fromaddr": "devops@example.com",
-        #     "toaddrs": ["receiver@example.com", "receiver2@example.com"],
-        #     "subject": "Error Logs",
-        #     "credentials": ("username", "password"),
-        # },
-        "error_file": {
-            "class": "logging.handlers.RotatingFileHandler",
-            "formatter": "detailed",
-            "filename": "log/gunicorn.error.log",
-            "maxBytes": 10000,
-            "backupCount": 10,
-            "delay": "True",
+        "loggers": {
+            "gunicorn.error": {
+                "handlers": ["console", "error_file"],  #, email],
+                "level": "INFO",
+                "propagate": False,
+            }
         },
-        "detailed_file": {
-            "class": "logging.handlers.RotatingFileHandler",
-            "formatter": "detailed",
-            "filename": "log/gunicorn.detailed.log",
-            "maxBytes": 10000,
-            "backupCount": 10,
-            "delay": "True",
-        }
-    },
-    "loggers": {
-        "gunicorn.error": {
-            "handlers": ["console", "error_file"],  #, email],
-            "level": "INFO",
-            "propagate": False,
+        "root": {
+            "handlers": ["console", "detailed_file"],
+            "level": nivel,
         }
-    },
-    "root": {
-        "handlers": ["console", "detailed_file"],
-        "level": "INFO",
-    }
-})
+    })
+
+    # o dictConfig desativa os loggers já existentes, inclusive o deste
+    # módulo quando a configuração é refeita
+    logging.getLogger(__name__).disabled = False
+
+    if fila:
+        _enfileira(logging.getLogger())
+        _enfileira(logging.getLogger("gunicorn.error"))
+
+
+def inicia_logging():
+    """ Configura os logs com as variáveis de ambiente, se isso ainda não
+        foi feito no processo.
+
+    É chamada pelo create_app, e não no import, para que importar um módulo
+    não crie o diretório de logs nem inicie as threads de escrita; os
+    workers do gunicorn recebem as threads de _reinicia_listeners.
+    """
+    if not _configurado:
+        configura_logging()
+
 
+atexit.register(para_listeners)
+os.register_at_fork(after_in_child=_reinicia_listeners)
 
 logger = logging.getLogger(__name__)
@@ -0,0 +1,193 @@
+from flask import g, request
+import cProfile
+import os
+import random
+import threading
+import time
+
+from model import ColetorConsultas, coletor_consultas
+from logger import logger
+
+
+# configuração da instrumentação, ajustável por variáveis de ambiente:
+# requisições acima de METRICAS_LENTO_MS são registradas no log com o SQL
+# emitido (0 desliga) e uma fração PERFIL_TAXA das requisições é perfilada
+# com cProfile, gravando o perfil das que passarem de PERFIL_LIMIAR_MS
+METRICAS_LENTO_MS = float(os.environ.get("METRICAS_LENTO_MS", 0))
+PERFIL_TAXA = float(os.environ.get("PERFIL_TAXA", 0))
+PERFIL_LIMIAR_MS = float(os.environ.get("PERFIL_LIMIAR_MS", 500))
+PERFIL_DIR = os.environ.get("PERFIL_DIR", "log/perfis")
+
+# limites das faixas dos histogramas, no estilo do Prometheus
+FAIXAS_DURACAO = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAIXAS_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histograma:
+    """ Histograma de faixas fixas com contagem e soma, como o do Prometheus.
+    """
+    __slots__ = ("faixas", "contagens", "soma", "total")
+
+    def __init__(self, faixas):
+        self.faixas = faixas
+        self.contagens = [0] * len(faixas)
+        self.soma = 0.0
+        self.total = 0
+
+    def observa(self, valor: float):
+        self.soma += valor
+        self.total += 1
+        for i, limite in enumerate(self.faixas):
+            if valor <= limite:
+                self.contagens[i] += 1
+                break
+
+    def acumulado(self):
+        """ Retorna as contagens acumuladas por faixa, como no formato de texto.
+        """
+        resultado = []
+        soma = 0
+        for contagem in self.contagens:
+            soma += contagem
+            resultado.append(soma)
+        return resultado
+
+
+class Registro:
+    """ Métricas acumuladas pelo processo desde a sua inicialização.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (rota, método, status) -> Histograma da duração
+        self.duracoes = {}
+        # (rota, método) -> Histograma da quantidade de comandos SQL
+        self.consultas = {}
+        # (rota, método) -> segundos gastos em comandos SQL
+        self.tempo_sql = {}
+        # fontes extras de contadores, como o cache e o controle de admissão
+        self.contadores = []
+
+    def observa(self, rota: str, metodo: str, status: int, duracao: float, coletor: ColetorConsultas):
+        with self._lock:
+            chave = (rota, metodo, str(status))
+            if chave not in self.duracoes:
+                self.duracoes[chave] = Histograma(FAIXAS_DURACAO)
+            self.duracoes[chave].observa(duracao)
+
+            chave = (rota, metodo)
+            if chave not in self.consultas:
+                self.consultas[chave] = Histograma(FAIXAS_CONSULTAS)
+                self.tempo_sql[chave] = 0.0
+            self.consultas[chave].observa(coletor.quantidade)
+            self.tempo_sql[chave] += coletor.tempo
+
+    def adiciona_contadores(self, nome: str, ajuda: str, funcao):
+        """ Registra uma função que retorna {rótulo: valor} para a métrica 'nome'.
+        """
+        self.contadores.append((nome, ajuda, funcao))
+
+
+registro = Registro()
+
+
+def _rotulos(**rotulos) -> str:
+    return ",".join('%s="%s"' % (nome, str(valor).replace('"', '\\"')) for nome, valor in rotulos.items())
+
+
+def _exporta_histograma(linhas, nome, rotulos, histograma):
+    for limite, contagem in zip(histograma.faixas, histograma.acumulado()):
+        linhas.append("%s_bucket{%s,le=\"%s\"} %d" % (nome, rotulos, limite, contagem))
+    linhas.append("%s_bucket{%s,le=\"+Inf\"} %d" % (nome, rotulos, histograma.total))
+    linhas.append("%s_sum{%s} %.6f" % (nome, rotulos, histograma.soma))
+    linhas.append("%s_count{%s} %d" % (nome, rotulos, histograma.total))
+
+
+def exporta_prometheus() -> str:
+    """ Retorna as métricas no formato de texto do Prometheus.
+    """
+    linhas = []
+    with registro._lock:
+        linhas.append("# HELP http_request_duration_seconds Duração das requisições por rota e status.")
+        linhas.append("# TYPE http_request_duration_seconds histogram")
+        for (rota, metodo, status), histograma in sorted(registro.duracoes.items()):
+            _exporta_histograma(linhas, "http_request_duration_seconds",
+                                _rotulos(rota=rota, metodo=metodo, status=status), histograma)
+
+        linhas.append("# HELP sql_queries_per_request Comandos SQL emitidos por requisição.")
+        linhas.append("# TYPE sql_queries_per_request histogram")
+        for (rota, metodo), histograma in sorted(registro.consultas.items()):
+            _exporta_histograma(linhas, "sql_queries_per_request", _rotulos(rota=rota, metodo=metodo), histograma)
+
+        linhas.append("# HELP sql_query_seconds_total Tempo gasto em comandos SQL por rota.")
+        linhas.append("# TYPE sql_query_seconds_total counter")
+        for (rota, metodo), tempo in sorted(registro.tempo_sql.items()):
+            linhas.append("sql_query_seconds_total{%s} %.6f" % (_rotulos(rota=rota, metodo=metodo), tempo))
+
+    for nome, ajuda, funcao in registro.contadores:
+        linhas.append("# HELP %s %s" % (nome, ajuda))
+        linhas.append("# TYPE %s counter" % nome)
+        for rotulos, valor in sorted(funcao().items()):
+            linhas.append("%s{%s} %s" % (nome, _rotulos(**dict(rotulos)), valor))
+
+    return "\n".join(linhas) + "\n"
+
+
+def _inicia_medicao():
+    g.inicio_requisicao = time.perf_counter()
+    coletor = ColetorConsultas(guarda_comandos=METRICAS_LENTO_MS > 0)
+    g.coletor_consultas = coletor
+    g.token_coletor = coletor_consultas.set(coletor)
+    g.perfil = None
+    if PERFIL_TAXA and random.random() < PERFIL_TAXA:
+        g.perfil = cProfile.Profile()
+        g.perfil.enable()
+
+
+def _registra_medicao(response):
+    inicio = g.get("inicio_requisicao")
+    if inicio is None:
+        return response
+    duracao = time.perf_counter() - inicio
+    coletor = g.coletor_consultas
+    rota = request.url_rule.rule if request.url_rule else "desconhecida"
+    registro.observa(rota, request.method, response.status_code, duracao, coletor)
+
+    if METRICAS_LENTO_MS and duracao * 1000 > METRICAS_LENTO_MS:
+        comandos = "\n".join("    %.1f ms %s" % (tempo * 1000, " ".join(comando.split()))
+                             for comando, tempo in coletor.comandos)
+        logger.warning("Requisição lenta %s %s: %.1f ms, %d comandos SQL em %.1f ms\n%s",
+                       request.method, request.path, duracao * 1000, coletor.quantidade,
+                       coletor.tempo * 1000, comandos)
+
+    perfil = g.perfil
+    if perfil is not None:
+        perfil.disable()
+        g.perfil = None
+        if duracao * 1000 > PERFIL_LIMIAR_MS:
+            _grava_perfil(perfil, rota, request.method)
+    return response
+
+
+def _grava_perfil(perfil, rota: str, metodo: str):
+    if not os.path.exists(PERFIL_DIR):
+        os.makedirs(PERFIL_DIR)
+    nome = "%s_%s_%d.prof" % (metodo, rota.strip("/").replace("/", "_") or "raiz", time.time() * 1000)
+    perfil.dump_stats(os.path.join(PERFIL_DIR, nome))
+
+
+def _encerra_medicao(exception=None):
+    token = g.pop("token_coletor", None)
+    if token is not None:
+        coletor_consultas.reset(token)
+    perfil = g.pop("perfil", None)
+    if perfil is not None:
+        perfil.disable()
+
+
+def instrumenta_app(app):
+    """ Registra no app os hooks que medem cada requisição.
+    """
+    app.before_request(_inicia_medicao)
+    app.after_request(_registra_medicao)
+    app.teardown_request(_encerra_medicao)
@@ -1,31 +1,604 @@
-from sqlalchemy_utils import database_exists, create_database
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session, Session as SessaoOrm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.engine import make_url
+from sqlalchemy import create_engine, event, inspect, select
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import contextvars
+import functools
 import os
+import threading
 
 # importando os elementos definidos no modelo
 from model.base import Base
-from model.historico import Historico
+from model.historico import Historico, interpreta_score
 from model.usuario import Usuario
+from model.arquivo import historico_arquivado, tabela_historicos, caminho_arquivo, anexa_arquivo, \
+                          arquiva_historicos, limite_arquivamento, LoteArquivado, ARQUIVO_DIAS, \
+                          ARQUIVO_LOTE, ARQUIVO_PAUSA_MS
+from model.ranking import Ranking, RankingPontuacao, atualiza_ranking, reconstroi_ranking, consulta_ranking, \
+                          posicao_no_ranking, cria_pontuacoes, reconstroi_pontuacoes
+from model.busca import Categoria, ResultadoBusca, UsuarioEncontrado, CategoriaEncontrada, busca_usuarios, \
+                        busca_categorias, junta_categorias, reconstroi_busca, CANDIDATOS_BUSCA
+from model.serie import HistoricoDiario, PontoSerie, atualiza_serie, desconta_serie, reconstroi_serie, consulta_serie, \
+                        soma_series
+from model.administracao import FiltroUsuarios, LoteUsuarios, OrfaosRemovidos, CAMPOS_LOTE, USUARIOS_LOTE, \
+                               USUARIOS_PAUSA_MS, ORFAOS_LOTE, ORFAOS_PAUSA_MS, em_transacao, remove_usuarios, \
+                               atualiza_usuarios, valida_valores, remove_arquivados, prepara_remocao, \
+                               remove_orfaos
+from model.emails import EmailDuplicado, email_substituto, emails_duplicados, substitui_email, le_emails_duplicados
+from model.versao import Versao, cria_versao, inicia_versao, le_versao_atual, le_versao_listagem, le_versao_usuario
+from model.consultas import consulta_usuarios_com_historicos, consulta_historicos_por_categoria
+from model.leitura import UsuarioLeitura, HistoricoLeitura, le_usuarios, le_usuario_por_nome, le_usuario_por_id, \
+                          le_credenciais_por_email, le_historicos_por_categoria, chave_categoria, \
+                          HistoricoExportacao, le_historicos_exportacao, le_tabela_exportacao, tabelas_exportacao, \
+                          chave_exportacao, ultimo_id_historico, estado_exportacao
+from model.estatisticas import carrega_pontuacoes, calcula_estatisticas, junta_pontuacoes
+from model.instrumentacao import ColetorConsultas, coletor_consultas, instrumenta_engine
+from model.migracao import aplica_migracoes, marca_versao, versao_mais_recente
+from model.shard import SUFIXO_SHARD, SUFIXO_DIRETORIO, caminho_com_sufixo, indice_do_shard, registra_shard, \
+                        proximos_ids_historico, intercala, le_para_copia, copia_para_shards
+from model import diretorio
 
-db_path = "database/"
-# Verifica se o diretorio não existe
-if not os.path.exists(db_path):
-   # então cria o diretorio
-   os.makedirs(db_path)
+db_path = os.environ.get("DB_PATH", "database/")
 
 # url de acesso ao banco (essa é uma url de acesso ao sqlite local)
-db_url = 'sqlite:///%s/db.sqlite3' % db_path
+db_url = os.environ.get("DB_URL", 'sqlite:///%s/db.sqlite3' % db_path)
 
-# cria a engine de conexão com o banco
-engine = create_engine(db_url, echo=False)
+# configuração do pool e do SQLite, ajustável por variáveis de ambiente
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL").upper()
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper()
+# valores negativos de cache_size são em KiB, como definido pelo SQLite
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", -64000))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 268435456))
+# com DB_INICIALIZA=0 o esquema não é criado nem migrado pelo processo da
+# API, apenas pelo comando 'flask init-db'
+DB_INICIALIZA = os.environ.get("DB_INICIALIZA", "1") != "0"
+# as rotas de leitura usam uma engine própria, com conexões somente leitura
+# e um pool maior, e as escritas uma engine de uma única conexão, já que o
+# SQLite grava uma transação por vez; com DB_LEITURA=0 (ou com o banco em
+# memória) uma única engine com o pool de DB_POOL_SIZE atende tudo
+DB_LEITURA = os.environ.get("DB_LEITURA", "1") != "0"
+DB_LEITURA_POOL_SIZE = int(os.environ.get("DB_LEITURA_POOL_SIZE", 10))
+DB_LEITURA_MAX_OVERFLOW = int(os.environ.get("DB_LEITURA_MAX_OVERFLOW", 20))
+# quantidade de arquivos entre os quais os usuarios são divididos, e threads
+# do processo que consultam os shards em paralelo nas rotas que leem de
+# todos eles; com DB_SHARDS=1 há um único banco, sem diretório
+DB_SHARDS = int(os.environ.get("DB_SHARDS", 1))
+DB_SHARDS_THREADS = int(os.environ.get("DB_SHARDS_THREADS", 4 * DB_SHARDS))
 
-# Instancia um criador de seção com o banco
-Session = sessionmaker(bind=engine)
+if DB_JOURNAL_MODE not in ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"):
+    raise ValueError("DB_JOURNAL_MODE inválido: %s" % DB_JOURNAL_MODE)
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError("DB_SYNCHRONOUS inválido: %s" % DB_SYNCHRONOUS)
+if DB_SHARDS < 1:
+    raise ValueError("DB_SHARDS inválido: %d" % DB_SHARDS)
 
-# cria o banco se ele não existir 
-if not database_exists(engine.url):
-    create_database(engine.url) 
 
-# cria as tabelas do banco, caso não existam
-Base.metadata.create_all(engine)
+def configura_conexao_sqlite(dbapi_connection, connection_record):
+    """ Aplica os pragmas do SQLite em cada nova conexão do pool.
+
+    Com o journal em WAL as leituras não esperam pelas escritas, e o
+    busy_timeout faz o escritor aguardar o lock em vez de falhar com
+    "database is locked". As chaves estrangeiras, desligadas por padrão no
+    SQLite, são verificadas e removem em cascata os históricos e o ranking
+    de um usuario removido.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=%s" % DB_JOURNAL_MODE)
+    cursor.execute("PRAGMA synchronous=%s" % DB_SYNCHRONOUS)
+    cursor.execute("PRAGMA busy_timeout=%d" % DB_BUSY_TIMEOUT_MS)
+    cursor.execute("PRAGMA cache_size=%d" % DB_CACHE_SIZE)
+    cursor.execute("PRAGMA mmap_size=%d" % DB_MMAP_SIZE)
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def somente_consultas(dbapi_connection, connection_record):
+    """ Recusa qualquer escrita na conexão, inclusive em tabelas temporárias.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def banco_em_arquivo(url: str) -> bool:
+    """ Indica se a url é de um banco SQLite em arquivo, e não em memória.
+    """
+    banco = make_url(url).database
+    return bool(banco) and banco != ":memory:" and not banco.startswith("file:")
+
+
+def url_somente_leitura(url: str):
+    """ Retorna a url que abre o mesmo arquivo do banco apenas para leitura.
+    """
+    banco = make_url(url)
+    return banco.set(database="file:%s" % quote(os.path.abspath(banco.database)),
+                     query=dict(banco.query, mode="ro", uri="true"))
+
+
+def url_com_sufixo(url: str, sufixo: str):
+    """ Retorna a url do banco com o sufixo no nome do arquivo.
+    """
+    banco = make_url(url)
+    if not banco_em_arquivo(url):
+        raise ValueError("DB_SHARDS > 1 exige o banco em arquivo: %s" % url)
+    return banco.set(database=caminho_com_sufixo(banco.database, sufixo))
+
+
+def cria_engine(url: str = db_url, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW,
+                somente_leitura: bool = False, arquivo=None):
+    """ Cria a engine de conexão com o banco, com o pool, os pragmas e a
+        instrumentação dos comandos SQL.
+
+    Com 'somente_leitura' o arquivo é aberto com mode=ro e query_only, então
+    uma escrita pela engine falha em vez de disputar o lock com o escritor.
+    'arquivo' é o banco de arquivamento anexado às conexões: por padrão o
+    de caminho_arquivo(url) e, com False, nenhum.
+    """
+    engine = create_engine(
+        url_somente_leitura(url) if somente_leitura else url,
+        echo=False,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=DB_POOL_TIMEOUT,
+        # as conexões do pool são compartilhadas entre as threads do servidor
+        connect_args={"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT_MS / 1000},
+    )
+    event.listen(engine, "connect", configura_conexao_sqlite)
+    # os históricos arquivados ficam em outro arquivo, anexado a cada conexão
+    if arquivo is not False:
+        event.listen(engine, "connect", anexa_arquivo(arquivo or caminho_arquivo(url), DB_JOURNAL_MODE,
+                                                      DB_SYNCHRONOUS, somente_leitura))
+    if somente_leitura:
+        event.listen(engine, "connect", somente_consultas)
+    # mede quantidade e tempo dos comandos SQL de cada requisição
+    instrumenta_engine(engine)
+    return engine
+
+
+def inicializa_banco(engine):
+    """ Cria o banco e as tabelas que não existirem e aplica as migrações.
+    """
+    # importado aqui por ser usado só na inicialização, fora do import do app
+    from sqlalchemy_utils import database_exists, create_database
+
+    # Verifica se o diretorio do banco não existe
+    diretorio = os.path.dirname(engine.url.database or "")
+    if diretorio and not os.path.exists(diretorio):
+        # então cria o diretorio
+        os.makedirs(diretorio)
+
+    # cria o banco se ele não existir 
+    if not database_exists(engine.url):
+        create_database(engine.url) 
+
+    # um banco sem tabelas é criado já no esquema mais recente pelo create_all
+    banco_novo = not inspect(engine).has_table(Usuario.__tablename__)
+
+    # cria as tabelas do banco, caso não existam
+    Base.metadata.create_all(engine)
+
+    if banco_novo:
+        with engine.begin() as conn:
+            # os triggers das versões dependem de 'usuario.versao', que nos
+            # bancos antigos só existe depois da migração 7, e os do ranking
+            # são criados, como eles, junto com as migrações
+            cria_versao(conn)
+            cria_pontuacoes(conn)
+            marca_versao(conn, versao_mais_recente())
+    else:
+        # o create_all não altera tabelas existentes, então índices e colunas
+        # novas chegam aos bancos antigos pelas migrações versionadas
+        aplica_migracoes(engine)
+
+
+# marca, em Session.info, a engine usada pela sessão: 'leitura' ou 'escrita'
+MODO_SESSAO = "modo"
+# indica que a transação corrente da sessão já escreveu
+ESCREVEU = "escreveu"
+# marca, em Session.info, o shard usado pela sessão; sem ela, o primeiro
+SHARD = "shard"
+
+
+class SessaoRoteada(SessaoOrm):
+    """ Sessão que escolhe, a cada comando, a engine de leitura ou a de escrita.
+
+    As sessões das rotas marcadas com rota_leitura usam só a engine somente
+    leitura. Nas rotas marcadas com rota_escrita as leituras vão para ela até
+    a primeira escrita da transação; daí até o commit tudo vai para a engine
+    de escrita, e a requisição lê o que acabou de escrever. As sessões sem
+    marca, como as do escritor e dos comandos de manutenção, usam só a engine
+    de escrita, como quando há uma única engine. Com DB_SHARDS > 1 as engines
+    são as do shard marcado na sessão.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if not _shards:
+            return super().get_bind(mapper, clause, **kw)
+        escrita, leitura = _shards[self.info.get(SHARD, 0)]
+        modo = self.info.get(MODO_SESSAO)
+        if leitura is None or modo is None:
+            return escrita
+        if modo == "leitura":
+            return leitura
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info[ESCREVEU] = True
+        if self.info.get(ESCREVEU):
+            return escrita
+        return leitura
+
+    def usa_escrita(self):
+        """ Envia todos os comandos à engine de escrita até o fim da transação.
+
+        Usado antes de escritas que leem e gravam na mesma transação, ou que
+        gravam por comandos em texto, que a sessão não reconhece.
+        """
+        self.info[ESCREVEU] = True
+
+
+@event.listens_for(SessaoRoteada, "after_transaction_end")
+def _encerra_escrita(session, transacao):
+    # só a transação externa, e não os SAVEPOINTs, encerra as escritas
+    if transacao.parent is None:
+        session.info.pop(ESCREVEU, None)
+
+
+# Instancia um criador de seção, ligado à engine quando ela for criada
+session_factory = sessionmaker(class_=SessaoRoteada)
+
+# Sessão por thread, descartada ao fim de cada requisição pelo app
+Session = scoped_session(session_factory)
+
+
+def _marca_rota(modo: str):
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def rota(*args, **kwargs):
+            Session().info[MODO_SESSAO] = modo
+            return funcao(*args, **kwargs)
+        # também define a classe de admissão padrão da rota
+        rota.modo_sessao = modo
+        return rota
+    return decorador
+
+
+# decoradores das rotas, aplicados abaixo do registro da rota no blueprint
+rota_leitura = _marca_rota("leitura")
+rota_escrita = _marca_rota("escrita")
+
+# engines do processo, criadas no primeiro uso por obtem_engine: a de
+# escrita do primeiro shard, as de escrita e de leitura de cada shard e a
+# do diretório, que só existe com DB_SHARDS > 1
+_engine = None
+_shards = []
+_diretorio = None
+_lock_engine = threading.Lock()
+# threads que consultam os shards, criadas no primeiro uso
+_executor = None
+
+
+def _inicializa_shard(engine, indice: int = None):
+    inicializa_banco(engine)
+    if indice is not None:
+        with engine.begin() as conn:
+            registra_shard(conn, indice, DB_SHARDS)
+
+
+def _arquivo_do_shard(url, indice: int = None) -> str:
+    """ Retorna o banco de arquivamento do banco, ou o próprio do shard 'indice'.
+    """
+    arquivo = caminho_arquivo(str(url))
+    if indice is not None and arquivo != ":memory:":
+        arquivo = caminho_com_sufixo(arquivo, SUFIXO_SHARD % indice)
+    return arquivo
+
+
+def _cria_engines(url, inicializa: bool, indice: int = None):
+    """ Cria as engines de escrita e de leitura de um banco, ou as do shard
+        'indice', com o banco de arquivamento próprio do shard.
+    """
+    arquivo = None
+    if indice is not None:
+        arquivo = _arquivo_do_shard(url, indice)
+        url = url_com_sufixo(url, SUFIXO_SHARD % indice)
+    separa = DB_LEITURA and banco_em_arquivo(url)
+    if separa:
+        engine = cria_engine(url, pool_size=1, max_overflow=0, arquivo=arquivo)
+    else:
+        engine = cria_engine(url, arquivo=arquivo)
+    if inicializa:
+        _inicializa_shard(engine, indice)
+    leitura = None
+    if separa:
+        # a conexão de escrita cria os arquivos do banco e do arquivamento,
+        # que as conexões somente leitura só abrem
+        with engine.connect():
+            pass
+        leitura = cria_engine(url, DB_LEITURA_POOL_SIZE, DB_LEITURA_MAX_OVERFLOW, somente_leitura=True,
+                              arquivo=arquivo)
+    return engine, leitura
+
+
+def obtem_engine(url: str = None, inicializa: bool = None):
+    """ Retorna a engine de escrita do processo, criando-a no primeiro uso.
+
+    Na criação a engine passa a ser usada pelas sessões e, com 'inicializa'
+    (por padrão DB_INICIALIZA), o esquema do banco é criado ou migrado. Com
+    DB_LEITURA e o banco em arquivo também é criada a engine somente leitura
+    das rotas de leitura. Com DB_SHARDS > 1 são criadas as engines de cada
+    shard e a do diretório, e a retornada é a do primeiro shard. Os
+    argumentos só valem para a primeira chamada, pois há uma única engine de
+    cada tipo por processo.
+    """
+    global _engine, _shards, _diretorio
+    if _engine is None:
+        with _lock_engine:
+            if _engine is None:
+                url = url or db_url
+                inicializa = DB_INICIALIZA if inicializa is None else inicializa
+                if DB_SHARDS == 1:
+                    shards = [_cria_engines(url, inicializa)]
+                else:
+                    shards = [_cria_engines(url, inicializa, indice) for indice in range(DB_SHARDS)]
+                    _diretorio = cria_engine(url_com_sufixo(url, SUFIXO_DIRETORIO), arquivo=False)
+                _shards = shards
+                if inicializa and _diretorio is not None:
+                    _inicializa_diretorio()
+                session_factory.configure(bind=shards[0][0])
+                _engine = shards[0][0]
+    return _engine
+
+
+def inicializa_bancos():
+    """ Cria ou migra o banco de cada shard e o diretório.
+    """
+    for indice, engine in enumerate(engines_dos_shards()):
+        _inicializa_shard(engine, indice if DB_SHARDS > 1 else None)
+    if _diretorio is not None:
+        _inicializa_diretorio()
+
+
+def _inicializa_diretorio():
+    """ Cria o diretório e, nos criados antes do email único, resolve os
+        emails repetidos entre os shards antes de criar o índice único.
+
+    Cada shard já resolveu os seus repetidos na migração 8, mas o
+    diretório ainda tem os emails originais: o usuario de menor id entre
+    todos os shards fica com o email, e os outros recebem no shard e no
+    diretório o mesmo substituto da migração.
+    """
+    diretorio.cria_diretorio(_diretorio)
+    with _diretorio.begin() as conn:
+        if diretorio.email_unico(conn):
+            return
+        duplicados = emails_duplicados(conn, diretorio.usuario_diretorio)
+    for usuario_id, email, mantido in duplicados:
+        with _shards[shard_do_usuario(usuario_id)][0].begin() as conn:
+            substitui_email(conn, usuario_id, email, mantido)
+    with _diretorio.begin() as conn:
+        for usuario_id, email, mantido in duplicados:
+            diretorio.troca_email(conn, usuario_id, email_substituto(email, usuario_id))
+        diretorio.cria_indice_email_unico(conn)
+
+
+def arquivos_dos_bancos(url: str = None):
+    """ Retorna os arquivos SQLite da url (por padrão DB_URL) e de DB_SHARDS:
+        o banco de cada shard seguido do seu banco de arquivamento e, por
+        último, o diretório. Os bancos em memória ficam de fora.
+
+    Não abre nenhuma conexão, então serve também aos comandos que trocam
+    os arquivos com a API parada.
+    """
+    url = url or db_url
+    if DB_SHARDS == 1:
+        bancos = [(url, _arquivo_do_shard(url))]
+    else:
+        bancos = [(url_com_sufixo(url, SUFIXO_SHARD % indice), _arquivo_do_shard(url, indice))
+                  for indice in range(DB_SHARDS)]
+        bancos.append((url_com_sufixo(url, SUFIXO_DIRETORIO), ":memory:"))
+    arquivos = []
+    for banco, arquivo in bancos:
+        if banco_em_arquivo(str(banco)):
+            arquivos.append(os.path.abspath(make_url(banco).database))
+        if arquivo != ":memory:":
+            arquivos.append(os.path.abspath(arquivo))
+    return arquivos
+
+
+def emails_registrados():
+    """ Percorre os emails de todos os usuarios: os do diretório com
+        DB_SHARDS > 1, ou os do banco, pela engine de leitura se houver.
+    """
+    if _diretorio is not None:
+        engine, coluna = _diretorio, diretorio.usuario_diretorio.c.email
+    else:
+        engine, coluna = _shards[0][1] or _shards[0][0], Usuario.email
+    with engine.connect() as conn:
+        for (email,) in conn.execution_options(stream_results=True).execute(select(coluna)):
+            yield email
+
+
+def engines_dos_shards():
+    """ Retorna as engines de escrita de cada shard, na ordem dos shards.
+    """
+    return [escrita for escrita, _ in _shards]
+
+
+def engine_diretorio():
+    """ Retorna a engine do diretório de usuarios, ou None com um único banco.
+    """
+    return _diretorio
+
+
+def shard_do_usuario(usuario_id) -> int:
+    """ Retorna o shard do usuario; com um único banco, sempre 0.
+    """
+    return indice_do_shard(usuario_id, DB_SHARDS) if DB_SHARDS > 1 else 0
+
+
+def usa_shard(indice: int):
+    """ Aponta a sessão da requisição para o shard e a retorna.
+    """
+    session = Session()
+    session.info[SHARD] = indice
+    return session
+
+
+def sessao_do_usuario(usuario_id=None, nome: str = None, email: str = None):
+    """ Retorna a sessão da requisição apontada para o shard do usuario.
+
+    Com DB_SHARDS > 1 o usuario procurado pelo nome ou pelo email é
+    localizado no diretório, e None indica que ele não existe. Com um único
+    banco é sempre a sessão da requisição, sem nenhuma consulta.
+    """
+    if DB_SHARDS > 1 and usuario_id is None:
+        with _diretorio.connect() as conn:
+            if nome is not None:
+                usuario_id = diretorio.id_por_nome(conn, nome)
+            else:
+                usuario_id = diretorio.id_por_email(conn, email)
+        if usuario_id is None:
+            return None
+    return usa_shard(shard_do_usuario(usuario_id))
+
+
+def reserva_id_usuario(nome: str, email: str):
+    """ Com DB_SHARDS > 1 registra o usuario novo no diretório e retorna o
+        id dele; com um único banco retorna None, e o id vem do SQLite.
+    """
+    if DB_SHARDS == 1:
+        return None
+    with _diretorio.begin() as conn:
+        return diretorio.registra_usuario(conn, nome, email)
+
+
+def renomeia_no_diretorio(usuario_id: int, nome: str):
+    """ Atualiza o nome do usuario no diretório, se houver um.
+    """
+    if DB_SHARDS > 1:
+        with _diretorio.begin() as conn:
+            diretorio.renomeia_usuario(conn, usuario_id, nome)
+
+
+def remove_do_diretorio(*usuario_ids):
+    """ Remove os usuarios do diretório, se houver um.
+    """
+    usuario_ids = [usuario_id for usuario_id in usuario_ids if usuario_id is not None]
+    if DB_SHARDS > 1 and usuario_ids:
+        with _diretorio.begin() as conn:
+            diretorio.remove_usuarios(conn, usuario_ids)
+
+
+def numera_historicos(session, linhas):
+    """ Com DB_SHARDS > 1 define o id de cada linha de histórico a inserir
+        no shard da sessão; com um único banco os ids vêm do SQLite.
+    """
+    if DB_SHARDS > 1:
+        ids = proximos_ids_historico(session, len(linhas), session.info.get(SHARD, 0), DB_SHARDS)
+        for linha, id in zip(linhas, ids):
+            linha["id"] = id
+
+
+def _executa_no_shard(funcao, modo: str, indice: int):
+    session = session_factory(info={MODO_SESSAO: modo, SHARD: indice})
+    try:
+        return funcao(session)
+    finally:
+        session.close()
+
+
+def em_cada_shard(funcao, modo: str = "leitura"):
+    """ Executa funcao(session) em cada shard e retorna os resultados na
+        ordem dos shards.
+
+    Os shards são consultados em paralelo pelas threads do processo, cada
+    um em uma sessão própria, e o contexto da requisição, com o coletor dos
+    comandos SQL, segue para as threads. Com um único banco a função é
+    executada na sessão da requisição, sem threads.
+    """
+    global _executor
+    if DB_SHARDS == 1:
+        return [funcao(Session())]
+    if _executor is None:
+        with _lock_engine:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(DB_SHARDS_THREADS, thread_name_prefix="shard")
+    futuros = [_executor.submit(contextvars.copy_context().run, _executa_no_shard, funcao, modo, indice)
+               for indice in range(DB_SHARDS)]
+    return [futuro.result() for futuro in futuros]
+
+
+def sessoes_de_leitura():
+    """ Retorna uma sessão de leitura própria para cada shard, fechada por
+        quem a recebe, para os geradores que continuam depois da requisição.
+    """
+    return [session_factory(info={MODO_SESSAO: "leitura", SHARD: indice}) for indice in range(DB_SHARDS)]
+
+
+def reparte(destino: str, total: int):
+    """ Copia os usuarios e os históricos dos bancos do processo para
+        'total' bancos novos na url 'destino', com o diretório se 'total' > 1.
+
+    Os arquivos de destino, inclusive os de arquivamento, ficam no
+    diretório de 'destino' e não podem existir. Deve ser executada com a API
+    parada: o que for gravado nos bancos de origem durante a cópia se perde.
+    """
+    pasta = os.path.dirname(make_url(destino).database)
+    engines = []
+    try:
+        for indice in range(total):
+            url, arquivo = destino, os.path.join(pasta, "arquivo.sqlite3")
+            if total > 1:
+                url = url_com_sufixo(destino, SUFIXO_SHARD % indice)
+                arquivo = caminho_com_sufixo(arquivo, SUFIXO_SHARD % indice)
+            for caminho in (make_url(url).database, arquivo):
+                if os.path.exists(caminho):
+                    raise FileExistsError("O arquivo de destino já existe: %s" % caminho)
+            engines.append(cria_engine(url, arquivo=arquivo))
+            inicializa_banco(engines[-1])
+        engine_diretorio_destino = None
+        if total > 1:
+            url = url_com_sufixo(destino, SUFIXO_DIRETORIO)
+            if os.path.exists(make_url(url).database):
+                raise FileExistsError("O arquivo de destino já existe: %s" % make_url(url).database)
+            engine_diretorio_destino = cria_engine(url, arquivo=False)
+            diretorio.cria_diretorio(engine_diretorio_destino)
+            engines.append(engine_diretorio_destino)
+        # as versões dos destinos continuam acima das de todas as origens
+        versao = 0
+        for engine in engines_dos_shards():
+            with engine.connect() as conn:
+                versao = max(versao, le_versao_atual(conn))
+        copia_para_shards(engines[:total], *le_para_copia(engines_dos_shards()), diretorio=engine_diretorio_destino,
+                          versao=versao)
+    finally:
+        for engine in engines:
+            engine.dispose()
+
+
+def _descarta_conexoes_herdadas():
+    """ Esquece, sem fechar, as conexões herdadas do processo pai.
+
+    Com o '--preload' do gunicorn o app é carregado antes do fork, e uma
+    conexão SQLite usada por dois processos corrompe o estado de ambos. O
+    close=False deixa as conexões para o pai e o filho abre as suas. As
+    threads dos shards não sobrevivem ao fork, e o filho cria as suas.
+    """
+    global _executor
+    for escrita, leitura in _shards:
+        for engine in (escrita, leitura):
+            if engine is not None:
+                engine.dispose(close=False)
+    if _diretorio is not None:
+        _diretorio.dispose(close=False)
+    _executor = None
+
+
+os.register_at_fork(after_in_child=_descarta_conexoes_herdadas)
@@ -0,0 +1,232 @@
+from sqlalchemy import select, text
+from typing import NamedTuple, Optional, Tuple
+import os
+import time
+
+from model.usuario import Usuario
+from model.busca import desconta_arquivados
+from model.serie import desconta_serie
+
+# configuração das operações em lote de usuarios e da limpeza de órfãos,
+# ajustável por variáveis de ambiente: usuarios removidos ou alterados por
+# transação, linhas examinadas por passo da limpeza e pausa entre as
+# transações, para que as escritas da API não esperem pelo lote inteiro
+USUARIOS_LOTE = int(os.environ.get("USUARIOS_LOTE", 500))
+USUARIOS_PAUSA_MS = int(os.environ.get("USUARIOS_PAUSA_MS", 50))
+ORFAOS_LOTE = int(os.environ.get("ORFAOS_LOTE", 5000))
+ORFAOS_PAUSA_MS = int(os.environ.get("ORFAOS_PAUSA_MS", 50))
+
+# colunas de usuario usadas nos filtros e alteradas pelas operações em lote;
+# o nome e o email identificam o usuario e só mudam um a um
+CAMPOS_LOTE = ("cep", "logradouro", "bairro", "cidade", "estado")
+
+# tabelas com a coluna 'usuario' em que sobram linhas de usuarios removidos
+# antes do ON DELETE CASCADE; os arquivados, em outro arquivo de banco, não
+# têm chave estrangeira e são sempre removidos por aqui
+TABELAS_ORFAOS = ("main.historico", "arquivo.historico", "main.ranking")
+
+
+class FiltroUsuarios(NamedTuple):
+    """ Seleção de usuarios de uma operação em lote: uma lista de ids ou
+        valores das colunas de CAMPOS_LOTE, que devem ser todos iguais.
+    """
+    ids: Optional[Tuple[int, ...]] = None
+    campos: Tuple[Tuple[str, str], ...] = ()
+
+    def valida(self):
+        """ Levanta ValueError se o filtro selecionaria todos os usuarios ou
+            usa colunas fora de CAMPOS_LOTE.
+        """
+        if self.ids is None and not self.campos:
+            raise ValueError("Informe os ids ou ao menos um campo do filtro (%s)." % ", ".join(CAMPOS_LOTE))
+        invalidos = [campo for campo, _ in self.campos if campo not in CAMPOS_LOTE]
+        if invalidos:
+            raise ValueError("Campos inválidos no filtro: %s. Use %s." % (", ".join(invalidos), ", ".join(CAMPOS_LOTE)))
+
+
+class LoteUsuarios(NamedTuple):
+    """ Resultado de uma transação de uma operação em lote de usuarios.
+    """
+    quantidade: int
+    # (id, nome, email) de cada usuario afetado, para o cache e o diretório
+    usuarios: Tuple[Tuple[int, str, str], ...]
+
+
+class OrfaosRemovidos(NamedTuple):
+    """ Resultado de uma transação da limpeza de órfãos.
+    """
+    tabela: str
+    quantidade: int
+
+
+def em_transacao(engine):
+    """ Retorna a função que executa funcao(conn) em uma transação da
+        engine, com o lock de escrita desde o início, como no arquivamento.
+    """
+    def executa(funcao):
+        with engine.begin() as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            return funcao(conn)
+    return executa
+
+
+def _seleciona_lote(conn, filtro: FiltroUsuarios, ultimo: int, lote: int, ids=None):
+    """ Grava em temp.lote_usuarios os próximos usuarios do filtro depois do
+        id 'ultimo', até 'lote', ou, com 'ids', os usuarios do filtro entre
+        esses ids, e os retorna em ordem de id.
+    """
+    consulta = select(Usuario.id, Usuario.nome, Usuario.email)
+    if ids is not None:
+        consulta = consulta.where(Usuario.id.in_(ids))
+    else:
+        consulta = consulta.where(Usuario.id > ultimo).limit(lote)
+    for campo, valor in filtro.campos:
+        consulta = consulta.where(getattr(Usuario, campo) == valor)
+    usuarios = tuple(tuple(linha) for linha in conn.execute(consulta.order_by(Usuario.id)))
+    if usuarios:
+        conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS lote_usuarios (id INTEGER PRIMARY KEY)"))
+        conn.execute(text("DELETE FROM temp.lote_usuarios"))
+        conn.execute(text("INSERT INTO temp.lote_usuarios (id) VALUES (:id)"), [{"id": u[0]} for u in usuarios])
+    return usuarios
+
+
+def _em_lotes(executa, filtro: FiltroUsuarios, lote: int, pausa_ms: int, altera):
+    """ Aplica altera(conn) a cada lote de usuarios do filtro, cada um em uma
+        transação de executa(), como um gerador de LoteUsuarios.
+
+    Com uma lista de ids, cada lote é o próximo pedaço de 'lote' ids da
+    lista ordenada, e a operação só termina no fim da lista: um pedaço sem
+    nenhum usuario, com ids que não existem, de outro shard ou fora dos
+    campos do filtro, não gera LoteUsuarios. Sem ids os lotes avançam pelo
+    id até um lote vazio. Nos dois casos cada usuario é visto uma vez, mesmo
+    que continue no filtro depois da alteração.
+    """
+    # a lista é percorrida em pedaços, e nunca passa inteira para o SQLite
+    ids = sorted(set(filtro.ids)) if filtro.ids is not None else None
+    posicao = 0
+    ultimo = 0
+
+    def processa(conn):
+        # o lote é lido e alterado na mesma transação
+        pedaco = ids[posicao:posicao + lote] if ids is not None else None
+        usuarios = _seleciona_lote(conn, filtro, ultimo, lote, pedaco)
+        return LoteUsuarios(altera(conn) if usuarios else 0, usuarios)
+
+    while ids is None or posicao < len(ids):
+        resultado = executa(processa)
+        if ids is not None:
+            posicao += lote
+        elif not resultado.usuarios:
+            return
+        else:
+            ultimo = resultado.usuarios[-1][0]
+        if resultado.usuarios:
+            yield resultado
+            if pausa_ms:
+                time.sleep(pausa_ms / 1000)
+
+
+def remove_arquivados(conn, selecao: str, parametros: dict = None):
+    """ Remove os históricos arquivados da condição 'selecao', que não têm
+        chave estrangeira, descontando-os das categorias e do resumo diário.
+    """
+    desconta_arquivados(conn, selecao, parametros)
+    desconta_serie(conn, "arquivo.historico", selecao, parametros)
+    return conn.execute(text("DELETE FROM arquivo.historico WHERE " + selecao), parametros or {}).rowcount
+
+
+def prepara_remocao(conn, selecao: str, parametros: dict = None):
+    """ Prepara a remoção dos usuarios cujos históricos satisfazem a condição
+        'selecao', e deve ser chamada na mesma transação, antes do DELETE.
+
+    Os históricos da tabela quente saem com o usuario pelo ON DELETE
+    CASCADE, e o trigger desconta as categorias, mas não o resumo diário,
+    que é descontado aqui. Os arquivados são removidos por remove_arquivados.
+    """
+    desconta_serie(conn, "main.historico", selecao, parametros)
+    remove_arquivados(conn, selecao, parametros)
+
+
+def remove_usuarios(executa, filtro: FiltroUsuarios, lote: int = USUARIOS_LOTE, pausa_ms: int = USUARIOS_PAUSA_MS):
+    """ Remove os usuarios do filtro em lotes de até 'lote' por transação.
+
+    Cada lote é um DELETE de usuario, que remove os históricos e o ranking
+    pelo ON DELETE CASCADE, e um DELETE dos históricos arquivados. As
+    contagens das categorias são descontadas pelo trigger dos históricos e,
+    para os arquivados, por remove_arquivados; o resumo diário, pelo
+    prepara_remocao. 'executa' é a função que
+    roda cada lote em uma transação de escrita, como a de em_transacao. É
+    um gerador de LoteUsuarios.
+    """
+    def remove(conn):
+        prepara_remocao(conn, "usuario IN (SELECT id FROM temp.lote_usuarios)")
+        return conn.execute(text("DELETE FROM main.usuario WHERE id IN (SELECT id FROM temp.lote_usuarios)")).rowcount
+
+    return _em_lotes(executa, filtro, lote, pausa_ms, remove)
+
+
+def valida_valores(valores: dict):
+    """ Levanta ValueError se não há valores a alterar ou se algum é de uma
+        coluna fora de CAMPOS_LOTE.
+    """
+    invalidos = [campo for campo in valores if campo not in CAMPOS_LOTE]
+    if not valores or invalidos:
+        raise ValueError("Informe os valores a alterar, entre %s." % ", ".join(CAMPOS_LOTE))
+
+
+def atualiza_usuarios(executa, filtro: FiltroUsuarios, valores: dict, lote: int = USUARIOS_LOTE,
+                      pausa_ms: int = USUARIOS_PAUSA_MS):
+    """ Altera as colunas de 'valores', de CAMPOS_LOTE, dos usuarios do
+        filtro, com um UPDATE por lote de até 'lote' usuarios. É um gerador
+        de LoteUsuarios.
+    """
+    valida_valores(valores)
+    # os nomes das colunas vêm de CAMPOS_LOTE, e os valores são parâmetros
+    comando = text("UPDATE main.usuario SET %s WHERE id IN (SELECT id FROM temp.lote_usuarios)"
+                   % ", ".join("%s = :%s" % (campo, campo) for campo in valores))
+
+    def altera(conn):
+        return conn.execute(comando, valores).rowcount
+
+    return _em_lotes(executa, filtro, lote, pausa_ms, altera)
+
+
+def remove_orfaos(engine, lote: int = ORFAOS_LOTE, pausa_ms: int = ORFAOS_PAUSA_MS):
+    """ Remove as linhas de TABELAS_ORFAOS cujo usuario não existe mais.
+
+    Cada tabela é percorrida pelo rowid em janelas de 'lote' linhas. Os
+    órfãos de uma janela são contados em uma leitura, que não bloqueia as
+    escritas, e só as janelas com órfãos abrem uma transação de escrita,
+    seguida de uma pausa de 'pausa_ms'. O DELETE repete a condição, então
+    uma linha cujo usuario foi recriado no meio tempo não é removida. Os
+    históricos removidos são descontados das categorias e do resumo diário.
+    É um gerador de OrfaosRemovidos.
+    """
+    for tabela in TABELAS_ORFAOS:
+        nome = tabela.split(".")[1]
+        selecao = ("rowid > :ultimo AND rowid <= :fim AND NOT EXISTS "
+                   "(SELECT 1 FROM main.usuario WHERE main.usuario.id = %s.usuario)" % nome)
+        ultimo = 0
+        while True:
+            with engine.connect() as conn:
+                fim = conn.execute(text(
+                    "SELECT MAX(rowid) FROM (SELECT rowid FROM %s WHERE rowid > :ultimo ORDER BY rowid LIMIT :lote)"
+                    % tabela), {"ultimo": ultimo, "lote": lote}).scalar()
+                if fim is None:
+                    break
+                parametros = {"ultimo": ultimo, "fim": fim}
+                orfaos = conn.execute(text("SELECT COUNT(*) FROM %s WHERE %s" % (tabela, selecao)), parametros).scalar()
+            if orfaos:
+                with engine.begin() as conn:
+                    conn.exec_driver_sql("BEGIN IMMEDIATE")
+                    if tabela == "arquivo.historico":
+                        quantidade = remove_arquivados(conn, selecao, parametros)
+                    else:
+                        if tabela == "main.historico":
+                            # as categorias são descontadas pelo trigger
+                            desconta_serie(conn, tabela, selecao, parametros)
+                        quantidade = conn.execute(text("DELETE FROM %s WHERE %s" % (tabela, selecao)),
+                                                  parametros).rowcount
+                yield OrfaosRemovidos(tabela, quantidade)
+                time.sleep(pausa_ms / 1000)
+            ultimo = fim
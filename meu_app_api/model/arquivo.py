@@ -0,0 +1,189 @@
+from sqlalchemy import Table, MetaData, Column, String, Integer, DateTime, select, union_all, text, \
+                       bindparam
+from sqlalchemy.engine import make_url
+from datetime import datetime, timedelta
+from typing import NamedTuple, Tuple
+from urllib.parse import quote
+import os
+import time
+
+from model import Base
+from model.historico import Historico
+
+# configuração do arquivamento de históricos, ajustável por variáveis de
+# ambiente: arquivo do banco de arquivamento ('desligado' para não usar
+# nenhum), idade mínima em dias dos históricos arquivados, linhas movidas
+# por transação e pausa entre as transações, para que as escritas da API
+# não fiquem esperando o lock durante todo o arquivamento
+ARQUIVO_DB = os.environ.get("ARQUIVO_DB", "")
+ARQUIVO_DIAS = int(os.environ.get("ARQUIVO_DIAS", 180))
+ARQUIVO_LOTE = int(os.environ.get("ARQUIVO_LOTE", 500))
+ARQUIVO_PAUSA_MS = int(os.environ.get("ARQUIVO_PAUSA_MS", 50))
+
+# nome com que o banco de arquivamento é anexado a cada conexão
+ESQUEMA_ARQUIVO = "arquivo"
+
+# Históricos arquivados: as mesmas colunas e índices de 'historico', sem a
+# chave estrangeira, que não pode apontar para outro arquivo de banco. Os
+# ids são os originais, então um histórico nunca está nas duas tabelas com
+# ids diferentes.
+COMANDOS_ARQUIVO = (
+    "CREATE TABLE IF NOT EXISTS arquivo.historico ("
+    "id INTEGER NOT NULL PRIMARY KEY, categoria VARCHAR(256), score VARCHAR(32), "
+    "acertos INTEGER, total INTEGER, data_insercao DATETIME, usuario INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS arquivo.ix_historico_usuario_data ON historico (usuario, data_insercao)",
+    "CREATE INDEX IF NOT EXISTS arquivo.ix_historico_categoria_data ON historico (categoria, data_insercao)",
+    "CREATE INDEX IF NOT EXISTS arquivo.ix_historico_data ON historico (data_insercao)",
+)
+
+historico_arquivado = Table(
+    "historico", MetaData(schema=ESQUEMA_ARQUIVO),
+    Column("id", Integer, primary_key=True),
+    Column("categoria", String(256)),
+    Column("score", String(32)),
+    Column("acertos", Integer),
+    Column("total", Integer),
+    Column("data_insercao", DateTime),
+    Column("usuario", Integer, nullable=False),
+)
+
+# Enquanto o arquivamento move um lote, esta tabela tem uma linha e o
+# trigger 'categoria_remove' não desconta as remoções da contagem de
+# históricos das categorias, que continua valendo para o histórico completo.
+# A linha é inserida e removida na mesma transação, então nenhuma outra
+# conexão chega a vê-la.
+historico_arquivamento = Table(
+    "historico_arquivamento", Base.metadata,
+    Column("ativo", Integer, primary_key=True),
+)
+
+COLUNAS = ("id", "categoria", "score", "acertos", "total", "data_insercao", "usuario")
+
+# históricos das tabelas quente e de arquivamento, para os comandos em SQL
+# que recalculam os resumos a partir de todos os históricos
+SQL_HISTORICO_COMPLETO = "(SELECT {0} FROM main.historico UNION ALL SELECT {0} FROM arquivo.historico)"\
+    .format(", ".join(COLUNAS))
+
+
+def caminho_arquivo(url: str) -> str:
+    """ Retorna o arquivo do banco de arquivamento da url do banco principal.
+
+    Por padrão é o 'arquivo.sqlite3' no diretório do banco principal. Com
+    ARQUIVO_DB=desligado, ou com o banco principal em memória, é um banco em
+    memória: a tabela existe, vazia, e as consultas são as mesmas.
+    """
+    if ARQUIVO_DB == "desligado":
+        return ":memory:"
+    if ARQUIVO_DB:
+        return ARQUIVO_DB
+    banco = make_url(url).database
+    if not banco or banco == ":memory:":
+        return ":memory:"
+    return os.path.join(os.path.dirname(banco), "arquivo.sqlite3")
+
+
+def anexa_arquivo(caminho: str, journal_mode: str, synchronous: str, somente_leitura: bool = False):
+    """ Retorna o listener de conexão que anexa o banco de arquivamento.
+
+    A tabela de arquivamento é criada na primeira conexão, e nas demais o
+    IF NOT EXISTS não escreve nada no arquivo. Com 'somente_leitura' o
+    arquivo, já criado pela engine de escrita, é anexado com mode=ro.
+    """
+    def anexa(dbapi_connection, connection_record):
+        arquivo = caminho
+        if caminho != ":memory:" and somente_leitura:
+            arquivo = "file:%s?mode=ro" % quote(os.path.abspath(caminho))
+        elif caminho != ":memory:":
+            diretorio = os.path.dirname(caminho)
+            if diretorio and not os.path.exists(diretorio):
+                os.makedirs(diretorio, exist_ok=True)
+        cursor = dbapi_connection.cursor()
+        cursor.execute("ATTACH DATABASE ? AS %s" % ESQUEMA_ARQUIVO, (arquivo,))
+        if caminho != ":memory:" and not somente_leitura:
+            cursor.execute("PRAGMA %s.journal_mode=%s" % (ESQUEMA_ARQUIVO, journal_mode))
+            cursor.execute("PRAGMA %s.synchronous=%s" % (ESQUEMA_ARQUIVO, synchronous))
+        for comando in COMANDOS_ARQUIVO:
+            cursor.execute(comando)
+        cursor.close()
+    return anexa
+
+
+def tabela_historicos(completo: bool = False):
+    """ Retorna a tabela de históricos usada nas leituras.
+
+    Com 'completo', uma união das tabelas quente e de arquivamento com as
+    mesmas colunas de 'historico'. O SQLite aplica os filtros da consulta
+    externa em cada lado da união, então os índices das duas tabelas são
+    usados normalmente.
+    """
+    tabela = Historico.__table__
+    if not completo:
+        return tabela
+    return union_all(
+        select(*(tabela.c[coluna] for coluna in COLUNAS)),
+        select(*(historico_arquivado.c[coluna] for coluna in COLUNAS)),
+    ).subquery("historico")
+
+
+class LoteArquivado(NamedTuple):
+    """ Resultado de uma transação do arquivamento.
+    """
+    quantidade: int
+    usuarios: Tuple[int, ...]
+
+
+def limite_arquivamento(dias: int = ARQUIVO_DIAS, agora: datetime = None) -> datetime:
+    """ Retorna a data antes da qual os históricos são arquivados.
+    """
+    if dias < 1:
+        raise ValueError("Os históricos arquivados devem ter pelo menos 1 dia")
+    return (agora or datetime.now()) - timedelta(days=dias)
+
+
+def arquiva_historicos(engine, limite: datetime, lote: int = ARQUIVO_LOTE, pausa_ms: int = ARQUIVO_PAUSA_MS):
+    """ Move para o banco de arquivamento os históricos anteriores a 'limite'.
+
+    Cada lote de até 'lote' históricos, dos mais antigos para os mais
+    novos, é copiado e removido da tabela quente em uma transação curta,
+    seguida de uma pausa de 'pausa_ms' em que as escritas da API avançam. É
+    um gerador de LoteArquivado, com a quantidade movida e os usuários
+    afetados por lote.
+
+    O histórico de maior id nunca é arquivado: o SQLite reaproveita o id
+    seguinte ao maior da tabela, e um id já usado no arquivo seria repetido.
+    Se o processo parar entre a gravação dos dois arquivos, as linhas que
+    ficaram nas duas tabelas são removidas da quente na execução seguinte.
+    """
+    while True:
+        with engine.begin() as conn:
+            # o lote é lido e removido na mesma transação; começando pela
+            # leitura, outro escritor poderia gravar antes da remoção e o
+            # SQLite recusaria a escrita sem esperar pelo busy_timeout
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS lote_arquivamento (id INTEGER PRIMARY KEY)"))
+            conn.execute(text("DELETE FROM temp.lote_arquivamento"))
+            conn.execute(text(
+                "INSERT INTO temp.lote_arquivamento (id) "
+                "SELECT id FROM main.historico WHERE data_insercao < :limite "
+                "AND id < (SELECT MAX(id) FROM main.historico) "
+                "ORDER BY data_insercao LIMIT :lote").bindparams(
+                    # gravada no mesmo formato de texto da coluna, para a comparação valer
+                    bindparam("limite", limite, type_=DateTime), lote=lote))
+            usuarios = tuple(conn.execute(text(
+                "SELECT DISTINCT usuario FROM main.historico "
+                "WHERE id IN (SELECT id FROM temp.lote_arquivamento)")).scalars())
+            if not usuarios:
+                return
+
+            conn.execute(text(
+                "INSERT OR IGNORE INTO arquivo.historico ({0}) SELECT {0} FROM main.historico "
+                "WHERE id IN (SELECT id FROM temp.lote_arquivamento)".format(", ".join(COLUNAS))))
+            conn.execute(historico_arquivamento.insert().values(ativo=1))
+            quantidade = conn.execute(text(
+                "DELETE FROM main.historico WHERE id IN (SELECT id FROM temp.lote_arquivamento)")).rowcount
+            conn.execute(historico_arquivamento.delete())
+        yield LoteArquivado(quantidade, usuarios)
+
+        if quantidade < lote:
+            return
+        time.sleep(pausa_ms / 1000)
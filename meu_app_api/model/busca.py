@@ -0,0 +1,349 @@
+from sqlalchemy import Column, String, Integer, event, text
+from itertools import combinations
+import string
+from typing import NamedTuple
+
+from model import Base
+from model.arquivo import SQL_HISTORICO_COMPLETO
+
+# Busca textual por nome/email de usuário e por nome de categoria, feita
+# por tabelas virtuais FTS5 com o tokenizador 'trigram'. Cada trigrama do
+# texto é um termo do índice, então um trecho com 3 ou mais caracteres é
+# encontrado em qualquer posição do nome pelas listas de trigramas, sem
+# varrer a tabela como um LIKE '%trecho%'. Quando nenhum nome contém o
+# trecho, a busca aproximada procura os nomes que compartilham mais
+# trigramas com ele, o que tolera erros de digitação. As tabelas são
+# mantidas pelos triggers abaixo, inclusive nas inserções em lote.
+
+# quantidade de candidatos lidos de cada índice antes da ordenação final;
+# limita o custo de buscas com termos muito comuns, e a busca informa
+# quando algum índice tinha mais candidatos que isso
+CANDIDATOS_BUSCA = 1000
+# termos menores que um trigrama são buscados pelo prefixo no índice B-tree
+# sem distinção de maiúsculas, como o índice de trigramas
+TAMANHO_TRIGRAMA = 3
+# quantidade de trigramas, os mais raros do termo, usados na busca aproximada,
+# e quantos deles um nome precisa ter para ser considerado parecido
+TRIGRAMAS_APROXIMADA = 4
+TRIGRAMAS_EM_COMUM = 2
+
+
+class Categoria(Base):
+    """ Categorias existentes e a quantidade de históricos de cada uma.
+
+    É mantida pelos triggers de 'historico' e serve de conteúdo para o
+    índice de busca 'categoria_fts'.
+    """
+    __tablename__ = 'categoria'
+
+    # chave inteira para que o rowid, usado pelo índice FTS, seja estável
+    id = Column(Integer, primary_key=True)
+    nome = Column(String(256), unique=True, nullable=False)
+    historicos = Column(Integer, nullable=False)
+
+
+class ResultadoBusca(NamedTuple):
+    """ Registros encontrados pela busca, em ordem de relevância, e se a
+        ordenação considerou só parte dos registros com o termo.
+    """
+    registros: list
+    truncado: bool
+
+
+class UsuarioEncontrado(NamedTuple):
+    """ Usuário retornado pela busca, em ordem de relevância.
+    """
+    id: int
+    nome: str
+    email: str
+
+
+class CategoriaEncontrada(NamedTuple):
+    """ Categoria retornada pela busca, em ordem de relevância.
+    """
+    nome: str
+    historicos: int
+
+
+# índices FTS5 de conteúdo externo: guardam só os trigramas, e os textos
+# continuam nas tabelas 'usuario' e 'categoria'
+COMANDOS_BUSCA_USUARIOS = (
+    # nomes que começam com o termo, sem distinção de maiúsculas
+    "CREATE INDEX IF NOT EXISTS ix_usuario_nome_nocase ON usuario (nome COLLATE NOCASE)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS usuario_fts USING fts5("
+    "nome, email, content='usuario', content_rowid='id', tokenize='trigram')",
+    # quantidade de documentos de cada trigrama, para a busca aproximada
+    "CREATE VIRTUAL TABLE IF NOT EXISTS usuario_fts_termos USING fts5vocab(usuario_fts, 'row')",
+
+    "CREATE TRIGGER IF NOT EXISTS usuario_fts_insere AFTER INSERT ON usuario BEGIN "
+    "INSERT INTO usuario_fts (rowid, nome, email) VALUES (new.id, new.nome, new.email); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS usuario_fts_remove AFTER DELETE ON usuario BEGIN "
+    "INSERT INTO usuario_fts (usuario_fts, rowid, nome, email) VALUES ('delete', old.id, old.nome, old.email); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS usuario_fts_atualiza AFTER UPDATE OF nome, email ON usuario BEGIN "
+    "INSERT INTO usuario_fts (usuario_fts, rowid, nome, email) VALUES ('delete', old.id, old.nome, old.email); "
+    "INSERT INTO usuario_fts (rowid, nome, email) VALUES (new.id, new.nome, new.email); "
+    "END",
+)
+
+COMANDOS_BUSCA_CATEGORIAS = (
+    "CREATE INDEX IF NOT EXISTS ix_categoria_nome_nocase ON categoria (nome COLLATE NOCASE)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS categoria_fts USING fts5("
+    "nome, content='categoria', content_rowid='id', tokenize='trigram')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS categoria_fts_termos USING fts5vocab(categoria_fts, 'row')",
+
+    # a categoria entra no índice ao receber o primeiro histórico e sai
+    # dele quando o último histórico é removido
+    "CREATE TRIGGER IF NOT EXISTS categoria_insere AFTER INSERT ON historico BEGIN "
+    "INSERT INTO categoria (nome, historicos) SELECT new.categoria, 1 "
+    "WHERE new.categoria IS NOT NULL "
+    "ON CONFLICT (nome) DO UPDATE SET historicos = historicos + 1; "
+    "INSERT INTO categoria_fts (rowid, nome) "
+    "SELECT id, nome FROM categoria WHERE nome = new.categoria AND historicos = 1; "
+    "END",
+    # os históricos movidos para o arquivo continuam contando para a categoria
+    "CREATE TRIGGER IF NOT EXISTS categoria_remove AFTER DELETE ON historico "
+    "WHEN NOT EXISTS (SELECT 1 FROM historico_arquivamento) BEGIN "
+    "INSERT INTO categoria_fts (categoria_fts, rowid, nome) "
+    "SELECT 'delete', id, nome FROM categoria WHERE nome = old.categoria AND historicos = 1; "
+    "UPDATE categoria SET historicos = historicos - 1 WHERE nome = old.categoria; "
+    "DELETE FROM categoria WHERE nome = old.categoria AND historicos <= 0; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS categoria_atualiza AFTER UPDATE OF categoria ON historico "
+    "WHEN old.categoria IS NOT new.categoria BEGIN "
+    "INSERT INTO categoria_fts (categoria_fts, rowid, nome) "
+    "SELECT 'delete', id, nome FROM categoria WHERE nome = old.categoria AND historicos = 1; "
+    "UPDATE categoria SET historicos = historicos - 1 WHERE nome = old.categoria; "
+    "DELETE FROM categoria WHERE nome = old.categoria AND historicos <= 0; "
+    "INSERT INTO categoria (nome, historicos) SELECT new.categoria, 1 "
+    "WHERE new.categoria IS NOT NULL "
+    "ON CONFLICT (nome) DO UPDATE SET historicos = historicos + 1; "
+    "INSERT INTO categoria_fts (rowid, nome) "
+    "SELECT id, nome FROM categoria WHERE nome = new.categoria AND historicos = 1; "
+    "END",
+)
+
+COMANDOS_BUSCA = COMANDOS_BUSCA_USUARIOS + COMANDOS_BUSCA_CATEGORIAS
+
+
+def cria_busca(conn):
+    """ Cria, se ainda não existirem, as tabelas FTS5 e os triggers de busca.
+    """
+    for comando in COMANDOS_BUSCA:
+        conn.exec_driver_sql(comando)
+
+
+@event.listens_for(Base.metadata, "after_create")
+def _cria_busca_com_tabelas(target, connection, **kw):
+    # bancos novos recebem os índices de busca junto com as tabelas
+    cria_busca(connection)
+
+
+def reconstroi_busca(conn):
+    """ Recalcula as categorias e reconstrói os índices FTS5 a partir das
+        tabelas 'usuario' e 'historico', inclusive os históricos arquivados.
+    """
+    conn.execute(text("DELETE FROM categoria"))
+    conn.execute(text(
+        "INSERT INTO categoria (nome, historicos) "
+        "SELECT categoria, COUNT(*) FROM " + SQL_HISTORICO_COMPLETO + " WHERE categoria IS NOT NULL "
+        "GROUP BY categoria"))
+    conn.execute(text("INSERT INTO categoria_fts (categoria_fts) VALUES ('rebuild')"))
+    conn.execute(text("INSERT INTO usuario_fts (usuario_fts) VALUES ('rebuild')"))
+
+
+def desconta_arquivados(conn, selecao: str, parametros: dict = None):
+    """ Desconta das categorias os históricos arquivados que satisfazem a
+        condição 'selecao', antes que sejam removidos.
+
+    Faz para um conjunto de linhas o que o trigger 'categoria_remove' faz
+    para cada histórico da tabela quente, que é a única com triggers.
+    """
+    conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS desconto_categoria "
+                      "(nome TEXT PRIMARY KEY, historicos INTEGER NOT NULL)"))
+    conn.execute(text("DELETE FROM temp.desconto_categoria"))
+    conn.execute(text(
+        "INSERT INTO temp.desconto_categoria (nome, historicos) SELECT categoria, COUNT(*) "
+        "FROM arquivo.historico WHERE categoria IS NOT NULL AND (" + selecao + ") GROUP BY categoria"),
+        parametros or {})
+    conn.execute(text(
+        "INSERT INTO categoria_fts (categoria_fts, rowid, nome) SELECT 'delete', c.id, c.nome "
+        "FROM categoria c JOIN temp.desconto_categoria d ON d.nome = c.nome WHERE c.historicos <= d.historicos"))
+    conn.execute(text(
+        "UPDATE categoria SET historicos = historicos - "
+        "(SELECT d.historicos FROM temp.desconto_categoria d WHERE d.nome = categoria.nome) "
+        "WHERE nome IN (SELECT nome FROM temp.desconto_categoria)"))
+    conn.execute(text("DELETE FROM categoria WHERE nome IN (SELECT nome FROM temp.desconto_categoria) "
+                      "AND historicos <= 0"))
+
+
+def _frase(termo: str) -> str:
+    # entre aspas o termo é um trecho contínuo; aspas no texto são dobradas
+    return '"%s"' % termo.replace('"', '""')
+
+
+def _fim_do_prefixo(termo: str) -> str:
+    # menor texto maior que todos os textos iniciados pelo termo
+    return termo + "\U0010ffff"
+
+
+def trigramas_raros(session, fts: str, termo: str):
+    """ Retorna os trigramas do termo presentes no índice 'fts', dos que
+        aparecem em menos documentos para os que aparecem em mais.
+
+    Os trigramas raros são os que distinguem o nome procurado; os comuns a
+    quase todos os nomes só deixariam a busca mais lenta.
+    """
+    termo = termo.lower()
+    trigramas = sorted({termo[i:i + TAMANHO_TRIGRAMA] for i in range(len(termo) - TAMANHO_TRIGRAMA + 1)})
+    # uma igualdade por trigrama usa o índice; um IN varreria o vocabulário
+    consulta = " UNION ALL ".join(
+        "SELECT term, doc FROM %s_termos WHERE term = :t%d" % (fts, i) for i in range(len(trigramas)))
+    linhas = session.execute(text(consulta), {"t%d" % i: t for i, t in enumerate(trigramas)})
+    return [termo for termo, _ in sorted(linhas, key=lambda linha: linha[1])]
+
+
+def consulta_aproximada(trigramas, minimo: int) -> str:
+    """ Monta a consulta FTS5 que aceita os registros com pelo menos 'minimo'
+        dos trigramas informados.
+    """
+    return " OR ".join("(%s)" % " AND ".join(_frase(trigrama) for trigrama in grupo)
+                       for grupo in combinations(trigramas, minimo))
+
+
+def _busca(session, fts: str, tabela: str, selecao: str, ordem_trecho: str, termo: str, limit: int, offset: int):
+    """ Executa a busca por trecho e, se nenhum registro contém o termo, a
+        busca aproximada pelos trigramas raros. Retorna um ResultadoBusca.
+
+    Os candidatos da busca por trecho são os registros de 'tabela' cujo
+    nome começa com o termo, lidos pelo índice B-tree na ordem do nome, e
+    os que o contêm, lidos do índice de trigramas na ordem do rowid, até
+    CANDIDATOS_BUSCA de cada um; assim os que começam com o termo, os mais
+    relevantes, não ficam de fora por estarem depois dos outros no índice
+    de trigramas. Os da busca aproximada são os de melhor bm25. 'selecao' é
+    o SELECT dos registros juntado aos candidatos 'c', com {truncado} entre
+    as colunas, e 'ordem_trecho' a ordenação dos que contêm o termo.
+    """
+    parametros = {"termo": termo, "fim": _fim_do_prefixo(termo), "candidatos": CANDIDATOS_BUSCA,
+                  "limit": limit, "offset": offset}
+    linhas = session.execute(text(
+        "WITH prefixo AS (SELECT id AS rowid FROM " + tabela + " WHERE nome >= :termo COLLATE NOCASE "
+        "AND nome < :fim COLLATE NOCASE ORDER BY nome COLLATE NOCASE LIMIT :candidatos), "
+        "trecho AS (SELECT rowid FROM " + fts + " WHERE " + fts + " MATCH :consulta LIMIT :candidatos) "
+        + selecao.format(
+            candidatos="SELECT rowid FROM prefixo UNION SELECT rowid FROM trecho",
+            truncado="(SELECT COUNT(*) FROM prefixo) >= :candidatos OR (SELECT COUNT(*) FROM trecho) >= :candidatos")
+        + " ORDER BY " + ordem_trecho + " LIMIT :limit OFFSET :offset"),
+        dict(parametros, consulta=_frase(termo))).fetchall()
+    if linhas:
+        return _resultado(linhas)
+    # uma página vazia depois da primeira pode ser só o fim dos resultados
+    if offset and session.execute(text("SELECT 1 FROM %s WHERE %s MATCH :consulta LIMIT 1" % (fts, fts)),
+                                  {"consulta": _frase(termo)}).first():
+        return ResultadoBusca([], False)
+
+    trigramas = trigramas_raros(session, fts, termo)[:TRIGRAMAS_APROXIMADA]
+    # termos de um só trigrama não têm como exigir mais de um em comum
+    minimo = min(TRIGRAMAS_EM_COMUM, len(termo) - TAMANHO_TRIGRAMA + 1)
+    if len(trigramas) < minimo:
+        return ResultadoBusca([], False)
+    # os registros com mais trigramas raros em comum têm o melhor bm25
+    return _resultado(session.execute(text(
+        "WITH aproximados AS (SELECT rowid, rank FROM " + fts + " WHERE " + fts + " MATCH :consulta "
+        "ORDER BY rank LIMIT :candidatos) "
+        + selecao.format(candidatos="SELECT rowid, rank FROM aproximados",
+                         truncado="(SELECT COUNT(*) FROM aproximados) >= :candidatos")
+        + " ORDER BY c.rank, c.rowid LIMIT :limit OFFSET :offset"),
+        dict(parametros, consulta=consulta_aproximada(trigramas, minimo))).fetchall())
+
+
+def _resultado(linhas) -> ResultadoBusca:
+    # a última coluna de cada linha indica se os candidatos foram truncados
+    return ResultadoBusca([linha[:-1] for linha in linhas], bool(linhas and linhas[0][-1]))
+
+
+def _busca_prefixo(session, tabela: str, colunas: str, ordem: str, termo: str, limit: int, offset: int):
+    """ Busca os registros de 'tabela' cujo nome começa com o termo, sem
+        distinção de maiúsculas, pelo índice de nome com COLLATE NOCASE.
+    """
+    linhas = session.execute(text(
+        "SELECT " + colunas + " FROM " + tabela + " WHERE nome >= :termo COLLATE NOCASE "
+        "AND nome < :fim COLLATE NOCASE ORDER BY nome COLLATE NOCASE, " + ordem + " LIMIT :limit OFFSET :offset"),
+        {"termo": termo, "fim": _fim_do_prefixo(termo), "limit": limit, "offset": offset})
+    return ResultadoBusca(linhas.fetchall(), False)
+
+
+def busca_usuarios(session, termo: str, limit: int, offset: int = 0) -> ResultadoBusca:
+    """ Retorna os usuários cujo nome ou email contém o termo ou, se não
+        houver nenhum, os de nome ou email mais parecido com ele.
+
+    Entre os que contêm o termo vêm primeiro os nomes que começam com ele,
+    depois os demais nomes que o contêm e os mais curtos, mais próximos do
+    termo. Termos curtos demais para um trigrama buscam só o início do nome.
+    """
+    if len(termo) < TAMANHO_TRIGRAMA:
+        resultado = _busca_prefixo(session, "usuario", "id, nome, email", "id", termo, limit, offset)
+    else:
+        resultado = _busca(
+            session, "usuario_fts", "usuario",
+            "SELECT u.id, u.nome, u.email, {truncado} FROM ({candidatos}) AS c JOIN usuario AS u ON u.id = c.rowid",
+            "substr(lower(u.nome), 1, length(:termo)) = lower(:termo) DESC, "
+            "instr(lower(u.nome), lower(:termo)) > 0 DESC, length(u.nome), u.id",
+            termo, limit, offset)
+    return resultado._replace(registros=[UsuarioEncontrado(*linha) for linha in resultado.registros])
+
+
+def busca_categorias(session, termo: str, limit: int, offset: int = 0) -> ResultadoBusca:
+    """ Retorna as categorias cujo nome contém o termo ou, se não houver
+        nenhuma, as de nome mais parecido, na mesma ordem de busca_usuarios.
+    """
+    if len(termo) < TAMANHO_TRIGRAMA:
+        resultado = _busca_prefixo(session, "categoria", "nome, historicos", "nome", termo, limit, offset)
+    else:
+        resultado = _busca(
+            session, "categoria_fts", "categoria",
+            "SELECT k.nome, k.historicos, {truncado} FROM ({candidatos}) AS c JOIN categoria AS k ON k.id = c.rowid",
+            "substr(lower(k.nome), 1, length(:termo)) = lower(:termo) DESC, length(k.nome), k.nome",
+            termo, limit, offset)
+    return resultado._replace(registros=[CategoriaEncontrada(*linha) for linha in resultado.registros])
+
+
+def minusculas_ascii(texto: str) -> str:
+    """ Troca só as maiúsculas ASCII pelas minúsculas, como o COLLATE NOCASE
+        e o lower() do SQLite.
+    """
+    return texto.translate(_MINUSCULAS_ASCII)
+
+
+_MINUSCULAS_ASCII = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def junta_categorias(partes, termo: str, limit: int, offset: int = 0) -> ResultadoBusca:
+    """ Junta as categorias encontradas em cada shard na página pedida.
+
+    Cada parte é o ResultadoBusca de busca_categorias em um shard, buscado
+    do início até o fim da página. A quantidade de históricos de uma
+    categoria é a soma dos shards. Os nomes com o trecho seguem a ordem de
+    busca_categorias, que só depende do nome e por isso é a mesma em todos
+    os shards; as categorias aproximadas, ordenadas pelo bm25 do índice de
+    cada shard, são intercaladas pela posição em cada um. O resultado é
+    truncado se o de algum shard foi.
+    """
+    historicos = {}
+    posicoes = {}
+    for parte in partes:
+        for posicao, categoria in enumerate(parte.registros):
+            historicos[categoria.nome] = historicos.get(categoria.nome, 0) + categoria.historicos
+            posicoes[categoria.nome] = min(posicoes.get(categoria.nome, posicao), posicao)
+
+    minusculo = termo.lower()
+    com_trecho = [nome for nome in historicos if minusculo in nome.lower()]
+    if len(termo) < TAMANHO_TRIGRAMA:
+        nomes = sorted(historicos, key=lambda nome: (minusculas_ascii(nome), nome))
+    elif com_trecho:
+        nomes = sorted(com_trecho, key=lambda nome: (not nome.lower().startswith(minusculo), len(nome), nome))
+    else:
+        nomes = sorted(historicos, key=lambda nome: (posicoes[nome], nome))
+    return ResultadoBusca([CategoriaEncontrada(nome, historicos[nome]) for nome in nomes[offset:offset + limit]],
+                          any(parte.truncado for parte in partes))
@@ -0,0 +1,26 @@
+from sqlalchemy.orm import contains_eager, selectinload
+
+from model.historico import Historico
+from model.usuario import Usuario
+
+
+def consulta_usuarios_com_historicos(session):
+    """ Retorna uma consulta de usuários que já carrega os históricos.
+
+    Os históricos são buscados em uma única consulta extra com 'IN' sobre os
+    ids dos usuários retornados, em vez de uma consulta por usuário quando
+    'usuario.historicos' for lido.
+    """
+    return session.query(Usuario).options(selectinload(Usuario.historicos))
+
+
+def consulta_historicos_por_categoria(session, categoria: str):
+    """ Retorna uma consulta dos históricos de uma categoria junto com o usuário.
+
+    O usuário vem no mesmo SELECT através do join, então ler
+    'historico.usuario_obj.nome' não dispara uma consulta por registro.
+    """
+    return session.query(Historico)\
+        .join(Historico.usuario_obj)\
+        .options(contains_eager(Historico.usuario_obj))\
+        .filter(Historico.categoria == categoria)
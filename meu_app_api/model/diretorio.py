@@ -0,0 +1,104 @@
+from sqlalchemy import Table, MetaData, Column, Integer, String, Index, select, text
+
+from model.busca import COMANDOS_BUSCA_USUARIOS
+
+# Diretório dos usuarios com DB_SHARDS > 1: um banco pequeno, separado dos
+# shards, com o id, o nome e o email de cada usuario. Ele gera os ids dos
+# usuarios novos, pelo AUTOINCREMENT, e localiza o shard de um usuario
+# procurado pelo nome ou pelo email. A tabela tem o nome e as colunas de
+# 'usuario', então o índice de busca textual de usuarios e as consultas de
+# busca_usuarios valem também para ele.
+usuario_diretorio = Table(
+    "usuario", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("nome", String(140)),
+    Column("email", String(256)),
+    Index("ix_usuario_nome", "nome"),
+    # o email é único entre todos os shards
+    Index("ix_usuario_email", "email", unique=True),
+    # ids de usuarios removidos não são reaproveitados
+    sqlite_autoincrement=True,
+)
+
+
+def cria_diretorio(engine):
+    """ Cria, se ainda não existirem, a tabela e o índice de busca do diretório.
+    """
+    usuario_diretorio.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for comando in COMANDOS_BUSCA_USUARIOS:
+            conn.exec_driver_sql(comando)
+
+
+def registra_usuario(conn, nome: str, email: str) -> int:
+    """ Registra um usuario novo no diretório e retorna o id gerado para ele.
+    """
+    return conn.execute(usuario_diretorio.insert().values(nome=nome, email=email)).inserted_primary_key[0]
+
+
+def renomeia_usuario(conn, usuario_id: int, nome: str):
+    """ Atualiza o nome de um usuario no diretório.
+    """
+    conn.execute(usuario_diretorio.update().where(usuario_diretorio.c.id == usuario_id).values(nome=nome))
+
+
+def troca_email(conn, usuario_id: int, email: str):
+    """ Atualiza o email de um usuario no diretório.
+    """
+    conn.execute(usuario_diretorio.update().where(usuario_diretorio.c.id == usuario_id).values(email=email))
+
+
+def email_unico(conn) -> bool:
+    """ Indica se o índice de emails do diretório já é único.
+
+    Os diretórios criados antes do email único têm o índice sem a
+    restrição, trocado por cria_indice_email_unico depois que os emails
+    repetidos são resolvidos nos shards.
+    """
+    return any(linha[1] == "ix_usuario_email" and linha[2] for linha in conn.exec_driver_sql("PRAGMA index_list(usuario)"))
+
+
+def cria_indice_email_unico(conn):
+    """ Troca o índice de emails do diretório pelo índice único.
+    """
+    conn.exec_driver_sql("DROP INDEX IF EXISTS ix_usuario_email")
+    conn.exec_driver_sql("CREATE UNIQUE INDEX ix_usuario_email ON usuario (email)")
+
+
+def remove_usuarios(conn, usuario_ids):
+    """ Remove os usuarios do diretório com um único DELETE.
+    """
+    conn.execute(usuario_diretorio.delete().where(usuario_diretorio.c.id.in_(list(usuario_ids))))
+
+
+def id_por_nome(conn, nome: str):
+    """ Retorna o id do primeiro usuario com o nome informado, ou None.
+
+    O primeiro é o de menor id, o mesmo que le_usuario_por_nome encontra no
+    shard dele, já que nenhum outro shard tem um id menor com esse nome.
+    """
+    consulta = select(usuario_diretorio.c.id).where(usuario_diretorio.c.nome == nome)\
+        .order_by(usuario_diretorio.c.id).limit(1)
+    return conn.execute(consulta).scalar()
+
+
+def id_por_email(conn, email: str):
+    """ Retorna o id do primeiro usuario com o email informado, ou None.
+    """
+    consulta = select(usuario_diretorio.c.id).where(usuario_diretorio.c.email == email)\
+        .order_by(usuario_diretorio.c.id).limit(1)
+    return conn.execute(consulta).scalar()
+
+
+def reconstroi_diretorio(conn, usuarios):
+    """ Substitui o conteúdo do diretório pelos usuarios informados, tuplas
+        (id, nome, email), e reconstrói o índice de busca.
+
+    Corrige o diretório quando um processo parou entre a gravação do shard
+    e a do diretório.
+    """
+    conn.execute(usuario_diretorio.delete())
+    linhas = [{"id": id, "nome": nome, "email": email} for id, nome, email in usuarios]
+    if linhas:
+        conn.execute(usuario_diretorio.insert(), linhas)
+    conn.execute(text("INSERT INTO usuario_fts (usuario_fts) VALUES ('rebuild')"))
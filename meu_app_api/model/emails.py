@@ -0,0 +1,59 @@
+from sqlalchemy import Column, Integer, String, DateTime, select, update, func
+from sqlalchemy.dialects.sqlite import insert
+from datetime import datetime
+
+from model import Base
+from model.usuario import Usuario
+
+# O email de 'usuario' é único desde a migração 8. Os usuarios que tinham o
+# email de outro, com menor id, ficaram com um email substituto, que não é
+# um endereço válido, e a troca fica registrada em 'email_duplicado' para
+# que os administradores possam avisá-los ou juntar as contas.
+
+
+class EmailDuplicado(Base):
+    """ Usuario cujo email repetido foi substituído pelo índice único.
+    """
+    __tablename__ = 'email_duplicado'
+
+    usuario = Column(Integer, primary_key=True)
+    # email original do usuario
+    email = Column(String(256), nullable=False)
+    # usuario que ficou com o email
+    mantido = Column(Integer, nullable=False)
+    data_resolucao = Column(DateTime, default=datetime.now)
+
+
+def email_substituto(email: str, usuario_id: int) -> str:
+    """ Retorna o email que substitui o repetido do usuario, único pelo id.
+    """
+    return "%s#duplicado-%d" % (email, usuario_id)
+
+
+def emails_duplicados(conn, tabela=Usuario.__table__):
+    """ Retorna (id, email, mantido) de cada usuario da tabela com o email de
+        outro de menor id, que é o 'mantido' com o email.
+    """
+    primeiros = select(tabela.c.email, func.min(tabela.c.id).label("mantido"))\
+        .group_by(tabela.c.email).having(func.count() > 1).subquery()
+    consulta = select(tabela.c.id, tabela.c.email, primeiros.c.mantido)\
+        .join(primeiros, tabela.c.email == primeiros.c.email)\
+        .where(tabela.c.id != primeiros.c.mantido).order_by(tabela.c.id)
+    return conn.execute(consulta).all()
+
+
+def substitui_email(conn, usuario_id: int, email: str, mantido: int):
+    """ Troca o email repetido do usuario pelo substituto e registra a troca.
+
+    Pode ser executada de novo para o mesmo usuario, como na resolução dos
+    emails repetidos entre shards, que atualiza o usuario 'mantido'.
+    """
+    conn.execute(update(Usuario).where(Usuario.id == usuario_id).values(email=email_substituto(email, usuario_id)))
+    comando = insert(EmailDuplicado).values(usuario=usuario_id, email=email, mantido=mantido)
+    conn.execute(comando.on_conflict_do_update(index_elements=[EmailDuplicado.usuario], set_={"mantido": mantido}))
+
+
+def le_emails_duplicados(session):
+    """ Retorna as trocas de emails repetidos, em ordem de usuario.
+    """
+    return session.execute(select(EmailDuplicado).order_by(EmailDuplicado.usuario)).scalars().all()
@@ -0,0 +1,90 @@
+import numpy as np
+
+from model.historico import Historico
+
+# faixas do histograma de pontuação, em pontos percentuais
+FAIXAS_HISTOGRAMA = 10
+
+
+def carrega_pontuacoes(session, categoria: str = None):
+    """ Busca em bloco as categorias e os percentuais de acerto dos históricos.
+
+    Retorna dois arrays alinhados: o nome da categoria e o percentual de
+    acertos (0 a 100) de cada histórico com pontuação numérica.
+    """
+    consulta = session.query(Historico.categoria, Historico.acertos, Historico.total)\
+        .filter(Historico.categoria.isnot(None), Historico.total > 0)
+    if categoria is not None:
+        consulta = consulta.filter(Historico.categoria == categoria)
+
+    linhas = consulta.all()
+    if not linhas:
+        return np.array([], dtype=str), np.array([], dtype=float)
+
+    # transpõe as linhas em colunas sem percorrer objetos do ORM
+    categorias, acertos, totais = zip(*linhas)
+    percentuais = 100.0 * np.array(acertos, dtype=float) / np.array(totais, dtype=float)
+    return np.array(categorias), percentuais
+
+
+def _quantis(valores, inicios, contagens, q: float):
+    """ Calcula o quantil 'q' de cada grupo contíguo de 'valores' já ordenados.
+
+    Usa interpolação linear, como o padrão do numpy.percentile.
+    """
+    posicoes = inicios + q * (contagens - 1)
+    abaixo = np.floor(posicoes).astype(int)
+    acima = np.ceil(posicoes).astype(int)
+    fracao = posicoes - abaixo
+    return valores[abaixo] + (valores[acima] - valores[abaixo]) * fracao
+
+
+def calcula_estatisticas(categorias, percentuais):
+    """ Calcula as estatísticas de pontuação de cada categoria.
+
+    Todas as contas são feitas sobre os arrays inteiros, agrupando as
+    categorias por ordenação, sem laços por histórico. Retorna uma lista de
+    dicionários ordenada pelo nome da categoria.
+    """
+    if len(categorias) == 0:
+        return []
+
+    # ordena por categoria e, dentro dela, pelo percentual, deixando cada
+    # categoria em um trecho contíguo já pronto para os quantis
+    ordem = np.lexsort((percentuais, categorias))
+    categorias = categorias[ordem]
+    percentuais = percentuais[ordem]
+    nomes, inicios, contagens = np.unique(categorias, return_index=True, return_counts=True)
+
+    medias = np.add.reduceat(percentuais, inicios) / contagens
+    quadrados = np.add.reduceat(percentuais ** 2, inicios) / contagens
+    desvios = np.sqrt(np.maximum(quadrados - medias ** 2, 0.0))
+    medianas = _quantis(percentuais, inicios, contagens, 0.5)
+    p90s = _quantis(percentuais, inicios, contagens, 0.9)
+
+    # histograma de todos os grupos de uma vez: cada valor cai na posição
+    # grupo * FAIXAS_HISTOGRAMA + faixa; 100% entra na última faixa
+    grupos = np.repeat(np.arange(len(nomes)), contagens)
+    faixas = np.minimum((percentuais * FAIXAS_HISTOGRAMA // 100).astype(int), FAIXAS_HISTOGRAMA - 1)
+    histogramas = np.bincount(grupos * FAIXAS_HISTOGRAMA + faixas,
+                              minlength=len(nomes) * FAIXAS_HISTOGRAMA)\
+        .reshape(len(nomes), FAIXAS_HISTOGRAMA)
+
+    return [{
+        "categoria": str(nomes[i]),
+        "quantidade": int(contagens[i]),
+        "media": float(medias[i]),
+        "mediana": float(medianas[i]),
+        "p90": float(p90s[i]),
+        "desvio_padrao": float(desvios[i]),
+        "histograma": histogramas[i].tolist(),
+    } for i in range(len(nomes))]
+
+
+def junta_pontuacoes(partes):
+    """ Junta os arrays de carrega_pontuacoes de cada shard em um único par.
+    """
+    if len(partes) == 1:
+        return partes[0]
+    categorias, percentuais = zip(*partes)
+    return np.concatenate(categorias), np.concatenate(percentuais)
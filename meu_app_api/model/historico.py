@@ -1,30 +1,73 @@
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Index
 from datetime import datetime
-from typing import Union
+import re
+from typing import Optional, Tuple, Union
 from sqlalchemy.orm import relationship
 
 from  model import Base
 
 
+# "acertos/total" só com dígitos, a mesma regra do GLOB da migração 2
+FORMATO_SCORE = re.compile(r"([0-9]+)/([0-9]+)")
+
+
+def interpreta_score(score: str) -> Tuple[Optional[int], Optional[int]]:
+    """ Extrai os acertos e o total de um score no formato "acertos/total".
+
+    Retorna (None, None) quando o score não segue esse formato ou quando os
+    acertos não estão entre 0 e o total, que deve ser maior que 0.
+    """
+    encontrado = FORMATO_SCORE.fullmatch(str(score))
+    if encontrado is None:
+        return None, None
+    acertos, total = int(encontrado.group(1)), int(encontrado.group(2))
+    if total <= 0 or acertos > total:
+        return None, None
+    return acertos, total
+
+
 class Historico(Base):
     __tablename__ = 'historico'
 
     id = Column(Integer, primary_key=True)
     categoria = Column(String(256))
     score = Column(String(32))
-    data_insercao = Column(DateTime, default=datetime.now())
+    # pontuação numérica extraída do score "acertos/total", usada nas
+    # agregações feitas no banco e nas estatísticas por categoria
+    acertos = Column(Integer)
+    total = Column(Integer)
+    # a função é chamada a cada inserção; com datetime.now() todas as linhas
+    # receberiam o horário em que o módulo foi importado
+    data_insercao = Column(DateTime, default=datetime.now)
     
     # Definição do relacionamento entre o histórico e um usuário.
     # Aqui está sendo definido a coluna 'usuário' que vai guardar
     # a referencia ao usuário, a chave estrangeira que relaciona
-    # um usuário ao histórico.
-    usuario = Column(Integer, ForeignKey("usuario.id"), nullable=False)
+    # um usuário ao histórico. Os históricos são removidos pelo banco
+    # junto com o usuário (ON DELETE CASCADE).
+    usuario = Column(Integer, ForeignKey("usuario.id", ondelete="CASCADE"), nullable=False)
 
     # ... também armazene uma referência ao objeto Usuario associado:
     usuario_obj = relationship("Usuario", back_populates="historicos")
 
+    # Índices compostos usados nas consultas por usuário e por categoria.
+    # O prefixo de cada índice também atende aos filtros simples em
+    # 'usuario' e 'categoria', dispensando índices isolados nessas colunas.
+    __table_args__ = (
+        Index("ix_historico_usuario_data", "usuario", "data_insercao"),
+        Index("ix_historico_categoria_data", "categoria", "data_insercao"),
+        # consultas por período de todas as categorias
+        Index("ix_historico_data", "data_insercao"),
+    )
+
+
+    @property
+    def nome_usuario(self) -> str:
+        """ Nome do usuário dono do histórico.
+        """
+        return self.usuario_obj.nome
 
-    def __init__(self, idUsuario:str, categoria:str, score:str, data_insercao:Union[DateTime, None] = None):
+    def __init__(self, idUsuario:str, categoria:str, score:str, data_insercao:Union[datetime, str, None] = None):
         """
         Cria um Histórico
 
@@ -32,9 +75,13 @@ class Historico(Base):
             categoria: Categoria do quiz.
             score: quantidade de acertos / total de acertos no quiz.
             data_insercao: data de quando o registro foi feito ou inserido
-                           à base
+                           à base, como datetime ou texto ISO 8601; se não
+                           informada, o momento da criação
         """        
         self.categoria = categoria
         self.score = score
-        if data_insercao:
-            self.data = data_insercao
+        self.acertos, self.total = interpreta_score(score)
+        if isinstance(data_insercao, str):
+            # ValueError para datas fora do formato ISO 8601
+            data_insercao = datetime.fromisoformat(data_insercao)
+        self.data_insercao = data_insercao or datetime.now()
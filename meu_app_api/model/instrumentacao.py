@@ -0,0 +1,45 @@
+from contextvars import ContextVar
+import time
+
+from sqlalchemy import event
+
+
+class ColetorConsultas:
+    """ Acumula a quantidade e o tempo dos comandos SQL de uma requisição.
+
+    Os comandos em si só são guardados quando 'guarda_comandos' é verdadeiro,
+    usado pelo log de requisições lentas.
+    """
+    __slots__ = ("quantidade", "tempo", "comandos", "guarda_comandos")
+
+    def __init__(self, guarda_comandos: bool = False):
+        self.quantidade = 0
+        self.tempo = 0.0
+        self.comandos = []
+        self.guarda_comandos = guarda_comandos
+
+    def registra(self, comando: str, duracao: float):
+        self.quantidade += 1
+        self.tempo += duracao
+        if self.guarda_comandos:
+            self.comandos.append((comando, duracao))
+
+
+# coletor da requisição em andamento nesta thread; None fora de requisições
+coletor_consultas = ContextVar("coletor_consultas", default=None)
+
+
+def instrumenta_engine(engine):
+    """ Registra na engine os listeners que medem cada comando SQL executado.
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def inicio_comando(conn, cursor, statement, parameters, context, executemany):
+        if coletor_consultas.get() is not None:
+            conn.info.setdefault("inicio_comandos", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def fim_comando(conn, cursor, statement, parameters, context, executemany):
+        coletor = coletor_consultas.get()
+        inicios = conn.info.get("inicio_comandos")
+        if coletor is not None and inicios:
+            coletor.registra(statement, time.perf_counter() - inicios.pop())
@@ -0,0 +1,222 @@
+from datetime import datetime
+from typing import NamedTuple, Optional, Tuple
+
+from sqlalchemy import select, func, text
+
+from model.historico import Historico
+from model.usuario import Usuario
+from model.arquivo import tabela_historicos, historico_arquivado
+from model.versao import le_versao_atual
+
+# Camada de leitura das rotas de consulta. Os SELECTs trazem apenas as
+# colunas usadas pelos schemas e cada linha vira uma tupla nomeada, sem
+# passar pelo mapa de identidade, pelo controle de estado e pelos
+# relacionamentos que o ORM monta para cada entidade carregada.
+
+
+class HistoricoLeitura(NamedTuple):
+    """ Registro de histórico somente leitura, com o nome do usuário quando
+        buscado junto com ele.
+    """
+    id: int
+    categoria: str
+    score: str
+    data_insercao: datetime
+    nome_usuario: Optional[str] = None
+
+
+class HistoricoExportacao(NamedTuple):
+    """ Registro de histórico exportado, com o nome do usuário quando ele
+        ainda existe.
+    """
+    id: int
+    usuario: int
+    nome_usuario: Optional[str]
+    categoria: str
+    score: str
+    acertos: Optional[int]
+    total: Optional[int]
+    data_insercao: datetime
+
+
+class UsuarioLeitura(NamedTuple):
+    """ Registro de usuário somente leitura, com os históricos quando
+        buscados junto com ele.
+    """
+    id: int
+    nome: str
+    email: str
+    senha: str
+    cep: str
+    logradouro: str
+    bairro: str
+    cidade: str
+    estado: str
+    historicos: Tuple[HistoricoLeitura, ...] = ()
+    versao: Optional[int] = None
+
+
+COLUNAS_USUARIO = (Usuario.id, Usuario.nome, Usuario.email, Usuario.senha, Usuario.cep,
+                   Usuario.logradouro, Usuario.bairro, Usuario.cidade, Usuario.estado)
+
+
+def colunas_historico(tabela):
+    """ Colunas de HistoricoLeitura na tabela de históricos informada.
+    """
+    return tabela.c.id, tabela.c.categoria, tabela.c.score, tabela.c.data_insercao
+
+
+def le_usuarios(session, after: int = 0, limit: Optional[int] = None, lote: Optional[int] = None):
+    """ Retorna os usuários com id maior que 'after', em ordem de id.
+
+    Com 'lote' as linhas são buscadas do cursor aos poucos e o resultado é um
+    gerador, para listagens que não devem ficar inteiras na memória.
+    """
+    consulta = select(*COLUNAS_USUARIO).where(Usuario.id > after).order_by(Usuario.id)
+    if limit:
+        consulta = consulta.limit(limit)
+    if lote:
+        consulta = consulta.execution_options(yield_per=lote)
+        return (UsuarioLeitura(*linha) for linha in session.execute(consulta))
+    return [UsuarioLeitura(*linha) for linha in session.execute(consulta)]
+
+
+def le_historicos_do_usuario(session, usuario_id: int, completo: bool = False):
+    """ Retorna os históricos de um usuário, com os arquivados se 'completo'.
+    """
+    historicos = tabela_historicos(completo)
+    consulta = select(*colunas_historico(historicos)).where(historicos.c.usuario == usuario_id)
+    return tuple(HistoricoLeitura(*linha) for linha in session.execute(consulta))
+
+
+def le_usuario_por_nome(session, nome: str, completo: bool = False,
+                        com_historicos: bool = True) -> Optional[UsuarioLeitura]:
+    """ Retorna o primeiro usuário com o nome informado, com a versão e já
+        com os históricos (com os arquivados se 'completo'), a não ser que
+        'com_historicos' seja falso.
+    """
+    linha = session.execute(select(*COLUNAS_USUARIO, Usuario.versao).where(Usuario.nome == nome).limit(1)).first()
+    if linha is None:
+        return None
+    historicos = le_historicos_do_usuario(session, linha.id, completo) if com_historicos else ()
+    return UsuarioLeitura(*linha[:-1], historicos=historicos, versao=linha.versao)
+
+
+def le_usuario_por_id(session, usuario_id: int, completo: bool = False) -> Optional[UsuarioLeitura]:
+    """ Retorna o usuário com o id informado, já com os históricos (com os
+        arquivados se 'completo').
+    """
+    linha = session.execute(select(*COLUNAS_USUARIO).where(Usuario.id == usuario_id)).first()
+    if linha is None:
+        return None
+    return UsuarioLeitura(*linha, historicos=le_historicos_do_usuario(session, linha.id, completo))
+
+
+def le_credenciais_por_email(session, email: str):
+    """ Retorna id, nome e senha do primeiro usuário com o email informado.
+    """
+    consulta = select(Usuario.id, Usuario.nome, Usuario.senha).where(Usuario.email == email).limit(1)
+    return session.execute(consulta).first()
+
+
+def le_historicos_por_categoria(session, categoria: str, completo: bool = False):
+    """ Retorna os históricos de uma categoria com o nome do usuário, em um
+        único SELECT com join, com os arquivados se 'completo'.
+
+    A ordem é a de chave_categoria, a do índice (categoria, data_insercao),
+    para que os resultados de vários shards sejam intercalados.
+    """
+    historicos = tabela_historicos(completo)
+    consulta = select(*colunas_historico(historicos), Usuario.nome)\
+        .join(Usuario, Usuario.id == historicos.c.usuario)\
+        .where(historicos.c.categoria == categoria)\
+        .order_by(historicos.c.data_insercao, historicos.c.id)
+    return [HistoricoLeitura(*linha) for linha in session.execute(consulta)]
+
+
+def chave_categoria(historico):
+    """ Chave da ordem de le_historicos_por_categoria; datas nulas vêm
+        primeiro, como no ORDER BY do SQLite.
+    """
+    return historico.data_insercao or datetime.min, historico.id
+
+
+def ultimo_id_historico(session) -> int:
+    """ Retorna o maior id de histórico, ou 0 se a tabela estiver vazia.
+    """
+    return session.execute(select(func.max(Historico.id))).scalar() or 0
+
+
+def estado_exportacao(session) -> Tuple[int, int]:
+    """ Abre uma transação de leitura na sessão e retorna o maior id de
+        histórico e a versão do banco vistos por ela.
+
+    Até o fim da transação as leituras da sessão veem o mesmo estado do
+    banco, então a exportação lida por ela corresponde à versão retornada,
+    que muda a cada histórico inserido, alterado, removido ou arquivado e a
+    cada usuario alterado ou removido. A transação é encerrada ao fechar a
+    sessão e, enquanto dura, impede o checkpoint do WAL de passar dela.
+    """
+    # sem o BEGIN explícito o driver do SQLite roda cada SELECT em uma
+    # transação própria
+    session.execute(text("BEGIN"))
+    return ultimo_id_historico(session), le_versao_atual(session)
+
+
+def _consulta_exportacao(historicos, ate_id: int, categoria: Optional[str], inicio: Optional[datetime],
+                         fim: Optional[datetime]):
+    consulta = select(historicos.c.id, historicos.c.usuario, Usuario.nome, historicos.c.categoria,
+                      historicos.c.score, historicos.c.acertos, historicos.c.total, historicos.c.data_insercao)\
+        .outerjoin(Usuario, Usuario.id == historicos.c.usuario)\
+        .where(historicos.c.id <= ate_id)
+    if categoria is not None:
+        consulta = consulta.where(historicos.c.categoria == categoria)
+    if inicio is not None:
+        consulta = consulta.where(historicos.c.data_insercao >= inicio)
+    if fim is not None:
+        consulta = consulta.where(historicos.c.data_insercao < fim)
+    if categoria is None and inicio is None and fim is None:
+        return consulta.order_by(historicos.c.id)
+    return consulta.order_by(historicos.c.data_insercao, historicos.c.id)
+
+
+def chave_exportacao(categoria: Optional[str], inicio: Optional[datetime], fim: Optional[datetime]):
+    """ Retorna a chave da ordem das linhas exportadas com esses filtros.
+    """
+    if categoria is None and inicio is None and fim is None:
+        return lambda linha: linha.id
+    return lambda linha: (linha.data_insercao or datetime.min, linha.id)
+
+
+def tabelas_exportacao(completo: bool = False):
+    """ Retorna as tabelas exportadas, na ordem da exportação.
+    """
+    return (historico_arquivado, Historico.__table__) if completo else (Historico.__table__,)
+
+
+def le_tabela_exportacao(session, historicos, lote: int, ate_id: int, categoria: Optional[str] = None,
+                         inicio: Optional[datetime] = None, fim: Optional[datetime] = None):
+    """ Gera os históricos exportados de uma das tabelas de tabelas_exportacao.
+    """
+    consulta = _consulta_exportacao(historicos, ate_id, categoria, inicio, fim)
+    for linha in session.execute(consulta.execution_options(yield_per=lote)):
+        yield HistoricoExportacao(*linha)
+
+
+def le_historicos_exportacao(session, lote: int, ate_id: int, categoria: Optional[str] = None,
+                             inicio: Optional[datetime] = None, fim: Optional[datetime] = None,
+                             completo: bool = False):
+    """ Gera os históricos com id até 'ate_id', com o nome do usuário, em um
+        único SELECT lido do cursor em lotes de 'lote' linhas.
+
+    Filtra pela categoria e pelo período [inicio, fim). Com filtro a ordem é
+    a do índice de categoria ou de data e, sem filtro, a do id, para que as
+    linhas venham do índice na ordem final sem ordenação temporária. O
+    limite 'ate_id' fixa o conjunto exportado, então duas leituras com os
+    mesmos argumentos retornam as mesmas linhas na mesma ordem. Com
+    'completo', os históricos arquivados vêm antes, em um SELECT separado
+    com a mesma ordem, pois ordenar a união das duas tabelas pela data
+    exigiria uma ordenação temporária de todas as linhas.
+    """
+    for historicos in tabelas_exportacao(completo):
+        yield from le_tabela_exportacao(session, historicos, lote, ate_id, categoria, inicio, fim)
@@ -0,0 +1,194 @@
+from sqlalchemy import text
+import re
+
+from model.busca import cria_busca, reconstroi_busca
+from model.arquivo import historico_arquivamento
+from model.ranking import reconstroi_ranking, cria_pontuacoes, reconstroi_pontuacoes
+from model.serie import reconstroi_serie
+from model.versao import cria_versao
+from model.emails import emails_duplicados, substitui_email
+
+# Lista ordenada das migrações conhecidas: (versão, descrição, função).
+# A versão aplicada fica salva no próprio arquivo do banco através do
+# 'PRAGMA user_version' do SQLite, então não é preciso tabela de controle.
+MIGRACOES = []
+
+
+def migracao(versao: int, descricao: str):
+    """ Registra uma função como o passo de migração de número 'versao'.
+    """
+    def registra(funcao):
+        MIGRACOES.append((versao, descricao, funcao))
+        MIGRACOES.sort(key=lambda m: m[0])
+        return funcao
+    return registra
+
+
+def versao_atual(conn) -> int:
+    """ Retorna a versão de esquema registrada no banco.
+    """
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def versao_mais_recente() -> int:
+    """ Retorna a versão da última migração registrada.
+    """
+    return MIGRACOES[-1][0] if MIGRACOES else 0
+
+
+def marca_versao(conn, versao: int):
+    """ Registra no banco a versão de esquema informada.
+    """
+    # PRAGMA não aceita parâmetros, mas a versão é sempre um inteiro
+    conn.exec_driver_sql("PRAGMA user_version = %d" % int(versao))
+
+
+def aplica_migracoes(engine, logger=None):
+    """ Aplica, em ordem, as migrações ainda não executadas no banco.
+
+    Os passos devem ser idempotentes: a versão só é gravada depois que o
+    passo termina, então um passo interrompido é executado de novo na
+    próxima inicialização. Retorna a lista de versões aplicadas.
+    """
+    aplicadas = []
+    for versao, descricao, funcao in MIGRACOES:
+        with engine.begin() as conn:
+            if versao <= versao_atual(conn):
+                continue
+            if logger:
+                logger.info("Aplicando migração %d: %s", versao, descricao)
+            funcao(conn)
+            marca_versao(conn, versao)
+        aplicadas.append(versao)
+    return aplicadas
+
+
+@migracao(1, "índices nas colunas de busca de usuario e historico")
+def cria_indices_busca(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_usuario_email ON usuario (email)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_usuario_nome ON usuario (nome)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_historico_usuario_data "
+                      "ON historico (usuario, data_insercao)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_historico_categoria_data "
+                      "ON historico (categoria, data_insercao)"))
+    # atualiza as estatísticas do planejador apenas onde for necessário,
+    # sem o custo de um ANALYZE completo em tabelas grandes
+    conn.execute(text("PRAGMA optimize"))
+
+
+@migracao(2, "colunas numéricas acertos/total em historico")
+def adiciona_pontuacao_numerica(conn):
+    colunas = {linha[1] for linha in conn.exec_driver_sql("PRAGMA table_info(historico)")}
+    for coluna in ("acertos", "total"):
+        if coluna not in colunas:
+            conn.execute(text("ALTER TABLE historico ADD COLUMN %s INTEGER" % coluna))
+    # preenche a partir dos scores "acertos/total" já gravados, com a regra
+    # de interpreta_score: só dígitos e acertos entre 0 e o total
+    conn.execute(text(
+        "UPDATE historico SET "
+        "acertos = CAST(substr(score, 1, instr(score, '/') - 1) AS INTEGER), "
+        "total = CAST(substr(score, instr(score, '/') + 1) AS INTEGER) "
+        "WHERE acertos IS NULL AND score GLOB '[0-9]*/[0-9]*' "
+        "AND score NOT GLOB '*[^0-9/]*' AND score NOT GLOB '*/*/*' "
+        "AND CAST(substr(score, instr(score, '/') + 1) AS INTEGER) > 0 "
+        "AND CAST(substr(score, 1, instr(score, '/') - 1) AS INTEGER) "
+        "<= CAST(substr(score, instr(score, '/') + 1) AS INTEGER)"))
+
+
+@migracao(3, "tabela de ranking por usuario e categoria")
+def preenche_ranking(conn):
+    # a tabela é criada pelo create_all; aqui ela é preenchida com o histórico existente
+    reconstroi_ranking(conn)
+
+
+@migracao(4, "índices FTS5 de busca de usuarios e categorias")
+def preenche_busca(conn):
+    # a tabela 'categoria' é criada pelo create_all; as tabelas FTS5 e os
+    # triggers são criados aqui e preenchidos com os registros existentes
+    cria_busca(conn)
+    reconstroi_busca(conn)
+
+
+@migracao(5, "índice de data em historico e resumo diário por categoria")
+def preenche_serie(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_historico_data ON historico (data_insercao)"))
+    # a tabela é criada pelo create_all; aqui ela é preenchida com o histórico existente
+    reconstroi_serie(conn)
+
+
+@migracao(6, "arquivamento de históricos sem descontar as categorias")
+def cria_arquivamento(conn):
+    # o trigger passa a ignorar as remoções feitas pelo arquivamento
+    historico_arquivamento.create(conn, checkfirst=True)
+    conn.execute(text("DROP TRIGGER IF EXISTS categoria_remove"))
+    cria_busca(conn)
+
+
+@migracao(7, "versões de usuario e da listagem para os ETags das consultas")
+def cria_versoes(conn):
+    colunas = {linha[1] for linha in conn.exec_driver_sql("PRAGMA table_info(usuario)")}
+    if "versao" not in colunas:
+        conn.execute(text("ALTER TABLE usuario ADD COLUMN versao INTEGER NOT NULL DEFAULT 0"))
+    # a tabela 'versao' é criada pelo create_all; os usuarios existentes
+    # ficam na versão 0, e as próximas mudanças recebem versões a partir de 1
+    cria_versao(conn)
+
+
+@migracao(8, "email único em usuario, com os emails repetidos substituídos")
+def unifica_emails(conn):
+    # o usuario de menor id fica com o email, e os outros recebem um email
+    # substituto registrado em 'email_duplicado', criada pelo create_all
+    for usuario_id, email, mantido in emails_duplicados(conn):
+        substitui_email(conn, usuario_id, email, mantido)
+    conn.execute(text("DROP INDEX IF EXISTS ix_usuario_email"))
+    conn.execute(text("CREATE UNIQUE INDEX ix_usuario_email ON usuario (email)"))
+
+
+@migracao(9, "ON DELETE CASCADE nas chaves estrangeiras de historico e ranking")
+def cascateia_usuario(conn):
+    # a chave estrangeira não muda o formato das linhas nem dos índices,
+    # então, como recomenda a documentação do ALTER TABLE do SQLite, o
+    # esquema é reescrito no sqlite_master em vez de copiar as tabelas; o
+    # aumento do schema_version faz as conexões abertas relerem o esquema
+    conn.exec_driver_sql("PRAGMA writable_schema=ON")
+    for tabela in ("historico", "ranking"):
+        sql = conn.execute(text("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = :nome"),
+                           {"nome": tabela}).scalar()
+        if sql is None or "ON DELETE CASCADE" in sql:
+            continue
+        novo = re.sub(r"(REFERENCES\s+\"?usuario\"?\s*\(\s*\"?id\"?\s*\))", r"\1 ON DELETE CASCADE", sql)
+        conn.execute(text("UPDATE main.sqlite_master SET sql = :sql WHERE type = 'table' AND name = :nome"),
+                     {"sql": novo, "nome": tabela})
+    versao = conn.exec_driver_sql("PRAGMA schema_version").scalar()
+    conn.exec_driver_sql("PRAGMA schema_version=%d" % (versao + 1))
+    conn.exec_driver_sql("PRAGMA writable_schema=OFF")
+
+
+@migracao(10, "contagem de usuarios por pontuação do ranking")
+def conta_pontuacoes(conn):
+    # a tabela é criada pelo create_all; aqui ela é preenchida com o ranking
+    # existente e os triggers passam a mantê-la
+    reconstroi_pontuacoes(conn)
+    cria_pontuacoes(conn)
+
+
+@migracao(11, "scores com acertos fora de 0 a total descartados")
+def descarta_scores_invalidos(conn):
+    # até aqui o score era aceito só pelo formato, e "11/10" ou "-3/5"
+    # entravam no ranking, nas estatísticas e no resumo diário; eles
+    # continuam gravados, mas sem pontuação numérica, como os outros
+    # scores fora do formato
+    descartados = 0
+    for tabela in ("main.historico", "arquivo.historico"):
+        descartados += conn.execute(text(
+            "UPDATE %s SET acertos = NULL, total = NULL WHERE acertos IS NOT NULL "
+            "AND NOT (total > 0 AND acertos >= 0 AND acertos <= total)" % tabela)).rowcount
+    if descartados:
+        reconstroi_ranking(conn)
+        reconstroi_serie(conn)
+
+
+@migracao(12, "índices de nome sem distinção de maiúsculas para a busca por prefixo")
+def indexa_nomes_sem_caixa(conn):
+    # os índices fazem parte dos comandos de busca, criados se não existem
+    cria_busca(conn)
@@ -0,0 +1,167 @@
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Index, func, text
+from sqlalchemy.dialects.sqlite import insert
+
+from model import Base
+from model.usuario import Usuario
+from model.arquivo import SQL_HISTORICO_COMPLETO
+
+
+class Ranking(Base):
+    """ Resumo dos históricos de um usuário em uma categoria.
+
+    É mantido a cada inserção de histórico, para que o ranking de uma
+    categoria seja lido pelo índice (categoria, melhor_score) sem varrer a
+    tabela 'historico'. As pontuações são percentuais de acerto (0 a 100).
+    """
+    __tablename__ = 'ranking'
+
+    usuario = Column(Integer, ForeignKey("usuario.id", ondelete="CASCADE"), primary_key=True)
+    categoria = Column(String(256), primary_key=True)
+    melhor_score = Column(Float, nullable=False)
+    tentativas = Column(Integer, nullable=False)
+    soma_scores = Column(Float, nullable=False)
+
+    # o usuario no fim do índice serve de desempate na ordenação, para que o
+    # ranking seja lido direto do índice, sem ordenação temporária
+    __table_args__ = (
+        Index("ix_ranking_categoria_melhor_score", "categoria", "melhor_score", "usuario"),
+    )
+
+    @property
+    def media(self) -> float:
+        """ Média dos percentuais de acerto das tentativas.
+        """
+        return self.soma_scores / self.tentativas
+
+
+class RankingPontuacao(Base):
+    """ Quantidade de usuarios de uma categoria com cada melhor pontuação.
+
+    É mantida pelos triggers de COMANDOS_PONTUACAO a cada linha do ranking
+    inserida, alterada ou removida, inclusive pelo ON DELETE CASCADE, para
+    que a posição de um usuario seja a soma das pontuações distintas acima
+    da dele, e não a contagem dos usuarios à sua frente.
+    """
+    __tablename__ = 'ranking_pontuacao'
+
+    categoria = Column(String(256), primary_key=True)
+    melhor_score = Column(Float, primary_key=True)
+    usuarios = Column(Integer, nullable=False)
+
+
+_CONTA_PONTUACAO = ("INSERT INTO ranking_pontuacao (categoria, melhor_score, usuarios) "
+                    "VALUES (new.categoria, new.melhor_score, 1) "
+                    "ON CONFLICT (categoria, melhor_score) DO UPDATE SET usuarios = usuarios + 1; ")
+_DESCONTA_PONTUACAO = ("UPDATE ranking_pontuacao SET usuarios = usuarios - 1 "
+                       "WHERE categoria = old.categoria AND melhor_score = old.melhor_score; "
+                       "DELETE FROM ranking_pontuacao "
+                       "WHERE categoria = old.categoria AND melhor_score = old.melhor_score AND usuarios <= 0; ")
+
+COMANDOS_PONTUACAO = (
+    "CREATE TRIGGER IF NOT EXISTS ranking_pontuacao_insere AFTER INSERT ON ranking BEGIN "
+    + _CONTA_PONTUACAO + "END",
+    "CREATE TRIGGER IF NOT EXISTS ranking_pontuacao_remove AFTER DELETE ON ranking BEGIN "
+    + _DESCONTA_PONTUACAO + "END",
+    "CREATE TRIGGER IF NOT EXISTS ranking_pontuacao_atualiza AFTER UPDATE OF categoria, melhor_score ON ranking "
+    "WHEN old.categoria IS NOT new.categoria OR old.melhor_score IS NOT new.melhor_score BEGIN "
+    + _DESCONTA_PONTUACAO + _CONTA_PONTUACAO + "END",
+)
+
+
+def cria_pontuacoes(conn):
+    """ Cria, se ainda não existirem, os triggers da contagem por pontuação.
+
+    Como os das versões, são criados em inicializa_banco para os bancos
+    novos e na migração 10 para os antigos.
+    """
+    for comando in COMANDOS_PONTUACAO:
+        conn.exec_driver_sql(comando)
+
+
+def reconstroi_pontuacoes(conn):
+    """ Recalcula a contagem por pontuação a partir da tabela de ranking.
+    """
+    conn.execute(text("DELETE FROM ranking_pontuacao"))
+    conn.execute(text(
+        "INSERT INTO ranking_pontuacao (categoria, melhor_score, usuarios) "
+        "SELECT categoria, melhor_score, COUNT(*) FROM ranking GROUP BY categoria, melhor_score"))
+
+
+def atualiza_ranking(session, historicos):
+    """ Acumula no ranking as pontuações dos históricos informados.
+
+    Recebe dicionários com as chaves 'usuario', 'categoria', 'acertos' e
+    'total', no mesmo formato das linhas inseridas em 'historico', e deve ser
+    chamada na mesma transação da inserção. Históricos sem pontuação numérica
+    são ignorados.
+    """
+    resumo = {}
+    for historico in historicos:
+        if not historico["total"] or historico["categoria"] is None:
+            continue
+        percentual = 100.0 * historico["acertos"] / historico["total"]
+        chave = (historico["usuario"], historico["categoria"])
+        if chave in resumo:
+            melhor, tentativas, soma = resumo[chave]
+            resumo[chave] = (max(melhor, percentual), tentativas + 1, soma + percentual)
+        else:
+            resumo[chave] = (percentual, 1, percentual)
+
+    if not resumo:
+        return
+
+    tabela = Ranking.__table__
+    comando = insert(tabela)
+    comando = comando.on_conflict_do_update(
+        index_elements=[tabela.c.usuario, tabela.c.categoria],
+        set_={
+            "melhor_score": func.max(tabela.c.melhor_score, comando.excluded.melhor_score),
+            "tentativas": tabela.c.tentativas + comando.excluded.tentativas,
+            "soma_scores": tabela.c.soma_scores + comando.excluded.soma_scores,
+        })
+    session.execute(comando, [
+        {"usuario": usuario, "categoria": categoria, "melhor_score": melhor,
+         "tentativas": tentativas, "soma_scores": soma}
+        for (usuario, categoria), (melhor, tentativas, soma) in resumo.items()])
+
+
+def reconstroi_ranking(conn):
+    """ Recalcula toda a tabela de ranking a partir dos históricos, inclusive
+        os arquivados, e a contagem por pontuação.
+    """
+    conn.execute(text("DELETE FROM ranking"))
+    conn.execute(text(
+        "INSERT INTO ranking (usuario, categoria, melhor_score, tentativas, soma_scores) "
+        "SELECT usuario, categoria, MAX(100.0 * acertos / total), COUNT(*), "
+        "SUM(100.0 * acertos / total) "
+        "FROM " + SQL_HISTORICO_COMPLETO + " WHERE total > 0 AND categoria IS NOT NULL "
+        "GROUP BY usuario, categoria"))
+    # os triggers já mantêm a contagem, mas a reconstrução não depende deles
+    reconstroi_pontuacoes(conn)
+
+
+def consulta_ranking(session, categoria: str, limite: int):
+    """ Retorna os 'limite' melhores resumos da categoria com o nome do usuário.
+
+    A ordenação percorre o índice (categoria, melhor_score) de trás para
+    frente, então o custo depende apenas do limite.
+    """
+    return session.query(Ranking, Usuario.nome)\
+        .join(Usuario, Usuario.id == Ranking.usuario)\
+        .filter(Ranking.categoria == categoria)\
+        .order_by(Ranking.melhor_score.desc(), Ranking.usuario.desc())\
+        .limit(limite).all()
+
+
+def posicao_no_ranking(session, ranking: Ranking) -> int:
+    """ Retorna a posição de um resumo no ranking da sua categoria.
+
+    Empates dividem a mesma posição. A soma percorre na chave da contagem
+    por pontuação uma linha por pontuação distinta maior que a do usuário,
+    então o custo não cresce com a quantidade de usuarios à frente dele.
+    """
+    acima = session.query(func.coalesce(func.sum(RankingPontuacao.usuarios), 0))\
+        .filter(RankingPontuacao.categoria == ranking.categoria,
+                RankingPontuacao.melhor_score > ranking.melhor_score)\
+        .scalar()
+    return acima + 1
@@ -0,0 +1,197 @@
+from sqlalchemy import Column, String, Integer, Float, Date, Index, func, select, text, case
+from sqlalchemy.dialects.sqlite import insert
+from datetime import date, datetime, time, timedelta
+from typing import NamedTuple, Optional
+
+from model import Base
+from model.historico import Historico
+from model.arquivo import SQL_HISTORICO_COMPLETO
+
+
+class HistoricoDiario(Base):
+    """ Resumo dos históricos de uma categoria em um dia.
+
+    É mantido a cada inserção de histórico, para que as séries por dia ou
+    semana sejam lidas de uma linha por categoria e dia em vez de todos os
+    históricos do período. As pontuações são percentuais de acerto (0 a 100).
+    """
+    __tablename__ = 'historico_diario'
+
+    categoria = Column(String(256), primary_key=True)
+    dia = Column(Date, primary_key=True)
+    quantidade = Column(Integer, nullable=False)
+    # históricos com pontuação numérica e a soma dos seus percentuais
+    pontuados = Column(Integer, nullable=False)
+    soma_percentual = Column(Float, nullable=False)
+
+    # a chave (categoria, dia) atende às séries de uma categoria; o índice
+    # por dia, às séries de todas as categorias no período
+    __table_args__ = (
+        Index("ix_historico_diario_dia", "dia"),
+    )
+
+
+class PontoSerie(NamedTuple):
+    """ Totais de uma categoria em um período da série.
+    """
+    categoria: str
+    inicio: date
+    quantidade: int
+    pontuados: int
+    soma_percentual: float
+
+    @property
+    def media(self) -> Optional[float]:
+        """ Média dos percentuais de acerto do período, se houver pontuações.
+        """
+        return self.soma_percentual / self.pontuados if self.pontuados else None
+
+
+def atualiza_serie(session, historicos):
+    """ Acumula no resumo diário os históricos informados.
+
+    Recebe dicionários com as chaves 'categoria', 'acertos', 'total' e
+    'data_insercao', no mesmo formato das linhas inseridas em 'historico',
+    e deve ser chamada na mesma transação da inserção.
+    """
+    resumo = {}
+    for historico in historicos:
+        if historico["categoria"] is None:
+            continue
+        chave = (historico["categoria"], historico["data_insercao"].date())
+        quantidade, pontuados, soma = resumo.get(chave, (0, 0, 0.0))
+        if historico["total"]:
+            pontuados += 1
+            soma += 100.0 * historico["acertos"] / historico["total"]
+        resumo[chave] = (quantidade + 1, pontuados, soma)
+
+    if not resumo:
+        return
+
+    tabela = HistoricoDiario.__table__
+    comando = insert(tabela)
+    comando = comando.on_conflict_do_update(
+        index_elements=[tabela.c.categoria, tabela.c.dia],
+        set_={
+            "quantidade": tabela.c.quantidade + comando.excluded.quantidade,
+            "pontuados": tabela.c.pontuados + comando.excluded.pontuados,
+            "soma_percentual": tabela.c.soma_percentual + comando.excluded.soma_percentual,
+        })
+    session.execute(comando, [
+        {"categoria": categoria, "dia": dia, "quantidade": quantidade,
+         "pontuados": pontuados, "soma_percentual": soma}
+        for (categoria, dia), (quantidade, pontuados, soma) in resumo.items()])
+
+
+def desconta_serie(conn, tabela: str, selecao: str, parametros: dict = None):
+    """ Desconta do resumo diário os históricos de 'tabela', 'main.historico'
+        ou 'arquivo.historico', que satisfazem a condição 'selecao', antes
+        que sejam removidos.
+
+    Faz para um conjunto de linhas o inverso de atualiza_serie, e as linhas
+    da categoria e dia que ficam sem históricos são removidas.
+    """
+    conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS desconto_serie (categoria TEXT, dia TEXT, "
+                      "quantidade INTEGER, pontuados INTEGER, soma_percentual FLOAT, PRIMARY KEY (categoria, dia))"))
+    conn.execute(text("DELETE FROM temp.desconto_serie"))
+    conn.execute(text(
+        "INSERT INTO temp.desconto_serie (categoria, dia, quantidade, pontuados, soma_percentual) "
+        "SELECT categoria, date(data_insercao), COUNT(*), COUNT(CASE WHEN total > 0 THEN 1 END), "
+        "COALESCE(SUM(CASE WHEN total > 0 THEN 100.0 * acertos / total END), 0) "
+        "FROM " + tabela + " WHERE categoria IS NOT NULL AND data_insercao IS NOT NULL AND (" + selecao + ") "
+        "GROUP BY categoria, date(data_insercao)"), parametros or {})
+    conn.execute(text(
+        "UPDATE historico_diario SET (quantidade, pontuados, soma_percentual) = "
+        "(SELECT historico_diario.quantidade - d.quantidade, historico_diario.pontuados - d.pontuados, "
+        "historico_diario.soma_percentual - d.soma_percentual FROM temp.desconto_serie d "
+        "WHERE d.categoria = historico_diario.categoria AND d.dia = historico_diario.dia) "
+        "WHERE (categoria, dia) IN (SELECT categoria, dia FROM temp.desconto_serie)"))
+    conn.execute(text("DELETE FROM historico_diario WHERE quantidade <= 0 AND (categoria, dia) IN "
+                      "(SELECT categoria, dia FROM temp.desconto_serie)"))
+
+
+def reconstroi_serie(conn):
+    """ Recalcula todo o resumo diário a partir dos históricos, inclusive os
+        arquivados.
+    """
+    conn.execute(text("DELETE FROM historico_diario"))
+    conn.execute(text(
+        "INSERT INTO historico_diario (categoria, dia, quantidade, pontuados, soma_percentual) "
+        "SELECT categoria, date(data_insercao), COUNT(*), COUNT(CASE WHEN total > 0 THEN 1 END), "
+        "COALESCE(SUM(CASE WHEN total > 0 THEN 100.0 * acertos / total END), 0) "
+        "FROM " + SQL_HISTORICO_COMPLETO + " WHERE categoria IS NOT NULL AND data_insercao IS NOT NULL "
+        "GROUP BY categoria, date(data_insercao)"))
+
+
+def _le_resumos(session, inicio: date, fim: date, categoria: Optional[str]):
+    consulta = select(HistoricoDiario.categoria, HistoricoDiario.dia, HistoricoDiario.quantidade,
+                      HistoricoDiario.pontuados, HistoricoDiario.soma_percentual)\
+        .where(HistoricoDiario.dia >= inicio, HistoricoDiario.dia <= fim)
+    if categoria is not None:
+        consulta = consulta.where(HistoricoDiario.categoria == categoria)
+    return [PontoSerie(*linha) for linha in session.execute(consulta)]
+
+
+def _le_historicos_do_dia(session, dia: date, categoria: Optional[str]):
+    pontuado = Historico.total > 0
+    consulta = select(
+        Historico.categoria, func.count(),
+        func.count(case((pontuado, 1))),
+        func.coalesce(func.sum(case((pontuado, 100.0 * Historico.acertos / Historico.total))), 0))\
+        .where(Historico.data_insercao >= datetime.combine(dia, time.min),
+               Historico.data_insercao < datetime.combine(dia + timedelta(days=1), time.min),
+               Historico.categoria.isnot(None))\
+        .group_by(Historico.categoria)
+    if categoria is not None:
+        consulta = consulta.where(Historico.categoria == categoria)
+    return [PontoSerie(nome, dia, quantidade, pontuados, soma)
+            for nome, quantidade, pontuados, soma in session.execute(consulta)]
+
+
+def inicio_da_semana(dia: date) -> date:
+    """ Retorna a segunda-feira da semana do dia.
+    """
+    return dia - timedelta(days=dia.weekday())
+
+
+def consulta_serie(session, inicio: date, fim: date, categoria: Optional[str] = None,
+                   intervalo: str = "dia", hoje: Optional[date] = None):
+    """ Retorna os totais por categoria e período entre 'inicio' e 'fim'.
+
+    Os dias anteriores a 'hoje' são lidos do resumo diário. O dia corrente,
+    ainda incompleto, é lido direto dos históricos pelo índice de data, para
+    que a série inclua também os registros gravados sem passar pela API.
+    Com intervalo 'semana' os dias são somados por semana, de segunda a
+    domingo. Períodos sem históricos não aparecem no resultado.
+    """
+    hoje = hoje or date.today()
+    pontos = _le_resumos(session, inicio, min(fim, hoje - timedelta(days=1)), categoria)
+    if inicio <= hoje <= fim:
+        pontos += _le_historicos_do_dia(session, hoje, categoria)
+
+    if intervalo == "semana":
+        semanas = {}
+        for ponto in pontos:
+            chave = (ponto.categoria, inicio_da_semana(ponto.inicio))
+            quantidade, pontuados, soma = semanas.get(chave, (0, 0, 0.0))
+            semanas[chave] = (quantidade + ponto.quantidade, pontuados + ponto.pontuados,
+                              soma + ponto.soma_percentual)
+        pontos = [PontoSerie(categoria, semana, *totais) for (categoria, semana), totais in semanas.items()]
+
+    return sorted(pontos, key=lambda ponto: (ponto.categoria, ponto.inicio))
+
+
+def soma_series(series):
+    """ Soma por categoria e período os pontos de várias séries, como as de
+        cada shard, mantendo a ordem de consulta_serie.
+    """
+    if len(series) == 1:
+        return series[0]
+    totais = {}
+    for pontos in series:
+        for ponto in pontos:
+            chave = (ponto.categoria, ponto.inicio)
+            quantidade, pontuados, soma = totais.get(chave, (0, 0, 0.0))
+            totais[chave] = (quantidade + ponto.quantidade, pontuados + ponto.pontuados,
+                             soma + ponto.soma_percentual)
+    return [PontoSerie(categoria, inicio, *valores) for (categoria, inicio), valores in sorted(totais.items())]
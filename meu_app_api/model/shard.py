@@ -0,0 +1,193 @@
+from sqlalchemy import Table, MetaData, Column, Integer, select, func
+from sqlalchemy.dialects.sqlite import insert
+from contextlib import ExitStack
+import heapq
+import itertools
+import os
+import zlib
+
+from model.historico import Historico
+from model.usuario import Usuario
+from model.arquivo import historico_arquivado
+
+# Com DB_SHARDS > 1 os usuarios e os seus históricos ficam em um de vários
+# arquivos SQLite, escolhido pelo hash do id do usuario. Cada shard tem o
+# esquema completo, com o seu ranking, o seu resumo diário e o seu banco de
+# arquivamento, então as rotas de um usuario leem e gravam em um único
+# arquivo, e cada arquivo tem o seu próprio escritor.
+
+# sufixo do nome dos arquivos de cada shard e do diretório de usuarios
+SUFIXO_SHARD = "_shard%d"
+SUFIXO_DIRETORIO = "_diretorio"
+# linhas inseridas por executemany na cópia entre shards
+LOTE_COPIA = 10000
+
+# Identificação do shard, gravada no próprio arquivo. Impede que um arquivo
+# seja aberto com outra quantidade de shards, o que mudaria o shard de cada
+# usuario, e guarda o maior id de histórico de todos os shards na sua
+# criação: os ids novos de cada shard são maiores que ele, então os
+# históricos copiados de outra divisão nunca repetem um id.
+shard_info = Table(
+    "shard", MetaData(),
+    Column("indice", Integer, primary_key=True, autoincrement=False),
+    Column("total", Integer, nullable=False),
+    Column("id_base", Integer, nullable=False),
+)
+
+
+def caminho_com_sufixo(caminho: str, sufixo: str) -> str:
+    """ Insere o sufixo no nome do arquivo, antes da extensão.
+    """
+    raiz, extensao = os.path.splitext(caminho)
+    return raiz + sufixo + extensao
+
+
+def indice_do_shard(usuario_id, total: int) -> int:
+    """ Retorna o shard do usuario entre 'total' shards.
+
+    Um id que não é inteiro vai para o shard 0, onde a consulta não o
+    encontra, como aconteceria com um único banco.
+    """
+    try:
+        chave = str(int(usuario_id)).encode()
+    except (TypeError, ValueError):
+        return 0
+    return zlib.crc32(chave) % total
+
+
+def registra_shard(conn, indice: int, total: int, id_base: int = None):
+    """ Grava a identificação do shard no arquivo, ou confere a já gravada.
+
+    Com 'id_base', usado pela cópia entre shards, o id base é substituído.
+    """
+    shard_info.create(conn, checkfirst=True)
+    linha = conn.execute(select(shard_info.c.indice, shard_info.c.total)).first()
+    if linha is not None and tuple(linha) != (indice, total):
+        raise RuntimeError("O arquivo é o shard %d de %d, e não o %d de %d; use 'flask reshard-db' "
+                           "para mudar a quantidade de shards" % (linha[0], linha[1], indice, total))
+    comando = insert(shard_info).values(indice=indice, total=total, id_base=id_base or 0)
+    if id_base is None:
+        comando = comando.on_conflict_do_nothing()
+    else:
+        comando = comando.on_conflict_do_update(index_elements=[shard_info.c.indice], set_={"id_base": id_base})
+    conn.execute(comando)
+
+
+def proximos_ids_historico(session, quantidade: int, indice: int, total: int):
+    """ Retorna os ids dos próximos 'quantidade' históricos do shard.
+
+    Os ids de um shard são os congruentes ao seu índice módulo 'total', a
+    partir do maior entre o id base e o maior id do shard, então dois shards
+    nunca geram o mesmo id. Deve ser chamada na transação da inserção.
+    """
+    maximo = session.execute(select(func.max(
+        func.coalesce(select(func.max(Historico.id)).scalar_subquery(), 0),
+        select(shard_info.c.id_base).scalar_subquery()))).scalar() or 0
+    primeiro = maximo + 1 + (indice - maximo - 1) % total
+    return [primeiro + total * i for i in range(quantidade)]
+
+
+def intercala(partes, chave, limite: int = None):
+    """ Junta as sequências de cada shard, já ordenadas por 'chave', em uma
+        única sequência ordenada, com no máximo 'limite' itens.
+
+    Os itens são lidos das sequências conforme consumidos, então geradores
+    em lotes continuam ocupando a memória de um lote por shard.
+    """
+    itens = partes[0] if len(partes) == 1 else heapq.merge(*partes, key=chave)
+    if limite is not None:
+        itens = itertools.islice(itens, limite)
+    return itens
+
+
+def _le_tabela(conn, tabela, condicao=None):
+    colunas = [coluna.name for coluna in tabela.columns]
+    consulta = select(*tabela.columns)
+    if condicao is not None:
+        consulta = consulta.where(condicao)
+    for linha in conn.execute(consulta):
+        yield dict(zip(colunas, linha))
+
+
+def le_para_copia(origens):
+    """ Retorna os usuarios, os históricos e os históricos arquivados de
+        todas as engines de origem, como geradores de dicionários.
+
+    Os históricos órfãos, de usuarios removidos antes do ON DELETE CASCADE,
+    ficam de fora: nos destinos a chave estrangeira recusaria a inserção.
+    """
+    def le(tabela):
+        existe = None
+        if tabela is not Usuario.__table__:
+            existe = select(Usuario.id).where(Usuario.id == tabela.c.usuario).exists()
+        for engine in origens:
+            with engine.connect() as conn:
+                yield from _le_tabela(conn, tabela, existe)
+    return le(Usuario.__table__), le(Historico.__table__), le(historico_arquivado)
+
+
+def copia_para_shards(destinos, usuarios, historicos, arquivados=(), diretorio=None, lote: int = LOTE_COPIA,
+                      versao: int = 0):
+    """ Distribui usuarios e históricos, com os ids originais, entre as
+        engines de 'destinos', já inicializadas e vazias.
+
+    Cada linha vai para o shard do seu usuario e os resumos (ranking, série
+    e busca) de cada destino são recalculados no fim. Com mais de um
+    destino, cada um recebe a sua identificação com o maior id de histórico
+    copiado como id base, e os usuarios são registrados no 'diretorio'.
+    Cada destino é gravado em uma única transação: a cópia é feita com a
+    API parada e, se falhar, nenhum destino fica com metade dos dados. As
+    versões gravadas pelos triggers começam depois de 'versao', o maior
+    contador de versões das origens.
+    """
+    from model.ranking import reconstroi_ranking
+    from model.serie import reconstroi_serie
+    from model.busca import reconstroi_busca
+    from model.diretorio import usuario_diretorio
+    from model.versao import inicia_versao
+
+    total = len(destinos)
+    maior_id = 0
+    with ExitStack() as pilha:
+        conexoes = [pilha.enter_context(engine.begin()) for engine in destinos]
+        conexao_diretorio = pilha.enter_context(diretorio.begin()) if diretorio is not None else None
+        for conn in conexoes:
+            inicia_versao(conn, versao)
+
+        def grava(tabela, linhas, chave_usuario, copia_diretorio=False):
+            nonlocal maior_id
+            pendentes = [[] for _ in range(total)]
+            nomes = []
+
+            def descarrega(indice):
+                if pendentes[indice]:
+                    conexoes[indice].execute(tabela.insert(), pendentes[indice])
+                    pendentes[indice] = []
+
+            for linha in linhas:
+                indice = indice_do_shard(linha[chave_usuario], total) if total > 1 else 0
+                pendentes[indice].append(linha)
+                if tabela is not Usuario.__table__:
+                    maior_id = max(maior_id, linha["id"])
+                if copia_diretorio:
+                    nomes.append({"id": linha["id"], "nome": linha["nome"], "email": linha["email"]})
+                    if len(nomes) >= lote:
+                        conexao_diretorio.execute(usuario_diretorio.insert(), nomes)
+                        nomes = []
+                if len(pendentes[indice]) >= lote:
+                    descarrega(indice)
+            for indice in range(total):
+                descarrega(indice)
+            if nomes:
+                conexao_diretorio.execute(usuario_diretorio.insert(), nomes)
+
+        grava(Usuario.__table__, usuarios, "id", copia_diretorio=conexao_diretorio is not None)
+        grava(Historico.__table__, historicos, "usuario")
+        grava(historico_arquivado, arquivados, "usuario")
+
+        for indice, conn in enumerate(conexoes):
+            reconstroi_ranking(conn)
+            reconstroi_serie(conn)
+            reconstroi_busca(conn)
+            if total > 1:
+                registra_shard(conn, indice, total, maior_id)
@@ -10,20 +10,24 @@ class Usuario(Base):
     __tablename__ = 'usuario'
 
     id = Column(Integer, primary_key=True)
-    nome = Column(String(140), unique=False)
-    email = Column(String(256), unique=False)
+    nome = Column(String(140), unique=False, index=True)
+    email = Column(String(256), unique=True, index=True)
     senha = Column(String(256), unique=False)
     cep = Column(String(9), unique=False)
     logradouro = Column(String(256), unique=False)
     bairro = Column(String(256), unique=False)
     cidade = Column(String(256), unique=False)
     estado = Column(String(2), unique=False)
+    # versão do usuario e dos seus históricos, mantida pelos triggers de model/versao.py
+    versao = Column(Integer, nullable=False, server_default="0")
     
     # Definição do relacionamento entre o usuario e o histórico.
     # Essa relação é implicita, não está salva na tabela 'usuario',
     # mas aqui estou deixando para SQLAlchemy a responsabilidade
-    # de reconstruir esse relacionamento.
-    historicos = relationship("Historico", back_populates="usuario_obj")
+    # de reconstruir esse relacionamento. Os históricos de um usuario
+    # removido são apagados pelo ON DELETE CASCADE do banco, sem que o
+    # SQLAlchemy precise carregá-los.
+    historicos = relationship("Historico", back_populates="usuario_obj", passive_deletes=True)
 
 
     def __init__(self, nome: str, email: str, senha: str, cep: str, logradouro: str, bairro: str, cidade: str, estado: str):
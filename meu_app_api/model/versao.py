@@ -0,0 +1,99 @@
+from sqlalchemy import Column, Integer, select, func
+from sqlalchemy.dialects.sqlite import insert
+
+from model import Base
+from model.usuario import Usuario
+
+# Versões dos usuarios e da listagem de usuarios, usadas nos ETags das rotas
+# de consulta. As versões vêm de um único contador por banco, que só cresce:
+# cada usuario inserido, alterado ou com históricos inseridos, alterados ou
+# removidos recebe o próximo valor em 'usuario.versao', e cada usuario
+# inserido, alterado ou removido também o grava como versão da listagem.
+# Assim um par (id, versão) nunca se repete, nem depois que o id de um
+# usuario removido é reaproveitado. O contador é mantido pelos triggers
+# abaixo, inclusive nas inserções em lote e no arquivamento.
+
+
+class Versao(Base):
+    """ Contador de versões do banco, em uma única linha.
+    """
+    __tablename__ = 'versao'
+
+    id = Column(Integer, primary_key=True)
+    # último valor do contador
+    atual = Column(Integer, nullable=False)
+    # valor do contador na última mudança da listagem de usuarios
+    listagem = Column(Integer, nullable=False)
+
+
+# incrementa o contador, criando a linha se preciso
+_INCREMENTA = ("INSERT INTO versao (id, atual, listagem) VALUES (1, 1, 0) "
+               "ON CONFLICT (id) DO UPDATE SET atual = atual + 1; ")
+_INCREMENTA_LISTAGEM = ("INSERT INTO versao (id, atual, listagem) VALUES (1, 1, 1) "
+                        "ON CONFLICT (id) DO UPDATE SET atual = atual + 1, listagem = atual + 1; ")
+_MARCA_USUARIO = "UPDATE usuario SET versao = (SELECT atual FROM versao WHERE id = 1) WHERE id = {0}; "
+
+# colunas de usuario que aparecem nos payloads; a própria 'versao' fica de
+# fora para que a sua atualização pelos triggers não os dispare de novo
+COLUNAS_VERSIONADAS = "nome, email, senha, cep, logradouro, bairro, cidade, estado"
+
+COMANDOS_VERSAO = (
+    "CREATE TRIGGER IF NOT EXISTS versao_usuario_insere AFTER INSERT ON usuario BEGIN "
+    + _INCREMENTA_LISTAGEM + _MARCA_USUARIO.format("new.id") + "END",
+    "CREATE TRIGGER IF NOT EXISTS versao_usuario_atualiza AFTER UPDATE OF " + COLUNAS_VERSIONADAS
+    + " ON usuario BEGIN " + _INCREMENTA_LISTAGEM + _MARCA_USUARIO.format("new.id") + "END",
+    "CREATE TRIGGER IF NOT EXISTS versao_usuario_remove AFTER DELETE ON usuario BEGIN "
+    + _INCREMENTA_LISTAGEM + "END",
+
+    "CREATE TRIGGER IF NOT EXISTS versao_historico_insere AFTER INSERT ON historico BEGIN "
+    + _INCREMENTA + _MARCA_USUARIO.format("new.usuario") + "END",
+    "CREATE TRIGGER IF NOT EXISTS versao_historico_remove AFTER DELETE ON historico BEGIN "
+    + _INCREMENTA + _MARCA_USUARIO.format("old.usuario") + "END",
+    "CREATE TRIGGER IF NOT EXISTS versao_historico_atualiza AFTER UPDATE ON historico BEGIN "
+    + _INCREMENTA + _MARCA_USUARIO.format("old.usuario") + _MARCA_USUARIO.format("new.usuario") + "END",
+)
+
+
+def cria_versao(conn):
+    """ Cria, se ainda não existirem, os triggers das versões.
+
+    Ao contrário dos índices de busca, não é ligada ao create_all: em um
+    banco antigo o create_all roda antes da migração que adiciona a coluna
+    'usuario.versao', e os triggers fariam falhar as migrações anteriores
+    que alteram históricos. Os bancos novos os recebem em inicializa_banco,
+    e os antigos na migração 7.
+    """
+    for comando in COMANDOS_VERSAO:
+        conn.exec_driver_sql(comando)
+
+
+def inicia_versao(conn, base: int):
+    """ Garante que o contador do banco continue acima de 'base'.
+
+    Usada na cópia para outros bancos, com o maior contador dos bancos de
+    origem, para que as versões gravadas na cópia não repitam um ETag já
+    enviado pela origem.
+    """
+    comando = insert(Versao).values(id=1, atual=base, listagem=base)
+    conn.execute(comando.on_conflict_do_update(index_elements=[Versao.id], set_={
+        "atual": func.max(Versao.atual, comando.excluded.atual),
+        "listagem": func.max(Versao.listagem, comando.excluded.listagem)}))
+
+
+def le_versao_atual(session) -> int:
+    """ Retorna o último valor do contador do banco.
+    """
+    return session.execute(select(Versao.atual).where(Versao.id == 1)).scalar() or 0
+
+
+def le_versao_listagem(session) -> int:
+    """ Retorna a versão da listagem de usuarios.
+    """
+    return session.execute(select(Versao.listagem).where(Versao.id == 1)).scalar() or 0
+
+
+def le_versao_usuario(session, nome: str):
+    """ Retorna o id e a versão do primeiro usuario com o nome informado, o
+        mesmo de le_usuario_por_nome, ou None.
+    """
+    return session.execute(select(Usuario.id, Usuario.versao).where(Usuario.nome == nome).limit(1)).first()
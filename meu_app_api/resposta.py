@@ -0,0 +1,93 @@
+from flask import request
+import gzip
+import os
+import zlib
+
+# configuração da compressão das respostas, ajustável por variáveis de
+# ambiente: respostas a partir de COMPRESSAO_MINIMO bytes são enviadas com
+# gzip aos clientes que o aceitam, no nível COMPRESSAO_NIVEL (1 a 9)
+COMPRESSAO = os.environ.get("COMPRESSAO", "1") != "0"
+COMPRESSAO_MINIMO = int(os.environ.get("COMPRESSAO_MINIMO", 1024))
+COMPRESSAO_NIVEL = int(os.environ.get("COMPRESSAO_NIVEL", 6))
+
+if not 1 <= COMPRESSAO_NIVEL <= 9:
+    raise ValueError("COMPRESSAO_NIVEL inválido: %d" % COMPRESSAO_NIVEL)
+
+
+def le_campos(texto, permitidos):
+    """ Lê o parâmetro 'fields', nomes de campos separados por vírgula, em
+        uma tupla ordenada, ou None sem o parâmetro.
+
+    Um campo fora de 'permitidos' levanta ValueError.
+    """
+    if texto is None:
+        return None
+    campos = {campo.strip() for campo in texto.split(",") if campo.strip()}
+    invalidos = campos - set(permitidos)
+    if invalidos:
+        raise ValueError("Campos inválidos: %s. Use %s." % (", ".join(sorted(invalidos)), ", ".join(permitidos)))
+    return tuple(sorted(campos))
+
+
+def filtra_campos(payload: dict, campos) -> dict:
+    """ Retorna o payload só com os campos pedidos, ou inteiro sem 'campos'.
+    """
+    if campos is None:
+        return payload
+    return {campo: valor for campo, valor in payload.items() if campo in campos}
+
+
+def etag_versao(tipo: str, versoes, *variante) -> str:
+    """ Monta o ETag de um recurso a partir das suas versões.
+
+    A 'variante' (filtros, paginação e campos) entra como um hash, para que
+    cada representação do mesmo recurso tenha o seu ETag.
+    """
+    if isinstance(versoes, int):
+        versoes = (versoes,)
+    return "%s-%s-%08x" % (tipo, ".".join(str(v) for v in versoes), zlib.crc32(repr(variante).encode()))
+
+
+def cabecalhos_etag(etag: str) -> dict:
+    """ Cabeçalhos das respostas com ETag.
+
+    O ETag é fraco porque o mesmo payload pode ser enviado comprimido ou
+    não, e o no-cache pede que o cliente revalide a cada uso.
+    """
+    return {"ETag": 'W/"%s"' % etag, "Cache-Control": "no-cache"}
+
+
+def nao_modificado(etag: str) -> bool:
+    """ Indica se o If-None-Match da requisição já tem o ETag informado.
+    """
+    return request.if_none_match.contains_weak(etag)
+
+
+def resposta_nao_modificada(etag: str):
+    """ Resposta 304, sem corpo, para o cliente reaproveitar a sua cópia.
+    """
+    return "", 304, cabecalhos_etag(etag)
+
+
+def _comprime(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 206, 304)
+            or response.status_code < 200 or "Content-Encoding" in response.headers):
+        return response
+    dados = response.get_data()
+    if len(dados) < COMPRESSAO_MINIMO:
+        return response
+    response.vary.add("Accept-Encoding")
+    if request.accept_encodings["gzip"]:
+        response.set_data(gzip.compress(dados, COMPRESSAO_NIVEL))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def comprime_respostas(app):
+    """ Registra no app a compressão das respostas, se COMPRESSAO.
+
+    Só as respostas montadas inteiras na memória são comprimidas; as
+    enviadas em streaming e os arquivos seguem como estão.
+    """
+    if COMPRESSAO:
+        app.after_request(_comprime)
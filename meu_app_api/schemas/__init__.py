@@ -1,5 +1,11 @@
 from schemas.historico import HistoricoSchema
 from schemas.usuario import UsuarioSchema, UsuarioBuscaSchema, UsuarioViewSchema, \
                             ListagemUsuarioSchema, UsuarioDelSchema, UsuarioBuscaExclusaoSchema, \
-                            apresenta_usuarios, apresenta_usuario, apresenta_usuarios
+                            UsuarioListagemBuscaSchema, apresenta_usuarios, apresenta_usuario, \
+                            apresenta_usuario_listagem, CAMPOS_USUARIO_LISTAGEM, CAMPOS_USUARIO_VIEW
+from schemas.estatisticas import EstatisticaBuscaSchema, ListagemEstatisticaSchema, \
+                                apresenta_estatisticas
+from schemas.ranking import RankingBuscaSchema, RankingViewSchema, apresenta_ranking, apresenta_posicao
+from schemas.busca import BuscaSchema, BuscaUsuarioViewSchema, BuscaCategoriaViewSchema, \
+                          apresenta_busca_usuarios, apresenta_busca_categorias
 from schemas.error import ErrorSchema
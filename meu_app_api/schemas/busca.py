@@ -0,0 +1,76 @@
+from pydantic import BaseModel
+from typing import List, Optional
+
+from model.busca import UsuarioEncontrado, CategoriaEncontrada
+
+
+class BuscaSchema(BaseModel):
+    """ Define como deve ser a estrutura que representa uma busca textual.
+        O termo é procurado em qualquer posição do texto e tolera erros de
+        digitação; termos com menos de 3 caracteres buscam apenas pelo início.
+        A busca não distingue maiúsculas de minúsculas.
+    """
+    q: str
+    limit: Optional[int] = None
+    offset: Optional[int] = 0
+
+
+class UsuarioEncontradoSchema(BaseModel):
+    """ Define como um usuário encontrado pela busca será representado.
+    """
+    id: int
+    nome: str
+    email: str
+
+
+class BuscaUsuarioViewSchema(BaseModel):
+    """ Define como o resultado da busca de usuários será retornado, em ordem
+        de relevância. 'next_offset' é nulo na última página. 'truncado'
+        indica que o termo é comum demais e a ordenação considerou só os
+        primeiros candidatos de cada índice, ou que a paginação chegou ao
+        limite de candidatos; um termo mais longo traz os demais.
+    """
+    usuarios: List[UsuarioEncontradoSchema]
+    next_offset: Optional[int]
+    truncado: bool
+
+
+class CategoriaEncontradaSchema(BaseModel):
+    """ Define como uma categoria encontrada pela busca será representada.
+    """
+    categoria: str
+    historicos: int
+
+
+class BuscaCategoriaViewSchema(BaseModel):
+    """ Define como o resultado da busca de categorias será retornado, em
+        ordem de relevância. 'next_offset' é nulo na última página.
+        'truncado' tem o mesmo sentido da busca de usuários.
+    """
+    categorias: List[CategoriaEncontradaSchema]
+    next_offset: Optional[int]
+    truncado: bool
+
+
+def apresenta_busca_usuarios(usuarios: List[UsuarioEncontrado], next_offset: Optional[int] = None,
+                             truncado: bool = False):
+    """ Retorna uma representação da busca de usuários seguindo o schema
+        definido em BuscaUsuarioViewSchema.
+    """
+    return {
+        "usuarios": [{"id": u.id, "nome": u.nome, "email": u.email} for u in usuarios],
+        "next_offset": next_offset,
+        "truncado": truncado
+    }
+
+
+def apresenta_busca_categorias(categorias: List[CategoriaEncontrada], next_offset: Optional[int] = None,
+                               truncado: bool = False):
+    """ Retorna uma representação da busca de categorias seguindo o schema
+        definido em BuscaCategoriaViewSchema.
+    """
+    return {
+        "categorias": [{"categoria": c.nome, "historicos": c.historicos} for c in categorias],
+        "next_offset": next_offset,
+        "truncado": truncado
+    }
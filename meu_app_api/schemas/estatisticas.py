@@ -0,0 +1,36 @@
+from pydantic import BaseModel
+from typing import List, Optional
+
+
+class EstatisticaBuscaSchema(BaseModel):
+    """ Define como deve ser a estrutura que representa a busca de estatísticas.
+        Sem categoria, são retornadas as estatísticas de todas as categorias.
+    """
+    categoria: Optional[str] = None
+
+
+class EstatisticaCategoriaSchema(BaseModel):
+    """ Define como as estatísticas de pontuação de uma categoria serão
+        representadas. Os valores são percentuais de acerto (0 a 100) e o
+        histograma conta os históricos em faixas de 10 pontos.
+    """
+    categoria: str
+    quantidade: int
+    media: float
+    mediana: float
+    p90: float
+    desvio_padrao: float
+    histograma: List[int]
+
+
+class ListagemEstatisticaSchema(BaseModel):
+    """ Define como a listagem de estatísticas por categoria será retornada.
+    """
+    categorias: List[EstatisticaCategoriaSchema]
+
+
+def apresenta_estatisticas(estatisticas: List[dict]):
+    """ Retorna uma representação das estatísticas seguindo o schema definido em
+        ListagemEstatisticaSchema.
+    """
+    return {"categorias": estatisticas}
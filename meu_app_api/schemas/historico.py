@@ -1,6 +1,9 @@
 from pydantic import BaseModel
-from typing import List
+from datetime import date, datetime
+from typing import List, Optional, Union
 from model.historico import Historico
+from model.leitura import HistoricoLeitura
+from model.serie import PontoSerie
 
 class HistoricoSchema(BaseModel):
     """ Define como um novo histórico a ser inserido deve ser representado
@@ -10,6 +13,28 @@ class HistoricoSchema(BaseModel):
     score: str 
     data: str 
     
+class HistoricoLoteSchema(BaseModel):
+    """ Define como um lote de históricos a ser inserido deve ser representado
+    """
+    historicos: List[HistoricoSchema]
+
+
+class HistoricoLoteResultadoSchema(BaseModel):
+    """ Define como o resultado de cada registro de um lote será representado.
+        O status é 'inserido', 'invalido' ou 'usuario_nao_encontrado'.
+    """
+    indice: int
+    status: str
+    mesage: Optional[str]
+
+
+class HistoricoLoteViewSchema(BaseModel):
+    """ Define como o resultado da inserção de um lote será retornado
+    """
+    inseridos: int
+    resultados: List[HistoricoLoteResultadoSchema]
+
+
 class CategoriaSchema(BaseModel):
     """ Define como um novo registro de categoria a ser inserido deve ser representado
     """
@@ -22,18 +47,85 @@ class CategoriaBuscaHistoricoSchema(BaseModel):
         feita apenas com base na categoria do registro de histórico.
     """
     categoria: str
+
+
+class SerieBuscaSchema(BaseModel):
+    """ Define como deve ser a estrutura que representa a busca da série de
+        históricos. Sem datas, a série cobre os últimos 90 dias; o intervalo
+        é 'dia' ou 'semana'.
+    """
+    categoria: Optional[str] = None
+    inicio: Optional[date] = None
+    fim: Optional[date] = None
+    intervalo: Optional[str] = "dia"
+
+
+class ExportacaoBuscaSchema(BaseModel):
+    """ Define como deve ser a estrutura que representa a exportação de
+        históricos. O formato é 'csv' ou 'colunar', a compressão 'zlib' vale
+        só para o colunar e o período é [inicio, fim). Com historico_completo
+        os históricos arquivados também são exportados.
+    """
+    formato: Optional[str] = "csv"
+    categoria: Optional[str] = None
+    inicio: Optional[datetime] = None
+    fim: Optional[datetime] = None
+    compressao: Optional[str] = None
+    historico_completo: Optional[bool] = False
+
+
+class PontoSerieSchema(BaseModel):
+    """ Define como os totais de uma categoria em um período serão
+        representados. A média é o percentual de acerto (0 a 100).
+    """
+    categoria: str
+    periodo: date
+    quantidade: int
+    media: Optional[float]
+
+
+class SerieViewSchema(BaseModel):
+    """ Define como a série de históricos será retornada
+    """
+    intervalo: str
+    inicio: date
+    fim: date
+    serie: List[PontoSerieSchema]
+
     
-def apresenta_historico(historico: Historico):
+def apresenta_historico(historico: Union[Historico, HistoricoLeitura]):
     """ Retorna uma representação do registro de histórico seguindo o schema definido.
+        Aceita a entidade do ORM ou o registro da camada de leitura.
     """
     return {
         "id": historico.id,
         "categoria": historico.categoria,
         "score": historico.score,
         "data": historico.data_insercao,
-        "nome": historico.usuario_obj.nome  
+        "nome": historico.nome_usuario
     }
 
 
-def apresenta_historicos(historicos: List[Historico]):
+def apresenta_historicos(historicos: List[Union[Historico, HistoricoLeitura]]):
     return [apresenta_historico(historico) for historico in historicos]
+
+
+def apresenta_resultado_lote(resultados: List[dict]):
+    """ Retorna uma representação do resultado da inserção de um lote seguindo o
+        schema definido em HistoricoLoteViewSchema.
+    """
+    inseridos = sum(1 for resultado in resultados if resultado["status"] == "inserido")
+    return {"inseridos": inseridos, "resultados": resultados}
+
+
+def apresenta_serie(intervalo: str, inicio: date, fim: date, pontos: List[PontoSerie]):
+    """ Retorna uma representação da série de históricos seguindo o schema
+        definido em SerieViewSchema.
+    """
+    return {
+        "intervalo": intervalo,
+        "inicio": inicio.isoformat(),
+        "fim": fim.isoformat(),
+        "serie": [{"categoria": ponto.categoria, "periodo": ponto.inicio.isoformat(),
+                   "quantidade": ponto.quantidade, "media": ponto.media} for ponto in pontos]
+    }
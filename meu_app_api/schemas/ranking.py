@@ -0,0 +1,64 @@
+from pydantic import BaseModel
+from typing import List, Optional, Tuple
+
+from model.ranking import Ranking
+
+
+class RankingBuscaSchema(BaseModel):
+    """ Define como deve ser a estrutura que representa a busca do ranking de
+        uma categoria. Com 'usuario_id', a posição desse usuário também é
+        retornada.
+    """
+    categoria: str
+    limite: Optional[int] = 10
+    usuario_id: Optional[int] = None
+
+
+class RankingPosicaoSchema(BaseModel):
+    """ Define como uma posição do ranking será representada. As pontuações
+        são percentuais de acerto (0 a 100).
+    """
+    posicao: int
+    usuario_id: int
+    nome: Optional[str]
+    melhor_score: float
+    tentativas: int
+    media: float
+
+
+class RankingViewSchema(BaseModel):
+    """ Define como o ranking de uma categoria será retornado.
+    """
+    categoria: str
+    ranking: List[RankingPosicaoSchema]
+    usuario: Optional[RankingPosicaoSchema]
+
+
+def apresenta_posicao(ranking: Ranking, nome: str, posicao: int):
+    """ Retorna uma representação de uma posição do ranking seguindo o schema
+        definido em RankingPosicaoSchema.
+    """
+    return {
+        "posicao": posicao,
+        "usuario_id": ranking.usuario,
+        "nome": nome,
+        "melhor_score": ranking.melhor_score,
+        "tentativas": ranking.tentativas,
+        "media": ranking.media
+    }
+
+
+def apresenta_ranking(categoria: str, linhas: List[Tuple[Ranking, str]], usuario: Optional[dict] = None):
+    """ Retorna uma representação do ranking seguindo o schema definido em
+        RankingViewSchema. As linhas devem vir ordenadas pela pontuação.
+    """
+    resultado = []
+    for indice, (ranking, nome) in enumerate(linhas):
+        # empates dividem a posição do primeiro registro com a mesma pontuação
+        if resultado and ranking.melhor_score == resultado[-1]["melhor_score"]:
+            posicao = resultado[-1]["posicao"]
+        else:
+            posicao = indice + 1
+        resultado.append(apresenta_posicao(ranking, nome, posicao))
+
+    return {"categoria": categoria, "ranking": resultado, "usuario": usuario}
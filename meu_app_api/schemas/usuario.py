@@ -1,6 +1,7 @@
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Union
 from model.usuario import Usuario
+from model.leitura import UsuarioLeitura
 
 from schemas import HistoricoSchema
 from schemas.historico import CategoriaBuscaHistoricoSchema
@@ -21,9 +22,13 @@ class UsuarioSchema(BaseModel):
 
 class UsuarioBuscaSchema(BaseModel):
     """ Define como deve ser a estrutura que representa a busca. Que será
-        feita apenas com base no nome do registro de usuário.
+        feita apenas com base no nome do registro de usuário. Com
+        historico_completo os históricos arquivados também são retornados,
+        e 'fields' escolhe os campos retornados, separados por vírgula.
     """
     nome: str 
+    historico_completo: Optional[bool] = False
+    fields: Optional[str] = None
 
 class UsuarioBuscaLoginSchema(BaseModel):
     """ Define como deve ser a estrutura que representa a busca. Que será
@@ -32,6 +37,21 @@ class UsuarioBuscaLoginSchema(BaseModel):
     email: str 
     senha: str 
         
+class UsuarioBuscaEmailSchema(BaseModel):
+    """ Define como deve ser a estrutura que representa a consulta de
+        disponibilidade de um email para um novo cadastro.
+    """
+    email: str
+
+
+class DisponibilidadeEmailSchema(BaseModel):
+    """ Define como deve ser a estrutura do dado retornado pela consulta de
+        disponibilidade de um email.
+    """
+    email: str
+    disponivel: bool
+
+
 class UsuarioBuscaHistoricoSchema(BaseModel):
     """ Define como deve ser a estrutura que representa a busca. Que será
         feita apenas com base no nome do registro de usuário.
@@ -44,6 +64,42 @@ class UsuarioBuscaExclusaoSchema(BaseModel):
     """
     id: int 
     
+class EnderecoUsuarioSchema(BaseModel):
+    """ Define as colunas de endereço usadas nas operações em lote: como
+        filtro, os usuarios devem ter todos os valores informados, e como
+        valores, são as colunas alteradas.
+    """
+    cep: Optional[str] = None
+    logradouro: Optional[str] = None
+    bairro: Optional[str] = None
+    cidade: Optional[str] = None
+    estado: Optional[str] = None
+
+
+class UsuarioLoteExclusaoSchema(BaseModel):
+    """ Define como deve ser a estrutura que representa a remoção em lote.
+        Os usuarios são escolhidos pelos 'ids' ou pelo 'filtro', com ao
+        menos um campo.
+    """
+    ids: Optional[List[int]] = None
+    filtro: Optional[EnderecoUsuarioSchema] = None
+
+
+class UsuarioLoteAtualizacaoSchema(UsuarioLoteExclusaoSchema):
+    """ Define como deve ser a estrutura que representa a atualização em
+        lote: os usuarios escolhidos recebem os 'valores' informados.
+    """
+    valores: EnderecoUsuarioSchema
+
+
+class UsuarioLoteViewSchema(BaseModel):
+    """ Define como deve ser a estrutura do dado retornado após uma operação
+        em lote.
+    """
+    mesage: str
+    quantidade: int
+
+
 class UsuarioSchemaUpdate(BaseModel):
     """ Define como deve ser a estrutura que representa a busca. Que será
         feita apenas com base no id do registro de usuário.
@@ -56,31 +112,54 @@ class UsuarioSchemaUpdate(BaseModel):
     logradouro:str
     bairro: str
         
+class UsuarioListagemBuscaSchema(BaseModel):
+    """ Define os parâmetros da listagem paginada de usuários. A paginação é
+        feita por cursor: 'after' recebe o 'next_cursor' da página anterior.
+        Com formato 'ndjson' a listagem é enviada em streaming, um usuário
+        por linha. 'fields' escolhe os campos de cada usuário, separados por
+        vírgula. 'limit' deve ser ao menos 1.
+    """
+    limit: Optional[int] = None
+    after: Optional[int] = None
+    formato: Optional[str] = "json"
+    fields: Optional[str] = None
+
+
 class ListagemUsuarioSchema(BaseModel):
     """ Define como uma listagem de registro de usuário será retornada.
     """
     usuarios:List[UsuarioSchema]
+    next_cursor: Optional[int]
+
+
+# campos das representações, na ordem em que são retornados
+CAMPOS_USUARIO_LISTAGEM = ("id", "nome", "email", "senha", "cep", "logradouro", "bairro", "cidade", "estado")
+CAMPOS_USUARIO_VIEW = CAMPOS_USUARIO_LISTAGEM + ("historicos",)
+
+
+def apresenta_usuario_listagem(usuario: Union[Usuario, UsuarioLeitura]):
+    """ Retorna a representação de um usuário dentro da listagem, sem históricos.
+    """
+    return {
+        "id": usuario.id,
+        "nome": usuario.nome,
+        "email": usuario.email,
+        "senha": usuario.senha,
+        "cep": usuario.cep,
+        "logradouro": usuario.logradouro,
+        "bairro": usuario.bairro,
+        "cidade": usuario.cidade,
+        "estado": usuario.estado
+    }
 
 
-def apresenta_usuarios(usuarios: List[Usuario]):
+def apresenta_usuarios(usuarios: List[Union[Usuario, UsuarioLeitura]], next_cursor: Optional[int] = None):
     """ Retorna uma representação do registro de usuário seguindo o schema definido em
-        UsuarioViewSchema.
+        ListagemUsuarioSchema. Aceita entidades do ORM ou registros da camada de leitura.
     """
-    result = []
-    for usuario in usuarios:
-        result.append({
-            "id": usuario.id,
-            "nome": usuario.nome,
-            "email": usuario.email,
-            "senha": usuario.senha,
-            "cep": usuario.cep,
-            "logradouro": usuario.logradouro,
-            "bairro": usuario.bairro,
-            "cidade": usuario.cidade,
-            "estado": usuario.estado            
-        })
+    result = [apresenta_usuario_listagem(usuario) for usuario in usuarios]
 
-    return {"usuarios": result}
+    return {"usuarios": result, "next_cursor": next_cursor}
 
 
 class UsuarioViewSchema(BaseModel):
@@ -115,9 +194,9 @@ class UsuarioDelSchema(BaseModel):
     id: int
    
 
-def apresenta_usuario(usuario: Usuario):
+def apresenta_usuario(usuario: Union[Usuario, UsuarioLeitura]):
     """ Retorna uma representação do registro de usuário seguindo o schema definido em
-        UsuarioViewSchema.
+        UsuarioViewSchema. Aceita a entidade do ORM ou o registro da camada de leitura.
     """
     return {    
         "id": usuario.id,
@@ -140,4 +219,45 @@ def apresenta_login(usuario: Usuario):
     return {    
         "nome": usuario.nome,
         "id": usuario.id
-    }
\ No newline at end of file
+    }
+
+
+def apresenta_credenciais(usuario: Union[Usuario, UsuarioLeitura]):
+    """ Retorna os dados usados na verificação de login, no formato guardado
+        em cache.
+    """
+    return {
+        "nome": usuario.nome,
+        "id": usuario.id,
+        "senha": usuario.senha
+    }
+
+
+def apresenta_login_credenciais(credenciais: dict):
+    """ Retorna a mesma representação de apresenta_login a partir das
+        credenciais guardadas em cache.
+    """
+    return {
+        "nome": credenciais["nome"],
+        "id": credenciais["id"]
+    }
+
+
+def apresenta_disponibilidade(email: str, disponivel: bool):
+    """ Retorna a resposta da consulta de disponibilidade seguindo o schema
+        definido em DisponibilidadeEmailSchema.
+    """
+    return {
+        "email": email,
+        "disponivel": disponivel
+    }
+
+
+def apresenta_lote_usuarios(mensagem: str, quantidade: int):
+    """ Retorna a resposta de uma operação em lote seguindo o schema definido
+        em UsuarioLoteViewSchema.
+    """
+    return {
+        "mesage": mensagem,
+        "quantidade": quantidade
+    }
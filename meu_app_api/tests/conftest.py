@@ -0,0 +1,52 @@
+""" Configuração dos testes da API.
+
+Os testes rodam a partir do diretório da API, com 'python -m pytest', em
+um banco temporário com um único shard e sem o cache, como os scripts de
+verificação do pacote benchmark. O ambiente é preparado antes de importar
+o app, que lê a configuração na importação.
+"""
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import prepara_ambiente, dados_usuario  # noqa: E402
+
+prepara_ambiente("testes_")
+os.environ.setdefault("CACHE_BACKEND", "desligado")
+os.environ["DB_SHARDS"] = "1"
+
+# números dos usuarios sintéticos, únicos em toda a sessão de testes
+NUMEROS = itertools.count()
+
+
+@pytest.fixture(scope="session")
+def app():
+    from app import create_app
+    return create_app()
+
+
+@pytest.fixture
+def cliente(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def cadastra(cliente):
+    """ Retorna a função que cadastra usuarios com nomes únicos no banco
+        compartilhado pelos testes e retorna os seus ids.
+    """
+    def cadastra_usuarios(quantidade: int = 1, **campos):
+        ids = []
+        for _ in range(quantidade):
+            dados = dados_usuario(next(NUMEROS))
+            dados.update(campos)
+            resposta = cliente.post("/usuario", json=dados)
+            assert resposta.status_code == 200, resposta.json
+            ids.append(resposta.json["usuario"]["id"])
+        return ids
+
+    return cadastra_usuarios
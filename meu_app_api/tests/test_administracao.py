@@ -0,0 +1,43 @@
+""" Testes das operações em lote de usuarios.
+"""
+from model import FiltroUsuarios, em_transacao, obtem_engine, remove_usuarios, atualiza_usuarios
+
+
+def test_remove_com_ids_ausentes_no_primeiro_lote(cliente, cadastra):
+    ausentes = cadastra(3)
+    ids = cadastra(7)
+    # os três menores ids já foram removidos e formam o primeiro lote inteiro
+    assert cliente.delete("/usuarios/batch", json={"ids": ausentes}).json["quantidade"] == 3
+    filtro = FiltroUsuarios(ids=tuple(ausentes + ids))
+    lotes = list(remove_usuarios(em_transacao(obtem_engine()), filtro, lote=3, pausa_ms=0))
+    assert sorted(usuario[0] for lote in lotes for usuario in lote.usuarios) == ids
+    assert sum(lote.quantidade for lote in lotes) == 7
+
+
+def test_atualiza_com_lote_fora_dos_campos(cadastra):
+    fora = cadastra(3, estado="SP")
+    dentro = cadastra(4, estado="MG")
+    filtro = FiltroUsuarios(ids=tuple(fora + dentro), campos=(("estado", "MG"),))
+    lotes = list(atualiza_usuarios(em_transacao(obtem_engine()), filtro, {"cidade": "Belo Horizonte"}, lote=3,
+                                   pausa_ms=0))
+    assert sorted(usuario[0] for lote in lotes for usuario in lote.usuarios) == dentro
+
+
+def test_remove_pela_rota_com_ids_ausentes(cliente, cadastra):
+    ausentes = cadastra(3)
+    ids = cadastra(3)
+    cliente.delete("/usuarios/batch", json={"ids": ausentes})
+    # mais ids ausentes que um lote, todos antes dos existentes
+    resposta = cliente.delete("/usuarios/batch", json={"ids": list(range(-600, 0)) + ausentes + ids})
+    assert resposta.status_code == 200
+    assert resposta.json["quantidade"] == 3
+    # removidos de fato: uma segunda remoção não encontra ninguém
+    assert cliente.delete("/usuarios/batch", json={"ids": ids}).json["quantidade"] == 0
+
+
+def test_atualiza_sem_ids_percorre_todos_os_lotes(cadastra):
+    ids = cadastra(5, bairro="Lote sem ids")
+    filtro = FiltroUsuarios(campos=(("bairro", "Lote sem ids"),))
+    lotes = list(atualiza_usuarios(em_transacao(obtem_engine()), filtro, {"cep": "30000-000"}, lote=2, pausa_ms=0))
+    assert [len(lote.usuarios) for lote in lotes] == [2, 2, 1]
+    assert sorted(usuario[0] for lote in lotes for usuario in lote.usuarios) == ids
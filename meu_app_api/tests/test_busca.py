@@ -0,0 +1,53 @@
+""" Testes da busca textual de usuarios e categorias.
+"""
+import model.busca
+
+
+def cadastra_nomes(cadastra, *nomes):
+    for numero, nome in enumerate(nomes):
+        cadastra(nome=nome, email="busca%d_%s@quiz.com" % (numero, nome.lower().replace(" ", "")))
+
+
+def test_termo_curto_nao_distingue_maiusculas(cliente, cadastra):
+    cadastra_nomes(cadastra, "Qz Maiusculo", "qz minusculo")
+    for termo in ("qz", "QZ", "Qz"):
+        nomes = [u["nome"] for u in cliente.get("/busca/usuarios?q=%s" % termo).json["usuarios"]]
+        # na ordem do nome sem distinção de maiúsculas
+        assert nomes == ["Qz Maiusculo", "qz minusculo"]
+
+
+def test_prefixo_depois_dos_candidatos_do_indice(cliente, cadastra, monkeypatch):
+    monkeypatch.setattr(model.busca, "CANDIDATOS_BUSCA", 5)
+    # os que só contêm o termo vêm antes no índice de trigramas
+    cadastra_nomes(cadastra, *["contem xwq %d" % i for i in range(8)])
+    cadastra_nomes(cadastra, "Xwq começa")
+    resposta = cliente.get("/busca/usuarios?q=xwq&limit=3").json
+    assert resposta["usuarios"][0]["nome"] == "Xwq começa"
+    assert resposta["truncado"] is True
+
+
+def test_busca_sem_truncar(cliente, cadastra):
+    cadastra_nomes(cadastra, "unico kvj")
+    resposta = cliente.get("/busca/usuarios?q=kvj").json
+    assert [u["nome"] for u in resposta["usuarios"]] == ["unico kvj"]
+    assert resposta["truncado"] is False
+    assert resposta["next_offset"] is None
+
+
+def test_paginacao_para_no_limite_de_candidatos(cliente, cadastra, monkeypatch):
+    import app as modulo_app
+
+    monkeypatch.setattr(modulo_app, "CANDIDATOS_BUSCA", 2)
+    cadastra_nomes(cadastra, *["pagina jqp %d" % i for i in range(5)])
+    resposta = cliente.get("/busca/usuarios?q=jqp&limit=1&offset=2").json
+    assert len(resposta["usuarios"]) == 1
+    assert resposta["next_offset"] is None
+    assert resposta["truncado"] is True
+
+
+def test_categoria_curta_nao_distingue_maiusculas(cliente, cadastra):
+    usuario_id, = cadastra()
+    for categoria in ("Wy Historia", "wy geografia"):
+        cliente.post("/historico", json={"user": usuario_id, "category": categoria, "score": "1/2"})
+    nomes = [c["categoria"] for c in cliente.get("/busca/categorias?q=WY").json["categorias"]]
+    assert sorted(nomes) == ["Wy Historia", "wy geografia"]
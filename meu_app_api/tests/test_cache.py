@@ -0,0 +1,68 @@
+""" Testes do cache de usuarios.
+"""
+import pytest
+
+from cache import CacheMemoria, CacheSQLite, chave_usuario_nome
+
+
+@pytest.fixture(params=["memoria", "sqlite"])
+def novo_cache(request, tmp_path):
+    def cria(tamanho=16):
+        if request.param == "memoria":
+            return CacheMemoria(tamanho, 60)
+        return CacheSQLite(str(tmp_path / "cache.sqlite3"), tamanho, 60)
+    return cria
+
+
+def test_set_descarta_payload_invalidado_durante_a_leitura(novo_cache):
+    cache = novo_cache()
+    geracao = cache.geracao("a")
+    # a escrita termina e invalida a chave enquanto a leitura consultava o banco
+    cache.invalida("a")
+    cache.set("a", "antigo", geracao)
+    assert cache.get("a") is None
+
+    cache.set("a", "novo", cache.geracao("a"))
+    assert cache.get("a") == "novo"
+
+
+def test_invalidacao_de_outra_chave_nao_descarta_o_set(novo_cache):
+    cache = novo_cache()
+    geracao = cache.geracao("a")
+    cache.invalida("b")
+    cache.set("a", "valor", geracao)
+    assert cache.get("a") == "valor"
+
+
+def test_geracoes_descartadas_valem_para_todas_as_chaves(novo_cache):
+    cache = novo_cache(tamanho=2)
+    geracao = cache.geracao("a")
+    cache.invalida("a")
+    # 'a' sai das gerações guardadas, mas o set antigo continua descartado
+    cache.invalida("b", "c", "d")
+    cache.set("a", "antigo", geracao)
+    assert cache.get("a") is None
+
+
+def test_leitura_concorrente_com_escrita_nao_volta_ao_cache(cliente, cadastra, monkeypatch):
+    import app as modulo_app
+
+    cache = CacheMemoria(16, 60)
+    monkeypatch.setattr(modulo_app, "cache", cache)
+    nome = "concorrente_cache"
+    cadastra(nome=nome, email="%s@quiz.com" % nome)
+    le_usuario = modulo_app.le_usuario_por_nome
+
+    def le_e_invalida(*args, **kwargs):
+        usuario = le_usuario(*args, **kwargs)
+        # uma escrita no usuario termina depois da leitura e antes do set
+        cache.invalida(chave_usuario_nome(nome))
+        return usuario
+
+    monkeypatch.setattr(modulo_app, "le_usuario_por_nome", le_e_invalida)
+    assert cliente.get("/usuario?nome=%s" % nome).status_code == 200
+    assert cache.get(chave_usuario_nome(nome)) is None
+
+    monkeypatch.setattr(modulo_app, "le_usuario_por_nome", le_usuario)
+    assert cliente.get("/usuario?nome=%s" % nome).status_code == 200
+    assert cache.get(chave_usuario_nome(nome)) is not None
@@ -0,0 +1,39 @@
+""" Testes dos limites de comandos SQL de cada rota.
+
+Os limites são os de benchmark.contagem_consultas, executado em outro
+processo: ele popula um banco próprio, com ids e nomes fixos, que não pode
+ser o banco compartilhado pelos outros testes.
+"""
+import subprocess
+import sys
+
+import pytest
+
+from benchmark import DIR_API
+from benchmark.contagem_consultas import ROTAS, REVALIDACOES, EMAILS_DESCONHECIDOS
+
+
+@pytest.fixture(scope="module")
+def resultados():
+    """ Executa a verificação e retorna, por rota, a linha do resultado e
+        os comandos impressos quando ela falha.
+    """
+    processo = subprocess.run([sys.executable, "-m", "benchmark.contagem_consultas"], cwd=DIR_API,
+                              capture_output=True, text=True, timeout=300)
+    resultados = {}
+    rota = None
+    for linha in processo.stdout.splitlines():
+        if " status=" in linha:
+            rota = linha.split(" status=")[0].strip()
+            resultados[rota] = [linha]
+        elif linha.startswith("    ") and rota is not None:
+            resultados[rota].append(linha)
+    assert resultados, processo.stderr
+    return resultados
+
+
+@pytest.mark.parametrize("rota", list(ROTAS) + list(REVALIDACOES) + list(EMAILS_DESCONHECIDOS))
+def test_comandos_dentro_do_limite(resultados, rota):
+    assert rota in resultados, "rota não verificada"
+    linhas = resultados[rota]
+    assert linhas[0].endswith(" ok"), "\n".join(linhas)
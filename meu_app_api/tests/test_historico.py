@@ -0,0 +1,62 @@
+""" Testes da pontuação dos históricos.
+"""
+import pytest
+from sqlalchemy import text
+
+from model import cria_engine, inicializa_banco, interpreta_score, reconstroi_ranking
+from model.migracao import aplica_migracoes, marca_versao
+
+
+@pytest.mark.parametrize("score, esperado", [
+    ("7/10", (7, 10)),
+    ("0/5", (0, 5)),
+    ("10/10", (10, 10)),
+    ("11/10", (None, None)),
+    ("-3/5", (None, None)),
+    (" 7 / 10", (None, None)),
+    ("+7/10", (None, None)),
+    ("1_0/10", (None, None)),
+    ("3/0", (None, None)),
+    ("3/4/5", (None, None)),
+    ("", (None, None)),
+    (None, (None, None)),
+])
+def test_interpreta_score(score, esperado):
+    assert interpreta_score(score) == esperado
+
+
+def test_score_acima_do_total_fica_fora_do_ranking(cliente, cadastra):
+    usuario_id, = cadastra()
+    categoria = "categoria_score_%d" % usuario_id
+    resposta = cliente.post("/historico", json={"user": usuario_id, "category": categoria, "score": "11/10"})
+    assert resposta.status_code == 200
+    assert cliente.get("/ranking?categoria=%s" % categoria).status_code == 404
+
+    cliente.post("/historico", json={"user": usuario_id, "category": categoria, "score": "7/10"})
+    ranking = cliente.get("/ranking?categoria=%s&usuario_id=%d" % (categoria, usuario_id)).json
+    assert ranking["usuario"]["melhor_score"] == 70
+
+
+def test_migracao_descarta_scores_fora_do_intervalo(tmp_path):
+    engine = cria_engine("sqlite:///%s" % (tmp_path / "db.sqlite3"))
+    inicializa_banco(engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO usuario (id, nome, email) VALUES (1, 'ana', 'ana@quiz.com')"))
+        # gravados pelo interpreta_score anterior, que aceitava qualquer inteiro
+        conn.execute(text("INSERT INTO historico (categoria, score, acertos, total, data_insercao, usuario) "
+                          "VALUES ('c', :score, :acertos, :total, '2023-01-01 00:00:00.000000', 1)"),
+                     [{"score": "11/10", "acertos": 11, "total": 10},
+                      {"score": "-3/5", "acertos": -3, "total": 5},
+                      {"score": "4/5", "acertos": 4, "total": 5}])
+        reconstroi_ranking(conn)
+        marca_versao(conn, 10)
+
+    assert 11 in aplica_migracoes(engine)
+    with engine.connect() as conn:
+        pontuados = conn.execute(text("SELECT score FROM historico WHERE acertos IS NOT NULL")).scalars().all()
+        melhor = conn.execute(text("SELECT melhor_score FROM ranking WHERE usuario = 1")).scalar()
+        media = conn.execute(text("SELECT soma_percentual / pontuados FROM historico_diario")).scalar()
+    engine.dispose()
+    assert pontuados == ["4/5"]
+    assert melhor == 80
+    assert media == 80
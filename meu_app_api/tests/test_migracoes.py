@@ -0,0 +1,13 @@
+""" Teste da atualização de um banco criado pela primeira versão da API.
+"""
+import subprocess
+import sys
+
+from benchmark import DIR_API
+
+
+def test_banco_original_e_migrado():
+    # em outro processo, pois o app é iniciado sobre um banco próprio
+    processo = subprocess.run([sys.executable, "-m", "benchmark.migracoes"], cwd=DIR_API,
+                              capture_output=True, text=True, timeout=300)
+    assert processo.returncode == 0, processo.stdout + processo.stderr
@@ -0,0 +1,27 @@
+""" Testes da listagem de usuarios.
+"""
+import json
+
+import pytest
+
+
+@pytest.mark.parametrize("formato", ["json", "ndjson"])
+@pytest.mark.parametrize("limit", [0, -1, -2])
+def test_listagem_recusa_limite_menor_que_um(cliente, formato, limit):
+    resposta = cliente.get("/usuarios?formato=%s&limit=%d" % (formato, limit))
+    assert resposta.status_code == 400
+
+
+def test_listagem_pagina_pelo_limite(cliente, cadastra):
+    cadastra(3)
+    resposta = cliente.get("/usuarios?limit=2")
+    assert resposta.status_code == 200
+    assert len(resposta.json["usuarios"]) == 2
+    assert resposta.json["next_cursor"] is not None
+
+
+def test_listagem_ndjson_respeita_o_limite(cliente, cadastra):
+    cadastra(3)
+    resposta = cliente.get("/usuarios?formato=ndjson&limit=2")
+    assert resposta.status_code == 200
+    assert len([json.loads(linha) for linha in resposta.get_data(as_text=True).splitlines()]) == 2